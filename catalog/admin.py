@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.contrib import messages
 from django import forms
-from django.utils.html import format_html
+from django.utils.html import format_html, format_html_join
 from django.http import HttpResponse
 from django.db.models import Q
 from mptt.admin import DraggableMPTTAdmin
@@ -11,7 +11,7 @@ from import_export.widgets import ForeignKeyWidget
 import csv
 from .models import (
     Category, Product, ProductImage, Brand, ImportLog, OneCExchangeLog, 
-    FarpostAPISettings, Promotion, ProductCharacteristic, SyncLog
+    FarpostAPISettings, Promotion, ProductCharacteristic, SyncLog, ExchangeJob, ExchangeFile
 )
 
 
@@ -296,6 +296,8 @@ class CategoryAdmin(DraggableMPTTAdmin):
     """Админка для категорий."""
     list_display = ['tree_actions', 'indented_title', 'slug', 'has_keywords', 'product_count', 'is_active', 'order']
     list_display_links = ['indented_title']
+    list_select_related = ['counts']
+    change_list_template = 'admin/catalog/category_changelist.html'
     list_editable = ['is_active', 'order']
     list_filter = ['is_active', 'level']
     search_fields = ['name', 'slug', 'keywords']
@@ -365,6 +367,39 @@ class CategoryAdmin(DraggableMPTTAdmin):
             Category.objects.rebuild()
         return response
 
+    def get_urls(self):
+        """Добавляет URL принудительной синхронизации подкатегорий."""
+        from django.urls import path
+        urls = super().get_urls()
+        custom_urls = [
+            path(
+                'sync-keywords/',
+                self.admin_site.admin_view(self.sync_keywords_view),
+                name='catalog_category_sync_keywords',
+            ),
+        ]
+        return custom_urls + urls
+
+    def sync_keywords_view(self, request):
+        """
+        Принудительная синхронизация подкатегорий по ключевым словам.
+
+        Обмен запускает ее сам только при изменении отпечатка keywords категорий.
+        """
+        from catalog.services import sync_all_subcategories_from_keywords
+        from django.shortcuts import redirect
+
+        if request.method != 'POST':
+            return redirect('admin:catalog_category_changelist')
+        totals = sync_all_subcategories_from_keywords(root_only=True, deactivate_removed=False)
+        self.message_user(
+            request,
+            f'Подкатегории синхронизированы: создано {totals["created"]}, обновлено {totals["updated"]}, '
+            f'отключено {totals["deactivated"]}, перенесено {totals["moved"]}, объединено {totals["merged"]}.',
+            messages.SUCCESS
+        )
+        return redirect('admin:catalog_category_changelist')
+
 
 class PriceFilter(admin.SimpleListFilter):
     """Фильтр по наличию цены."""
@@ -575,7 +610,7 @@ class ProductAdmin(ImportExportModelAdmin, FarpostExportMixin, admin.ModelAdmin)
         # ВАЖНО: Оптимизируем запросы для производительности
         # Используем только необходимые select_related и prefetch_related
         # Не загружаем images для списка (только при необходимости)
-        qs = qs.select_related('category')
+        qs = qs.select_related('category', 'main_image')
         # Избегаем prefetch_related('images') для списка - это замедляет загрузку
         # Images будут загружены только при просмотре конкретного товара
         return qs
@@ -1798,6 +1833,41 @@ class OneCExchangeLogAdmin(admin.ModelAdmin):
     )
 
 
+@admin.register(ExchangeJob)
+class ExchangeJobAdmin(admin.ModelAdmin):
+    """Админка для очереди фоновой обработки файлов обмена с 1С."""
+    list_display = [
+        'created_at', 'filename', 'status', 'progress', 'checkpoint', 'total',
+        'attempts', 'is_ready', 'started_at', 'finished_at'
+    ]
+    list_filter = ['status', 'is_ready', 'created_at']
+    readonly_fields = [
+        'filename', 'file_path', 'member', 'session', 'is_ready', 'progress', 'checkpoint', 'total',
+        'attempts', 'worker', 'result', 'error', 'created_at', 'updated_at', 'started_at', 'finished_at'
+    ]
+    search_fields = ['filename', 'error']
+    ordering = ['-created_at']
+
+
+@admin.register(ExchangeFile)
+class ExchangeFileAdmin(admin.ModelAdmin):
+    """Админка для реестра файлов обмена с 1С (по хешу содержимого)."""
+    list_display = [
+        'created_at', 'filename', 'kind', 'status', 'size', 'skipped', 'short_hash', 'processed_at'
+    ]
+    list_filter = ['status', 'kind', 'created_at']
+    readonly_fields = [
+        'sha256', 'filename', 'file_path', 'size', 'kind', 'status', 'result', 'skipped',
+        'created_at', 'updated_at', 'processed_at'
+    ]
+    search_fields = ['filename', 'sha256']
+    ordering = ['-created_at']
+
+    def short_hash(self, obj):
+        return obj.sha256[:12]
+    short_hash.short_description = 'SHA-256'
+
+
 # Регистрируем ProductCharacteristic только если таблица существует
 try:
     from django.db import connection
@@ -1831,7 +1901,7 @@ class SyncLogAdmin(admin.ModelAdmin):
     readonly_fields = [
         'operation_type', 'status', 'message', 'processed_count', 'created_count', 
         'updated_count', 'errors_count', 'errors', 'request_ip', 'request_format', 
-        'filename', 'created_at', 'processing_time'
+        'filename', 'created_at', 'processing_time', 'phase_profile_table'
     ]
     ordering = ['-created_at']
     
@@ -1845,6 +1915,9 @@ class SyncLogAdmin(admin.ModelAdmin):
         ('Детали запроса', {
             'fields': ('request_ip', 'request_format', 'filename')
         }),
+        ('Профиль по фазам', {
+            'fields': ('phase_profile_table',)
+        }),
         ('Ошибки', {
             'fields': ('errors',),
             'classes': ('collapse',)
@@ -1855,6 +1928,43 @@ class SyncLogAdmin(admin.ModelAdmin):
         """Запрещаем создание логов вручную."""
         return False
 
+    def phase_profile_table(self, obj):
+        """Таблица фаз обмена: время, доля от общего, SQL-запросы, пик памяти."""
+        profile = obj.phase_profile or {}
+        phases = profile.get('phases') or []
+        if not phases:
+            return '—'
+        total = profile.get('total') or {}
+        total_seconds = total.get('seconds') or 0
+        rows = format_html_join(
+            '',
+            '<tr><td>{}</td><td style="text-align:right">{}</td><td style="text-align:right">{}%</td>'
+            '<td style="text-align:right">{}</td><td style="text-align:right">{}</td>'
+            '<td style="text-align:right">{}</td></tr>',
+            (
+                (
+                    phase.get('label', phase.get('name')),
+                    f"{phase.get('seconds', 0):.2f}",
+                    round(phase.get('seconds', 0) * 100 / total_seconds) if total_seconds else 0,
+                    phase.get('queries', 0),
+                    f"{phase.get('peak_mb', 0):.1f}" if profile.get('memory_traced') else '—',
+                    phase.get('calls', 0),
+                )
+                for phase in phases
+            ),
+        )
+        return format_html(
+            '<table><thead><tr><th>Фаза</th><th>Время, с</th><th>Доля</th><th>SQL-запросов</th>'
+            '<th>Пик памяти, МБ</th><th>Вызовов</th></tr></thead><tbody>{}</tbody>'
+            '<tfoot><tr><th>Итого</th><th style="text-align:right">{}</th><th></th>'
+            '<th style="text-align:right">{}</th><th style="text-align:right">{}</th><th></th></tr></tfoot></table>',
+            rows,
+            f"{total_seconds:.2f}",
+            total.get('queries', 0),
+            f"{total.get('peak_mb', 0):.1f}" if profile.get('memory_traced') else '—',
+        )
+    phase_profile_table.short_description = 'Фазы обмена'
+
 
 from django import forms
 
@@ -14,5 +14,7 @@ urlpatterns = [
     # Новые endpoints для полноценной интеграции
     path('sync/', one_c_views.one_c_api_view, name='sync'),
     path('upload/', one_c_views.file_upload_view, name='upload'),
+    # Только остатки и цены (частые обновления без полного обмена)
+    path('stock/', one_c_views.stock_update_view, name='stock'),
 ]
 
@@ -14,6 +14,8 @@ from django.core.exceptions import ValidationError
 import xml.etree.ElementTree as ET
 
 from .models import Product, ProductImage, OneCExchangeLog
+from .category_counts import safe_recompute_category_counts
+from .counterparts import safe_resolve_retail_counterparts
 
 logger = logging.getLogger(__name__)
 
@@ -430,6 +432,9 @@ def one_c_import(request):
                     error_msg = f'Товар #{idx + 1}: {str(e)}'
                     errors.append(error_msg)
                     logger.error(error_msg, exc_info=True)
+        if created_count or updated_count or hidden_count:
+            safe_recompute_category_counts()
+            safe_resolve_retail_counterparts()
         
         # Время обработки
         processing_time = time.time() - start_time
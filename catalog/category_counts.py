@@ -0,0 +1,175 @@
+"""
+Материализованные счетчики товаров по категориям (CategoryProductCount).
+
+Раньше Category.product_count на каждый показ категории делал get_descendants()
+и COUNT — на странице каталога, главной, подкатегориях и в оптовом каталоге это
+N+1 запросов. Теперь счетчики (видимые в рознице, видимые в опте, опт в наличии;
+прямые и по поддереву) хранятся в таблице и пересчитываются целиком одним
+INSERT ... SELECT с GROUP BY по диапазонам MPTT (tree_id, lft, rght): после
+каждого файла обмена, пакетного импорта API, обновления остатков и перемещения
+категории. Страницы читают их одним запросом.
+
+Одиночные изменения товара (админка, быстрое добавление, поштучные импорты)
+сдвигают счетчики его категории и ее предков на ±1 (сигналы post_save/post_delete
+Product, см. apply_product_count_change), чтобы счетчики не отставали от списков
+до следующего обмена.
+
+Категории без строки (например, созданной в админке после пересчета) вызывают
+пересчет при первом чтении.
+"""
+import logging
+
+from django.db import connection, transaction
+
+from .models import Category, CategoryProductCount, Product
+
+logger = logging.getLogger(__name__)
+
+# Видимость как в Product.for_site_catalog / for_purchase
+_RETAIL_VISIBLE = "p.catalog_type = 'retail' AND p.quantity > 0 AND p.availability = 'in_stock'"
+_WHOLESALE_VISIBLE = "p.catalog_type = 'wholesale'"
+_IN_STOCK = "p.catalog_type = 'wholesale' AND p.quantity > 0 AND p.availability = 'in_stock'"
+
+
+def recompute_category_counts():
+    """Пересчитывает счетчики всех категорий (DELETE + один INSERT ... SELECT). Возвращает число категорий."""
+    qn = connection.ops.quote_name
+    counts_table = qn(CategoryProductCount._meta.db_table)
+    category_table = qn(Category._meta.db_table)
+    product_table = qn(Product._meta.db_table)
+    sql = f"""
+        INSERT INTO {counts_table} (
+            category_id, retail_direct, retail_total, wholesale_direct, wholesale_total,
+            in_stock_direct, in_stock_total, updated_at
+        )
+        SELECT
+            a.id,
+            COALESCE(SUM(CASE WHEN d.id = a.id THEN direct.retail ELSE 0 END), 0),
+            COALESCE(SUM(direct.retail), 0),
+            COALESCE(SUM(CASE WHEN d.id = a.id THEN direct.wholesale ELSE 0 END), 0),
+            COALESCE(SUM(direct.wholesale), 0),
+            COALESCE(SUM(CASE WHEN d.id = a.id THEN direct.in_stock ELSE 0 END), 0),
+            COALESCE(SUM(direct.in_stock), 0),
+            CURRENT_TIMESTAMP
+        FROM {category_table} a
+        JOIN {category_table} d
+            ON d.tree_id = a.tree_id AND d.lft >= a.lft AND d.lft <= a.rght
+        LEFT JOIN (
+            SELECT
+                p.category_id AS category_id,
+                SUM(CASE WHEN {_RETAIL_VISIBLE} THEN 1 ELSE 0 END) AS retail,
+                SUM(CASE WHEN {_WHOLESALE_VISIBLE} THEN 1 ELSE 0 END) AS wholesale,
+                SUM(CASE WHEN {_IN_STOCK} THEN 1 ELSE 0 END) AS in_stock
+            FROM {product_table} p
+            WHERE p.is_active = %s AND p.category_id IS NOT NULL
+            GROUP BY p.category_id
+        ) direct ON direct.category_id = d.id
+        GROUP BY a.id
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {counts_table}')
+        cursor.execute(sql, [True])
+        written = cursor.rowcount
+    logger.info(f"Счетчики товаров пересчитаны для {written} категорий")
+    return written
+
+
+def safe_recompute_category_counts():
+    """recompute_category_counts, который не роняет обмен/импорт (ошибка только в лог)."""
+    try:
+        return recompute_category_counts()
+    except Exception as e:
+        logger.warning(f"Не удалось пересчитать счетчики товаров категорий: {e}", exc_info=True)
+        return 0
+
+
+def category_counts(categories):
+    """
+    {category_id: CategoryProductCount} для категорий (объекты или id) одним запросом.
+
+    Если для какой-то категории строки нет, счетчики пересчитываются и читаются заново.
+    """
+    ids = {getattr(category, 'pk', category) for category in categories}
+    if not ids:
+        return {}
+    counts = CategoryProductCount.objects.in_bulk(list(ids))
+    if len(counts) < len(ids):
+        recompute_category_counts()
+        counts = CategoryProductCount.objects.in_bulk(list(ids))
+    return counts
+
+
+def category_count(category, field='retail_total'):
+    """Один счетчик категории (0, если категории нет)."""
+    counts = category_counts([category]).get(getattr(category, 'pk', category))
+    return getattr(counts, field) if counts is not None else 0
+
+
+def product_visibility(catalog_type, is_active, quantity, availability):
+    """(розница, опт, опт в наличии) — вклад товара в счетчики, как в _RETAIL_VISIBLE и др."""
+    if not is_active:
+        return (0, 0, 0)
+    in_stock = int((quantity or 0) > 0 and availability == 'in_stock')
+    if catalog_type == 'retail':
+        return (in_stock, 0, 0)
+    if catalog_type == 'wholesale':
+        return (0, 1, in_stock)
+    return (0, 0, 0)
+
+
+def _shift(column):
+    # Не уходим ниже нуля, если счетчики уже разошлись с товарами (поля PositiveInteger)
+    return f'{column} = CASE WHEN {column} + %s < 0 THEN 0 ELSE {column} + %s END'
+
+
+def _shift_category(cursor, category_id, delta):
+    qn = connection.ops.quote_name
+    counts_table = qn(CategoryProductCount._meta.db_table)
+    category_table = qn(Category._meta.db_table)
+    columns = ('retail', 'wholesale', 'in_stock')
+    params = [value for value in delta for _ in range(2)]
+    totals = ', '.join(_shift(qn(f'{column}_total')) for column in columns)
+    cursor.execute(
+        f"""
+        UPDATE {counts_table} SET {totals}
+        WHERE category_id IN (
+            SELECT a.id FROM {category_table} a
+            JOIN {category_table} c ON a.tree_id = c.tree_id AND a.lft <= c.lft AND a.rght >= c.rght
+            WHERE c.id = %s
+        )
+        """,
+        params + [category_id],
+    )
+    direct = ', '.join(_shift(qn(f'{column}_direct')) for column in columns)
+    cursor.execute(f'UPDATE {counts_table} SET {direct} WHERE category_id = %s', params + [category_id])
+
+
+def apply_product_count_change(before, after):
+    """
+    Сдвигает счетчики при изменении одного товара.
+
+    before/after — (category_id, (розница, опт, опт в наличии)) до и после изменения
+    или None (товара не было / больше нет). Затрагиваются категория и ее предки:
+    два UPDATE на категорию, только если вклад товара изменился.
+    """
+    changes = {}
+    for state, sign in ((before, -1), (after, 1)):
+        if state is None or state[0] is None:
+            continue
+        category_id, visibility = state
+        current = changes.get(category_id, (0, 0, 0))
+        changes[category_id] = tuple(c + sign * v for c, v in zip(current, visibility))
+    changes = {category_id: delta for category_id, delta in changes.items() if any(delta)}
+    if not changes:
+        return
+    with transaction.atomic(), connection.cursor() as cursor:
+        for category_id, delta in changes.items():
+            _shift_category(cursor, category_id, delta)
+
+
+def safe_apply_product_count_change(before, after):
+    """apply_product_count_change, который не роняет сохранение товара (ошибка только в лог)."""
+    try:
+        apply_product_count_change(before, after)
+    except Exception as e:
+        logger.warning(f"Не удалось обновить счетчики товаров категорий: {e}", exc_info=True)
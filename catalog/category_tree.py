@@ -0,0 +1,169 @@
+"""
+Неизменяемый снимок дерева категорий в памяти процесса.
+
+Разбор пути /a/b/c/ делал запрос Category.objects.get(slug=..., parent=...) на
+каждый сегмент, а хлебные крошки и get_absolute_url товаров — get_ancestors()
+на каждый показ. Снимок загружает все категории одним запросом и отвечает на
+путь → категория, категория → полный путь slug, предков и множества id потомков
+без запросов к БД.
+
+Снимок версионируется счетчиком в кеше Django: Category.save/delete и перенос
+категории увеличивают его (bump_category_tree_version), а при каждом обращении
+сверяется только версия — одно чтение из кеша. Изменения, которые счетчик не
+видит (save в другом процессе при локальном кеше, rebuild MPTT, перенос через
+queryset.update(parent=...)), ловит сигнатура таблицы (количество, последнее
+updated_at, суммы rght и parent_id), которая проверяется не чаще раза в
+CATEGORY_TREE_RECHECK_SECONDS.
+"""
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max, Sum
+
+from .models import Category
+
+CATEGORY_TREE_VERSION_KEY = 'catalog_category_tree_version'
+# Секунд между проверками сигнатуры таблицы категорий в БД
+CATEGORY_TREE_RECHECK_SECONDS = getattr(settings, 'CATEGORY_TREE_RECHECK_SECONDS', 10)
+
+_Node = namedtuple('_Node', ['values', 'parent_id', 'slug', 'is_active', 'path', 'ancestor_ids', 'descendant_ids'])
+
+_lock = threading.Lock()
+_snapshot = None
+_snapshot_version = None
+_snapshot_signature = None
+_checked_at = 0.0
+
+
+class CategoryTree:
+    """Снимок дерева: узлы по id и активные категории по полному пути slug."""
+
+    def __init__(self, rows):
+        self._field_names = [field.attname for field in Category._meta.concrete_fields]
+        by_id = {row['id']: row for row in rows}
+        children = {}
+        for row in sorted(rows, key=lambda row: (row['tree_id'], row['lft'])):
+            children.setdefault(row['parent_id'], []).append(row['id'])
+
+        nodes = {}
+        by_path = {}
+
+        def _build(category_id, parent_path, ancestor_ids, parent_active):
+            row = by_id[category_id]
+            path = f"{parent_path}/{row['slug']}" if parent_path else row['slug']
+            descendant_ids = {category_id}
+            for child_id in children.get(category_id, ()):
+                descendant_ids |= _build(
+                    child_id, path, ancestor_ids + (category_id,), parent_active and row['is_active']
+                )
+            nodes[category_id] = _Node(
+                values=tuple(row[name] for name in self._field_names),
+                parent_id=row['parent_id'],
+                slug=row['slug'],
+                is_active=row['is_active'],
+                path=path,
+                ancestor_ids=ancestor_ids,
+                descendant_ids=frozenset(descendant_ids),
+            )
+            if parent_active and row['is_active']:
+                by_path[path] = category_id
+            return descendant_ids
+
+        # Рекурсивно от корней: глубина дерева категорий небольшая
+        for root_id in children.get(None, ()):
+            _build(root_id, '', (), True)
+        self._nodes = nodes
+        self._by_path = by_path
+
+    def __contains__(self, category_id):
+        return category_id in self._nodes
+
+    def get(self, category_id):
+        """Новый экземпляр Category из снимка (без запроса) или None."""
+        node = self._nodes.get(category_id)
+        if node is None:
+            return None
+        return Category.from_db(Category.objects.db, self._field_names, node.values)
+
+    def resolve_path(self, path):
+        """
+        Активная категория по пути 'a/b/c' (все категории пути активны) или None.
+
+        Как прежний обход Category.objects.get(slug=..., parent=..., is_active=True) по сегментам.
+        """
+        path = '/'.join(part for part in (path or '').split('/') if part)
+        category_id = self._by_path.get(path)
+        return self.get(category_id) if category_id is not None else None
+
+    def slug_path(self, category_id):
+        """Полный путь slug категории 'a/b/c' ('' для неизвестной категории)."""
+        node = self._nodes.get(category_id)
+        return node.path if node is not None else ''
+
+    def ancestor_ids(self, category_id, include_self=False):
+        """id предков от корня (и самой категории при include_self)."""
+        node = self._nodes.get(category_id)
+        if node is None:
+            return ()
+        return node.ancestor_ids + ((category_id,) if include_self else ())
+
+    def ancestors(self, category_id, include_self=False):
+        """Предки от корня как экземпляры Category (как get_ancestors)."""
+        return [self.get(ancestor_id) for ancestor_id in self.ancestor_ids(category_id, include_self)]
+
+    def descendant_ids(self, category_id, include_self=True):
+        """frozenset id потомков (как get_descendants(...).values_list('id'))."""
+        node = self._nodes.get(category_id)
+        if node is None:
+            return frozenset()
+        if include_self:
+            return node.descendant_ids
+        return node.descendant_ids - {category_id}
+
+
+def bump_category_tree_version():
+    """Помечает снимки дерева всех процессов устаревшими (изменилась категория)."""
+    global _snapshot
+    _snapshot = None
+    try:
+        cache.add(CATEGORY_TREE_VERSION_KEY, 0, timeout=None)
+        cache.incr(CATEGORY_TREE_VERSION_KEY)
+    except ValueError:
+        # Ключ вытеснен между add и incr
+        cache.set(CATEGORY_TREE_VERSION_KEY, 1, timeout=None)
+
+
+def _table_signature():
+    return tuple(Category.objects.order_by().aggregate(
+        count=Count('id'), updated=Max('updated_at'), rght=Sum('rght'), parents=Sum('parent_id'),
+    ).values())
+
+
+def category_tree():
+    """Актуальный снимок дерева категорий (пересобирается одним запросом при изменении)."""
+    global _snapshot, _snapshot_version, _snapshot_signature, _checked_at
+    version = cache.get(CATEGORY_TREE_VERSION_KEY, 0)
+    snapshot = _snapshot
+    now = time.monotonic()
+    if snapshot is not None and version == _snapshot_version:
+        if now - _checked_at < CATEGORY_TREE_RECHECK_SECONDS:
+            return snapshot
+        _checked_at = now
+        if _table_signature() == _snapshot_signature:
+            return snapshot
+
+    with _lock:
+        # Пока ждали блокировку, снимок могли пересобрать в другом потоке
+        if _snapshot is not None and _snapshot is not snapshot and version == _snapshot_version:
+            return _snapshot
+        signature = _table_signature()
+        fields = [field.attname for field in Category._meta.concrete_fields]
+        snapshot = CategoryTree(list(Category.objects.order_by().values(*fields)))
+        _snapshot_version = version
+        _snapshot_signature = signature
+        _checked_at = now
+        _snapshot = snapshot
+    return snapshot
@@ -0,0 +1,239 @@
+"""
+Извлечение данных Товар/Предложение CommerceML 2 за один обход поддерева.
+
+Раньше каждое поле искалось отдельным find('.//…') с перебором вариантов
+({namespace}Тег, Тег, catalog:Тег), и одно предложение обходилось десятки раз.
+Здесь поддерево обходится один раз, имена тегов берутся без namespace,
+а что делать с элементом, задает таблица _RULES по паре (родитель, тег).
+Результат — типизированная запись CommerceMLItem; ее используют обмен
+(commerceml_views), сверка offers (offers_parse) и management-команды.
+
+Модуль не зависит от Django: разбор выполняется и в пуле процессов.
+"""
+from __future__ import annotations
+
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Родитель для прямых потомков самого Товар/Предложение в таблице _RULES
+ROOT = ''
+
+
+@dataclass
+class PriceRecord:
+    """Цена предложения: Цены/Цена."""
+    type_id: str = ''
+    value: Optional[float] = None
+    currency: str = ''
+
+
+@dataclass
+class PropertyRecord:
+    """Характеристика (ХарактеристикаТовара) или значение свойства (ЗначенияСвойства).
+
+    None — элемента нет, '' — элемент есть, но пустой.
+    """
+    id: Optional[str] = None
+    name: Optional[str] = None
+    value: Optional[str] = None
+
+
+@dataclass
+class CommerceMLItem:
+    """Данные одного Товар/Предложение."""
+    tag: str = ''
+    id: Optional[str] = None
+    attr_id: Optional[str] = None
+    name: Optional[str] = None
+    article: Optional[str] = None
+    description: Optional[str] = None
+    quantity: Optional[str] = None
+    group_ids: List[str] = field(default_factory=list)
+    prices: List[PriceRecord] = field(default_factory=list)
+    quantities: List[str] = field(default_factory=list)
+    warehouses: List[Tuple[str, str]] = field(default_factory=list)
+    characteristics: List[PropertyRecord] = field(default_factory=list)
+    properties: List[PropertyRecord] = field(default_factory=list)
+
+    def price(self, type_id: str) -> Optional[float]:
+        """Положительная цена типа type_id (последняя в файле) или None."""
+        result = None
+        for price in self.prices:
+            if price.type_id == type_id and price.value is not None and price.value > 0:
+                result = price.value
+        return result
+
+    def stock(self) -> int:
+        """
+        Остаток: сумма всех Количество, а если она не больше нуля — сумма
+        КоличествоНаСкладе по складам.
+        """
+        tag_total = 0
+        tag_found = False
+        for raw in self.quantities:
+            value = parse_quantity(raw)
+            if value is not None:
+                tag_total += value
+                tag_found = True
+        wh_total = 0
+        for _warehouse_id, raw in self.warehouses:
+            value = parse_quantity(raw)
+            if value is not None:
+                wh_total += value
+        if tag_total > 0:
+            return tag_total
+        if wh_total > 0:
+            return wh_total
+        return tag_total if tag_found else wh_total
+
+    def property_pairs(self, characteristics=True, properties=True) -> List[Tuple[str, str]]:
+        """Непустые пары (наименование, значение): сначала характеристики, затем свойства."""
+        sources = []
+        if characteristics:
+            sources.append(self.characteristics)
+        if properties:
+            sources.append(self.properties)
+        return [
+            (prop.name, prop.value)
+            for source in sources
+            for prop in source
+            if prop.name and prop.value
+        ]
+
+
+def local_tag(tag) -> str:
+    """Имя тега без namespace: '{urn:...}Товар' -> 'Товар' ('' для комментариев)."""
+    if not isinstance(tag, str):
+        return ''
+    if tag.startswith('{'):
+        return tag.split('}', 1)[1]
+    return tag
+
+
+def parse_price(text: Optional[str]) -> Optional[float]:
+    """Число из ЦенаЗаЕдиницу ('1 234,50' → 1234.5) или None."""
+    if not text:
+        return None
+    try:
+        return float(text.strip().replace(',', '.').replace(' ', '').replace('\xa0', ''))
+    except (ValueError, TypeError):
+        return None
+
+
+def parse_quantity(text: Optional[str]) -> Optional[int]:
+    """Целое количество из текста ('3,000' → 3) или None."""
+    if not text:
+        return None
+    try:
+        return int(float(str(text).strip().replace(',', '.')))
+    except (ValueError, TypeError):
+        return None
+
+
+def find_elements(root, name: str) -> list:
+    """Все элементы с локальным именем name в дереве (в namespace корня или без него)."""
+    namespace = root.tag[1:root.tag.index('}')] if root.tag.startswith('{') else None
+    found = root.findall(f'.//{{{namespace}}}{name}') if namespace else []
+    return found or root.findall(f'.//{name}')
+
+
+def _text(elem) -> str:
+    return (elem.text or '').strip()
+
+
+def _full_text(elem) -> str:
+    # Значение может содержать вложенные элементы — собираем весь текст
+    return ''.join(elem.itertext()).strip()
+
+
+def _first(attr: str, read=_text) -> Callable:
+    def handler(item, elem):
+        if getattr(item, attr) is None:
+            setattr(item, attr, read(elem))
+    return handler
+
+
+def _append(attr: str, read=_text) -> Callable:
+    def handler(item, elem):
+        getattr(item, attr).append(read(elem))
+    return handler
+
+
+def _begin(attr: str, record: type) -> Callable:
+    def handler(item, elem):
+        getattr(item, attr).append(record())
+    return handler
+
+
+def _first_of_last(attr: str, field_name: str, read=_text) -> Callable:
+    def handler(item, elem):
+        entries = getattr(item, attr)
+        if entries and getattr(entries[-1], field_name) is None:
+            setattr(entries[-1], field_name, read(elem))
+    return handler
+
+
+def _set_price_field(field_name: str, read=_text) -> Callable:
+    def handler(item, elem):
+        if item.prices and not getattr(item.prices[-1], field_name):
+            setattr(item.prices[-1], field_name, read(elem))
+    return handler
+
+
+def _warehouse(item, elem):
+    raw = elem.get('КоличествоНаСкладе') or elem.get('QuantityInStock')
+    if raw:
+        item.warehouses.append((elem.get('ИдСклада', ''), raw))
+
+
+# (родитель, тег) → обработчик элемента; родитель ROOT — прямой потомок Товар/Предложение.
+# Обработчики «начать запись» (Цена, ХарактеристикаТовара, ЗначенияСвойства) добавляют
+# пустую запись, а поля ее потомков заполняют последнюю: обход идет в порядке документа.
+_RULES: Dict[Tuple[str, str], Callable] = {
+    (ROOT, 'Ид'): _first('id'),
+    (ROOT, 'Наименование'): _first('name'),
+    (ROOT, 'Артикул'): _first('article'),
+    (ROOT, 'Описание'): _first('description'),
+    (ROOT, 'Количество'): _first('quantity'),
+    ('Группы', 'Ид'): _append('group_ids'),
+    ('Цены', 'Цена'): _begin('prices', PriceRecord),
+    ('Цена', 'ИдТипаЦены'): _set_price_field('type_id'),
+    ('Цена', 'ЦенаЗаЕдиницу'): _set_price_field('value', lambda elem: parse_price(elem.text)),
+    ('Цена', 'Валюта'): _set_price_field('currency'),
+    ('ХарактеристикиТовара', 'ХарактеристикаТовара'): _begin('characteristics', PropertyRecord),
+    ('ХарактеристикаТовара', 'Ид'): _first_of_last('characteristics', 'id'),
+    ('ХарактеристикаТовара', 'Наименование'): _first_of_last('characteristics', 'name'),
+    ('ХарактеристикаТовара', 'Значение'): _first_of_last('characteristics', 'value', _full_text),
+    ('ЗначенияСвойств', 'ЗначенияСвойства'): _begin('properties', PropertyRecord),
+    ('ЗначенияСвойства', 'Ид'): _first_of_last('properties', 'id'),
+    ('ЗначенияСвойства', 'Наименование'): _first_of_last('properties', 'name'),
+    ('ЗначенияСвойства', 'Значение'): _first_of_last('properties', 'value', _full_text),
+}
+
+# Теги, которые учитываются на любой глубине (после правила из _RULES, если оно есть)
+_ANYWHERE: Dict[str, Callable] = {
+    'Количество': _append('quantities'),
+    'Склад': _warehouse,
+}
+
+
+def extract_commerceml_item(elem) -> CommerceMLItem:
+    """Разбирает элемент Товар/Предложение в CommerceMLItem за один обход поддерева."""
+    attr_id = (elem.get('Ид') or '').strip()
+    item = CommerceMLItem(tag=local_tag(elem.tag), attr_id=attr_id or None)
+    # Обход в глубину в порядке документа: (элемент, локальное имя родителя)
+    stack = [(child, ROOT) for child in reversed(elem)]
+    while stack:
+        node, parent_name = stack.pop()
+        name = local_tag(node.tag)
+        if not name:
+            continue
+        handler = _RULES.get((parent_name, name))
+        if handler is not None:
+            handler(item, node)
+        handler = _ANYWHERE.get(name)
+        if handler is not None:
+            handler(item, node)
+        if len(node):
+            stack.extend((child, name) for child in reversed(node))
+    return item
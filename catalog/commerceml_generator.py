@@ -0,0 +1,227 @@
+"""
+Генератор синтетических пакетов CommerceML 2 (import.xml + offers.xml).
+
+Нужен для воспроизводимых замеров обмена (benchmark_exchange): реальные
+выгрузки 1С большие и содержат данные клиентов, а регрессию скорости надо
+ловить на пакетах 1k/50k/500k предложений. Пакет похож на настоящий:
+классификатор с группами, названия вида «Стартер (DENSO, 28100-0D110, TOYOTA
+COROLLA)», кросс-номера, Двигатель/Кузов/Применимость, обе цены (розница и опт),
+Количество и остатки по складам. При одном и том же seed файлы побайтно совпадают.
+
+Файлы пишутся потоком, весь пакет в памяти не держится. Модуль не зависит от Django.
+"""
+import os
+import random
+import uuid
+from xml.sax.saxutils import escape
+
+from .offers_parse import RETAIL_PRICE_TYPE_ID, WHOLESALE_PRICE_TYPE_ID
+
+COMMERCEML_NAMESPACE = 'urn:1C.ru:commerceml_2'
+
+# Группа классификатора → виды деталей (они же ключевые слова подкатегорий)
+PART_GROUPS = {
+    'Электрика': ['Стартер', 'Генератор', 'Датчик кислорода', 'Реле поворотов', 'Катушка зажигания'],
+    'Двигатель': ['Фильтр масляный', 'Прокладка ГБЦ', 'Ремень ГРМ', 'Помпа', 'Свеча зажигания'],
+    'Подвеска': ['Амортизатор', 'Стойка стабилизатора', 'Шаровая опора', 'Рычаг подвески', 'Сайлентблок'],
+    'Тормозная система': ['Колодки тормозные', 'Диск тормозной', 'Суппорт', 'Шланг тормозной'],
+    'Кузов': ['Фара', 'Зеркало', 'Бампер', 'Решетка радиатора'],
+}
+
+BRANDS = [
+    'DENSO', 'BOSCH', 'NGK', 'AISIN', 'KYB', 'TOKICO', 'SANKEI', '555', 'GATES',
+    'MANN', 'NISSAN', 'TOYOTA', 'HONDA', 'MITSUBISHI', 'DEPO', 'FEBEST',
+]
+
+# (марка, модель, двигатель, кузов)
+CAR_MODELS = [
+    ('TOYOTA', 'COROLLA', '1ZZ-FE', 'ZZE120'),
+    ('TOYOTA', 'CAMRY', '2AZ-FE', 'ACV40'),
+    ('TOYOTA', 'LAND CRUISER PRADO', '1KD-FTV', 'KDJ120'),
+    ('NISSAN', 'X-TRAIL', 'QR25DE', 'T31'),
+    ('NISSAN', 'NOTE', 'HR15DE', 'E11'),
+    ('HONDA', 'FIT', 'L13A', 'GD1'),
+    ('HONDA', 'CR-V', 'K24A', 'RE4'),
+    ('MITSUBISHI', 'OUTLANDER', '4B12', 'CW5W'),
+    ('MAZDA', 'DEMIO', 'ZJ-VE', 'DY3W'),
+    ('SUBARU', 'FORESTER', 'EJ20', 'SG5'),
+]
+
+WAREHOUSES = [
+    ('a0000000-0000-0000-0000-000000000001', 'Основной склад'),
+    ('a0000000-0000-0000-0000-000000000002', 'Склад Артем'),
+]
+
+_ARTICLE_LETTERS = 'ABCDEFGHJKLMNPRSTUVWXYZ'
+
+
+def _uid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128)))
+
+
+def _article(rng):
+    return f'{rng.randint(10000, 99999)}-{rng.choice(_ARTICLE_LETTERS)}{rng.randint(100, 999)}'
+
+
+def _property(name, value):
+    return (
+        f'<ЗначенияСвойства><Наименование>{escape(name)}</Наименование>'
+        f'<Значение>{escape(value)}</Значение></ЗначенияСвойства>'
+    )
+
+
+def _open(root, namespace):
+    xmlns = f' xmlns="{namespace}"' if namespace else ''
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<КоммерческаяИнформация{xmlns} ВерсияСхемы="2.10" ДатаФормирования="2026-01-01T00:00:00">\n'
+        f'<{root}>'
+    )
+
+
+def _classifier_groups():
+    """Группы классификатора: {вид детали: Ид подгруппы} и XML блока Группы."""
+    rng = random.Random('classifier')
+    part_group_ids = {}
+    parts = ['<Группы>']
+    for group_name, part_types in PART_GROUPS.items():
+        parts.append(f'<Группа><Ид>{_uid(rng)}</Ид><Наименование>{escape(group_name)}</Наименование><Группы>')
+        for part_type in part_types:
+            group_id = _uid(rng)
+            part_group_ids[part_type] = group_id
+            parts.append(f'<Группа><Ид>{group_id}</Ид><Наименование>{escape(part_type)}</Наименование></Группа>')
+        parts.append('</Группы></Группа>')
+    parts.append('</Группы>')
+    return part_group_ids, ''.join(parts)
+
+
+def synthetic_items(offers, seed=0):
+    """Описания offers синтетических товаров (словари) — одинаковые при одном seed."""
+    rng = random.Random(seed)
+    part_types = [part for group in PART_GROUPS.values() for part in group]
+    for _ in range(offers):
+        make, model, engine, body = rng.choice(CAR_MODELS)
+        part_type = rng.choice(part_types)
+        brand = rng.choice(BRANDS)
+        article = _article(rng)
+        cross_numbers = [_article(rng) for _ in range(rng.randint(1, 3))]
+        retail = rng.randint(300, 60000)
+        quantities = [rng.choice((0, 0, 1, 2, 3, 5, 10)) for _ in WAREHOUSES]
+        yield {
+            'id': _uid(rng),
+            'part_type': part_type,
+            'brand': brand,
+            'article': article,
+            'cross_numbers': cross_numbers,
+            'number': str(rng.randint(1, 999)) if rng.random() < 0.3 else '',
+            'make': make,
+            'model': model,
+            'engine': engine,
+            'body': body,
+            'retail': retail,
+            'wholesale': round(retail * rng.uniform(0.7, 0.9), 2),
+            'quantities': quantities,
+        }
+
+
+def _import_product(item, group_id):
+    applicability = f"{item['make']} {item['model']}"
+    name = f"{item['part_type']} {item['brand']} {item['article']}"
+    properties = [
+        _property('Артикул1', item['article']),
+        _property('Артикул2', ', '.join(item['cross_numbers'])),
+        _property('Двигатель', item['engine']),
+        _property('Кузов', item['body']),
+        _property('Применимо для моделей', applicability),
+    ]
+    if item['number']:
+        properties.append(_property('Номер', item['number']))
+    return (
+        f"<Товар><Ид>{item['id']}</Ид><Артикул>{escape(item['article'])}</Артикул>"
+        f"<Наименование>{escape(name)}</Наименование>"
+        f"<Группы><Ид>{group_id}</Ид></Группы>"
+        f"<Описание>{escape(name)} для {escape(applicability)}</Описание>"
+        f"<ЗначенияСвойств>{''.join(properties)}</ЗначенияСвойств></Товар>\n"
+    )
+
+
+def _offer(item):
+    applicability = f"{item['make']} {item['model']}"
+    name = f"{item['part_type']} ({item['brand']}, {item['article']}, {applicability})"
+    properties = [
+        _property('Артикул1', item['article']),
+        _property('Артикул2', ', '.join(item['cross_numbers'])),
+        _property('Применимо для моделей', applicability),
+    ]
+    if item['number']:
+        properties.append(_property('Номер', item['number']))
+    warehouses = ''.join(
+        f'<Склад ИдСклада="{warehouse_id}" КоличествоНаСкладе="{quantity}"/>'
+        for (warehouse_id, _name), quantity in zip(WAREHOUSES, item['quantities'])
+    )
+    return (
+        f"<Предложение><Ид>{item['id']}</Ид><Наименование>{escape(name)}</Наименование>"
+        f"<ЗначенияСвойств>{''.join(properties)}</ЗначенияСвойств>"
+        f"<Цены>"
+        f"<Цена><ИдТипаЦены>{RETAIL_PRICE_TYPE_ID}</ИдТипаЦены><ЦенаЗаЕдиницу>{item['retail']}</ЦенаЗаЕдиницу>"
+        f"<Валюта>RUB</Валюта></Цена>"
+        f"<Цена><ИдТипаЦены>{WHOLESALE_PRICE_TYPE_ID}</ИдТипаЦены><ЦенаЗаЕдиницу>{item['wholesale']}</ЦенаЗаЕдиницу>"
+        f"<Валюта>RUB</Валюта></Цена>"
+        f"</Цены>"
+        f"<Количество>{sum(item['quantities'])}</Количество>{warehouses}</Предложение>\n"
+    )
+
+
+def generate_exchange_package(out_dir, offers, seed=0, namespace=COMMERCEML_NAMESPACE):
+    """
+    Пишет в out_dir пару import.xml и offers.xml на offers товаров.
+
+    namespace='' — файлы без xmlns (так выгружают некоторые конфигурации 1С).
+    Возвращает {'import': путь, 'offers': путь, 'offers_count': offers}.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    import_path = os.path.join(out_dir, 'import.xml')
+    offers_path = os.path.join(out_dir, 'offers.xml')
+    part_group_ids, groups_xml = _classifier_groups()
+
+    with open(import_path, 'w', encoding='utf-8') as import_file, \
+            open(offers_path, 'w', encoding='utf-8') as offers_file:
+        import_file.write(_open('Классификатор', namespace))
+        import_file.write('<Ид>synthetic-classifier</Ид><Наименование>Классификатор (синтетический)</Наименование>')
+        import_file.write(groups_xml)
+        import_file.write(
+            '</Классификатор>\n<Каталог СодержитТолькоИзменения="false"><Ид>synthetic-catalog</Ид>'
+            '<ИдКлассификатора>synthetic-classifier</ИдКлассификатора>'
+            '<Наименование>Основной каталог товаров</Наименование><Товары>\n'
+        )
+
+        offers_file.write(_open('ПакетПредложений', namespace))
+        offers_file.write(
+            '<Ид>synthetic-offers</Ид><Наименование>Пакет предложений</Наименование>'
+            '<ИдКаталога>synthetic-catalog</ИдКаталога><ТипыЦен>'
+            f'<ТипЦены><Ид>{RETAIL_PRICE_TYPE_ID}</Ид><Наименование>Розничная</Наименование><Валюта>RUB</Валюта></ТипЦены>'
+            f'<ТипЦены><Ид>{WHOLESALE_PRICE_TYPE_ID}</Ид><Наименование>Оптовая</Наименование><Валюта>RUB</Валюта></ТипЦены>'
+            '</ТипыЦен><Склады>'
+            + ''.join(
+                f'<Склад><Ид>{warehouse_id}</Ид><Наименование>{escape(name)}</Наименование></Склад>'
+                for warehouse_id, name in WAREHOUSES
+            )
+            + '</Склады><Предложения СодержитТолькоИзменения="false">\n'
+        )
+
+        for item in synthetic_items(offers, seed):
+            import_file.write(_import_product(item, part_group_ids[item['part_type']]))
+            offers_file.write(_offer(item))
+
+        import_file.write('</Товары></Каталог>\n</КоммерческаяИнформация>\n')
+        offers_file.write('</Предложения></ПакетПредложений>\n</КоммерческаяИнформация>\n')
+
+    return {'import': import_path, 'offers': offers_path, 'offers_count': offers}
+
+
+def synthetic_category_tree():
+    """Дерево категорий под синтетический пакет: [(корень, [(подкатегория, ключевые слова)])]."""
+    return [
+        (group_name, [(part_type, part_type.lower()) for part_type in part_types])
+        for group_name, part_types in PART_GROUPS.items()
+    ]
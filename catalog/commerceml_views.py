@@ -4,18 +4,19 @@ Views для обработки стандартного протокола Comm
 """
 import os
 import json
+import hashlib
 import logging
 import re
-import time
-import random
+import tempfile
+import zipfile
 import xml.etree.ElementTree as ET
+from contextlib import contextmanager
 from io import BytesIO
 from datetime import datetime
 from django.http import HttpResponse, HttpResponseBadRequest
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
-from django.db import transaction, OperationalError, close_old_connections, ProgrammingError, connections
-from django.db.transaction import TransactionManagementError
+from django.db import transaction
 from django.db.models import Q
 from django.conf import settings
 from django.utils import timezone
@@ -24,6 +25,29 @@ from django.core.files.base import ContentFile
 
 from .models import Product, ProductCharacteristic, Category, SyncLog
 from .serializers import validate_product, SerializerValidationError
+from .exchange_profiler import active_profiler, exchange_phase, profiled_exchange
+from .exchange_jobs import (
+    ASYNC_EXCHANGE, enqueue_exchange_job, find_exchange_job, exchange_job_response_text,
+    record_skipped_exchange_job,
+)
+from .exchange_package import ExchangeFileRef, iter_spooled_records, process_exchange_package, spool_records
+from .exchange_registry import (
+    applied_exchange_file, file_sha256, is_exchange_applied, mark_exchange_skipped,
+    new_exchange_digest, record_exchange_result, register_exchange_file, skipped_exchange_result,
+)
+from .import_writer import ImportTransaction, import_writer, save_in_import
+from .slugs import assign_slugs
+from .category_counts import safe_recompute_category_counts
+from .counterparts import safe_resolve_retail_counterparts
+from .product_images import safe_refresh_missing_main_images
+from .stock_updates import StockFormatError, apply_stock_updates, detect_stock_format, iter_stock_rows, request_stream
+from .product_upsert import (
+    ALWAYS, FILL_NULL, IF_PRESENT, allocate_product_slugs, upsert_products, upsert_supported,
+)
+from .commerceml_extract import extract_commerceml_item, local_tag, parse_quantity
+from .offers_parse import (
+    RETAIL_PRICE_TYPE_ID, WHOLESALE_PRICE_TYPE_ID, offer_number, offer_supplier_article,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -70,66 +94,113 @@ def _clean_offer_product_name(name: str) -> str:
     return s
 
 
-def save_with_retry(instance, update_fields=None, max_retries=5, delay=0.2):
+# Настройки
+EXCHANGE_DIR = getattr(settings, 'ONE_C_EXCHANGE_DIR', os.path.join(settings.MEDIA_ROOT, '1c_exchange'))
+FILE_LIMIT = getattr(settings, 'ONE_C_FILE_LIMIT', 104857600)  # 100 MB по умолчанию
+SUPPORT_ZIP = getattr(settings, 'ONE_C_SUPPORT_ZIP', True)
+
+# Размер куска при потоковой записи файлов обмена на диск
+UPLOAD_CHUNK_SIZE = getattr(settings, 'ONE_C_UPLOAD_CHUNK_SIZE', 64 * 1024)
+
+# Создаем директорию для обмена, если её нет
+os.makedirs(EXCHANGE_DIR, exist_ok=True)
+
+
+class ExchangeFileTooLarge(Exception):
+    """Файл обмена превысил FILE_LIMIT во время приёма."""
+
+
+def _upload_session_marker(file_path):
+    """Путь к маркеру сессии, в которой файл обмена начал загружаться."""
+    return f"{file_path}.upload_session"
+
+
+def _is_continuation_part(request, file_path):
     """
-    Надёжное сохранение объекта с повтором при 'database is locked' (SQLite).
-    Используется во всех местах обмена с 1С, чтобы единичные блокировки БД
-    не ломали весь процесс импорта.
+    Определяет, является ли запрос очередной частью уже начатого файла.
 
-    ВАЖНО: внутри transaction.atomic() нельзя закрывать/переоткрывать соединение —
-    это ломает SQLite и даёт «Cannot operate on a closed database».
+    1С делит файлы больше file_limit на части и отправляет их подряд с тем же filename
+    в рамках одной сессии (cookie из checkauth). Сессию, начавшую файл, храним рядом
+    с файлом в маркере — это работает и при нескольких воркерах.
+    Без cookie части не склеиваем: файл перезаписывается.
     """
-    from django.db import connection
+    session_key = request.COOKIES.get('1c_exchange_session', '')
+    marker_path = _upload_session_marker(file_path)
+    is_continuation = False
+    if session_key and os.path.exists(file_path):
+        try:
+            with open(marker_path, 'r') as f:
+                is_continuation = f.read().strip() == session_key
+        except OSError:
+            is_continuation = False
+    if not is_continuation:
+        try:
+            os.makedirs(os.path.dirname(marker_path), exist_ok=True)
+            with open(marker_path, 'w') as f:
+                f.write(session_key)
+        except OSError as e:
+            logger.warning(f"Не удалось записать маркер сессии загрузки {marker_path}: {e}")
+    return is_continuation
 
-    in_atomic_block = connection.in_atomic_block
 
-    for attempt in range(max_retries):
-        try:
-            # Вне atomic можно безопасно обновить соединение (CONN_MAX_AGE=0 для SQLite).
-            if not in_atomic_block:
-                try:
-                    db_alias = getattr(getattr(instance, '_state', None), 'db', None) or 'default'
-                    conn = connections[db_alias]
-                    conn.close_if_unusable_or_obsolete()
-                    conn.ensure_connection()
-                except Exception:
-                    pass
+def _receive_exchange_file(request, file_path, append=False, digest=None):
+    """
+    Потоково записывает тело запроса (wsgi.input) в файл обмена кусками по UPLOAD_CHUNK_SIZE.
 
-            if update_fields is not None:
-                instance.save(update_fields=update_fields)
-            else:
-                instance.save()
-            return
-        except (OperationalError, TransactionManagementError, ProgrammingError) as e:
-            msg = str(e).lower()
-            is_locked = 'database is locked' in msg or 'database table is locked' in msg
-            is_closed = 'closed database' in msg or 'cannot operate on a closed database' in msg
-
-            # Внутри atomic переподключение невозможно — сразу пробрасываем ошибку.
-            if in_atomic_block:
-                raise
-
-            if is_locked and attempt < max_retries - 1:
-                close_old_connections()
-                backoff = delay * (2 ** attempt)
-                jitter = random.uniform(0, delay)
-                time.sleep(backoff + jitter)
-                continue
-            if is_closed and attempt < max_retries - 1:
-                close_old_connections()
-                backoff = delay * (2 ** attempt)
-                jitter = random.uniform(0, delay)
-                time.sleep(backoff + jitter)
-                continue
-            raise
+    Лимит FILE_LIMIT проверяется по ходу чтения, поэтому память на запрос не зависит
+    от размера архива. Новый файл сначала пишется во временный файл в той же директории
+    и атомарно подменяет старый; при дописывании части (append=True) в случае ошибки
+    файл обрезается до исходного размера.
 
-# Настройки
-EXCHANGE_DIR = getattr(settings, 'ONE_C_EXCHANGE_DIR', os.path.join(settings.MEDIA_ROOT, '1c_exchange'))
-FILE_LIMIT = getattr(settings, 'ONE_C_FILE_LIMIT', 104857600)  # 100 MB по умолчанию
-SUPPORT_ZIP = getattr(settings, 'ONE_C_SUPPORT_ZIP', True)
+    digest (hashlib) обновляется по ходу записи: после вызова в нем хеш всего файла,
+    при дописывании части уже принятое начало файла дочитывается в хеш с диска.
 
-# Создаем директорию для обмена, если её нет
-os.makedirs(EXCHANGE_DIR, exist_ok=True)
+    Возвращает количество принятых байт.
+    """
+    target_dir = os.path.dirname(file_path) or EXCHANGE_DIR
+    os.makedirs(target_dir, exist_ok=True)
+
+    tmp_path = None
+    start_offset = 0
+    if append and os.path.exists(file_path):
+        if digest is not None:
+            with open(file_path, 'rb') as head:
+                for chunk in iter(lambda: head.read(UPLOAD_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+        out = open(file_path, 'ab')
+        start_offset = out.tell()
+    else:
+        fd, tmp_path = tempfile.mkstemp(dir=target_dir, prefix='.upload-', suffix='.part')
+        out = os.fdopen(fd, 'wb')
+
+    received = 0
+    try:
+        with out:
+            while True:
+                chunk = request.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                received += len(chunk)
+                if received > FILE_LIMIT:
+                    raise ExchangeFileTooLarge(f"{received} > {FILE_LIMIT}")
+                out.write(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+        if tmp_path:
+            os.replace(tmp_path, file_path)
+    except BaseException:
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        else:
+            try:
+                os.truncate(file_path, start_offset)
+            except OSError:
+                pass
+        raise
+    return received
 
 
 def _clear_1c_products_inline(*, catalog_type: str = 'all') -> dict:
@@ -202,11 +273,12 @@ def invalidate_category_cache(category, force=False):
     
     from django.core.cache import cache
     # Инвалидируем кеш для текущей категории и всех родительских
-    current = category
-    while current:
-        cache_key = f'category_product_count_{current.id}'
-        cache.delete(cache_key)
-        current = current.parent
+    with exchange_phase('cache'):
+        current = category
+        while current:
+            cache_key = f'category_product_count_{current.id}'
+            cache.delete(cache_key)
+            current = current.parent
 
 
 def check_basic_auth(request):
@@ -234,8 +306,8 @@ def commerceml_exchange(request):
     
     Параметры запроса:
     - type: catalog (тип обмена)
-    - mode: checkauth, init, file, import (режим обмена)
-    - filename: имя файла (для режимов file и import)
+    - mode: checkauth, init, file, import, stock (режим обмена)
+    - filename: имя файла (для режимов file, import и stock)
     """
     # Явное логирование ВСЕХ запросов
     exchange_type = request.GET.get('type', '')
@@ -363,6 +435,9 @@ def commerceml_exchange(request):
     elif mode == 'import':
         logger.info(f"Обработка режима: import, filename={filename}")
         return handle_import(request, filename)
+    elif mode == 'stock':
+        logger.info(f"Обработка режима: stock, filename={filename}")
+        return handle_stock(request, filename)
     else:
         logger.warning(f"Неизвестный режим обмена: {mode}")
         return HttpResponse('failure\nНеизвестный режим обмена', status=400)
@@ -466,6 +541,7 @@ def handle_init(request):
     return HttpResponse(response_text, content_type='text/plain; charset=utf-8')
 
 
+@profiled_exchange
 def handle_file(request, filename):
     """
     Режим C: Выгрузка на сайт файлов обмена
@@ -493,59 +569,100 @@ def handle_file(request, filename):
         return HttpResponse('failure\nНе указано имя файла', status=400)
     
     try:
-        # Получаем содержимое файла
-        file_content = request.body
-        logger.info(f"Получен файл {filename}, размер: {len(file_content)} байт")
-        
-        if len(file_content) > FILE_LIMIT:
-            logger.error(f"Файл {filename} превышает лимит: {len(file_content)} > {FILE_LIMIT}")
+        # Если 1С заранее сообщила размер — отказываем сразу, не читая тело запроса
+        try:
+            content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except (TypeError, ValueError):
+            content_length = 0
+        if content_length > FILE_LIMIT:
+            logger.error(f"Файл {filename} превышает лимит: {content_length} > {FILE_LIMIT}")
             return HttpResponse('failure\nФайл превышает лимит размера', status=413)
         
         # Проверяем, что директория существует
         os.makedirs(EXCHANGE_DIR, exist_ok=True)
         logger.info(f"Директория обмена: {EXCHANGE_DIR}")
         
-        # Сохраняем файл
         file_path = os.path.join(EXCHANGE_DIR, filename)
-        logger.info(f"Сохраняем файл в: {file_path}")
+        # Большие файлы 1С присылает несколькими запросами с одним и тем же filename —
+        # в рамках одной сессии обмена дописываем части в конец файла.
+        append = _is_continuation_part(request, file_path)
+        logger.info(f"Сохраняем файл в: {file_path} ({'дописываем часть' if append else 'новый файл'})")
         
-        with open(file_path, 'wb') as f:
-            f.write(file_content)
+        # Пишем тело запроса на диск кусками, не держа весь архив в памяти; хеш считаем по ходу
+        digest = new_exchange_digest()
+        try:
+            with exchange_phase('upload'):
+                received = _receive_exchange_file(request, file_path, append=append, digest=digest)
+        except ExchangeFileTooLarge as e:
+            logger.error(f"Файл {filename} превышает лимит: {e}")
+            return HttpResponse('failure\nФайл превышает лимит размера', status=413)
+        logger.info(f"Получен файл {filename}, размер части: {received} байт")
         
         # Проверяем, что файл действительно сохранен
         if os.path.exists(file_path):
             actual_size = os.path.getsize(file_path)
             logger.info(f"Файл успешно сохранен: {filename}, размер: {actual_size} байт")
             
-            # Если это ZIP, распаковываем сразу
+            content_hash = digest.hexdigest()
+            register_exchange_file(filename, content_hash, actual_size, file_path)
+            
+            # 1С после таймаута присылает тот же пакет снова: если он уже применен,
+            # подтверждаем сразу, без повторной обработки (для ZIP — все XML архива)
+            applied_names = [filename]
             if filename.lower().endswith('.zip'):
-                logger.info("Обнаружен ZIP архив, распаковываем...")
-                import zipfile
                 try:
-                    with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                        zip_ref.extractall(EXCHANGE_DIR)
-                        extracted_files = zip_ref.namelist()
-                        logger.info(f"Распаковано файлов: {len(extracted_files)}")
-                        for ext_file in extracted_files[:5]:  # Логируем первые 5
-                            logger.info(f"  - {ext_file}")
-                        
-                        # Обрабатываем распакованные XML файлы автоматически
-                        for ext_file in extracted_files:
-                            if ext_file.lower().endswith('.xml'):
-                                ext_file_path = os.path.join(EXCHANGE_DIR, ext_file)
-                                if os.path.exists(ext_file_path):
-                                    logger.info(f"Автоматическая обработка распакованного файла: {ext_file}")
-                                    try:
-                                        result = process_commerceml_file(ext_file_path, ext_file, request)
-                                        logger.info(f"Результат обработки {ext_file}: {result.get('status')}")
-                                    except Exception as e:
-                                        logger.error(f"Ошибка автоматической обработки {ext_file}: {e}", exc_info=True)
+                    applied_names = exchange_xml_members(file_path)
+                except zipfile.BadZipFile:
+                    applied_names = []
+            if is_exchange_applied(content_hash, applied_names):
+                logger.info(f"Файл {filename} ({content_hash[:12]}) уже применен, повторно не обрабатываем")
+                mark_exchange_skipped(content_hash, [filename, *applied_names])
+                if ASYNC_EXCHANGE:
+                    # mode=import по этим файлам сразу получит success
+                    for name in applied_names:
+                        record_skipped_exchange_job(
+                            file_path, name, request,
+                            member=name if name != filename else None,
+                        )
+                return HttpResponse('success', content_type='text/plain; charset=utf-8')
+            
+            # Если это ZIP, XML из него читаем прямо из архива — на диск ничего не распаковываем
+            if filename.lower().endswith('.zip'):
+                logger.info("Обнаружен ZIP архив, читаем XML прямо из архива...")
+                try:
+                    xml_members = exchange_xml_members(file_path)
+                    logger.info(f"XML файлов в архиве: {len(xml_members)}")
+                    for member in xml_members[:5]:  # Логируем первые 5
+                        logger.info(f"  - {member}")
+                    
+                    # Обрабатываем XML файлы архива автоматически
+                    if ASYNC_EXCHANGE:
+                        for member in xml_members:
+                            # Обработает воркер run_exchange_jobs; 1С узнает результат через mode=import
+                            enqueue_exchange_job(
+                                file_path, member, request, member=member,
+                                upload_phases=active_profiler().as_dict(only=('upload',))['phases'],
+                            )
+                    else:
+                        # Файлы архива — один пакет: разбор параллельно, запись import → offers
+                        package = [ExchangeFileRef(file_path, member, member) for member in xml_members]
+                        logger.info(f"Автоматическая обработка файлов из архива: {len(package)}")
+                        for ref, result in process_exchange_package(package, request, content_hash=content_hash):
+                            logger.info(f"Результат обработки {ref.filename}: {result.get('status')}")
                 except zipfile.BadZipFile:
                     logger.warning("Файл не является ZIP архивом, оставляем как есть")
                 except Exception as e:
-                    logger.error(f"Ошибка распаковки ZIP: {e}", exc_info=True)
+                    logger.error(f"Ошибка чтения ZIP: {e}", exc_info=True)
                     # Не возвращаем ошибку, файл сохранен, можно попробовать обработать
             
+            # Фоновый режим: XML только ставим в очередь, ответ 1С не ждет обработки
+            elif filename.lower().endswith('.xml') and ASYNC_EXCHANGE:
+                job = enqueue_exchange_job(
+                    file_path, filename, request,
+                    upload_phases=active_profiler().as_dict(only=('upload',))['phases'],
+                )
+                logger.info(f"XML файл {filename} в очереди обработки (задание #{job.pk})")
+            
             # Если это XML файл, обрабатываем автоматически
             elif filename.lower().endswith('.xml'):
                 logger.info("=" * 80)
@@ -562,7 +679,7 @@ def handle_file(request, filename):
                     #
                     # Теперь обрабатываем файл СИНХРОННО в рамках HTTP‑запроса от 1С.
                     # 1С спокойно ждёт ответ, а мы гарантированно завершаем обработку import/offers.
-                    result = process_commerceml_file(file_path, filename, request)
+                    result = process_commerceml_file(file_path, filename, request, content_hash=content_hash)
                     logger.info("=" * 80)
                     logger.info(f"✅ СИНХРОННАЯ ОБРАБОТКА XML ФАЙЛА {filename} ЗАВЕРШЕНА")
                     logger.info(f"✅ Статус: {result.get('status')}")
@@ -586,6 +703,50 @@ def handle_file(request, filename):
         return HttpResponse(f'failure\nОшибка сохранения файла: {str(e)}', status=500)
 
 
+def handle_stock(request, filename):
+    """
+    Режим stock (расширение протокола): только остатки и цены.
+
+    1С присылает POST с компактным файлом (CSV, NDJSON, XML или offers.xml без
+    свойств); формат — по filename. Файл не сохраняется и в очередь не ставится:
+    строки сразу применяются пакетными UPDATE по external_id (catalog.stock_updates).
+    Возвращает success и статистику или failure.
+    """
+    if not (check_basic_auth(request) or check_session_cookie(request)):
+        logger.warning("Ошибка авторизации в handle_stock")
+        return HttpResponse('failure\nОшибка авторизации', status=401)
+
+    if request.method != 'POST':
+        return HttpResponse('failure\nТребуется POST запрос', status=405)
+
+    file_format = detect_stock_format(filename, request.content_type)
+    started = timezone.now()
+    try:
+        stats = apply_stock_updates(iter_stock_rows(request_stream(request, UPLOAD_CHUNK_SIZE), file_format))
+    except StockFormatError as e:
+        logger.warning(f"Остатки {filename}: {e}")
+        return HttpResponse(f'failure\n{e}', content_type='text/plain; charset=utf-8')
+    except Exception as e:
+        logger.error(f"Ошибка обновления остатков {filename}: {e}", exc_info=True)
+        return HttpResponse(f'failure\nОшибка обновления остатков: {str(e)}', status=500)
+
+    SyncLog.objects.create(
+        operation_type='stock_update',
+        status='success' if stats['updated'] or not stats['received'] else 'partial',
+        message=f"CommerceML stock: строк {stats['received']}, не найдено Ид {stats['not_found']}",
+        processed_count=stats['received'],
+        updated_count=stats['updated'],
+        request_ip=get_client_ip(request),
+        request_format=file_format.upper(),
+        filename=filename,
+        processing_time=(timezone.now() - started).total_seconds(),
+    )
+    return HttpResponse(
+        f"success\nОбновлено {stats['updated']}, не найдено {stats['not_found']}",
+        content_type='text/plain; charset=utf-8',
+    )
+
+
 def handle_import(request, filename):
     """
     Режим D: Пошаговая загрузка данных
@@ -616,6 +777,14 @@ def handle_import(request, filename):
     logger.info(f"Директория существует: {os.path.exists(EXCHANGE_DIR)}")
     logger.info(f"Файл существует: {os.path.exists(file_path)}")
     
+    # XML из ZIP-архива не распаковывается — 1С присылает имя файла внутри архива
+    member = None
+    if not os.path.exists(file_path):
+        archive_path = find_exchange_archive(filename)
+        if archive_path:
+            file_path, member = archive_path, filename
+            logger.info(f"Файл {filename} найден в архиве: {archive_path}")
+    
     if not os.path.exists(file_path):
         # Проверим, какие файлы есть в директории
         if os.path.exists(EXCHANGE_DIR):
@@ -626,6 +795,16 @@ def handle_import(request, filename):
             logger.error(f"Директория обмена не существует: {EXCHANGE_DIR}")
         return HttpResponse('failure\nФайл не найден', status=404)
     
+    if ASYNC_EXCHANGE:
+        # Файл обрабатывает воркер; здесь только подтверждаем, что загрузка закончена,
+        # и отвечаем состоянием задания. 1С повторяет mode=import, пока получает progress.
+        job = find_exchange_job(filename, request)
+        if job is None or job.status == 'pending':
+            job = enqueue_exchange_job(file_path, filename, request, ready=True, member=member)
+        response_text = exchange_job_response_text(job)
+        logger.info(f"РЕЖИМ IMPORT (фоновый): задание #{job.pk} {filename}: {response_text.splitlines()[0]} {job.progress}%")
+        return HttpResponse(response_text, content_type='text/plain; charset=utf-8')
+    
     logger.info("=" * 80)
     logger.info(f"🚀 РЕЖИМ IMPORT: Начало обработки файла: {filename}")
     logger.info(f"🚀 Размер файла: {os.path.getsize(file_path)} байт")
@@ -633,7 +812,7 @@ def handle_import(request, filename):
     
     try:
         # Парсим и обрабатываем файл CommerceML 2
-        result = process_commerceml_file(file_path, filename, request)
+        result = process_commerceml_file(file_path, filename, request, member=member)
         
         logger.info("=" * 80)
         logger.info(f"✅ РЕЖИМ IMPORT: Результат обработки файла {filename}")
@@ -657,13 +836,147 @@ def handle_import(request, filename):
         return HttpResponse(f'failure\nОшибка обработки: {str(e)}', status=500)
 
 
-def process_commerceml_file(file_path, filename, request=None):
+def hide_products_missing_from_exchange(catalog_type, external_ids, articles=(), only_active=False,
+                                        hide_stale_by_article=False):
+    """
+    Отмечает «нет в наличии» товары каталога, которых нет в текущем обмене.
+
+    Ключи обмена (external_id и артикулы в верхнем и нижнем регистре) пишутся пачкой
+    в ExchangeStagingKey под отдельным run_id, а сами изменения — set-based UPDATE
+    с NOT EXISTS по индексу промежуточной таблицы: один проход по каталогу без
+    огромных списков параметров. Уже отмеченные товары не перезаписываются.
+
+    only_active — трогать только активные товары; hide_stale_by_article — дополнительно
+    скрыть товары без external_id, артикула которых нет в обмене.
+    Возвращает {'hidden', 'reactivated', 'stale'}.
+    """
+    import uuid
+    from django.db import connection
+    from .models import ExchangeStagingKey
+
+    run_id = uuid.uuid4().hex
+    article_values = set()
+    for article in articles:
+        article = str(article).strip()
+        if article:
+            article_values.update((article, article.upper(), article.lower()))
+    keys = [ExchangeStagingKey(run_id=run_id, kind='external_id', value=ext_id) for ext_id in external_ids if ext_id]
+    keys += [ExchangeStagingKey(run_id=run_id, kind='article', value=value) for value in article_values]
+
+    product_table = connection.ops.quote_name(Product._meta.db_table)
+    key_table = connection.ops.quote_name(ExchangeStagingKey._meta.db_table)
+
+    def _not_in_exchange(kind, column):
+        return (
+            f"NOT EXISTS (SELECT 1 FROM {key_table} k WHERE k.run_id = %s AND k.kind = '{kind}' "
+            f"AND k.value = {product_table}.{column})"
+        )
+
+    already_hidden = "NOT (quantity = 0 AND availability = 'out_of_stock' AND is_active = %s)"
+    active_filter = "AND is_active = %s" if only_active else ""
+    result = {'hidden': 0, 'reactivated': 0, 'stale': 0}
+    try:
+        with transaction.atomic():
+            ExchangeStagingKey.objects.bulk_create(keys, batch_size=500)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"UPDATE {product_table} SET quantity = 0, is_active = %s, availability = 'out_of_stock' "
+                    f"WHERE catalog_type = %s AND external_id IS NOT NULL AND external_id > '' {active_filter} "
+                    f"AND {already_hidden} "
+                    f"AND {_not_in_exchange('external_id', 'external_id')} "
+                    f"AND {_not_in_exchange('article', 'article')} "
+                    f"AND {_not_in_exchange('article', 'supplier_article')}",
+                    [True, catalog_type] + ([True] if only_active else []) + [True, run_id, run_id, run_id],
+                )
+                result['hidden'] = cursor.rowcount
+
+                # Позиции из текущего обмена должны быть активны
+                cursor.execute(
+                    f"UPDATE {product_table} SET is_active = %s WHERE catalog_type = %s AND is_active = %s "
+                    f"AND NOT {_not_in_exchange('external_id', 'external_id')}",
+                    [True, catalog_type, False, run_id],
+                )
+                result['reactivated'] = cursor.rowcount
+
+                if hide_stale_by_article and article_values:
+                    cursor.execute(
+                        f"UPDATE {product_table} SET quantity = 0, is_active = %s, availability = 'out_of_stock' "
+                        f"WHERE catalog_type = %s AND is_active = %s "
+                        f"AND (external_id IS NULL OR external_id = '') AND article IS NOT NULL AND article <> '' "
+                        f"AND {already_hidden} AND {_not_in_exchange('article', 'article')}",
+                        [True, catalog_type, True, True, run_id],
+                    )
+                    result['stale'] = cursor.rowcount
+    finally:
+        ExchangeStagingKey.objects.filter(run_id=run_id).delete()
+    return result
+
+
+@profiled_exchange
+def process_commerceml_file(file_path, filename, request=None, start_index=0, progress_callback=None,
+                            member=None, force=False, content_hash=None, parsed=None):
     """
     Обработка файла CommerceML 2.
     
     Парсит XML в формате CommerceML 2 и импортирует товары в базу данных.
-    Поддерживает ZIP архивы (распаковывает автоматически).
+    Поддерживает ZIP архивы: XML читается прямо из архива, без распаковки на диск.
+    member — имя XML файла внутри ZIP-архива file_path (по умолчанию первый XML архива).
+    start_index/progress_callback передаются в обработку offers.xml (см. ExchangeJob).
+
+    Побайтно тот же файл, уже успешно примененный под тем же именем (реестр ExchangeFile),
+    не обрабатывается повторно, если не указан force. content_hash — SHA-256 файла,
+    если он уже посчитан при приеме. parsed — результат parse_exchange_file, если файл
+    уже разобран (пакет файлов разбирается параллельно, см. exchange_package).
+    Обработка идет в режиме писателя импорта (см. import_writer).
     """
+    name = member or filename
+    if content_hash is None:
+        try:
+            content_hash = file_sha256(file_path)
+        except OSError as e:
+            logger.warning(f"Не удалось посчитать хеш файла {file_path}: {e}")
+    if content_hash and not force:
+        applied = applied_exchange_file(content_hash, name)
+        if applied is not None:
+            logger.info(
+                f"Файл {name} ({content_hash[:12]}) уже применен "
+                f"{applied.processed_at}, повторно не обрабатываем"
+            )
+            mark_exchange_skipped(content_hash, [name])
+            return skipped_exchange_result(applied)
+
+    # Запись — в режиме писателя импорта: WAL, транзакции пачками, один импорт за раз
+    with import_writer():
+        result = _process_commerceml_file(
+            file_path, filename, request=request, start_index=start_index,
+            progress_callback=progress_callback, member=member, parsed=parsed,
+        )
+        if result.get('status') not in ('progress', 'failure'):
+            with exchange_phase('category_counts'):
+                safe_recompute_category_counts()
+            with exchange_phase('counterparts'):
+                safe_resolve_retail_counterparts()
+            # Новые оптовые строки получают фото розничного аналога
+            with exchange_phase('main_images'):
+                safe_refresh_missing_main_images()
+    if content_hash and result.get('status') != 'progress':
+        try:
+            archive = archive_members = None
+            if member:
+                archive = os.path.basename(file_path)
+                archive_members = exchange_xml_members(file_path)
+            record_exchange_result(
+                content_hash, name, result, file_path=file_path,
+                archive=archive, archive_members=archive_members or (),
+            )
+        except Exception as e:
+            logger.warning(f"Не удалось записать результат в реестр файлов обмена: {e}")
+    return result
+
+
+def _process_commerceml_file(file_path, filename, request=None, start_index=0, progress_callback=None,
+                             member=None, parsed=None):
+    """Разбор и импорт файла CommerceML 2 (см. process_commerceml_file)."""
     start_time = timezone.now()
     
     logger.info("=" * 80)
@@ -674,11 +987,15 @@ def process_commerceml_file(file_path, filename, request=None):
     try:
         # Перед обработкой обмена синхронизируем подкатегории из keywords категорий.
         # Это нужно, чтобы изменения ключевых слов в админке начинали работать автоматически "после обмена".
+        # Синхронизация выполняется, только если категории изменились с прошлого запуска
+        # (отпечаток ключевых слов), а не перед каждым файлом пакета.
         try:
-            from catalog.services import sync_all_subcategories_from_keywords
+            from catalog.services import sync_subcategories_if_keywords_changed
             # Во время обмена не деактивируем подкатегории агрессивно:
             # это может скрыть существующие рабочие ветки при неполных keywords.
-            sync_all_subcategories_from_keywords(root_only=True, deactivate_removed=False)
+            with exchange_phase('category_sync'):
+                if sync_subcategories_if_keywords_changed(root_only=True, deactivate_removed=False) is None:
+                    logger.info("Ключевые слова категорий не менялись, синхронизация подкатегорий пропущена")
         except Exception:
             pass
 
@@ -695,58 +1012,35 @@ def process_commerceml_file(file_path, filename, request=None):
         # т.к. `ProductImage` связан с `Product` через FK и удаляется каскадно).
         # Логика "пропавших из обмена товаров" реализована ниже через `products_to_hide.update(is_active=False, ...)`.
         
-        # Проверяем, не ZIP ли это
-        xml_file_path = file_path
-        if filename.lower().endswith('.zip'):
-            logger.info("Обнаружен ZIP архив, распаковываем...")
-            import zipfile
+        # Проверяем, не ZIP ли это: XML читаем прямо из архива, не распаковывая на диск
+        xml_member = member
+        if not xml_member and filename.lower().endswith('.zip'):
+            logger.info("Обнаружен ZIP архив, читаем XML прямо из архива...")
             try:
-                with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                    # Распаковываем в ту же директорию
-                    zip_ref.extractall(EXCHANGE_DIR)
-                    # Ищем XML файлы в архиве
-                    xml_files = [f for f in zip_ref.namelist() if f.lower().endswith('.xml')]
-                    if xml_files:
-                        xml_file_path = os.path.join(EXCHANGE_DIR, xml_files[0])
-                        logger.info(f"Распакован XML файл: {xml_files[0]}")
-                    else:
-                        logger.error("В ZIP архиве не найдено XML файлов")
-                        return {'status': 'failure', 'error': 'В ZIP архиве не найдено XML файлов'}
+                xml_files = exchange_xml_members(file_path)
+                if xml_files:
+                    xml_member = xml_files[0]
+                    logger.info(f"XML файл в архиве: {xml_member}")
+                else:
+                    logger.error("В ZIP архиве не найдено XML файлов")
+                    return {'status': 'failure', 'error': 'В ZIP архиве не найдено XML файлов'}
             except zipfile.BadZipFile:
                 logger.warning("Файл не является ZIP архивом, обрабатываем как XML")
             except Exception as e:
-                logger.error(f"Ошибка распаковки ZIP: {e}", exc_info=True)
-                return {'status': 'failure', 'error': f'Ошибка распаковки ZIP: {str(e)}'}
-        
-        # Парсим XML
-        tree = ET.parse(xml_file_path)
-        root = tree.getroot()
-        
-        logger.info(f"Корневой элемент XML: {root.tag}")
+                logger.error(f"Ошибка чтения ZIP: {e}", exc_info=True)
+                return {'status': 'failure', 'error': f'Ошибка чтения ZIP: {str(e)}'}
         
-        # Автоматически определяем namespace из корневого элемента
-        root_tag = root.tag
-        if root_tag.startswith('{'):
-            # Извлекаем namespace из тега
-            namespace = root_tag[1:root_tag.index('}')]
-            root_tag_name = root_tag[root_tag.index('}')+1:]
+        # Определяем тип файла по первым элементам (iterparse), не строя дерево целиком
+        if parsed is not None:
+            file_kind, namespace = parsed['kind'], parsed['namespace']
         else:
-            namespace = None
-            root_tag_name = root_tag
+            with exchange_phase('parse'):
+                with open_exchange_xml(file_path, xml_member) as xml_file:
+                    file_kind, namespace = detect_commerceml_file_kind(xml_file)
+        logger.info(f"Тип файла CommerceML: {file_kind or 'не определён'}")
         
         # Определяем namespace CommerceML (поддерживаем разные варианты)
-        namespaces = {}
-        if namespace:
-            # Используем найденный namespace
-            namespaces['cml'] = namespace
-            namespaces[''] = namespace
-        else:
-            # Стандартные namespace CommerceML
-            namespaces['cml'] = 'http://v8.1c.ru/8.3/commerceml'
-            namespaces[''] = 'http://v8.1c.ru/8.3/commerceml'
-        
-        # Также добавляем альтернативный namespace (urn:1C.ru:commerceml_2)
-        namespaces['cml2'] = 'urn:1C.ru:commerceml_2'
+        namespaces = _commerceml_namespaces(namespace)
         
         logger.info(f"Определен namespace: {namespace or 'стандартный'}")
         
@@ -772,36 +1066,23 @@ def process_commerceml_file(file_path, filename, request=None):
         # 2. offers.xml, offers0_1.xml, offers1.xml и т.д. - предложения (цены, остатки)
         
         # Сначала проверяем, не файл ли это предложений
-        # Ищем ПакетПредложений или Предложения в корне
         package = None
-        if namespace:
-            package = root.find(f'.//{{{namespace}}}ПакетПредложений')
-        if package is None:
-            package = root.find('.//ПакетПредложений')
-        if package is None:
-            # Пробуем найти Предложения напрямую
-            if namespace:
-                package = root.find(f'.//{{{namespace}}}Предложения')
-            if package is None:
-                package = root.find('.//Предложения')
-        # Пробуем найти с альтернативными namespace (без префикса catalog)
-        if package is None:
-            for ns_key in ['cml', 'cml2', '']:
-                if ns_key in namespaces:
-                    try:
-                        ns_value = namespaces[ns_key]
-                        if ns_value:
-                            package = root.find(f'.//{{{ns_value}}}ПакетПредложений')
-                            if package is None:
-                                package = root.find(f'.//{{{ns_value}}}Предложения')
-                            if package is not None:
-                                break
-                    except (KeyError, ValueError):
-                        pass
-        
-        logger.info(f"Проверка типа файла: package={package is not None}, filename={filename}")
-        logger.info(f"Корневой элемент: {root.tag}, namespace: {namespace or 'нет'}")
-        logger.info(f"Дочерние элементы корня: {[child.tag for child in root[:10]]}")
+        if file_kind == 'offers' and parsed is not None:
+            logger.info("Файл предложений уже разобран - однопроходная запись для retail+wholesale")
+            return process_offers_file_single_pass(
+                None, namespaces, filename, request, changes_only=parsed['changes_only'],
+                start_index=start_index, progress_callback=progress_callback, parsed=parsed,
+            )
+        if file_kind == 'offers':
+            # Файл предложений пока разбирается целиком (process_offers_file_single_pass работает с деревом)
+            with exchange_phase('parse'):
+                with open_exchange_xml(file_path, xml_member) as xml_file:
+                    tree = ET.parse(xml_file)
+            root = tree.getroot()
+            package = _find_offers_package(root, namespace, namespaces)
+            logger.info(f"Проверка типа файла: package={package is not None}, filename={filename}")
+            logger.info(f"Корневой элемент: {root.tag}, namespace: {namespace or 'нет'}")
+            logger.info(f"Дочерние элементы корня: {[child.tag for child in root[:10]]}")
         
         if package is not None:
             # Для файла предложений дополнительно проверяем типы цен (retail/wholesale),
@@ -871,230 +1152,26 @@ def process_commerceml_file(file_path, filename, request=None):
             # ВАЖНО: Файл offers.xml содержит оба типа цен (розничную и оптовую)
             # Обрабатываем его для обоих каталогов, чтобы установить цены и остатки отдельно.
             logger.info("Обнаружен файл предложений (offers.xml) - однопроходная обработка для retail+wholesale")
-            return process_offers_file_single_pass(root, namespaces, filename, request)
-        
-        # Ищем каталог товаров
-        catalog = None
-        if namespace:
-            catalog = root.find(f'.//{{{namespace}}}Каталог') or root.find(f'.//{{{namespace}}}catalog')
-        if catalog is None:
-            catalog = (
-                root.find('.//catalog', namespaces) or 
-                root.find('.//Каталог', namespaces) or
-                root.find('.//catalog') or 
-                root.find('.//Каталог')
+            return process_offers_file_single_pass(
+                root, namespaces, filename, request, changes_only=_offers_changes_only(package),
+                start_index=start_index, progress_callback=progress_callback,
             )
         
-        if catalog is None:
-            logger.error(f"Каталог не найден в файле. Корневой элемент: {root.tag}, namespace: {namespace or 'нет'}")
-            # Выведем все дочерние элементы для отладки
-            logger.error(f"Дочерние элементы корня: {[child.tag for child in root[:5]]}")
+        if file_kind != 'import':
+            logger.error(f"Каталог не найден в файле {filename}, namespace: {namespace or 'нет'}")
             return {'status': 'failure', 'error': 'Каталог не найден в файле'}
         
-        logger.info(f"Каталог найден: {catalog.tag}")
-        
-        # Дополнительная проверка: если тип еще не определен как опт, проверяем название каталога
-        if catalog_type == 'retail':
-            catalog_name_elem = None
-            if namespace:
-                catalog_name_elem = catalog.find(f'.//{{{namespace}}}Наименование')
-            if catalog_name_elem is None:
-                catalog_name_elem = catalog.find('.//Наименование')
-            if catalog_name_elem is None and 'catalog' in namespaces:
-                try:
-                    catalog_name_elem = catalog.find('.//catalog:Наименование', namespaces)
-                except (KeyError, ValueError):
-                    pass
-            
-            if catalog_name_elem is not None and catalog_name_elem.text:
-                catalog_name = catalog_name_elem.text.lower()
-                if any(keyword in catalog_name for keyword in ['опт', 'opt', 'wholesale', 'оптовый', 'оптовая', 'партнер', 'partner']):
-                    catalog_type = 'wholesale'
-                    logger.info(f"Определен тип каталога: ОПТОВЫЙ (wholesale) по названию каталога: {catalog_name_elem.text}")
-                else:
-                    logger.info(f"Тип каталога подтвержден как РОЗНИЦА (retail) по названию каталога: {catalog_name_elem.text}")
-        
-        # Извлекаем товары
-        products_data = []
-        
-        # Ищем товары в разных возможных местах
-        products_elements = []
-        if namespace:
-            products_elements = (
-                catalog.findall(f'.//{{{namespace}}}Товары/{{{namespace}}}Товар') or
-                catalog.findall(f'.//{{{namespace}}}Товар')
-            )
-        if not products_elements:
-            products_elements = (
-                catalog.findall('.//catalog:Товары/catalog:Товар', namespaces) or
-                catalog.findall('.//Товары/Товар') or
-                catalog.findall('.//catalog:Товар', namespaces) or
-                catalog.findall('.//Товар')
-            )
-        
-        logger.info(f"Найдено элементов товаров: {len(products_elements)}")
-        
-        # Если товары не найдены, выводим структуру XML для отладки
-        if not products_elements:
-            logger.error("Товары не найдены в XML! Выводим структуру для отладки:")
-            logger.error(f"Корневой элемент: {root.tag}")
-            logger.error(f"Атрибуты корня: {root.attrib}")
-            for child in root:
-                logger.error(f"  Дочерний элемент: {child.tag}, атрибуты: {child.attrib}")
-                for grandchild in child:
-                    logger.error(f"    Внук: {grandchild.tag}, атрибуты: {grandchild.attrib}")
-        
-        # Оптимизация: создаем кэш групп один раз перед обработкой товаров
-        # Это значительно ускоряет обработку больших XML файлов
-        groups_cache = {}
-        logger.info("Создание кэша групп для оптимизации поиска категорий...")
-        try:
-            # Ищем Классификатор/Группы
-            classifier = None
-            if namespace:
-                classifier = root.find(f'.//{{{namespace}}}Классификатор')
-            if classifier is None:
-                classifier = root.find('.//Классификатор')
-            if classifier is None and 'catalog' in namespaces:
-                try:
-                    classifier = root.find('.//catalog:Классификатор', namespaces)
-                except (KeyError, ValueError):
-                    pass
-            
-            if classifier is not None:
-                # Ищем все группы
-                groups = []
-                if namespace:
-                    groups = classifier.findall(f'.//{{{namespace}}}Группа')
-                if not groups:
-                    groups = classifier.findall('.//Группа')
-                if not groups and 'catalog' in namespaces:
-                    try:
-                        groups = classifier.findall('.//catalog:Группа', namespaces)
-                    except (KeyError, ValueError):
-                        pass
-                
-                # Кэшируем группы по Ид
-                for group in groups:
-                    group_id = None
-                    group_name = None
-                    
-                    # Ищем Ид группы
-                    id_elem = None
-                    if namespace:
-                        id_elem = group.find(f'{{{namespace}}}Ид')
-                    if id_elem is None:
-                        id_elem = group.find('Ид')
-                    if id_elem is None and 'catalog' in namespaces:
-                        try:
-                            id_elem = group.find('catalog:Ид', namespaces)
-                        except (KeyError, ValueError):
-                            pass
-                    if id_elem is not None and id_elem.text:
-                        group_id = id_elem.text.strip()
-                    
-                    # Ищем Наименование группы
-                    name_elem = None
-                    if namespace:
-                        name_elem = group.find(f'{{{namespace}}}Наименование')
-                    if name_elem is None:
-                        name_elem = group.find('Наименование')
-                    if name_elem is None and 'catalog' in namespaces:
-                        try:
-                            name_elem = group.find('catalog:Наименование', namespaces)
-                        except (KeyError, ValueError):
-                            pass
-                    if name_elem is not None and name_elem.text:
-                        group_name = name_elem.text.strip()
-                    
-                    if group_id and group_name:
-                        groups_cache[group_id] = group_name
-                
-                logger.info(f"Кэш групп создан: {len(groups_cache)} групп")
-            else:
-                logger.warning("Классификатор не найден, кэш групп не создан")
-        except Exception as e:
-            logger.warning(f"Ошибка при создании кэша групп: {e}, продолжаем без кэша")
-        
-        # ВАЖНО: Группируем товары по ПОЛНОМУ external_id (не по base_id!)
-        # Это гарантирует, что каждый товар с уникальным external_id обрабатывается отдельно.
-        # Если в XML приходит несколько записей с одинаковым external_id - используем последнюю (обновлённые данные из 1С).
-        products_by_external_id = {}  # Словарь: external_id -> последние данные товара
-        
-        for idx, product_elem in enumerate(products_elements):
-            product_data = parse_commerceml_product(product_elem, namespaces, root, groups_cache=groups_cache)
-            if product_data:
-                # ВАЖНО: ключ группировки = ПОЛНЫЙ Ид (uuid#характеристика), если он есть.
-                external_id = _get_full_external_id_from_product_data(product_data)
-                if external_id:
-                    # ВАЖНО: Используем ПОЛНЫЙ external_id как ключ (не обрезаем до base_id!)
-                    # Это гарантирует, что товары с разными характеристиками обрабатываются отдельно.
-                    if external_id in products_by_external_id:
-                        # Если товар с таким external_id уже встречался, заменяем на последний вариант
-                        old_name = products_by_external_id[external_id].get('name', '')[:50]
-                        new_name = product_data.get('name', '')[:50]
-                        logger.info(f"Товар #{idx+1}: найден дубликат external_id {external_id}")
-                        logger.info(f"  Старое название: {old_name}")
-                        logger.info(f"  Новое название: {new_name}")
-                        logger.info(f"  → Используем данные из последнего варианта (измененные из 1С)")
-                    products_by_external_id[external_id] = product_data
-                else:
-                    # Если по какой-то причине Ид отсутствует, добавляем товар как есть
-                    products_data.append(product_data)
-                    logger.warning(f"Товар #{idx+1}: отсутствует Ид, добавлен как есть")
-                
-                if idx < 3:  # Логируем первые 3 товара для отладки
-                    logger.info(f"Товар #{idx+1}: sku={product_data.get('sku')}, name={product_data.get('name')[:50] if product_data.get('name') else 'N/A'}")
-            else:
-                logger.warning(f"Товар #{idx+1}: не удалось распарсить (нет обязательных полей)")
-                # Выводим структуру элемента для отладки
-                if idx < 3:
-                    logger.warning(f"  Структура элемента: tag={product_elem.tag}, атрибуты={product_elem.attrib}")
-                    for child in product_elem:
-                        logger.warning(f"    Дочерний: {child.tag} = {child.text[:50] if child.text else 'None'}")
-        
-        # Добавляем все уникальные товары (последние варианты для каждого external_id)
-        products_data.extend(products_by_external_id.values())
-        
-        logger.info(
-            f"Всего распарсено товаров: {len(products_data)} "
-            f"(уникальных по external_id: {len(products_by_external_id)})"
-        )
-        
-        if not products_data:
-            logger.warning("Товары не найдены в файле после парсинга")
-            # Сохраняем информацию о файле для отладки
-            logger.warning(f"Размер файла: {file_size} байт")
-            logger.warning(f"Корневой элемент XML: {root.tag}")
-            # Если это файл каталога (import.xml), но товары не найдены - это ошибка
-            # Создаем SyncLog с предупреждением
-            request_ip = get_client_ip(request) if request else None
-            SyncLog.objects.create(
-                operation_type='file_upload',
-                status='partial',
-                message=f'Файл {filename} обработан, но товары не найдены в XML',
-                processed_count=0,
-                created_count=0,
-                updated_count=0,
-                errors_count=1,
-                errors=[{'error': 'Товары не найдены в XML файле. Проверьте структуру файла.'}],
-                request_ip=request_ip,
-                request_format='CommerceML 2',
-                filename=filename,
-                processing_time=0
-            )
-            return {'status': 'partial', 'message': 'Товары не найдены в файле', 'processed': 0, 'created': 0, 'updated': 0}
-        
         total_processed = 0
         total_created = 0
         total_updated = 0
         all_errors = []
         results = {}
+        import_info = {}
 
         # import.xml: быстро создаём отсутствующие карточки только для ОПТА (нет в наличии).
         # Розница — только из offers.xml (товары с остатком > 0).
         logger.info(
-            f"Обработка import.xml: {len(products_data)} товаров "
+            f"Обработка import.xml: потоковый разбор "
             f"(быстрый режим: создание отсутствующих карточек опта «нет в наличии»)"
         )
         for current_catalog_type in ['wholesale']:
@@ -1102,9 +1179,26 @@ def process_commerceml_file(file_path, filename, request=None):
             logger.info(f"ОБРАБОТКА ДЛЯ КАТАЛОГА: {current_catalog_type.upper()}")
             logger.info("=" * 80)
 
-            bulk_result = bulk_ensure_missing_import_products(
-                products_data, catalog_type=current_catalog_type
-            )
+            # import.xml разбираем потоково: Классификатор/Группы попадают в groups_cache,
+            # затем каждый Товар разбирается, передаётся дальше и сразу освобождается.
+            # Память не зависит от размера каталога.
+            import_info = {}
+            if parsed is not None:
+                # Файл разобран в пуле: здесь только чтение готовых записей и запись в БД
+                import_info = parsed['info']
+                with exchange_phase('db_write'):
+                    bulk_result = bulk_ensure_missing_import_products(
+                        iter_spooled_records(parsed['spool']), catalog_type=current_catalog_type
+                    )
+            else:
+                # Разбор товаров идет по мере чтения генератора; запись пачек — фаза db_write
+                with exchange_phase('parse'), open_exchange_xml(file_path, xml_member) as xml_file:
+                    products_iter = iter_commerceml_import_products(
+                        xml_file, namespaces, groups_cache={}, info=import_info
+                    )
+                    bulk_result = bulk_ensure_missing_import_products(
+                        products_iter, catalog_type=current_catalog_type
+                    )
 
             created_count = bulk_result['created']
             updated_count = bulk_result['updated']
@@ -1137,6 +1231,38 @@ def process_commerceml_file(file_path, filename, request=None):
             total_updated += updated_count
             all_errors.extend(errors)
         
+        catalog_name = import_info.get('catalog_name') or ''
+        if catalog_name and any(keyword in catalog_name.lower() for keyword in ['опт', 'opt', 'wholesale', 'оптовый', 'оптовая', 'партнер', 'partner']):
+            logger.info(f"Название каталога указывает на ОПТОВЫЙ каталог: {catalog_name}")
+        logger.info(
+            f"Всего распарсено товаров: {import_info.get('parsed', 0)} "
+            f"(элементов Товар: {import_info.get('found', 0)}, групп: {import_info.get('groups', 0)})"
+        )
+        
+        if not import_info.get('parsed'):
+            logger.warning("Товары не найдены в файле после парсинга")
+            # Сохраняем информацию о файле для отладки
+            logger.warning(f"Размер файла: {file_size} байт")
+            # Если это файл каталога (import.xml), но товары не найдены - это ошибка
+            # Создаем SyncLog с предупреждением
+            request_ip = get_client_ip(request) if request else None
+            SyncLog.objects.create(
+                operation_type='file_upload',
+                status='partial',
+                message=f'Файл {filename} обработан, но товары не найдены в XML',
+                processed_count=0,
+                created_count=0,
+                updated_count=0,
+                errors_count=1,
+                errors=[{'error': 'Товары не найдены в XML файле. Проверьте структуру файла.'}],
+                request_ip=request_ip,
+                request_format='CommerceML 2',
+                filename=filename,
+                processing_time=0,
+                phase_profile=active_profiler().as_dict(),
+            )
+            return {'status': 'partial', 'message': 'Товары не найдены в файле', 'processed': 0, 'created': 0, 'updated': 0}
+        
         # ВАЖНО: Скрываем товары ТОЛЬКО ПОСЛЕ обработки каталога
         # Это предотвращает ситуацию, когда товары скрываются/показываются во время обработки
         # ВАЖНО: Скрываем товары ТОЛЬКО при обработке через веб-интерфейс (когда 1С загружает файлы напрямую)
@@ -1148,8 +1274,11 @@ def process_commerceml_file(file_path, filename, request=None):
         if not getattr(settings, 'ONE_C_HIDE_MISSING_PRODUCTS', False):
             should_hide_products = False
             logger.info("ONE_C_HIDE_MISSING_PRODUCTS=False — товары, отсутствующие в обмене, НЕ скрываем")
+        elif import_info.get('changes_only'):
+            # Пакет изменений содержит только изменившиеся позиции — остальные товары не трогаем.
+            logger.info(f"Каталог {filename} содержит только изменения — товары, отсутствующие в обмене, НЕ скрываем")
         
-        if getattr(settings, 'ONE_C_HIDE_MISSING_PRODUCTS', False):
+        if getattr(settings, 'ONE_C_HIDE_MISSING_PRODUCTS', False) and not import_info.get('changes_only'):
             # Проверяем, нужно ли скрывать товары для файлов обмена.
             # ВАЖНО: в проекте фактическое создание/обновление идёт из offers.xml,
             # поэтому скрытие должно срабатывать и на offers-файлах.
@@ -1225,61 +1354,25 @@ def process_commerceml_file(file_path, filename, request=None):
                     # ВАЖНО: Для вашего случая нужно, чтобы на сайте оставались ТОЛЬКО товары,
                     # которые пришли в текущем обмене. Поэтому НЕ смотрим на price/quantity,
                     # а скрываем все товары, которых нет в processed_external_ids.
-                    products_to_hide = Product.objects.filter(
-                        catalog_type=current_catalog_type,
-                        external_id__isnull=False,
-                        external_id__gt=''
-                    ).exclude(external_id__in=processed_external_ids)
-                    if processed_articles:
-                        art_list = list(processed_articles)
-                        art_lower = [a.lower() for a in art_list]
-                        products_to_hide = products_to_hide.exclude(
-                            Q(article__in=art_list) | Q(supplier_article__in=art_list)
-                        ).exclude(
-                            Q(article__in=art_lower) | Q(supplier_article__in=art_lower)
+                    with exchange_phase('hide_missing'):
+                        sweep = hide_products_missing_from_exchange(
+                            current_catalog_type, processed_external_ids, processed_articles
                         )
-                    
-                    deleted_count = products_to_hide.count()
+                    deleted_count = sweep['hidden']
                     if deleted_count > 0:
-                        logger.info(
-                            f"Найдено {deleted_count} товаров в каталоге {current_catalog_type}, "
-                            f"external_id которых НЕТ в текущем обмене (итого обработано: {len(processed_external_ids)}). "
-                            f"Скрываем их, чтобы на сайте показывались ТОЛЬКО товары из последнего XML."
-                        )
-                        # Логируем первые 5 для отладки
-                        for product in products_to_hide[:5]:
-                            if current_catalog_type == 'wholesale':
-                                price_val = product.wholesale_price or 0
-                            else:
-                                price_val = product.price or 0
-                            logger.info(
-                                f"  Скрываем (нет в текущем обмене): {product.name[:50]} "
-                                f"(external_id={product.external_id}, article={product.article}, "
-                                f"price={price_val}, quantity={product.quantity})"
-                            )
-                        
                         # Нет в offers: показываем на сайте как «нет в наличии», qty=0 (не уходит на Farpost)
-                        products_to_hide.update(
-                            quantity=0,
-                            is_active=True,
-                            availability='out_of_stock',
-                        )
                         logger.info(
                             f"✓ Отмечено как нет в наличии в каталоге {current_catalog_type}: {deleted_count} "
-                            f"(external_id НЕ входят в список из текущего обмена)"
+                            f"(external_id НЕ входят в список из текущего обмена, "
+                            f"итого обработано: {len(processed_external_ids)})"
                         )
                         total_deleted += deleted_count
                         # Обновляем результаты для текущего каталога
                         results[current_catalog_type]['deleted'] = deleted_count
 
-                    reactivated = Product.objects.filter(
-                        catalog_type=current_catalog_type,
-                        external_id__in=processed_external_ids,
-                        is_active=False,
-                    ).update(is_active=True)
-                    if reactivated:
+                    if sweep['reactivated']:
                         logger.info(
-                            f"✓ Повторно активировано {reactivated} товаров в каталоге "
+                            f"✓ Повторно активировано {sweep['reactivated']} товаров в каталоге "
                             f"{current_catalog_type} (есть в exchange и qty>0)"
                         )
                     if deleted_count == 0:
@@ -1320,7 +1413,7 @@ def process_commerceml_file(file_path, filename, request=None):
         # ВАЖНО: Создаем маркер обработанного файла, чтобы скрипт не обрабатывал его повторно
         # Это нужно как для прямого обмена, так и для обработки через скрипт
         # Создаем маркер только если товары действительно обработаны
-        # ВАЖНО: Создаем маркер для оригинального файла (file_path), а не для распакованного (xml_file_path)
+        # ВАЖНО: Создаем маркер для оригинального файла (file_path), в т.ч. для ZIP-архива, из которого читали XML
         if total_processed > 0:
             # Определяем, для какого файла создавать маркер
             # Если это ZIP, создаем маркер для ZIP файла
@@ -1378,36 +1471,38 @@ def process_commerceml_file(file_path, filename, request=None):
         else:
             logger.warning(f"⚠ Маркер не создан: total_processed={total_processed} (товары не обработаны)")
         
-            # ВАЖНО: Проверяем существование таблицы SyncLog перед использованием
-            from django.db import connection
-            table_exists = False
-            try:
-                with connection.cursor() as cursor:
-                    if 'sqlite' in connection.vendor:
-                        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='catalog_synclog'")
-                    else:
-                        cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_name='catalog_synclog'")
-                    table_exists = cursor.fetchone() is not None
-            except Exception:
-                pass
-            
-            if table_exists:
-                sync_log = SyncLog.objects.create(
-                    operation_type='file_upload',
-                    status=status,
-                    message=message,
-                    processed_count=total_processed,
-                    created_count=total_created,
-                    updated_count=total_updated,
-                    errors_count=len(all_errors),
-                    errors=all_errors,
-                    request_ip=request_ip,
-                    request_format='CommerceML 2',
-                    filename=filename,
-                    processing_time=processing_time
-                )
+        # ВАЖНО: Проверяем существование таблицы SyncLog перед использованием
+        from django.db import connection
+        table_exists = False
+        try:
+            with connection.cursor() as cursor:
+                if 'sqlite' in connection.vendor:
+                    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='catalog_synclog'")
+                else:
+                    cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_name='catalog_synclog'")
+                table_exists = cursor.fetchone() is not None
+        except Exception:
+            pass
+        
+        if table_exists:
+            SyncLog.objects.create(
+                operation_type='file_upload',
+                status=status,
+                message=message,
+                processed_count=total_processed,
+                created_count=total_created,
+                updated_count=total_updated,
+                errors_count=len(all_errors),
+                errors=all_errors,
+                request_ip=request_ip,
+                request_format='CommerceML 2',
+                filename=filename,
+                processing_time=processing_time,
+                phase_profile=active_profiler().as_dict(),
+            )
         
         logger.info(f"Импорт завершен: обработано {total_processed}, создано {total_created}, обновлено {total_updated}, скрыто {total_deleted}, ошибок {len(all_errors)}")
+        logger.info(f"Профиль обмена {filename}: {active_profiler().summary()}")
         # ВАЖНО: results может не содержать ключи 'retail'/'wholesale' при частичных сценариях — не падаем на логировании
         retail_stats = results.get('retail') if isinstance(results, dict) else None
         wholesale_stats = results.get('wholesale') if isinstance(results, dict) else None
@@ -1448,7 +1543,249 @@ def process_commerceml_file(file_path, filename, request=None):
         return {'status': 'failure', 'error': str(e)}
 
 
-def parse_commerceml_product(product_elem, namespaces, root_elem=None, groups_cache=None):
+def exchange_xml_members(zip_path):
+    """Имена XML файлов внутри ZIP-архива обмена (в порядке архива)."""
+    with zipfile.ZipFile(zip_path) as archive:
+        return [name for name in archive.namelist() if name.lower().endswith('.xml')]
+
+
+def find_exchange_archive(member):
+    """Самый свежий ZIP-архив директории обмена, в котором есть файл member, или None."""
+    try:
+        archives = [
+            os.path.join(EXCHANGE_DIR, name) for name in os.listdir(EXCHANGE_DIR)
+            if name.lower().endswith('.zip')
+        ]
+    except OSError:
+        return None
+    for archive_path in sorted(archives, key=os.path.getmtime, reverse=True):
+        try:
+            with zipfile.ZipFile(archive_path) as archive:
+                archive.getinfo(member)
+        except (KeyError, OSError, zipfile.BadZipFile):
+            continue
+        return archive_path
+    return None
+
+
+@contextmanager
+def open_exchange_xml(file_path, member=None):
+    """
+    Открывает XML обмена на чтение в бинарном режиме: файл на диске или member внутри ZIP.
+
+    Член архива читается потоком через ZipFile.open — на диск ничего не распаковывается,
+    парсер (iterparse/ET.parse) получает распакованные байты по мере чтения.
+    """
+    if not member:
+        with open(file_path, 'rb') as xml_file:
+            yield xml_file
+        return
+    with zipfile.ZipFile(file_path) as archive:
+        with archive.open(member) as xml_file:
+            yield xml_file
+
+
+def detect_commerceml_file_kind(source):
+    """
+    Определяет тип файла CommerceML по первым элементам, не строя дерево.
+
+    source — путь к файлу или открытый бинарный файл (см. open_exchange_xml).
+    Возвращает (kind, namespace), где kind — 'offers' (ПакетПредложений/Предложения),
+    'import' (Классификатор/Каталог) или None, если ни то ни другое не встретилось.
+    """
+    namespace = None
+    for _event, elem in ET.iterparse(source, events=('start',)):
+        if namespace is None and elem.tag.startswith('{'):
+            namespace = elem.tag[1:elem.tag.index('}')]
+        name = local_tag(elem.tag)
+        if name in ('ПакетПредложений', 'Предложения'):
+            return 'offers', namespace
+        if name in ('Классификатор', 'Каталог', 'catalog', 'Товары'):
+            return 'import', namespace
+    return None, namespace
+
+
+def _commerceml_namespaces(namespace):
+    """Словарь namespace для поиска элементов: найденный в файле (или стандартный) и urn:1C.ru:commerceml_2."""
+    namespaces = {}
+    if namespace:
+        # Используем найденный namespace
+        namespaces['cml'] = namespace
+        namespaces[''] = namespace
+    else:
+        # Стандартные namespace CommerceML
+        namespaces['cml'] = 'http://v8.1c.ru/8.3/commerceml'
+        namespaces[''] = 'http://v8.1c.ru/8.3/commerceml'
+    # Также добавляем альтернативный namespace (urn:1C.ru:commerceml_2)
+    namespaces['cml2'] = 'urn:1C.ru:commerceml_2'
+    return namespaces
+
+
+def _find_offers_package(root, namespace, namespaces):
+    """Ищет ПакетПредложений (или Предложения) в дереве offers-файла."""
+    package = None
+    if namespace:
+        package = root.find(f'.//{{{namespace}}}ПакетПредложений')
+    if package is None:
+        package = root.find('.//ПакетПредложений')
+    if package is None:
+        # Пробуем найти Предложения напрямую
+        if namespace:
+            package = root.find(f'.//{{{namespace}}}Предложения')
+        if package is None:
+            package = root.find('.//Предложения')
+    # Пробуем найти с альтернативными namespace (без префикса catalog)
+    if package is None:
+        for ns_key in ['cml', 'cml2', '']:
+            ns_value = namespaces.get(ns_key)
+            if not ns_value:
+                continue
+            package = root.find(f'.//{{{ns_value}}}ПакетПредложений')
+            if package is None:
+                package = root.find(f'.//{{{ns_value}}}Предложения')
+            if package is not None:
+                break
+    return package
+
+
+def _is_changes_only(elem):
+    """
+    Признак пакета изменений CommerceML (СодержитТолькоИзменения) у Каталог/ПакетПредложений.
+
+    В ранних версиях схемы это атрибут, в 2.05+ — дочерний элемент; поддерживаем оба варианта.
+    В таком пакете только изменившиеся позиции, поэтому отсутствующие в нём товары скрывать нельзя.
+    """
+    if elem is None:
+        return False
+    value = elem.attrib.get('СодержитТолькоИзменения')
+    if value is None:
+        value = _child_text(elem, 'СодержитТолькоИзменения')
+    return _is_true_flag(value)
+
+
+def _offers_changes_only(package):
+    """
+    Признак пакета изменений для offers-файла: у ПакетПредложений или у вложенного Предложения.
+
+    Как при потоковом разборе (iter_offer_elems): 1С ставит флаг на любой из двух элементов.
+    """
+    if package is None:
+        return False
+    if _is_changes_only(package):
+        return True
+    return any(
+        local_tag(child.tag) == 'Предложения' and _is_changes_only(child)
+        for child in package
+    )
+
+
+def _is_true_flag(value):
+    return (value or '').strip().lower() in ('true', '1', 'да')
+
+
+def _child_text(elem, tag):
+    """Текст прямого потомка с локальным именем tag (namespace не важен)."""
+    for child in elem:
+        if local_tag(child.tag) == tag:
+            return (child.text or '').strip()
+    return ''
+
+
+def iter_commerceml_import_products(source, namespaces, groups_cache=None, info=None):
+    """
+    Потоково разбирает import.xml через iterparse и отдаёт данные товаров по одному.
+    source — путь к файлу или открытый бинарный файл (см. open_exchange_xml).
+
+    Классификатор/Группы (в CommerceML идут раньше Каталога) складываются в groups_cache,
+    каждый Каталог/Товары/Товар разбирается parse_commerceml_product и сразу удаляется
+    из дерева — в памяти держится только текущий товар.
+
+    info (dict, опционально) заполняется статистикой: catalog_name, groups, found, parsed,
+    а также changes_only — Каталог помечен СодержитТолькоИзменения (пакет изменений).
+    """
+    if groups_cache is None:
+        groups_cache = {}
+    if info is None:
+        info = {}
+    info.update({'catalog_name': '', 'groups': 0, 'found': 0, 'parsed': 0, 'changes_only': False})
+
+    path = []
+    elems = []
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            name = local_tag(elem.tag)
+            if name in ('Каталог', 'catalog') and _is_true_flag(elem.attrib.get('СодержитТолькоИзменения')):
+                info['changes_only'] = True
+            path.append(name)
+            elems.append(elem)
+            continue
+
+        name = path.pop()
+        elems.pop()
+        parent_name = path[-1] if path else None
+        parent = elems[-1] if elems else None
+
+        if name == 'Группа' and 'Классификатор' in path:
+            group_id = _child_text(elem, 'Ид')
+            group_name = _child_text(elem, 'Наименование')
+            if group_id and group_name:
+                groups_cache[group_id] = group_name
+                info['groups'] += 1
+        elif name == 'Классификатор':
+            # Группы уже в кэше — освобождаем поддерево классификатора
+            logger.info(f"Кэш групп создан: {len(groups_cache)} групп")
+            elem.clear()
+        elif name == 'Наименование' and parent_name in ('Каталог', 'catalog'):
+            info['catalog_name'] = (elem.text or '').strip()
+        elif name == 'СодержитТолькоИзменения' and parent_name in ('Каталог', 'catalog'):
+            if _is_true_flag(elem.text):
+                info['changes_only'] = True
+        elif name == 'Товар' and parent_name == 'Товары':
+            info['found'] += 1
+            product_data = parse_commerceml_product(elem, namespaces, None, groups_cache=groups_cache)
+            if product_data:
+                info['parsed'] += 1
+            elif info['found'] - info['parsed'] <= 3:
+                logger.warning(f"Товар #{info['found']}: не удалось распарсить (нет обязательных полей)")
+                logger.warning(f"  Структура элемента: tag={elem.tag}, атрибуты={elem.attrib}")
+                for child in elem:
+                    logger.warning(f"    Дочерний: {child.tag} = {child.text[:50] if child.text else 'None'}")
+            elem.clear()
+            if parent is not None:
+                parent.remove(elem)
+            if product_data:
+                yield product_data
+
+
+def parse_exchange_file(file_path, member=None):
+    """
+    Потоково разбирает файл обмена в записи, не обращаясь к БД.
+
+    Выполняется в пуле процессов (см. exchange_package), поэтому результат — только
+    простые данные: kind и namespace; spool — временный файл с записями (товары
+    import как у iter_commerceml_import_products или записи предложений offers),
+    для import — info, для offers — total и changes_only. Записи читает
+    iter_spooled_records, запись в БД делает process_commerceml_file(..., parsed=...)
+    в основном процессе.
+    """
+    with open_exchange_xml(file_path, member) as xml_file:
+        kind, namespace = detect_commerceml_file_kind(xml_file)
+    namespaces = _commerceml_namespaces(namespace)
+    parsed = {'kind': kind, 'namespace': namespace}
+    if kind == 'offers':
+        info = {}
+        with open_exchange_xml(file_path, member) as xml_file:
+            spool = spool_records(iter_offer_records(iter_offer_elems(xml_file, info), namespace))
+        parsed.update({'spool': spool, 'total': info['total'], 'changes_only': info['changes_only']})
+    elif kind == 'import':
+        info = {}
+        with open_exchange_xml(file_path, member) as xml_file:
+            spool = spool_records(iter_commerceml_import_products(xml_file, namespaces, groups_cache={}, info=info))
+        parsed.update({'spool': spool, 'info': info})
+    return parsed
+
+
+def parse_commerceml_product(product_elem, namespaces, root_elem=None, groups_cache=None):
     """
     Парсит элемент товара из CommerceML 2 XML.
     
@@ -1456,7 +1793,7 @@ def parse_commerceml_product(product_elem, namespaces, root_elem=None, groups_ca
     
     Args:
         product_elem: Элемент товара из XML
-        namespaces: Словарь с namespace
+        namespaces: Словарь с namespace (нужен только для поиска группы в root_elem)
         root_elem: Корневой элемент XML (опционально, для поиска групп)
         groups_cache: Кэш групп {group_id: group_name} для оптимизации поиска
     """
@@ -1464,188 +1801,67 @@ def parse_commerceml_product(product_elem, namespaces, root_elem=None, groups_ca
     
     product_data = {}
     
-    # Получаем namespace из словаря (если есть)
-    namespace = namespaces.get('', namespaces.get('cml', None))
-    
-    # Функция для поиска элемента с разными вариантами
-    def find_elem(tag_name):
-        """Ищет элемент с разными вариантами namespace."""
-        # Вариант 1: С namespace напрямую (приоритет, если namespace есть)
-        if namespace:
-            elem = product_elem.find(f'{{{namespace}}}{tag_name}')
-            if elem is not None:
-                return elem
-        
-        # Вариант 2: Без namespace (если элементы без namespace)
-        elem = product_elem.find(tag_name)
-        if elem is not None:
-            return elem
-        
-        # Вариант 3: С префиксом catalog: (только если префикс определен в namespaces)
-        # Проверяем, что префикс 'catalog' действительно есть в словаре
-        if 'catalog' in namespaces:
-            try:
-                elem = product_elem.find(f'catalog:{tag_name}', namespaces)
-                if elem is not None:
-                    return elem
-            except (KeyError, ValueError):
-                # Если префикс не найден, просто пропускаем
-                pass
-        
-        return None
-    
-    # Идентификатор товара (Ид)
-    id_elem = find_elem('Ид')
-    if id_elem is not None and id_elem.text:
-        full_id = id_elem.text.strip()
+    # Товар разбирается за один обход поддерева; теги сравниваются без namespace
+    item = extract_commerceml_item(product_elem)
+    namespace = (namespaces or {}).get('', (namespaces or {}).get('cml', None))
+
+    if not hasattr(parse_commerceml_product, '_log_count'):
+        parse_commerceml_product._log_count = 0
+    parse_commerceml_product._log_count += 1
+
+    # Идентификатор товара: элемент Ид, иначе атрибут Ид
+    if item.id:
+        full_id, id_source = item.id, 'XML'
+    else:
+        full_id, id_source = item.attr_id, 'атрибутах XML'
+    if full_id:
         # ВАЖНО: В CommerceML 2.0 товар с вариантами характеристик имеет составной Ид вида "uuid#characteristic_id"
         # Например: "14393176-aa13-4ac2-8095-1a5459b743c7#51374053-fd66-11ea-80ce-00155d01d802"
         # ВАЖНО: Используем ПОЛНЫЙ Ид (включая часть после #) как external_id.
         # Это гарантирует, что каждый товар с уникальным полным Ид создаст отдельную карточку.
+        product_data['sku'] = full_id
+        product_data['external_id'] = full_id
         if '#' in full_id:
-            base_id = full_id.split('#', 1)[0].strip()  # base_id только для диагностики/логирования
-            # ВАЖНО: external_id = ПОЛНЫЙ Ид (включая часть после #)
-            # Каждая комбинация uuid#характеристика = отдельный товар.
-            product_data['base_id'] = base_id  # Только для диагностики
+            # base_id только для диагностики/логирования
+            product_data['base_id'] = full_id.split('#', 1)[0].strip()
             product_data['original_external_id'] = full_id
-            product_data['external_id'] = full_id  # ВАЖНО: Полный Ид!
-            product_data['sku'] = full_id
-            # Логируем для диагностики (только первые 3 товара)
-            if not hasattr(parse_commerceml_product, '_log_count'):
-                parse_commerceml_product._log_count = 0
-            parse_commerceml_product._log_count += 1
-            if parse_commerceml_product._log_count <= 3:
-                logger.info(f"Найден составной Ид товара в XML: ПОЛНЫЙ Ид={full_id}, base_id={base_id} (только для диагностики)")
-        else:
-            product_data['sku'] = full_id
-            product_data['external_id'] = full_id
-            # Логируем для диагностики (только первые 3 товара)
-            if not hasattr(parse_commerceml_product, '_log_count'):
-                parse_commerceml_product._log_count = 0
-            parse_commerceml_product._log_count += 1
-            if parse_commerceml_product._log_count <= 3:
-                logger.info(f"Найден Ид товара в XML: {product_data['external_id']}")
-    else:
-        # Пробуем найти Ид в атрибутах
-        if 'Ид' in product_elem.attrib:
-            full_id = product_elem.attrib['Ид'].strip()
-            # ВАЖНО: В CommerceML 2.0 товар с вариантами характеристик имеет составной Ид вида "uuid#characteristic_id"
-            # Здесь тоже: external_id = полный Ид, base_id — только вспомогательно.
-            if '#' in full_id:
-                base_id = full_id.split('#', 1)[0].strip()
-                product_data['base_id'] = base_id
-                product_data['original_external_id'] = full_id
-                product_data['external_id'] = full_id
-                product_data['sku'] = full_id
-                # Логируем для диагностики
-                if not hasattr(parse_commerceml_product, '_log_count'):
-                    parse_commerceml_product._log_count = 0
-                parse_commerceml_product._log_count += 1
-                if parse_commerceml_product._log_count <= 3:
-                    logger.info(f"Найден составной Ид товара в атрибутах XML: {full_id} -> используем base_id: {base_id}")
-            else:
-                product_data['sku'] = full_id
-                product_data['external_id'] = full_id
-                # Логируем для диагностики
-                if not hasattr(parse_commerceml_product, '_log_count'):
-                    parse_commerceml_product._log_count = 0
-                parse_commerceml_product._log_count += 1
-                if parse_commerceml_product._log_count <= 3:
-                    logger.info(f"Найден Ид товара в атрибутах XML: {product_data['external_id']}")
-        else:
-            # Логируем, если Ид не найден (только первые 3 товара)
-            if not hasattr(parse_commerceml_product, '_log_count'):
-                parse_commerceml_product._log_count = 0
-            parse_commerceml_product._log_count += 1
             if parse_commerceml_product._log_count <= 3:
-                logger.warning(f"⚠ Ид товара не найден в XML! Тег товара: {product_elem.tag}, атрибуты: {product_elem.attrib}")
-    
+                logger.info(
+                    f"Найден составной Ид товара в {id_source}: ПОЛНЫЙ Ид={full_id}, "
+                    f"base_id={product_data['base_id']} (только для диагностики)"
+                )
+        elif parse_commerceml_product._log_count <= 3:
+            logger.info(f"Найден Ид товара в {id_source}: {full_id}")
+    elif parse_commerceml_product._log_count <= 3:
+        logger.warning(f"⚠ Ид товара не найден в XML! Тег товара: {product_elem.tag}, атрибуты: {product_elem.attrib}")
+
     # Артикул
-    article_elem = find_elem('Артикул')
-    if article_elem is not None and article_elem.text:
-        product_data['article'] = article_elem.text.strip()
+    if item.article:
+        product_data['article'] = item.article
         if 'sku' not in product_data:
-            product_data['sku'] = article_elem.text.strip()
-    
+            product_data['sku'] = item.article
+
     # Наименование
-    name_elem = find_elem('Наименование')
-    if name_elem is not None and name_elem.text:
-        product_data['name'] = name_elem.text.strip()
-    
+    if item.name:
+        product_data['name'] = item.name
+
     # Описание
-    description_elem = find_elem('Описание')
-    if description_elem is not None and description_elem.text:
-        product_data['description'] = description_elem.text.strip()
-    
-    # Цены (ищем в предложениях)
-    # В CommerceML цены обычно в отдельном файле предложений, но могут быть и здесь
-    # Ищем цену в разных возможных местах структуры XML
-    price_elem = None
-    if namespace:
-        # Вариант 1: ЦенаЗаЕдиницу напрямую
-        price_elem = product_elem.find(f'.//{{{namespace}}}ЦенаЗаЕдиницу')
-        # Вариант 2: Цены/Цена/ЦенаЗаЕдиницу (полная структура)
-        if price_elem is None:
-            price_elem = product_elem.find(f'.//{{{namespace}}}Цены/{{{namespace}}}Цена/{{{namespace}}}ЦенаЗаЕдиницу')
-        # Вариант 3: Предложения/Предложение/Цены/Цена/ЦенаЗаЕдиницу
-        if price_elem is None:
-            price_elem = product_elem.find(f'.//{{{namespace}}}Предложения/{{{namespace}}}Предложение/{{{namespace}}}Цены/{{{namespace}}}Цена/{{{namespace}}}ЦенаЗаЕдиницу')
-    if price_elem is None:
-        # Без namespace
-        price_elem = product_elem.find('.//ЦенаЗаЕдиницу')
-        if price_elem is None:
-            price_elem = product_elem.find('.//Цены/Цена/ЦенаЗаЕдиницу')
-        if price_elem is None:
-            price_elem = product_elem.find('.//Предложения/Предложение/Цены/Цена/ЦенаЗаЕдиницу')
-    # Пробуем с префиксом catalog: только если он определен
-    if price_elem is None and 'catalog' in namespaces:
-        try:
-            price_elem = product_elem.find('.//catalog:ЦенаЗаЕдиницу', namespaces)
-            if price_elem is None:
-                price_elem = product_elem.find('.//catalog:Цены/catalog:Цена/catalog:ЦенаЗаЕдиницу', namespaces)
-        except (KeyError, ValueError):
-            pass
-    
-    if price_elem is not None and price_elem.text:
-        try:
-            price_str = price_elem.text.strip().replace(',', '.').replace(' ', '').replace('\xa0', '')
-            if price_str:
-                product_data['price'] = float(price_str)
-        except (ValueError, AttributeError, TypeError):
-            pass
-    
-    # Остатки (ищем в предложениях)
-    quantity_elem = None
-    if namespace:
-        quantity_elem = product_elem.find(f'.//{{{namespace}}}Количество')
-    if quantity_elem is None:
-        quantity_elem = product_elem.find('.//Количество')
-    # Пробуем с префиксом catalog: только если он определен
-    if quantity_elem is None and 'catalog' in namespaces:
-        try:
-            quantity_elem = product_elem.find('.//catalog:Количество', namespaces)
-        except (KeyError, ValueError):
-            pass
-    if quantity_elem is not None and quantity_elem.text:
-        try:
-            product_data['stock'] = int(float(quantity_elem.text.strip().replace(',', '.')))
-        except (ValueError, AttributeError):
-            pass
-    
+    if item.description:
+        product_data['description'] = item.description
+
+    # Цены (в CommerceML обычно в отдельном файле предложений, но могут быть и здесь)
+    price = next((p.value for p in item.prices if p.value is not None), None)
+    if price is not None:
+        product_data['price'] = price
+
+    # Остатки (первое Количество в товаре)
+    stock = parse_quantity(item.quantities[0]) if item.quantities else None
+    if stock is not None:
+        product_data['stock'] = stock
+
     # Категория (группа) - ищем название группы
-    group_elem = None
-    if namespace:
-        group_elem = product_elem.find(f'{{{namespace}}}Группы/{{{namespace}}}Ид')
-    if group_elem is None:
-        group_elem = product_elem.find('Группы/Ид')
-    # Пробуем с префиксом catalog: только если он определен
-    if group_elem is None and 'catalog' in namespaces:
-        try:
-            group_elem = product_elem.find('catalog:Группы/catalog:Ид', namespaces)
-        except (KeyError, ValueError):
-            pass
-    if group_elem is not None and group_elem.text:
-        product_data['category_id'] = group_elem.text.strip()
+    if item.group_ids and item.group_ids[0]:
+        product_data['category_id'] = item.group_ids[0]
         # Пробуем найти название группы в корне документа
         # Используем переданный root_elem
         root = root_elem
@@ -1664,8 +1880,6 @@ def parse_commerceml_product(product_elem, namespaces, root_elem=None, groups_ca
         if groups_cache and product_data['category_id'] in groups_cache:
             product_data['category_name'] = groups_cache[product_data['category_id']]
             # Логируем для первых 3 товаров
-            if not hasattr(parse_commerceml_product, '_log_count'):
-                parse_commerceml_product._log_count = 0
             parse_commerceml_product._log_count += 1
             if parse_commerceml_product._log_count <= 3:
                 logger.info(f"Категория из кэша для Ид {product_data['category_id']}: '{product_data['category_name']}'")
@@ -1676,12 +1890,6 @@ def parse_commerceml_product(product_elem, namespaces, root_elem=None, groups_ca
                 group_name_elem = root.find(f".//{{{namespace}}}Группа[@Ид='{product_data['category_id']}']/{{{namespace}}}Наименование")
             if group_name_elem is None:
                 group_name_elem = root.find(f".//Группа[@Ид='{product_data['category_id']}']/Наименование")
-            # Пробуем с префиксом catalog: только если он определен
-            if group_name_elem is None and 'catalog' in namespaces:
-                try:
-                    group_name_elem = root.find(f".//catalog:Группа[@Ид='{product_data['category_id']}']/catalog:Наименование", namespaces)
-                except (KeyError, ValueError):
-                    pass
             if group_name_elem is not None and group_name_elem.text:
                 product_data['category_name'] = group_name_elem.text.strip()
     
@@ -1689,380 +1897,245 @@ def parse_commerceml_product(product_elem, namespaces, root_elem=None, groups_ca
     characteristics = []
     
     # Вариант 1: ХарактеристикиТовара (как в вашем XML)
-    char_elem = None
-    if namespace:
-        char_elem = product_elem.find(f'{{{namespace}}}ХарактеристикиТовара')
-    if char_elem is None:
-        char_elem = product_elem.find('ХарактеристикиТовара')
-    # Пробуем с префиксом catalog: только если он определен
-    if char_elem is None and 'catalog' in namespaces:
-        try:
-            char_elem = product_elem.find('catalog:ХарактеристикиТовара', namespaces)
-        except (KeyError, ValueError):
-            pass
-    
-    if char_elem is not None:
-        # Ищем все ХарактеристикаТовара
-        char_items = []
-        if namespace:
-            char_items = char_elem.findall(f'{{{namespace}}}ХарактеристикаТовара')
-        if not char_items:
-            char_items = char_elem.findall('ХарактеристикаТовара')
-        # Пробуем с префиксом catalog: только если он определен
-        if not char_items and 'catalog' in namespaces:
-            try:
-                char_items = char_elem.findall('catalog:ХарактеристикаТовара', namespaces)
-            except (KeyError, ValueError):
-                pass
-        
-        for char_item in char_items:
-            # Ищем Наименование
-            char_name_elem = None
-            if namespace:
-                char_name_elem = char_item.find(f'{{{namespace}}}Наименование')
-            if char_name_elem is None:
-                char_name_elem = char_item.find('Наименование')
-            # Пробуем с префиксом catalog: только если он определен
-            if char_name_elem is None and 'catalog' in namespaces:
-                try:
-                    char_name_elem = char_item.find('catalog:Наименование', namespaces)
-                except (KeyError, ValueError):
-                    pass
-            
-            # Ищем Значение
-            char_value_elem = None
-            if namespace:
-                char_value_elem = char_item.find(f'{{{namespace}}}Значение')
-            if char_value_elem is None:
-                char_value_elem = char_item.find('Значение')
-            # Пробуем с префиксом catalog: только если он определен
-            if char_value_elem is None and 'catalog' in namespaces:
-                try:
-                    char_value_elem = char_item.find('catalog:Значение', namespaces)
-                except (KeyError, ValueError):
-                    pass
+    for char_item in item.characteristics:
+        if char_item.name is not None and char_item.value is not None:
+            # Значение собрано со всего текста элемента (itertext) — это важно для "Размера",
+            # который может содержать сложные значения типа "12V/140А/ПЛ.РЕМ.6Д/ОВ.Ф/ЗКОНТ"
+            char_name = char_item.name
+            char_value = char_item.value
+
+            # Логируем извлечение "Размера" для отладки (только первые 3)
+            if char_name and ('размер' in char_name.lower() or 'size' in char_name.lower()):
+                if not hasattr(parse_commerceml_product, '_log_size_extract_count'):
+                    parse_commerceml_product._log_size_extract_count = 0
+                parse_commerceml_product._log_size_extract_count += 1
+                if parse_commerceml_product._log_size_extract_count <= 3:
+                    logger.info(f"[XML] Извлечение 'Размер': name='{char_name}', value='{char_value}' (длина={len(char_value)})")
             
-            if char_name_elem is not None and char_value_elem is not None:
-                # Извлекаем полное имя характеристики
-                char_name = char_name_elem.text.strip() if char_name_elem.text else ''
-                # Извлекаем полное значение характеристики, включая весь текст из элемента и дочерних элементов
-                # Это важно для "Размера", который может содержать сложные значения типа "12V/140А/ПЛ.РЕМ.6Д/ОВ.Ф/ЗКОНТ"
-                # Используем itertext() для сбора всего текста, включая дочерние элементы
-                # ВАЖНО: Не используем strip() для каждой части, чтобы сохранить пробелы внутри значения
-                char_value_parts = []
-                for text in char_value_elem.itertext():
-                    if text:
-                        # Сохраняем текст как есть, только убираем лишние пробелы в начале/конце строк
-                        char_value_parts.append(text)
-                # Объединяем все части без добавления пробелов (они уже есть в тексте)
-                char_value = ''.join(char_value_parts).strip() if char_value_parts else ''
-                
-                # Логируем извлечение "Размера" для отладки (только первые 3)
-                if char_name and ('размер' in char_name.lower() or 'size' in char_name.lower()):
-                    if not hasattr(parse_commerceml_product, '_log_size_extract_count'):
-                        parse_commerceml_product._log_size_extract_count = 0
-                    parse_commerceml_product._log_size_extract_count += 1
-                    if parse_commerceml_product._log_size_extract_count <= 3:
-                        logger.info(f"[XML] Извлечение 'Размер': name='{char_name}', value='{char_value}' (длина={len(char_value)})")
+            if char_name and char_value:
+                char_name_lower = char_name.lower()
                 
-                if char_name and char_value:
-                    char_name_lower = char_name.lower()
-                    
-                    # Обрабатываем служебные характеристики - они не должны попадать в characteristics
-                    # Артикул1 → article + supplier_article (колонка «Артикул» в опте)
-                    if char_name_lower in ['артикул1', 'артикул 1', 'article1', 'article 1']:
-                        if not product_data.get('article'):
-                            product_data['article'] = char_value
-                        if not product_data.get('supplier_article'):
-                            product_data['supplier_article'] = char_value
-                        # Добавляем в кросс-номера, если article уже был заполнен
-                        elif product_data.get('article') != char_value:
-                            if 'cross_numbers' not in product_data:
-                                product_data['cross_numbers'] = []
-                            product_data['cross_numbers'].append(char_value)
-                    
-                    # Артикул2 → cross_numbers (OEM номер)
-                    elif char_name_lower in ['артикул2', 'артикул 2', 'article2', 'article 2', 'oem', 'oem номер']:
+                # Обрабатываем служебные характеристики - они не должны попадать в characteristics
+                # Артикул1 → article + supplier_article (колонка «Артикул» в опте)
+                if char_name_lower in ['артикул1', 'артикул 1', 'article1', 'article 1']:
+                    if not product_data.get('article'):
+                        product_data['article'] = char_value
+                    if not product_data.get('supplier_article'):
+                        product_data['supplier_article'] = char_value
+                    # Добавляем в кросс-номера, если article уже был заполнен
+                    elif product_data.get('article') != char_value:
                         if 'cross_numbers' not in product_data:
                             product_data['cross_numbers'] = []
                         product_data['cross_numbers'].append(char_value)
-                    
-                    # Марка → brand (бренд)
-                    elif char_name_lower in ['марка', 'brand', 'бренд']:
-                        product_data['brand'] = char_value
-                    
-                    # Двигатель → engine (для раздела "Применимость")
-                    # ВАЖНО: Не добавляем в applicability здесь, чтобы избежать дублирования
-                    # applicability будет заполнено из engine при сохранении товара
-                    elif char_name_lower in ['двигатель', 'engine', 'мотор']:
-                        if 'engine' not in product_data:
-                            product_data['engine'] = []
-                        if char_value not in product_data['engine']:
-                            product_data['engine'].append(char_value)
-                    
-                    # Кузов → body (для раздела "Применимость"/описание)
-                    # ВАЖНО: Не добавляем в applicability здесь, чтобы избежать дублирования
-                    # applicability будет заполнено из body при сохранении товара
-                    elif char_name_lower in ['кузов', 'body', 'тип кузова']:
-                        if 'body' not in product_data:
-                            product_data['body'] = []
-                        if char_value not in product_data['body']:
-                            product_data['body'].append(char_value)
-                    
-                    # Размер → всегда в характеристики (без фильтрации)
-                    elif 'размер' in char_name_lower or 'size' in char_name_lower:
+                
+                # Артикул2 → cross_numbers (OEM номер)
+                elif char_name_lower in ['артикул2', 'артикул 2', 'article2', 'article 2', 'oem', 'oem номер']:
+                    if 'cross_numbers' not in product_data:
+                        product_data['cross_numbers'] = []
+                    product_data['cross_numbers'].append(char_value)
+                
+                # Марка → brand (бренд)
+                elif char_name_lower in ['марка', 'brand', 'бренд']:
+                    product_data['brand'] = char_value
+                
+                # Двигатель → engine (для раздела "Применимость")
+                # ВАЖНО: Не добавляем в applicability здесь, чтобы избежать дублирования
+                # applicability будет заполнено из engine при сохранении товара
+                elif char_name_lower in ['двигатель', 'engine', 'мотор']:
+                    if 'engine' not in product_data:
+                        product_data['engine'] = []
+                    if char_value not in product_data['engine']:
+                        product_data['engine'].append(char_value)
+                
+                # Кузов → body (для раздела "Применимость"/описание)
+                # ВАЖНО: Не добавляем в applicability здесь, чтобы избежать дублирования
+                # applicability будет заполнено из body при сохранении товара
+                elif char_name_lower in ['кузов', 'body', 'тип кузова']:
+                    if 'body' not in product_data:
+                        product_data['body'] = []
+                    if char_value not in product_data['body']:
+                        product_data['body'].append(char_value)
+                
+                # Размер → всегда в характеристики (без фильтрации)
+                elif 'размер' in char_name_lower or 'size' in char_name_lower:
+                    characteristics.append({
+                        'name': char_name,
+                        'value': char_value
+                    })
+                
+                # Проверяем, является ли значение размером (например, 128*410 мм, 20*450, 260*170*10*29)
+                # ВАЖНО: Размеры могут быть в любых характеристиках, не только в поле "Размер"
+                elif re.search(r'\d+(?:\*|x)\d+(?:(?:\*|x)\d+)*(?:\s*(?:мм|см|м|mm|cm|m))?', char_value, re.IGNORECASE):
+                    # Это размер - добавляем в характеристики как "Размер"
+                    # Ищем существующий Размер в characteristics и заменяем его
+                    size_found = False
+                    for i, char in enumerate(characteristics):
+                        if isinstance(char, dict) and ('размер' in char.get('name', '').lower() or 'size' in char.get('name', '').lower()):
+                            # Объединяем значения, если размер уже есть
+                            existing_value = char.get('value', '')
+                            if char_value not in existing_value:
+                                characteristics[i] = {
+                                    'name': 'Размер',
+                                    'value': f"{existing_value}, {char_value}" if existing_value else char_value
+                                }
+                            size_found = True
+                            break
+                    # Если не нашли, добавляем новый
+                    if not size_found:
                         characteristics.append({
-                            'name': char_name,
-                            'value': char_value
-                        })
+                            'name': 'Размер',
+                        'value': char_value
+                    })
+                
+                # Все остальные характеристики добавляем в список
+                # ВАЖНО: Фильтруем неправильные значения (коды моделей, материалы и т.д.)
+                else:
+                    # Исключаем материалы
+                    excluded_materials = ['прокладка', 'gasket', 'паронит', 'paronit', 'материал', 'material']
+                    char_name_lower = char_name.lower()
+                    char_value_upper = char_value.upper()
                     
-                    # Проверяем, является ли значение размером (например, 128*410 мм, 20*450, 260*170*10*29)
-                    # ВАЖНО: Размеры могут быть в любых характеристиках, не только в поле "Размер"
-                    elif re.search(r'\d+(?:\*|x)\d+(?:(?:\*|x)\d+)*(?:\s*(?:мм|см|м|mm|cm|m))?', char_value, re.IGNORECASE):
-                        # Это размер - добавляем в характеристики как "Размер"
-                        # Ищем существующий Размер в characteristics и заменяем его
-                        size_found = False
-                        for i, char in enumerate(characteristics):
-                            if isinstance(char, dict) and ('размер' in char.get('name', '').lower() or 'size' in char.get('name', '').lower()):
-                                # Объединяем значения, если размер уже есть
-                                existing_value = char.get('value', '')
-                                if char_value not in existing_value:
-                                    characteristics[i] = {
-                                        'name': 'Размер',
-                                        'value': f"{existing_value}, {char_value}" if existing_value else char_value
-                                    }
-                                size_found = True
-                                break
-                        # Если не нашли, добавляем новый
-                        if not size_found:
-                            characteristics.append({
-                                'name': 'Размер',
-                            'value': char_value
-                        })
+                    # Пропускаем материалы
+                    if any(material in char_name_lower for material in excluded_materials):
+                        continue
                     
-                    # Все остальные характеристики добавляем в список
-                    # ВАЖНО: Фильтруем неправильные значения (коды моделей, материалы и т.д.)
-                    else:
-                        # Исключаем материалы
-                        excluded_materials = ['прокладка', 'gasket', 'паронит', 'paronit', 'материал', 'material']
-                        char_name_lower = char_name.lower()
-                        char_value_upper = char_value.upper()
-                        
-                        # Пропускаем материалы
-                        if any(material in char_name_lower for material in excluded_materials):
-                            continue
-                        
-                        from catalog.services import _looks_like_model_code_not_characteristic
-                        if _looks_like_model_code_not_characteristic(char_value):
-                            continue
+                    from catalog.services import _looks_like_model_code_not_characteristic
+                    if _looks_like_model_code_not_characteristic(char_value):
+                        continue
+
+                    characteristics.append({
+                        'name': char_name,
+                        'value': char_value
+                    })
 
-                        characteristics.append({
-                            'name': char_name,
-                            'value': char_value
-                        })
-    
     # Вариант 2: ЗначенияСвойств (старый формат)
     # ВАЖНО: Обрабатываем ЗначенияСвойств всегда, даже если есть ХарактеристикиТовара,
-    # так как в XML могут быть оба варианта одновременно
-    props_elem = None
-    prop_items = []  # ВАЖНО: всегда инициализируем, чтобы не было UnboundLocalError
-    if namespace:
-        props_elem = product_elem.find(f'{{{namespace}}}ЗначенияСвойств')
-    if props_elem is None:
-        props_elem = product_elem.find('ЗначенияСвойств')
-    # Пробуем с префиксом catalog: только если он определен
-    if props_elem is None and 'catalog' in namespaces:
-        try:
-            props_elem = product_elem.find('catalog:ЗначенияСвойств', namespaces)
-        except (KeyError, ValueError):
-            pass
-    
-    if props_elem is not None:
-        if namespace:
-            prop_items = props_elem.findall(f'{{{namespace}}}ЗначенияСвойства')
-        if not prop_items:
-            prop_items = props_elem.findall('ЗначенияСвойства')
-        # Пробуем с префиксом catalog: только если он определен
-        if not prop_items and 'catalog' in namespaces:
-            try:
-                prop_items = props_elem.findall('catalog:ЗначенияСвойства', namespaces)
-            except (KeyError, ValueError):
-                pass
-        
-    if prop_items:
-            # ВАЖНО: Обрабатываем ЗначенияСвойств всегда для специальных полей (Артикул1, Артикул2, Двигатель, Кузов, Размер)
-            # Эти поля должны браться из ЗначенияСвойств, а не из ХарактеристикиТовара
-            # Для остальных характеристик добавляем только если characteristics пуст, чтобы избежать дублирования
-            for prop_elem in prop_items:
-                # Ищем Наименование свойства (приоритет)
-                prop_name_elem = None
-                if namespace:
-                    prop_name_elem = prop_elem.find(f'{{{namespace}}}Наименование')
-                if prop_name_elem is None:
-                    prop_name_elem = prop_elem.find('Наименование')
-                # Пробуем с префиксом catalog: только если он определен
-                if prop_name_elem is None and 'catalog' in namespaces:
-                    try:
-                        prop_name_elem = prop_elem.find('catalog:Наименование', namespaces)
-                    except (KeyError, ValueError):
-                        pass
+    # так как в XML могут быть оба варианта одновременно. Специальные поля (Артикул1, Артикул2,
+    # Двигатель, Кузов, Размер) должны браться из ЗначенияСвойств, а не из ХарактеристикиТовара
+    for prop in item.properties:
+        # Если Наименование не найдено, используем Ид как fallback (для совместимости)
+        prop_name = prop.name if prop.name is not None else prop.id
+        if prop_name is not None and prop.value is not None:
+            prop_val = prop.value
+            
+            if prop_name:
+                prop_name_lower = prop_name.lower()
                 
-                # Если Наименование не найдено, используем Ид как fallback (для совместимости)
-                if prop_name_elem is None:
-                    prop_id_elem = None
-                    if namespace:
-                        prop_id_elem = prop_elem.find(f'{{{namespace}}}Ид')
-                    if prop_id_elem is None:
-                        prop_id_elem = prop_elem.find('Ид')
-                    if prop_id_elem is None and 'catalog' in namespaces:
-                        try:
-                            prop_id_elem = prop_elem.find('catalog:Ид', namespaces)
-                        except (KeyError, ValueError):
-                            pass
-                    if prop_id_elem is not None:
-                        prop_name_elem = prop_id_elem  # Используем Ид как fallback
+                # ВАЖНО: "Размер" обрабатываем ПЕРВЫМ и ВСЕГДА, даже если значение пустое!
+                # Это гарантирует, что значение "Размер" всегда попадет в характеристики
+                if 'размер' in prop_name_lower or 'size' in prop_name_lower:
+                    # Ищем существующий Размер в characteristics и заменяем его
+                    size_found = False
+                    for i, char in enumerate(characteristics):
+                        if isinstance(char, dict) and ('размер' in char.get('name', '').lower() or 'size' in char.get('name', '').lower()):
+                            characteristics[i] = {
+                                'name': prop_name,
+                                'value': prop_val  # Добавляем значение, даже если оно пустое
+                            }
+                            size_found = True
+                            break
+                    # Если не нашли, добавляем новый
+                    if not size_found:
+                        characteristics.append({
+                            'name': prop_name,
+                            'value': prop_val  # Добавляем значение, даже если оно пустое
+                        })
+                    # Продолжаем обработку только если значение не пустое (для остальных полей)
+                    if not prop_val:
+                        continue
                 
-                # Ищем Значение свойства
-                prop_value_elem = None
-                if namespace:
-                    prop_value_elem = prop_elem.find(f'{{{namespace}}}Значение')
-                if prop_value_elem is None:
-                    prop_value_elem = prop_elem.find('Значение')
-                # Пробуем с префиксом catalog: только если он определен
-                if prop_value_elem is None and 'catalog' in namespaces:
-                    try:
-                        prop_value_elem = prop_elem.find('catalog:Значение', namespaces)
-                    except (KeyError, ValueError):
-                        pass
+                # Обрабатываем служебные свойства - они не должны попадать в characteristics
+                # Артикул1 → article + supplier_article (колонка «Артикул» в опте)
+                if prop_name_lower in ['артикул1', 'артикул 1', 'article1', 'article 1']:
+                    if not product_data.get('article'):
+                        product_data['article'] = prop_val
+                    if not product_data.get('supplier_article'):
+                        product_data['supplier_article'] = prop_val
+                    # Добавляем в кросс-номера, если article уже был заполнен
+                    elif product_data.get('article') != prop_val:
+                        if 'cross_numbers' not in product_data:
+                            product_data['cross_numbers'] = []
+                        if prop_val not in product_data['cross_numbers']:
+                            product_data['cross_numbers'].append(prop_val)
                 
-                if prop_name_elem is not None and prop_value_elem is not None:
-                    # Извлекаем полное имя свойства
-                    prop_name = prop_name_elem.text.strip() if prop_name_elem.text else ''
-                    # Извлекаем полное значение свойства, включая весь текст из элемента и дочерних элементов
-                    prop_value_parts = []
-                    for text in prop_value_elem.itertext():
-                        if text:
-                            prop_value_parts.append(text)
-                    prop_val = ''.join(prop_value_parts).strip() if prop_value_parts else ''
-                    
-                    if prop_name:
-                        prop_name_lower = prop_name.lower()
-                        
-                        # ВАЖНО: "Размер" обрабатываем ПЕРВЫМ и ВСЕГДА, даже если значение пустое!
-                        # Это гарантирует, что значение "Размер" всегда попадет в характеристики
-                        if 'размер' in prop_name_lower or 'size' in prop_name_lower:
-                            # Ищем существующий Размер в characteristics и заменяем его
-                            size_found = False
-                            for i, char in enumerate(characteristics):
-                                if isinstance(char, dict) and ('размер' in char.get('name', '').lower() or 'size' in char.get('name', '').lower()):
-                                    characteristics[i] = {
-                                        'name': prop_name,
-                                        'value': prop_val  # Добавляем значение, даже если оно пустое
-                                    }
-                                    size_found = True
-                                    break
-                            # Если не нашли, добавляем новый
-                            if not size_found:
-                                characteristics.append({
-                                    'name': prop_name,
-                                    'value': prop_val  # Добавляем значение, даже если оно пустое
-                                })
-                            # Продолжаем обработку только если значение не пустое (для остальных полей)
-                            if not prop_val:
-                                continue
-                        
-                        # Обрабатываем служебные свойства - они не должны попадать в characteristics
-                        # Артикул1 → article + supplier_article (колонка «Артикул» в опте)
-                        if prop_name_lower in ['артикул1', 'артикул 1', 'article1', 'article 1']:
-                            if not product_data.get('article'):
-                                product_data['article'] = prop_val
-                            if not product_data.get('supplier_article'):
-                                product_data['supplier_article'] = prop_val
-                            # Добавляем в кросс-номера, если article уже был заполнен
-                            elif product_data.get('article') != prop_val:
-                                if 'cross_numbers' not in product_data:
-                                    product_data['cross_numbers'] = []
-                                if prop_val not in product_data['cross_numbers']:
-                                    product_data['cross_numbers'].append(prop_val)
-                        
-                        # Артикул2 → cross_numbers (OEM номер)
-                        elif prop_name_lower in ['артикул2', 'артикул 2', 'article2', 'article 2', 'oem', 'oem номер']:
-                            if 'cross_numbers' not in product_data:
-                                product_data['cross_numbers'] = []
-                            if prop_val not in product_data['cross_numbers']:
-                                product_data['cross_numbers'].append(prop_val)
-                        
-                        # Марка → brand (бренд)
-                        elif prop_name_lower in ['марка', 'brand', 'бренд']:
-                            product_data['brand'] = prop_val
-                        
-                        # Двигатель → engine (для раздела "Применимость")
-                        # ВАЖНО: Не добавляем в applicability здесь, чтобы избежать дублирования
-                        # applicability будет заполнено из engine при сохранении товара
-                        elif prop_name_lower in ['двигатель', 'engine', 'мотор']:
-                            if 'engine' not in product_data:
-                                product_data['engine'] = []
-                            if prop_val not in product_data['engine']:
-                                product_data['engine'].append(prop_val)
-                        
-                        # Кузов → body (для раздела "Применимость"/описание)
-                        # ВАЖНО: Не добавляем в applicability здесь, чтобы избежать дублирования
-                        # applicability будет заполнено из body при сохранении товара
-                        elif prop_name_lower in ['кузов', 'body', 'тип кузова']:
-                            if 'body' not in product_data:
-                                product_data['body'] = []
-                            if prop_val not in product_data['body']:
-                                product_data['body'].append(prop_val)
-                        
-                        # Проверяем, является ли значение размером (например, 128*410 мм, 20*450, 260*170*10*29)
-                        # ВАЖНО: Размеры могут быть в любых характеристиках, не только в поле "Размер"
-                        # Но только если поле НЕ называется "Размер" (так как "Размер" уже обработан выше)
-                        elif prop_val and 'размер' not in prop_name_lower and 'size' not in prop_name_lower and re.search(r'\d+(?:\*|x)\d+(?:(?:\*|x)\d+)*(?:\s*(?:мм|см|м|mm|cm|m))?', prop_val, re.IGNORECASE):
-                            # Это размер - добавляем в характеристики как "Размер"
-                            # Ищем существующий Размер в characteristics и заменяем его
-                            size_found = False
-                            for i, char in enumerate(characteristics):
-                                if isinstance(char, dict) and ('размер' in char.get('name', '').lower() or 'size' in char.get('name', '').lower()):
-                                    # Объединяем значения, если размер уже есть
-                                    existing_value = char.get('value', '')
-                                    if prop_val not in existing_value:
-                                        characteristics[i] = {
-                                            'name': 'Размер',
-                                            'value': f"{existing_value}, {prop_val}" if existing_value else prop_val
-                                        }
-                                    size_found = True
-                                    break
-                            # Если не нашли, добавляем новый
-                            if not size_found:
-                                characteristics.append({
+                # Артикул2 → cross_numbers (OEM номер)
+                elif prop_name_lower in ['артикул2', 'артикул 2', 'article2', 'article 2', 'oem', 'oem номер']:
+                    if 'cross_numbers' not in product_data:
+                        product_data['cross_numbers'] = []
+                    if prop_val not in product_data['cross_numbers']:
+                        product_data['cross_numbers'].append(prop_val)
+                
+                # Марка → brand (бренд)
+                elif prop_name_lower in ['марка', 'brand', 'бренд']:
+                    product_data['brand'] = prop_val
+                
+                # Двигатель → engine (для раздела "Применимость")
+                # ВАЖНО: Не добавляем в applicability здесь, чтобы избежать дублирования
+                # applicability будет заполнено из engine при сохранении товара
+                elif prop_name_lower in ['двигатель', 'engine', 'мотор']:
+                    if 'engine' not in product_data:
+                        product_data['engine'] = []
+                    if prop_val not in product_data['engine']:
+                        product_data['engine'].append(prop_val)
+                
+                # Кузов → body (для раздела "Применимость"/описание)
+                # ВАЖНО: Не добавляем в applicability здесь, чтобы избежать дублирования
+                # applicability будет заполнено из body при сохранении товара
+                elif prop_name_lower in ['кузов', 'body', 'тип кузова']:
+                    if 'body' not in product_data:
+                        product_data['body'] = []
+                    if prop_val not in product_data['body']:
+                        product_data['body'].append(prop_val)
+                
+                # Проверяем, является ли значение размером (например, 128*410 мм, 20*450, 260*170*10*29)
+                # ВАЖНО: Размеры могут быть в любых характеристиках, не только в поле "Размер"
+                # Но только если поле НЕ называется "Размер" (так как "Размер" уже обработан выше)
+                elif prop_val and 'размер' not in prop_name_lower and 'size' not in prop_name_lower and re.search(r'\d+(?:\*|x)\d+(?:(?:\*|x)\d+)*(?:\s*(?:мм|см|м|mm|cm|m))?', prop_val, re.IGNORECASE):
+                    # Это размер - добавляем в характеристики как "Размер"
+                    # Ищем существующий Размер в characteristics и заменяем его
+                    size_found = False
+                    for i, char in enumerate(characteristics):
+                        if isinstance(char, dict) and ('размер' in char.get('name', '').lower() or 'size' in char.get('name', '').lower()):
+                            # Объединяем значения, если размер уже есть
+                            existing_value = char.get('value', '')
+                            if prop_val not in existing_value:
+                                characteristics[i] = {
                                     'name': 'Размер',
-                                    'value': prop_val
-                                })
-                        
-                        # Свойства карточки из 1С (ЗначенияСвойств) — всегда сохраняем
-                        elif prop_name_lower in (
-                            'номер', 'number', 'oem', 'артикул', 'article',
-                            'характеристика', 'характеристики',
-                            'применимо для моделей', 'применимо для двигателей',
-                            'кросс-номера', 'кросс-номер', 'кросс номер',
-                        ) or prop_name_lower.startswith('применимо для'):
-                            characteristics.append({
-                                'name': prop_name,
-                                'value': prop_val,
-                            })
-
-                        # Остальные свойства — с фильтрацией кодов моделей
-                        else:
-                            from catalog.services import _looks_like_model_code_not_characteristic
-                            excluded_materials = ['прокладка', 'gasket', 'паронит', 'paronit', 'материал', 'material']
-                            if any(material in prop_name_lower for material in excluded_materials):
-                                continue
-                            if _looks_like_model_code_not_characteristic(prop_val):
-                                continue
-                            characteristics.append({
-                                'name': prop_name,
-                                'value': prop_val,
-                            })
+                                    'value': f"{existing_value}, {prop_val}" if existing_value else prop_val
+                                }
+                            size_found = True
+                            break
+                    # Если не нашли, добавляем новый
+                    if not size_found:
+                        characteristics.append({
+                            'name': 'Размер',
+                            'value': prop_val
+                        })
+                
+                # Свойства карточки из 1С (ЗначенияСвойств) — всегда сохраняем
+                elif prop_name_lower in (
+                    'номер', 'number', 'oem', 'артикул', 'article',
+                    'характеристика', 'характеристики',
+                    'применимо для моделей', 'применимо для двигателей',
+                    'кросс-номера', 'кросс-номер', 'кросс номер',
+                ) or prop_name_lower.startswith('применимо для'):
+                    characteristics.append({
+                        'name': prop_name,
+                        'value': prop_val,
+                    })
+
+                # Остальные свойства — с фильтрацией кодов моделей
+                else:
+                    from catalog.services import _looks_like_model_code_not_characteristic
+                    excluded_materials = ['прокладка', 'gasket', 'паронит', 'paronit', 'материал', 'material']
+                    if any(material in prop_name_lower for material in excluded_materials):
+                        continue
+                    if _looks_like_model_code_not_characteristic(prop_val):
+                        continue
+                    characteristics.append({
+                        'name': prop_name,
+                        'value': prop_val,
+                    })
     
     if characteristics:
         product_data['characteristics'] = characteristics
@@ -2073,12 +2146,263 @@ def parse_commerceml_product(product_elem, namespaces, root_elem=None, groups_ca
     return product_data if product_data.get('sku') and product_data.get('name') else None
 
 
-def process_offers_file_single_pass(root, namespaces, filename, request=None):
-    """Обрабатывает offers.xml одним проходом сразу для retail и wholesale."""
-    from .models import Category
-    from .services import get_category_for_product
+# Сколько предложений offers.xml обрабатывается за одну пачку (один SELECT + одна транзакция)
+OFFERS_BATCH_SIZE = getattr(settings, 'ONE_C_OFFERS_BATCH_SIZE', 400)
+
+
+def _apply_offer_fields(product, rec, catalog_type, created, resolve_category):
+    """Переносит поля предложения в карточку (правила те же, что при поштучном сохранении)."""
+    product.external_id = rec['product_id']
+    product.name = rec['name']
+    if rec['article']:
+        product.article = rec['article']
+    if rec['supplier_article']:
+        product.supplier_article = rec['supplier_article']
+    if rec['brand']:
+        product.brand = rec['brand']
+    product.characteristics = rec['characteristics']
+    product.applicability = rec['applicability']
+    if rec['cross_numbers']:
+        product.cross_numbers = rec['cross_numbers']
+    product.quantity = rec['quantity']
+    product.availability = 'in_stock' if rec['quantity'] > 0 else 'out_of_stock'
+    product.is_active = True
+    # Не перетираем ручную категорию из админки при каждом обмене 1С.
+    # Категорию из 1С/автораспределения ставим только для новых товаров
+    # или если у существующего товара категория еще не задана.
+    if created or not product.category_id:
+        category = resolve_category(rec['name'])
+        if category:
+            product.category = category
+    if catalog_type == 'retail' and rec['retail_price'] is not None:
+        product.price = rec['retail_price']
+    if catalog_type == 'wholesale' and rec['wholesale_price'] is not None:
+        product.wholesale_price = rec['wholesale_price']
+
+
+def offer_upsert_policies(catalog_type):
+    """Политики upsert для предложения offers.xml — те же правила, что в _apply_offer_fields."""
+    return {
+        'name': ALWAYS,
+        'article': IF_PRESENT,
+        'supplier_article': IF_PRESENT,
+        'brand': IF_PRESENT,
+        'characteristics': ALWAYS,
+        'applicability': ALWAYS,
+        'cross_numbers': IF_PRESENT,
+        'quantity': ALWAYS,
+        'availability': ALWAYS,
+        'is_active': ALWAYS,
+        'category': FILL_NULL,
+        'price' if catalog_type == 'retail' else 'wholesale_price': ALWAYS,
+        'offer_fingerprint': ALWAYS,
+    }
 
-    namespace = namespaces.get('', namespaces.get('cml', namespaces.get('cml2', None)))
+
+def _offer_fingerprint(rec):
+    """Хеш разобранных полей предложения: совпал с сохраненным — предложение не изменилось."""
+    payload = [
+        rec['product_id'], rec['name'], rec['article'], rec['supplier_article'], rec['brand'],
+        rec['characteristics'], rec['applicability'], rec['cross_numbers'], rec['quantity'],
+        None if rec['retail_price'] is None else str(rec['retail_price']),
+        None if rec['wholesale_price'] is None else str(rec['wholesale_price']),
+    ]
+    return hashlib.sha1(json.dumps(payload, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def _offer_unchanged(product, rec, fingerprint, catalog_type, resolve_category):
+    """
+    Можно ли не перезаписывать товар: отпечаток совпал и остаток/цена в строке те же.
+
+    Остаток и цену сверяем дополнительно — их могли поменять в обход обмена
+    (скрытие отсутствующих, админка), и тогда предложение нужно применить заново.
+    Товар без категории перезаписываем, только если категорию теперь удается определить.
+    """
+    if product.offer_fingerprint != fingerprint:
+        return False
+    if not product.is_active or product.quantity != rec['quantity']:
+        return False
+    if not product.category_id and resolve_category(rec['name']):
+        return False
+    price = rec['retail_price'] if catalog_type == 'retail' else rec['wholesale_price']
+    current = product.price if catalog_type == 'retail' else product.wholesale_price
+    return price is None or current == price
+
+
+def _upsert_offers_chunk(records, catalog_type, stats, resolve_category, prefetch_categories=None):
+    """
+    Записывает пачку разобранных предложений в один каталог (retail или wholesale).
+
+    Существующие товары пачки загружаются одним запросом по external_id/article,
+    изменения собираются в памяти и пишутся bulk_create/bulk_update в одной транзакции.
+    Порядок разрешения совпадает с поштучной обработкой: сначала external_id, затем
+    article; несколько предложений, попавших на одну карточку, применяются по очереди.
+    Если пачка не записалась целиком, товары сохраняются по одному, чтобы ошибка
+    одной позиции не теряла остальные.
+
+    prefetch_categories(names) — если задан, категории для новых товаров и товаров
+    без категории определяются заранее одним пакетом (classify_names).
+    """
+    product_ids = {rec['product_id'] for rec in records}
+    articles = {rec['article'] for rec in records if rec['article']}
+    existing = Product.objects.filter(catalog_type=catalog_type).filter(
+        Q(external_id__in=product_ids) | Q(article__in=articles)
+    ).order_by('-created_at')
+
+    by_external_id = {}
+    by_article = {}
+    for product in existing:
+        if product.external_id:
+            by_external_id.setdefault(product.external_id, product)
+        if product.article:
+            by_article.setdefault(product.article, product)
+
+    if prefetch_categories:
+        names = []
+        for rec in records:
+            product = by_external_id.get(rec['product_id'])
+            if product is None and rec['article']:
+                product = by_article.get(rec['article'])
+            if product is None or not product.category_id:
+                names.append(rec['name'])
+        prefetch_categories(names)
+
+    to_create = []
+    to_update = {}
+    rekeyed = set()
+    applied = []  # (rec, product, created) в порядке файла
+    for rec in records:
+        fingerprint = _offer_fingerprint(rec)
+        product = by_external_id.get(rec['product_id'])
+        if product is None and rec['article']:
+            product = by_article.get(rec['article'])
+        created = product is None
+        if not created and product.pk not in to_update and _offer_unchanged(product, rec, fingerprint, catalog_type, resolve_category):
+            stats['unchanged'] += 1
+            applied.append((rec, product, None))
+            continue
+        if created:
+            product = Product(
+                external_id=rec['product_id'],
+                article=rec['article'],
+                supplier_article=rec['supplier_article'],
+                brand=rec['brand'],
+                name=rec['name'],
+                catalog_type=catalog_type,
+                characteristics=rec['characteristics'],
+                applicability=rec['applicability'],
+                cross_numbers=rec['cross_numbers'],
+                quantity=0,
+                availability='out_of_stock',
+                is_active=False,
+            )
+            to_create.append(product)
+        elif product.external_id != rec['product_id']:
+            # Карточка найдена по артикулу и получает новый external_id: ключа upsert
+            # у нее еще нет, такие строки обновляются по первичному ключу
+            rekeyed.add(product.pk)
+            if by_external_id.get(product.external_id) is product:
+                del by_external_id[product.external_id]
+
+        _apply_offer_fields(product, rec, catalog_type, created, resolve_category)
+        product.offer_fingerprint = fingerprint
+        by_external_id[rec['product_id']] = product
+        if product.article:
+            by_article.setdefault(product.article, product)
+        if product.pk is not None:
+            to_update[product.pk] = product
+        applied.append((rec, product, created))
+
+    update_fields = [
+        'external_id', 'name', 'article', 'supplier_article', 'brand',
+        'characteristics', 'applicability', 'cross_numbers', 'quantity', 'availability',
+        'is_active', 'category', 'price' if catalog_type == 'retail' else 'wholesale_price',
+        'offer_fingerprint',
+    ]
+    failed_ids = set()
+    try:
+        with transaction.atomic():
+            if upsert_supported():
+                # Новые и найденные по external_id карточки — один INSERT ... ON CONFLICT
+                upsert_products(
+                    to_create + [product for pk, product in to_update.items() if pk not in rekeyed],
+                    offer_upsert_policies(catalog_type),
+                )
+                if rekeyed:
+                    Product.objects.bulk_update([to_update[pk] for pk in rekeyed], update_fields)
+            else:
+                allocate_product_slugs(to_create)
+                if to_create:
+                    Product.objects.bulk_create(to_create)
+                if to_update:
+                    Product.objects.bulk_update(list(to_update.values()), update_fields)
+    except Exception as e:
+        logger.warning(
+            f"offers.xml: пачка {catalog_type} из {len(records)} предложений не записалась целиком ({e}), "
+            f"сохраняем по одному"
+        )
+        for product in to_create:
+            product.pk = None
+            product._state.adding = True
+        saved = set()
+        for rec, product, created in applied:
+            if created is None or id(product) in saved:
+                continue
+            saved.add(id(product))
+            try:
+                if product._state.adding:
+                    save_in_import(product)
+                else:
+                    save_in_import(product, update_fields=update_fields)
+            except Exception as save_error:
+                failed_ids.add(id(product))
+                stats['errors'].append({'offer_id': rec['product_id'], 'error': str(save_error)})
+
+    for rec, product, created in applied:
+        if id(product) in failed_ids:
+            continue
+        if created is not None:
+            stats['created' if created else 'updated'] += 1
+        stats['processed'] += 1
+        stats['processed_external_ids'].add(rec['product_id'])
+        for art_key in (rec['article'], rec['supplier_article']):
+            if art_key and str(art_key).strip():
+                stats['processed_articles'].add(str(art_key).strip().upper())
+
+
+def iter_offer_elems(source, info):
+    """
+    Потоково (iterparse) отдает элементы Предложение offers-файла и освобождает каждый после обработки.
+
+    Как _find_offer_elems + _is_changes_only, но без дерева в памяти. info заполняется
+    по мере чтения: total — число элементов Предложение, changes_only — признак
+    СодержитТолькоИзменения у ПакетПредложений/Предложения.
+    """
+    info.update({'total': 0, 'changes_only': False})
+    elems = []
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        name = local_tag(elem.tag)
+        if event == 'start':
+            if name in ('ПакетПредложений', 'Предложения') and _is_true_flag(elem.attrib.get('СодержитТолькоИзменения')):
+                info['changes_only'] = True
+            elems.append(elem)
+            continue
+
+        elems.pop()
+        parent = elems[-1] if elems else None
+        if name == 'СодержитТолькоИзменения' and parent is not None:
+            if local_tag(parent.tag) in ('ПакетПредложений', 'Предложения') and _is_true_flag(elem.text):
+                info['changes_only'] = True
+        elif name == 'Предложение':
+            info['total'] += 1
+            yield elem
+            elem.clear()
+            if parent is not None:
+                parent.remove(elem)
+
+
+def _find_offer_elems(root, namespace):
+    """Все элементы Предложение offers-файла (с namespace или без)."""
     offers = []
     if namespace:
         offers = root.findall(f'.//{{{namespace}}}Предложение')
@@ -2092,423 +2416,228 @@ def process_offers_file_single_pass(root, namespaces, filename, request=None):
             package = root.find('.//ПакетПредложений')
             if package is not None:
                 offers = package.findall('.//Предложение')
+    return offers
 
-    if not offers:
-        return {'status': 'success', 'processed': 0, 'updated': 0, 'errors': [], 'processed_external_ids': set()}
 
-    RETAIL_PRICE_TYPE_ID = 'f6708032-0bd5-11f1-811f-00155d01d802'
-    WHOLESALE_PRICE_TYPE_ID = 'b12f44c0-1208-11f1-811f-00155d01d802'
-    stats = {
-        'retail': {
-            'processed': 0,
-            'created': 0,
-            'updated': 0,
-            'errors': [],
-            'processed_external_ids': set(),
-            'processed_articles': set(),
-        },
-        'wholesale': {
-            'processed': 0,
-            'created': 0,
-            'updated': 0,
-            'errors': [],
-            'processed_external_ids': set(),
-            'processed_articles': set(),
-        },
-    }
+# Свойства предложения, которые идут в cross_numbers (поиск по OEM и артикулам)
+OFFER_CROSS_NUMBER_NAMES = frozenset([
+    'артикул2', 'артикул 2', 'article2', 'article 2',
+    'oem', 'oem номер',
+    'артикул1', 'артикул 1', 'article1', 'article 1',
+])
+OFFER_BRAND_NAMES = frozenset(['марка', 'бренд', 'производитель', 'brand'])
+# Служебные свойства, которые не показываются в характеристиках карточки
+OFFER_HIDDEN_CHARACTERISTICS = frozenset(['марка', 'бренд', 'brand', 'артикул', 'артикул1', 'article', 'article1'])
+OFFER_APPLICABILITY_TOKENS = ('примен', 'модель', 'двигател', 'кузов', 'марка', 'авто', 'engine', 'body')
 
-    def _find(elem, tag):
-        if namespace:
-            x = elem.find(f'.//{{{namespace}}}{tag}')
-            if x is not None:
-                return x
-        return elem.find(f'.//{tag}')
-
-    def _parse_prices(offer_elem):
-        retail_price = None
-        wholesale_price = None
-        prices_elem = _find(offer_elem, 'Цены')
-        if prices_elem is None:
-            return retail_price, wholesale_price
-        if namespace:
-            price_elems = prices_elem.findall(f'{{{namespace}}}Цена')
-        else:
-            price_elems = []
-        if not price_elems:
-            price_elems = prices_elem.findall('Цена')
-        for price_elem in price_elems:
-            type_elem = _find(price_elem, 'ИдТипаЦены')
-            val_elem = _find(price_elem, 'ЦенаЗаЕдиницу')
-            if type_elem is None or val_elem is None or not type_elem.text or not val_elem.text:
-                continue
-            try:
-                val = float(val_elem.text.strip().replace(',', '.').replace(' ', '').replace('\xa0', ''))
-            except (ValueError, TypeError):
-                continue
-            if val <= 0:
-                continue
-            type_id = type_elem.text.strip()
-            if type_id == RETAIL_PRICE_TYPE_ID:
-                retail_price = val
-            elif type_id == WHOLESALE_PRICE_TYPE_ID:
-                wholesale_price = val
-        return retail_price, wholesale_price
-
-    def _parse_quantity(offer_elem):
-        tag_total = 0
-        tag_found = False
-        if namespace:
-            qty_elems = offer_elem.findall(f'.//{{{namespace}}}Количество')
-        else:
-            qty_elems = []
-        if not qty_elems:
-            qty_elems = offer_elem.findall('.//Количество')
-        for q in qty_elems:
-            if q is None or q.text is None:
-                continue
-            try:
-                tag_total += int(float(q.text.strip().replace(',', '.')))
-                tag_found = True
-            except (ValueError, TypeError):
-                continue
-        wh_total = 0
-        if namespace:
-            warehouse_elems = offer_elem.findall(f'.//{{{namespace}}}Склад')
-        else:
-            warehouse_elems = []
-        if not warehouse_elems:
-            warehouse_elems = offer_elem.findall('.//Склад')
-        for w in warehouse_elems:
-            raw = w.get('КоличествоНаСкладе') or w.get('QuantityInStock')
-            if not raw:
-                continue
-            try:
-                wh_total += int(float(str(raw).strip().replace(',', '.')))
-            except (ValueError, TypeError):
-                continue
-        if tag_total > 0:
-            return tag_total
-        if wh_total > 0:
-            return wh_total
-        return tag_total if tag_found else wh_total
-
-    def _extract_supplier_article(offer_elem):
-        # 1) Пытаемся найти Артикул1/Артикул в ХарактеристикиТовара
-        characteristics_elem = _find(offer_elem, 'ХарактеристикиТовара')
-        if characteristics_elem is not None:
-            for char_elem in characteristics_elem.findall('.//*'):
-                name_elem = _find(char_elem, 'Наименование')
-                value_elem = _find(char_elem, 'Значение')
-                if name_elem is None or value_elem is None or not name_elem.text or not value_elem.text:
-                    continue
-                char_name = name_elem.text.strip().lower()
-                char_value = value_elem.text.strip()
-                if char_name in ['артикул1', 'артикул 1', 'article1', 'article 1', 'артикул', 'article'] and char_value:
-                    return char_value
-
-        # 2) Пытаемся найти Артикул1/Артикул в ЗначенияСвойств
-        props_elem = _find(offer_elem, 'ЗначенияСвойств')
-        if props_elem is not None:
-            if namespace:
-                prop_items = props_elem.findall(f'{{{namespace}}}ЗначенияСвойства')
-            else:
-                prop_items = []
-            if not prop_items:
-                prop_items = props_elem.findall('ЗначенияСвойства')
-
-            for item in prop_items:
-                name_elem = _find(item, 'Наименование')
-                value_elem = _find(item, 'Значение')
-                if name_elem is None or value_elem is None or not name_elem.text or not value_elem.text:
-                    continue
-                prop_name = name_elem.text.strip().lower()
-                prop_value = value_elem.text.strip()
-                if prop_name in ['артикул1', 'артикул 1', 'article1', 'article 1', 'артикул', 'article'] and prop_value:
-                    return prop_value
-
-        # 3) Если не нашли, пробуем взять из имени по шаблону: "Название (БРЕНД, АРТИКУЛ, ...)"
-        name_elem = _find(offer_elem, 'Наименование')
-        raw_name = name_elem.text.strip() if (name_elem is not None and name_elem.text) else ''
-        if raw_name and '(' in raw_name and ')' in raw_name:
-            inside = raw_name[raw_name.find('(') + 1: raw_name.rfind(')')]
-            parts = [p.strip() for p in inside.split(',') if p.strip()]
-            if len(parts) >= 2:
-                return parts[1]
-        return ''
 
-    def _extract_number(offer_elem):
-        # Ищем поле "Номер" из характеристик/свойств — это отображаемый номер в карточке.
-        for root_name in ('ХарактеристикиТовара', 'ЗначенияСвойств'):
-            root_elem = _find(offer_elem, root_name)
-            if root_elem is None:
-                continue
-            for item in root_elem.findall('.//*'):
-                name_elem = _find(item, 'Наименование')
-                value_elem = _find(item, 'Значение')
-                if name_elem is None or value_elem is None or not name_elem.text or not value_elem.text:
-                    continue
-                n = name_elem.text.strip().lower()
-                v = value_elem.text.strip()
-                if not v:
-                    continue
-                if n in ('номер', 'number', 'номер детали', 'part number', 'partnumber'):
-                    return v
-        return ''
+def _offer_cross_numbers(item):
+    """OEM / Артикул1 / Артикул2 → cross_numbers для поиска на сайте."""
+    parts = []
+    seen = set()
+    for name, value in item.property_pairs():
+        if name.lower() in OFFER_CROSS_NUMBER_NAMES and value.upper() not in seen:
+            seen.add(value.upper())
+            parts.append(value)
+    return ', '.join(parts)
+
+
+def _offer_brand(item):
+    """Бренд из наименования «Название (БРЕНД, АРТИКУЛ, ...)», иначе из Марка/Бренд характеристик."""
+    raw_name = item.name or ''
+    if raw_name and '(' in raw_name and ')' in raw_name:
+        inside = raw_name[raw_name.find('(') + 1: raw_name.rfind(')')]
+        parts = [p.strip() for p in inside.split(',') if p.strip()]
+        # Не используем UUID-подобные значения как бренд
+        if parts and not re.match(r'^[0-9a-fA-F-]{20,}$', parts[0]):
+            return parts[0]
+    for name, value in item.property_pairs(properties=False):
+        if name.lower() in OFFER_BRAND_NAMES and not re.match(r'^[0-9a-fA-F-]{20,}$', value):
+            return value
+    return ''
 
-    def _extract_cross_numbers(offer_elem):
-        """OEM / Артикул1 / Артикул2 → cross_numbers для поиска на сайте."""
-        parts = []
-        seen = set()
-        cross_names = (
-            'артикул2', 'артикул 2', 'article2', 'article 2',
-            'oem', 'oem номер',
-            'артикул1', 'артикул 1', 'article1', 'article 1',
-        )
 
-        def _add(value):
-            v = (value or '').strip()
-            if not v:
-                return
-            key = v.upper()
-            if key not in seen:
-                seen.add(key)
-                parts.append(v)
-
-        for root_name in ('ХарактеристикиТовара', 'ЗначенияСвойств'):
-            root_elem = _find(offer_elem, root_name)
-            if root_elem is None:
-                continue
-            if root_name == 'ЗначенияСвойств':
-                if namespace:
-                    items = root_elem.findall(f'{{{namespace}}}ЗначенияСвойства')
-                else:
-                    items = []
-                if not items:
-                    items = root_elem.findall('ЗначенияСвойства')
-            else:
-                items = root_elem.findall('.//*')
-            for item in items:
-                name_elem = _find(item, 'Наименование')
-                value_elem = _find(item, 'Значение')
-                if name_elem is None or value_elem is None or not name_elem.text or not value_elem.text:
-                    continue
-                n = name_elem.text.strip().lower()
-                v = value_elem.text.strip()
-                if n in cross_names:
-                    _add(v)
-        return ', '.join(parts)
-
-    def _extract_brand(offer_elem):
-        # 1) Пытаемся взять бренд из наименования: "Название (БРЕНД, АРТИКУЛ, ...)"
-        name_elem = _find(offer_elem, 'Наименование')
-        raw_name = name_elem.text.strip() if (name_elem is not None and name_elem.text) else ''
-        if raw_name and '(' in raw_name and ')' in raw_name:
-            inside = raw_name[raw_name.find('(') + 1: raw_name.rfind(')')]
-            parts = [p.strip() for p in inside.split(',') if p.strip()]
-            if parts:
-                brand_candidate = parts[0]
-                # Не используем UUID-подобные значения как бренд
-                if not re.match(r'^[0-9a-fA-F-]{20,}$', brand_candidate):
-                    return brand_candidate
-
-        # 2) Фоллбэк: ищем "Марка"/"Бренд" в ХарактеристикиТовара
-        characteristics_elem = _find(offer_elem, 'ХарактеристикиТовара')
-        if characteristics_elem is not None:
-            for char_elem in characteristics_elem.findall('.//*'):
-                name_node = _find(char_elem, 'Наименование')
-                value_node = _find(char_elem, 'Значение')
-                if name_node is None or value_node is None or not name_node.text or not value_node.text:
-                    continue
-                n = name_node.text.strip().lower()
-                v = value_node.text.strip()
-                if n in ('марка', 'бренд', 'производитель', 'brand') and v:
-                    if not re.match(r'^[0-9a-fA-F-]{20,}$', v):
-                        return v
-        return ''
+def _offer_characteristics_and_applicability(item):
+    """Текст характеристик карточки и применимость из характеристик и свойств предложения."""
+    characteristics_parts = []
+    applicability_parts = []
+    seen_chars = set()
+    seen_app = set()
+    for name, value in item.property_pairs():
+        if name.lower() in OFFER_HIDDEN_CHARACTERISTICS:
+            continue
+        line = f"{name}: {value}"
+        if line not in seen_chars:
+            seen_chars.add(line)
+            characteristics_parts.append(line)
+        if any(token in name.lower() for token in OFFER_APPLICABILITY_TOKENS) and value.lower() not in seen_app:
+            seen_app.add(value.lower())
+            applicability_parts.append(value)
+    return '\n'.join(characteristics_parts).strip(), ', '.join(applicability_parts).strip()
 
-    def _extract_characteristics_and_applicability(offer_elem):
-        characteristics_parts = []
-        applicability_parts = []
-        seen_chars = set()
-        seen_app = set()
-
-        def _add_char(name, value):
-            if not name or not value:
-                return
-            line = f"{name}: {value}"
-            if line not in seen_chars:
-                seen_chars.add(line)
-                characteristics_parts.append(line)
-
-        def _add_app(value):
-            if not value:
-                return
-            v = str(value).strip()
-            if not v:
-                return
-            key = v.lower()
-            if key not in seen_app:
-                seen_app.add(key)
-                applicability_parts.append(v)
-
-        def _is_applicability_key(name):
-            n = str(name).strip().lower()
-            return any(token in n for token in (
-                'примен', 'модель', 'двигател', 'кузов', 'марка', 'авто', 'engine', 'body'
-            ))
 
-        # 1) ХарактеристикиТовара
-        characteristics_elem = _find(offer_elem, 'ХарактеристикиТовара')
-        if characteristics_elem is not None:
-            for char_elem in characteristics_elem.findall('.//*'):
-                name_elem = _find(char_elem, 'Наименование')
-                value_elem = _find(char_elem, 'Значение')
-                if name_elem is None or value_elem is None or not name_elem.text or not value_elem.text:
-                    continue
-                char_name = name_elem.text.strip()
-                char_value = value_elem.text.strip()
-                if not char_name or not char_value:
-                    continue
-                # Служебные поля не показываем в характеристиках карточки.
-                if char_name.strip().lower() in ('марка', 'бренд', 'brand'):
-                    continue
-                if char_name.lower() in ('артикул', 'артикул1', 'article', 'article1'):
-                    continue
-                _add_char(char_name, char_value)
-                if _is_applicability_key(char_name):
-                    _add_app(char_value)
+def iter_offer_records(offers, namespace=None, start_index=0):
+    """
+    Разбирает элементы Предложение в записи для _upsert_offers_chunk (без обращения к БД).
 
-        # 2) ЗначенияСвойства
-        props_elem = _find(offer_elem, 'ЗначенияСвойств')
-        if props_elem is not None:
-            if namespace:
-                prop_items = props_elem.findall(f'{{{namespace}}}ЗначенияСвойства')
-            else:
-                prop_items = []
-            if not prop_items:
-                prop_items = props_elem.findall('ЗначенияСвойства')
-
-            for item in prop_items:
-                name_elem = _find(item, 'Наименование')
-                value_elem = _find(item, 'Значение')
-                if name_elem is None or value_elem is None or not name_elem.text or not value_elem.text:
-                    continue
-                prop_name = name_elem.text.strip()
-                prop_value = value_elem.text.strip()
-                if not prop_name or not prop_value:
-                    continue
-                # Служебные поля не показываем в характеристиках карточки.
-                if prop_name.strip().lower() in ('марка', 'бренд', 'brand'):
-                    continue
-                if prop_name.lower() in ('артикул', 'артикул1', 'article', 'article1'):
-                    continue
-                _add_char(prop_name, prop_value)
-                if _is_applicability_key(prop_name):
-                    _add_app(prop_value)
-
-        characteristics_text = '\n'.join(characteristics_parts).strip()
-        applicability_text = ', '.join(applicability_parts).strip()
-        return characteristics_text, applicability_text
-
-    for offer_elem in offers:
-        close_old_connections()
-        product_id_elem = _find(offer_elem, 'Ид')
-        if product_id_elem is None or not product_id_elem.text:
-            continue
-        product_id = product_id_elem.text.strip()
+    Каждое предложение обходится один раз (extract_commerceml_item), namespace не важен.
+    index записи — позиция предложения в файле (контрольная точка задания обмена).
+    Предложения до start_index уже записаны: для них отдаются только ключи
+    product_id/article/supplier_article — они нужны для скрытия отсутствующих.
+    """
+    for index, offer_elem in enumerate(offers):
+        item = extract_commerceml_item(offer_elem)
+        product_id = item.id
         if not product_id:
             continue
 
-        name_elem = _find(offer_elem, 'Наименование')
-        raw_offer_name = name_elem.text.strip() if (name_elem is not None and name_elem.text) else ''
-        offer_name = _clean_offer_product_name(raw_offer_name) if raw_offer_name else product_id
-        supplier_article = _extract_supplier_article(offer_elem)
-        number_article = _extract_number(offer_elem)
+        supplier_article = offer_supplier_article(item)
+        number_article = offer_number(item)
         # Уникальный ключ для карточки — артикул из свойств (06033), а не «Номер» (H7/H11):
         # иначе два разных SKU с одним цоколем сливаются при поиске Product(article=...).
         article = (supplier_article or number_article or '').strip()
-        brand = _extract_brand(offer_elem)
-        characteristics_text, applicability_text = _extract_characteristics_and_applicability(offer_elem)
-        cross_numbers_text = _extract_cross_numbers(offer_elem)
-        quantity = _parse_quantity(offer_elem)
-        retail_price, wholesale_price = _parse_prices(offer_elem)
+        if index < start_index:
+            yield {
+                'index': index,
+                'product_id': product_id,
+                'article': article,
+                'supplier_article': supplier_article,
+            }
+            continue
+
+        raw_offer_name = item.name or ''
+        offer_name = _clean_offer_product_name(raw_offer_name) if raw_offer_name else product_id
+        characteristics_text, applicability_text = _offer_characteristics_and_applicability(item)
+        yield {
+            'index': index,
+            'product_id': product_id,
+            'name': offer_name,
+            'article': article,
+            'supplier_article': supplier_article,
+            'brand': _offer_brand(item),
+            'characteristics': characteristics_text,
+            'applicability': applicability_text,
+            'cross_numbers': _offer_cross_numbers(item),
+            'quantity': item.stock(),
+            'retail_price': item.price(RETAIL_PRICE_TYPE_ID),
+            'wholesale_price': item.price(WHOLESALE_PRICE_TYPE_ID),
+        }
+
+
+@profiled_exchange
+def process_offers_file_single_pass(root, namespaces, filename, request=None, changes_only=None,
+                                    start_index=0, progress_callback=None, parsed=None):
+    """
+    Обрабатывает offers.xml одним проходом сразу для retail и wholesale.
+
+    start_index — с какого предложения продолжить (контрольная точка задания обмена),
+    progress_callback(done, total) вызывается после записи каждой пачки.
+    parsed — файл, уже разобранный parse_exchange_file (в пуле процессов): тогда root
+    не нужен и здесь остается только запись в БД.
+    Итог и профиль по фазам пишутся в SyncLog.
+    """
+    from .models import Category
+    from .services import classify_names
+
+    start_time = timezone.now()
+
+    namespace = namespaces.get('', namespaces.get('cml', namespaces.get('cml2', None)))
+    if parsed is not None:
+        total_offers = parsed['total']
+        records = iter_spooled_records(parsed['spool'])
+    else:
+        offers = _find_offer_elems(root, namespace)
+        total_offers = len(offers)
+        records = iter_offer_records(offers, namespace, start_index)
+
+    if not total_offers:
+        return {'status': 'success', 'processed': 0, 'updated': 0, 'errors': [], 'processed_external_ids': set()}
+
+    stats = {
+        'retail': {
+            'processed': 0,
+            'created': 0,
+            'updated': 0,
+            'unchanged': 0,
+            'errors': [],
+            'processed_external_ids': set(),
+            'processed_articles': set(),
+        },
+        'wholesale': {
+            'processed': 0,
+            'created': 0,
+            'updated': 0,
+            'unchanged': 0,
+            'errors': [],
+            'processed_external_ids': set(),
+            'processed_articles': set(),
+        },
+    }
 
-        for catalog_type in ('retail', 'wholesale'):
-            try:
-                product = Product.objects.filter(external_id=product_id, catalog_type=catalog_type).first()
-                if not product and article:
-                    product = Product.objects.filter(
-                        article=article, catalog_type=catalog_type
-                    ).first()
-                created = product is None
-                category = get_category_for_product(offer_name, use_db_subcategories=True)
-                if not category:
-                    category = Category.objects.filter(parent=None, is_active=True).first()
-                if created:
-                    product = Product(
-                        external_id=product_id,
-                        article=article,
-                        supplier_article=supplier_article,
-                        brand=brand,
-                        name=offer_name,
-                        category=category,
-                        catalog_type=catalog_type,
-                        characteristics=characteristics_text,
-                        applicability=applicability_text,
-                        cross_numbers=cross_numbers_text,
-                        quantity=0,
-                        availability='out_of_stock',
-                        is_active=False,
-                    )
+    # Категория по названию нужна только новым товарам и товарам без категории.
+    # Определяем ее пакетом на всю пачку предложений (classify_names — без запросов
+    # на каждое название) и кешируем по названию на весь файл.
+    category_cache = {}
+    default_category = Category.objects.filter(parent=None, is_active=True).first()
 
-                product.external_id = product_id
-                product.name = offer_name
-                if article:
-                    product.article = article
-                if supplier_article:
-                    product.supplier_article = supplier_article
-                if brand:
-                    product.brand = brand
-                product.characteristics = characteristics_text
-                product.applicability = applicability_text
-                if cross_numbers_text:
-                    product.cross_numbers = cross_numbers_text
-                product.quantity = quantity
-                product.availability = 'in_stock' if quantity > 0 else 'out_of_stock'
-                product.is_active = True
-                # Не перетираем ручную категорию из админки при каждом обмене 1С.
-                # Категорию из 1С/автораспределения ставим только для новых товаров
-                # или если у существующего товара категория еще не задана.
-                if category and (created or not product.category_id):
-                    product.category = category
-                if catalog_type == 'retail' and retail_price is not None:
-                    product.price = retail_price
-                if catalog_type == 'wholesale' and wholesale_price is not None:
-                    product.wholesale_price = wholesale_price
-
-                if created:
-                    save_with_retry(product)
-                    stats[catalog_type]['created'] += 1
-                else:
-                    fields = [
-                        'external_id', 'name', 'article', 'supplier_article', 'brand',
-                        'characteristics', 'applicability', 'quantity', 'availability', 'is_active',
-                    ]
-                    if cross_numbers_text:
-                        fields.append('cross_numbers')
-                    if created or not product.category_id:
-                        fields.append('category')
-                    fields.append('price' if catalog_type == 'retail' else 'wholesale_price')
-                    save_with_retry(product, update_fields=fields)
-                    stats[catalog_type]['updated'] += 1
-
-                stats[catalog_type]['processed'] += 1
-                stats[catalog_type]['processed_external_ids'].add(product_id)
-                for art_key in (article, supplier_article):
-                    if art_key and str(art_key).strip():
-                        stats[catalog_type]['processed_articles'].add(str(art_key).strip().upper())
-            except Exception as e:
-                stats[catalog_type]['errors'].append({'offer_id': product_id, 'error': str(e)})
+    def _prefetch_categories(offer_names):
+        missing = [name for name in dict.fromkeys(offer_names) if name not in category_cache]
+        if not missing:
+            return
+        with exchange_phase('categories'):
+            classified = classify_names(missing, use_db_subcategories=True)
+        for name in missing:
+            category_cache[name] = classified.get(name) or default_category
+
+    def _resolve_category(offer_name):
+        if offer_name not in category_cache:
+            _prefetch_categories([offer_name])
+        return category_cache[offer_name]
+
+    # Предложения разбираем в память пачками и пишем в БД пачкой:
+    # один запрос на поиск существующих товаров и одна точка сохранения на пачку для каждого каталога.
+    # После каждой пачки progress_callback(обработано, всего) сохраняет контрольную точку
+    # задания обмена; при перезапуске предложения до start_index уже записаны и только
+    # учитываются как присутствующие в обмене (для скрытия отсутствующих).
+    if start_index:
+        logger.info(f"offers.xml {filename}: продолжаем с предложения {start_index} из {total_offers}")
+
+    # Пачки пишутся в транзакции импорта (ImportTransaction): она фиксируется раз в несколько
+    # пачек вместе с контрольной точкой задания, поэтому перезапуск продолжает ровно
+    # с последней зафиксированной пачки.
+    def _flush(records, done):
+        with exchange_phase('db_write'):
+            for catalog_type in ('retail', 'wholesale'):
+                _upsert_offers_chunk(
+                    records, catalog_type, stats[catalog_type], _resolve_category, _prefetch_categories
+                )
+            if progress_callback:
+                progress_callback(done, total_offers)
+            batch.wrote(2 * len(records))
+
+    # Разбор предложений — фаза parse, запись пачек внутри _flush — фаза db_write
+    with exchange_phase('parse'), ImportTransaction() as batch:
+        chunk = []
+        for rec in records:
+            if rec['index'] < start_index:
+                for catalog_type in ('retail', 'wholesale'):
+                    stats[catalog_type]['processed'] += 1
+                    stats[catalog_type]['processed_external_ids'].add(rec['product_id'])
+                    for art_key in (rec['article'], rec['supplier_article']):
+                        if art_key and str(art_key).strip():
+                            stats[catalog_type]['processed_articles'].add(str(art_key).strip().upper())
+                continue
+            chunk.append(rec)
+            if len(chunk) >= OFFERS_BATCH_SIZE:
+                _flush(chunk, rec['index'] + 1)
+                chunk = []
+        if chunk:
+            _flush(chunk, total_offers)
+    for catalog_type in ('retail', 'wholesale'):
+        logger.info(
+            f"offers.xml {catalog_type}: создано {stats[catalog_type]['created']}, "
+            f"обновлено {stats[catalog_type]['updated']}, без изменений {stats[catalog_type]['unchanged']}"
+        )
 
     if request:
         if not hasattr(request, '_offers_processed_external_ids'):
@@ -2521,7 +2650,13 @@ def process_offers_file_single_pass(root, namespaces, filename, request=None):
         request._offers_processed_articles['wholesale'] = stats['wholesale']['processed_articles']
 
     # Скрываем товары, которых нет в текущем offers-файле.
-    if getattr(settings, 'ONE_C_HIDE_MISSING_PRODUCTS', False):
+    # Пакет изменений (СодержитТолькоИзменения) — не полный срез: в нём только изменившиеся
+    # позиции, поэтому отсутствие товара в файле ничего не значит и скрытие пропускаем.
+    if changes_only is None:
+        changes_only = _offers_changes_only(_find_offers_package(root, namespace, namespaces))
+    if changes_only:
+        logger.info(f"offers.xml {filename}: пакет содержит только изменения — скрытие отсутствующих товаров пропущено")
+    elif getattr(settings, 'ONE_C_HIDE_MISSING_PRODUCTS', False):
         for catalog_type in ('retail', 'wholesale'):
             ids_in_exchange = set(stats[catalog_type]['processed_external_ids'])
             articles_in_exchange = set(stats[catalog_type].get('processed_articles', set()))
@@ -2543,27 +2678,13 @@ def process_offers_file_single_pass(root, namespaces, filename, request=None):
                 )
                 continue
 
-            products_to_hide = Product.objects.filter(
-                catalog_type=catalog_type,
-                external_id__isnull=False,
-                external_id__gt='',
-                is_active=True,
-            ).exclude(external_id__in=ids_in_exchange)
-            if articles_in_exchange:
-                art_list = list(articles_in_exchange)
-                art_lower = [a.lower() for a in art_list]
-                products_to_hide = products_to_hide.exclude(
-                    Q(article__in=art_list) | Q(supplier_article__in=art_list)
-                ).exclude(
-                    Q(article__in=art_lower) | Q(supplier_article__in=art_lower)
+            with exchange_phase('hide_missing'):
+                sweep = hide_products_missing_from_exchange(
+                    catalog_type, ids_in_exchange, articles_in_exchange,
+                    only_active=True, hide_stale_by_article=True,
                 )
-            hidden_count = products_to_hide.count()
+            hidden_count = sweep['hidden']
             if hidden_count:
-                products_to_hide.update(
-                    quantity=0,
-                    is_active=True,
-                    availability='out_of_stock',
-                )
                 logger.info(
                     f"✓ offers.xml: нет в наличии {hidden_count} товаров в каталоге {catalog_type}, "
                     f"которых нет в текущем exchange"
@@ -2571,55 +2692,56 @@ def process_offers_file_single_pass(root, namespaces, filename, request=None):
                 stats[catalog_type]['deleted'] = hidden_count
 
             # Safety net: позиции из текущего обмена с остатком должны быть активны.
-            reactivated = Product.objects.filter(
-                catalog_type=catalog_type,
-                external_id__in=ids_in_exchange,
-                is_active=False,
-            ).update(is_active=True)
-            if reactivated:
+            if sweep['reactivated']:
                 logger.info(
-                    f"✓ offers.xml: повторно активировано {reactivated} товаров "
+                    f"✓ offers.xml: повторно активировано {sweep['reactivated']} товаров "
                     f"в каталоге {catalog_type} (есть в exchange и qty>0)"
                 )
 
             # Дополнительно скрываем "старые хвосты" без external_id по артикулу.
             # Это покрывает исторические карточки, которые не попадают под скрытие по external_id.
-            if articles_in_exchange:
-                products_no_external = Product.objects.filter(
-                    catalog_type=catalog_type,
-                    is_active=True,
-                ).filter(
-                    Q(external_id__isnull=True) | Q(external_id='')
-                ).exclude(
-                    article__isnull=True
-                ).exclude(
-                    article=''
-                )
-                stale_by_article = products_no_external.exclude(
-                    article__in=articles_in_exchange
-                ).exclude(
-                    article__in=[a.lower() for a in articles_in_exchange]
+            if sweep['stale']:
+                logger.info(
+                    f"✓ offers.xml: нет в наличии {sweep['stale']} товаров без external_id "
+                    f"в каталоге {catalog_type} (по отсутствию артикула в текущем exchange)"
                 )
-                stale_count = stale_by_article.count()
-                if stale_count:
-                    stale_by_article.update(
-                        quantity=0,
-                        is_active=True,
-                        availability='out_of_stock',
-                    )
-                    logger.info(
-                        f"✓ offers.xml: нет в наличии {stale_count} товаров без external_id "
-                        f"в каталоге {catalog_type} (по отсутствию артикула в текущем exchange)"
-                    )
-                    stats[catalog_type]['deleted'] = stats[catalog_type].get('deleted', 0) + stale_count
+                stats[catalog_type]['deleted'] = stats[catalog_type].get('deleted', 0) + sweep['stale']
 
     all_errors = stats['retail']['errors'] + stats['wholesale']['errors']
     all_ids = set(stats['retail']['processed_external_ids']).union(stats['wholesale']['processed_external_ids'])
+    processed_total = stats['retail']['processed'] + stats['wholesale']['processed']
+    profile = active_profiler().as_dict()
+    logger.info(f"Профиль обмена {filename}: {active_profiler().summary()}")
+    try:
+        SyncLog.objects.create(
+            operation_type='file_upload',
+            status='partial' if all_errors else 'success',
+            message=(
+                f'Обработано предложений из файла {filename} (retail+wholesale)'
+                + (' (с ошибками)' if all_errors else '')
+                + (', пакет изменений' if changes_only else '')
+            ),
+            processed_count=processed_total,
+            created_count=stats['retail']['created'] + stats['wholesale']['created'],
+            updated_count=stats['retail']['updated'] + stats['wholesale']['updated'],
+            errors_count=len(all_errors),
+            errors=all_errors,
+            request_ip=get_client_ip(request) if request else None,
+            request_format='CommerceML 2 (offers)',
+            filename=filename,
+            processing_time=(timezone.now() - start_time).total_seconds(),
+            phase_profile=profile,
+        )
+    except Exception as log_error:
+        # Лог синхронизации не должен ломать обмен
+        logger.warning(f"Не удалось записать SyncLog для {filename}: {log_error}")
     return {
         'status': 'success' if not all_errors else 'partial',
-        'processed': stats['retail']['processed'] + stats['wholesale']['processed'],
+        'processed': processed_total,
         'updated': stats['retail']['updated'] + stats['wholesale']['updated'],
+        'unchanged': stats['retail']['unchanged'] + stats['wholesale']['unchanged'],
         'errors': all_errors,
+        'changes_only': changes_only,
         'processed_external_ids': all_ids,
     }
 
@@ -2641,998 +2763,23 @@ def process_offers_file(root, namespaces, filename, request=None, catalog_type='
         f"process_offers_file(catalog_type={catalog_type}) перенаправлен в single-pass обработку"
     )
     return process_offers_file_single_pass(root, namespaces, filename, request)
-    
-    
-    def process_offer_with_retry(offer_elem, idx, max_retries=3):
-        """Обрабатывает предложение с повторными попытками при ошибке 'database is locked'"""
-        for attempt in range(max_retries):
-            try:
-                with transaction.atomic():
-                    return process_single_offer(offer_elem, idx)
-            except OperationalError as e:
-                error_str = str(e).lower()
-                if 'database is locked' in error_str or 'locked' in error_str:
-                    if attempt < max_retries - 1:
-                        # Экспоненциальная задержка: 0.1, 0.2, 0.4, 0.8 секунд
-                        wait_time = 0.1 * (2 ** attempt)
-                        logger.warning(f"⚠ База данных заблокирована для предложения #{idx+1}, попытка {attempt+1}/{max_retries}, ждем {wait_time:.2f} сек...")
-                        time.sleep(wait_time)
-                        continue
-                    else:
-                        logger.error(f"✗ Не удалось обработать предложение #{idx+1} после {max_retries} попыток: database is locked")
-                        return {'error': 'database is locked', 'offer_id': None}
-                else:
-                    # Другая ошибка - пробрасываем дальше
-                    raise
-            except Exception as e:
-                # Другие ошибки - пробрасываем дальше
-                logger.error(f"✗ Ошибка обработки предложения #{idx+1}: {e}")
-                raise
-    
-    def process_single_offer(offer_elem, idx):
-        """Обрабатывает одно предложение"""
-        # Ищем Ид товара
-        product_id_elem = None
-        if namespace:
-            product_id_elem = offer_elem.find(f'{{{namespace}}}Ид')
-        if product_id_elem is None:
-            product_id_elem = offer_elem.find('.//Ид')
-        if product_id_elem is None and 'catalog' in namespaces:
-            try:
-                product_id_elem = offer_elem.find('catalog:Ид', namespaces)
-            except (KeyError, ValueError):
-                pass
-        
-        if product_id_elem is None or not product_id_elem.text:
-            if idx < 5:
-                logger.warning(f"Предложение #{idx+1}: не найден Ид товара")
-            return {'error': 'no product_id', 'offer_id': None}
-        
-        product_id = product_id_elem.text.strip()
-        
-        # Ищем товар по external_id сначала в нужном типе каталога, потом в любом
-        product = Product.objects.filter(external_id=product_id, catalog_type=catalog_type).first()
-        if not product:
-            # Пробуем по артикулу в нужном типе каталога
-            product = Product.objects.filter(article=product_id, catalog_type=catalog_type).first()
-        
-        # Если не нашли в нужном типе каталога, ищем в любом каталоге
-        if not product:
-            product = Product.objects.filter(external_id=product_id).first()
-        if not product:
-            product = Product.objects.filter(article=product_id).first()
-        
-        # Продолжаем обработку товара...
-        # (остальной код обработки товара)
-        return {'success': True, 'offer_id': product_id}
-    
-    for idx, offer_elem in enumerate(offers):
-        # Каждое предложение обрабатывается в отдельной транзакции с retry
-        product_id = None
-        # Используем retry логику для обработки ошибок "database is locked"
-        max_retries = 3
-        processed_successfully = False
-        
-        for attempt in range(max_retries):
-            try:
-                with transaction.atomic():
-                    # Ищем Ид товара
-                    product_id_elem = None
-                    if namespace:
-                        product_id_elem = offer_elem.find(f'{{{namespace}}}Ид')
-                    if product_id_elem is None:
-                        product_id_elem = offer_elem.find('.//Ид')
-                    if product_id_elem is None and 'catalog' in namespaces:
-                        try:
-                            product_id_elem = offer_elem.find('catalog:Ид', namespaces)
-                        except (KeyError, ValueError):
-                            pass
-                    
-                    if product_id_elem is None or not product_id_elem.text:
-                        if idx < 5:
-                            logger.warning(f"Предложение #{idx+1}: не найден Ид товара")
-                        continue
-                    
-                    product_id = product_id_elem.text.strip()
-                    
-                    # ВАЖНО: В CommerceML 2.0 Ид может быть составным: "uuid#характеристика".
-                    # Например: "14393176-aa13-4ac2-8095-1a5459b743c7#a1f57d8f-cc9a-11eb-80d8-00155d01d802"
-                    # ВАЖНО: Используем ПОЛНЫЙ Ид (включая часть после #) как external_id.
-                    # Это гарантирует, что каждое предложение с уникальным полным Ид создаст отдельную карточку.
-                    # Часть после # - это идентификатор характеристики, и она важна для различения товаров.
-                    
-                    # ВАЖНО: Логируем обработку каждого товара для диагностики (первые 100 и товары с артикулом 8-97086-338-2)
-                    should_log = (
-                        idx < 100 or 
-                        '8-97086-338-2' in str(product_id) or 
-                        '86491d95-6cf4-44be-969c-e7f53c1bdb64' in str(product_id)
-                    )
-                    if should_log:
-                        # Извлекаем base_id только для логирования
-                        product_base_id = product_id.split('#', 1)[0].strip() if '#' in product_id else product_id
-                        logger.info(f"🔄 Обработка предложения #{idx+1} в offers.xml: ПОЛНЫЙ Ид={product_id}, base_id={product_base_id}")
-                    
-                    # ВАЖНО: Извлекаем артикул из характеристик товара в offers.xml
-                    # Ищем элемент ХарактеристикиТовара или ЗначенияСвойства
-                    article_from_xml = None
-                    characteristics_elem = None
-                    if namespace:
-                        characteristics_elem = offer_elem.find(f'.//{{{namespace}}}ХарактеристикиТовара')
-                    if characteristics_elem is None:
-                        characteristics_elem = offer_elem.find('.//ХарактеристикиТовара')
-                    if characteristics_elem is None and 'catalog' in namespaces:
-                        try:
-                            characteristics_elem = offer_elem.find('.//catalog:ХарактеристикиТовара', namespaces)
-                        except (KeyError, ValueError):
-                            pass
-                    
-                    if characteristics_elem is not None:
-                        # Ищем Артикул1 в характеристиках
-                        for char_elem in characteristics_elem.findall('.//*'):
-                            char_name = None
-                            char_value = None
-                            
-                            # Ищем название характеристики
-                            name_elem = None
-                            if namespace:
-                                name_elem = char_elem.find(f'{{{namespace}}}Наименование')
-                            if name_elem is None:
-                                name_elem = char_elem.find('Наименование')
-                            if name_elem is not None and name_elem.text:
-                                char_name = name_elem.text.strip().lower()
-                            
-                            # Ищем значение характеристики
-                            value_elem = None
-                            if namespace:
-                                value_elem = char_elem.find(f'{{{namespace}}}Значение')
-                            if value_elem is None:
-                                value_elem = char_elem.find('Значение')
-                            if value_elem is not None and value_elem.text:
-                                char_value = value_elem.text.strip()
-                            
-                            # Проверяем, является ли это Артикул1
-                            if char_name and char_value:
-                                if char_name in ['артикул1', 'артикул 1', 'article1', 'article 1']:
-                                    article_from_xml = char_value
-                                    if idx < 10:
-                                        logger.info(f"Найден артикул в XML для товара {product_id}: {article_from_xml}")
-                                    break
-                    
-                    # Если не нашли в характеристиках, пробуем в ЗначенияСвойства
-                    if not article_from_xml:
-                        properties_elem = None
-                        if namespace:
-                            properties_elem = offer_elem.find(f'.//{{{namespace}}}ЗначенияСвойства')
-                        if properties_elem is None:
-                            properties_elem = offer_elem.find('.//ЗначенияСвойства')
-                        if properties_elem is not None:
-                            # Ищем свойство с Ид = Артикул1
-                            # Обычно Ид свойства для Артикул1: bbd40f55-aa4e-11ea-ba83-e0d55e9e70f8
-                            for prop_elem in properties_elem.findall('.//*'):
-                                prop_id = None
-                                prop_value = None
-                                
-                                # Ищем Ид свойства
-                                id_elem = None
-                                if namespace:
-                                    id_elem = prop_elem.find(f'{{{namespace}}}Ид')
-                                if id_elem is None:
-                                    id_elem = prop_elem.find('Ид')
-                                if id_elem is not None and id_elem.text:
-                                    prop_id = id_elem.text.strip()
-                                
-                                # Ищем значение свойства
-                                value_elem = None
-                                if namespace:
-                                    value_elem = prop_elem.find(f'{{{namespace}}}Значение')
-                                if value_elem is None:
-                                    value_elem = prop_elem.find('Значение')
-                                if value_elem is not None and value_elem.text:
-                                    prop_value = value_elem.text.strip()
-                                
-                                # Проверяем, является ли это Артикул1 (по Ид или по значению)
-                                if prop_id == 'bbd40f55-aa4e-11ea-ba83-e0d55e9e70f8' or (prop_value and prop_value and len(prop_value) > 3):
-                                    # Если это похоже на артикул (содержит цифры и дефисы), используем его
-                                    if prop_value and ('-' in prop_value or prop_value.replace('-', '').replace('.', '').isdigit()):
-                                        article_from_xml = prop_value
-                                        if idx < 10:
-                                            logger.info(f"Найден артикул в ЗначенияСвойства для товара {product_id}: {article_from_xml}")
-                                        break
-                    
-                    # ВАЖНО: Логируем поиск товара для диагностики (особенно для товара 8-97086-338-2 и 22680-AD210)
-                    should_log_search = (
-                        '86491d95-6cf4-44be-969c-e7f53c1bdb64' in str(product_id) or
-                        article_from_xml == '8-97086-338-2' or
-                        product_id == '8-97086-338-2' or
-                        article_from_xml == '22680-AD210' or
-                        '22680-AD210' in str(product_id) or
-                        idx < 10
-                    )
-                    
-                    # ВАЖНО: Для схемы "1 предложение = 1 карточка" ищем товар ТОЛЬКО по точному external_id.
-                    # Используем ПОЛНЫЙ Ид (включая часть после #), например:
-                    # "14393176-aa13-4ac2-8095-1a5459b743c7#a1f57d8f-cc9a-11eb-80d8-00155d01d802"
-                    # Если не найден - создаём новый товар, игнорируя поиск по base_id/артикулу.
-                    # Это гарантирует, что каждое предложение с уникальным полным Ид создаст отдельную карточку.
-                    product = Product.objects.filter(
-                        external_id=product_id,  # ВАЖНО: Используем ПОЛНЫЙ Ид, включая часть после #
-                        catalog_type=catalog_type
-                    ).first()
-                    
-                    if should_log_search:
-                        if product:
-                            logger.info(f"🔍 [ПОИСК ТОВАРА] Товар найден по ТОЧНОМУ external_id в каталоге {catalog_type}: Ид={product_id}, артикул={product.article}")
-                        else:
-                            logger.warning(f"🔍 [ПОИСК ТОВАРА] Товар НЕ найден по ТОЧНОМУ external_id в каталоге {catalog_type}: Ид={product_id}, артикул из XML={article_from_xml}. Будет создан новый товар.")
-                    
-                    # ВАЖНО: Логируем статистику для первых 100 товаров, чтобы понять паттерн
-                    if idx < 100 and not product:
-                        logger.info(f"📊 [СТАТИСТИКА] Предложение #{idx+1}: Ид={product_id}, артикул={article_from_xml}, товар НЕ найден - будет создан")
-                    elif idx < 100 and product:
-                        logger.info(f"📊 [СТАТИСТИКА] Предложение #{idx+1}: Ид={product_id}, артикул={article_from_xml}, товар НАЙДЕН (ID={product.id})")
-                    
-                    # Если не нашли в нужном каталоге, проверяем, есть ли в другом (для создания копии)
-                    existing_product = None
-                    if not product:
-                        existing_product = Product.objects.filter(
-                            external_id=product_id
-                        ).first()
-                        if existing_product and idx < 10:
-                            logger.info(f"Товар {product_id} найден в каталоге {existing_product.catalog_type}, но нужен {catalog_type}. Будет создана копия.")
-                    
-                    # Если товар не найден в нужном каталоге, но найден в другом - создаем копию
-                    if not product and existing_product:
-                        # Создаем новый товар в нужном каталоге на основе найденного
-                        # ВАЖНО: Используем ПОЛНЫЙ product_id как external_id (не existing_product.external_id),
-                        # чтобы каждый каталог имел товар с правильным идентификатором из offers.xml
-                        product_external_id = product_id.strip() if product_id and product_id.strip() else None
-                        product = Product(
-                            external_id=product_external_id,
-                            article=existing_product.article or '',
-                            name=existing_product.name or '',
-                            brand=existing_product.brand or '',
-                            category=existing_product.category,
-                            description=existing_product.description or '',
-                            short_description=existing_product.short_description or '',
-                            applicability=existing_product.applicability or '',
-                            cross_numbers=existing_product.cross_numbers or '',
-                            characteristics=existing_product.characteristics or '',
-                            farpost_url=existing_product.farpost_url or '',
-                            condition=existing_product.condition or 'new',
-                            catalog_type=catalog_type,
-                            is_active=False,  # Будет активирован после обновления цены/остатка
-                        )
-                        # Устанавливаем цену в зависимости от типа каталога
-                        if catalog_type == 'wholesale':
-                            product.wholesale_price = existing_product.wholesale_price or existing_product.price
-                            product.price = existing_product.price
-                        else:
-                            product.price = existing_product.price
-                            product.wholesale_price = existing_product.wholesale_price
-                        save_with_retry(product)
-                        # ВАЖНО: НЕ копируем изображения - оптовые товары используют изображения розничных аналогов
-                        # через методы get_main_image() и get_all_images() в модели Product
-                        if idx < 5:
-                            logger.info(f"Создан товар в каталоге {catalog_type} на основе товара из другого каталога: {product_id}")
-                
-                # ВАЖНО: Если товар найден, обновляем его название из offers.xml (если оно есть)
-                # Это гарантирует, что название всегда синхронизировано с 1С
-                if product:
-                    # Пытаемся получить название из предложения
-                    offer_name = None
-                    try:
-                        if namespace:
-                            name_elem = offer_elem.find(f'.//{{{namespace}}}Наименование')
-                        else:
-                            name_elem = offer_elem.find('.//Наименование')
-                        if name_elem is not None and name_elem.text:
-                            offer_name = name_elem.text.strip()
-                    except Exception:
-                        offer_name = None
-                    
-                    # Приводим название к «чистому» виду так же, как при импорте из import.xml
-                    if offer_name:
-                        try:
-                            import re
-                            clean_name = offer_name
-                            clean_name = re.sub(r',+', ',', clean_name)
-                            clean_name = re.sub(r'\s+', ' ', clean_name)
-                            clean_name = re.sub(r'\(\s*,', '(', clean_name)
-                            clean_name = re.sub(r',\s*\)', ')', clean_name)
-                            clean_name = re.sub(r'\(\s*\)', '', clean_name)
-                            clean_name = re.sub(r',\s*,', ',', clean_name)
-                            clean_name = clean_name.strip(' ,()')
-                            offer_name = clean_name
-                        except Exception:
-                            pass
-                    
-                    # Если название найдено в offers.xml и отличается от текущего - обновляем
-                    if offer_name and offer_name != product.name:
-                        old_name = product.name or ''
-                        product.name = offer_name
-                        if idx < 10:
-                            logger.info(
-                                f"✓ Обновлено название товара {product_id} (артикул: {product.article}): "
-                                f"'{old_name[:50]}' → '{offer_name[:50]}'"
-                            )
-                
-                if not product:
-                    # Товар не найден ни в одном каталоге и не был создан из import.xml.
-                    # Для схемы 1 предложение = 1 карточка создаём НОВЫЙ товар напрямую из offers.xml.
-                    if idx < 50:
-                        logger.warning(
-                            f"⚠ Товар с Ид {product_id} не найден в базе (catalog_type={catalog_type}). "
-                            f"Создаём новый товар напрямую из offers.xml"
-                        )
-                    # Пытаемся получить человекочитаемое имя товара из предложения
-                    offer_name = None
-                    try:
-                        if namespace:
-                            name_elem = offer_elem.find(f'.//{{{namespace}}}Наименование')
-                        else:
-                            name_elem = offer_elem.find('.//Наименование')
-                        if name_elem is not None and name_elem.text:
-                            offer_name = name_elem.text.strip()
-                    except Exception:
-                        offer_name = None
-                    
-                    # Приводим название к «чистому» виду так же, как при импорте из import.xml
-                    # (убираем лишние запятые, пробелы, пустые скобки и т.п.), чтобы не было дублей
-                    # с «сырым» и отформатированным вариантом одного и того же названия.
-                    if offer_name:
-                        try:
-                            import re
-                            clean_name = offer_name
-                            clean_name = re.sub(r',+', ',', clean_name)
-                            clean_name = re.sub(r'\s+', ' ', clean_name)
-                            clean_name = re.sub(r'\(\s*,', '(', clean_name)
-                            clean_name = re.sub(r',\s*\)', ')', clean_name)
-                            clean_name = re.sub(r'\(\s*\)', '', clean_name)
-                            clean_name = re.sub(r',\s*,', ',', clean_name)
-                            clean_name = clean_name.strip(' ,()')
-                            offer_name = clean_name
-                        except Exception:
-                            # При любой ошибке просто используем исходное offer_name
-                            pass
-                    # Если имени нет, используем артикул или Ид
-                    if not offer_name:
-                        offer_name = article_from_xml or product_id or 'Товар из offers.xml'
-
-                    # Определяем категорию по названию товара
-                    category = None
-                    if offer_name:
-                        try:
-                            from .services import get_category_for_product
-                            category = get_category_for_product(offer_name, use_db_subcategories=True)
-                        except Exception:
-                            pass
-                    
-                    # Если категория не найдена, используем первую активную корневую категорию
-                    if not category:
-                        try:
-                            from .models import Category
-                            category = Category.objects.filter(parent=None, is_active=True).first()
-                        except Exception:
-                            pass
-
-                    # ВАЖНО: Используем ПОЛНЫЙ product_id (включая часть после #) как external_id
-                    # Это гарантирует уникальность каждого товара по полному идентификатору из 1С
-                    product_external_id = product_id.strip() if product_id and product_id.strip() else None
-                    product = Product(
-                        external_id=product_external_id,  # Полный Ид: "uuid#characteristic_id"
-                        article=article_from_xml or '',
-                        name=offer_name,
-                        brand='',
-                        category=category,
-                        description='',
-                        short_description='',
-                        applicability='',
-                        cross_numbers='',
-                        characteristics='',
-                        farpost_url='',
-                        condition='new',
-                        catalog_type=catalog_type,
-                        quantity=0,
-                        availability='out_of_stock',
-                        is_active=False,  # Будет активирован после обновления цены/остатка
-                    )
-                    save_with_retry(product)
-                    # ВАЖНО: Увеличиваем счетчики сразу после создания товара
-                    processed_count += 1
-                    created_count += 1
-                    # ВАЖНО: Помечаем товар как только что созданный, чтобы не увеличивать updated_count
-                    product._just_created = True
-                    # ВАЖНО: Логируем ВСЕ создания товаров (не только первые 50), чтобы видеть реальную статистику
-                    logger.info(
-                        f"✅ Создан новый товар из offers.xml (#{idx+1}): external_id={product_external_id}, "
-                        f"article={product.article}, name={product.name[:80]}, catalog_type={catalog_type}, "
-                        f"created_count={created_count}"
-                    )
-                    # Добавляем external_id в список обработанных
-                    if product.external_id:
-                        processed_external_ids.add(str(product.external_id).strip())
-                    elif product_id:
-                        processed_external_ids.add(str(product_id).strip())
-                
-                # ВАЖНО: Проверяем, что товар найден перед обновлением количества
-                # Эта проверка будет выполнена позже, после извлечения количества из XML
-                
-                # Обновляем цену из предложений (приоритет - цены из offers.xml)
-                # В offers.xml может быть несколько типов цен:
-                # f6708032-0bd5-11f1-811f-00155d01d802 - розничная цена
-                # b12f44c0-1208-11f1-811f-00155d01d802 - оптовая цена
-                
-                # Определяем ID типов цен
-                RETAIL_PRICE_TYPE_ID = 'f6708032-0bd5-11f1-811f-00155d01d802'
-                WHOLESALE_PRICE_TYPE_ID = 'b12f44c0-1208-11f1-811f-00155d01d802'
-                
-                # Ищем все цены в предложении
-                prices_elem = None
-                if namespace:
-                    prices_elem = offer_elem.find(f'.//{{{namespace}}}Цены')
-                if prices_elem is None:
-                    prices_elem = offer_elem.find('.//Цены')
-                if prices_elem is None and 'catalog' in namespaces:
-                    try:
-                        prices_elem = offer_elem.find('.//catalog:Цены', namespaces)
-                    except (KeyError, ValueError):
-                        pass
-                
-                price = None
-                if prices_elem is not None:
-                    # Ищем все элементы Цена
-                    price_elems = []
-                    if namespace:
-                        price_elems = prices_elem.findall(f'{{{namespace}}}Цена')
-                    if not price_elems:
-                        price_elems = prices_elem.findall('Цена')
-                    if not price_elems and 'catalog' in namespaces:
-                        try:
-                            price_elems = prices_elem.findall('catalog:Цена', namespaces)
-                        except (KeyError, ValueError):
-                            pass
-                    
-                    # Ищем нужную цену по типу каталога
-                    for price_elem in price_elems:
-                        # Ищем ИдТипаЦены
-                        price_type_id_elem = None
-                        if namespace:
-                            price_type_id_elem = price_elem.find(f'{{{namespace}}}ИдТипаЦены')
-                        if price_type_id_elem is None:
-                            price_type_id_elem = price_elem.find('ИдТипаЦены')
-                        if price_type_id_elem is None and 'catalog' in namespaces:
-                            try:
-                                price_type_id_elem = price_elem.find('catalog:ИдТипаЦены', namespaces)
-                            except (KeyError, ValueError):
-                                pass
-                
-                        if price_type_id_elem is not None and price_type_id_elem.text:
-                            price_type_id = price_type_id_elem.text.strip()
-                            
-                            # Проверяем, подходит ли эта цена для текущего типа каталога
-                            is_correct_price_type = False
-                            if catalog_type == 'wholesale':
-                                # Для оптового каталога нужна оптовая цена
-                                is_correct_price_type = (price_type_id == WHOLESALE_PRICE_TYPE_ID)
-                            else:
-                                # Для розничного каталога нужна розничная цена
-                                is_correct_price_type = (price_type_id == RETAIL_PRICE_TYPE_ID)
-                            
-                            if is_correct_price_type:
-                                # Ищем ЦенаЗаЕдиницу
-                                price_value_elem = None
-                                if namespace:
-                                    price_value_elem = price_elem.find(f'{{{namespace}}}ЦенаЗаЕдиницу')
-                                if price_value_elem is None:
-                                    price_value_elem = price_elem.find('ЦенаЗаЕдиницу')
-                                if price_value_elem is None and 'catalog' in namespaces:
-                                    try:
-                                        price_value_elem = price_elem.find('catalog:ЦенаЗаЕдиницу', namespaces)
-                                    except (KeyError, ValueError):
-                                        pass
-                                
-                                if price_value_elem is not None and price_value_elem.text:
-                                    try:
-                                        price_str = price_value_elem.text.strip().replace(',', '.').replace(' ', '').replace('\xa0', '')
-                                        if price_str:
-                                            price = float(price_str)
-                                            if price > 0:
-                                                # Для оптового каталога обновляем wholesale_price, для розничного - price
-                                                if catalog_type == 'wholesale':
-                                                    product.wholesale_price = price
-                                                    if idx < 10:
-                                                        logger.info(f"✓ Обновлена оптовая цена для товара {product_id}: {price} (тип цены: {price_type_id})")
-                                                else:
-                                                    product.price = price
-                                                    product._price_updated = True  # Флаг для сохранения
-                                                    if idx < 10:
-                                                        logger.info(f"✓ Обновлена розничная цена для товара {product_id}: {price} (тип цены: {price_type_id})")
-                                                # Видимость задаётся только блоком остатков ниже (не держать карточку «под заказ» при quantity=0)
-                                                break  # Нашли нужную цену, выходим из цикла
-                                    except (ValueError, AttributeError, TypeError) as e:
-                                        if idx < 5:
-                                            logger.warning(f"Не удалось распарсить цену для товара {product_id}: {price_value_elem.text}, ошибка: {e}")
-                
-                # Если не нашли цену по типу, пробуем взять нужную цену (fallback)
-                # ВАЖНО: Для оптового каталога ищем оптовую цену, для розничного - розничную
-                if price is None or price == 0:
-                    if prices_elem is not None:
-                        price_elems = []
-                        if namespace:
-                            price_elems = prices_elem.findall(f'{{{namespace}}}Цена')
-                        if not price_elems:
-                            price_elems = prices_elem.findall('Цена')
-                        if not price_elems and 'catalog' in namespaces:
-                            try:
-                                price_elems = prices_elem.findall('catalog:Цена', namespaces)
-                            except (KeyError, ValueError):
-                                pass
-                        
-                        # Сначала пытаемся найти нужный тип цены (оптовая для оптового каталога, розничная для розничного)
-                        for price_elem in price_elems:
-                            price_type_id_elem = None
-                            if namespace:
-                                price_type_id_elem = price_elem.find(f'{{{namespace}}}ИдТипаЦены')
-                            if price_type_id_elem is None:
-                                price_type_id_elem = price_elem.find('ИдТипаЦены')
-                            if price_type_id_elem is None and 'catalog' in namespaces:
-                                try:
-                                    price_type_id_elem = price_elem.find('catalog:ИдТипаЦены', namespaces)
-                                except (KeyError, ValueError):
-                                    pass
-                            
-                            if price_type_id_elem is not None and price_type_id_elem.text:
-                                price_type_id = price_type_id_elem.text.strip()
-                                # Проверяем, подходит ли эта цена для текущего типа каталога
-                                is_correct_price_type = False
-                                if catalog_type == 'wholesale':
-                                    is_correct_price_type = (price_type_id == WHOLESALE_PRICE_TYPE_ID)
-                                else:
-                                    is_correct_price_type = (price_type_id == RETAIL_PRICE_TYPE_ID)
-                                
-                                if is_correct_price_type:
-                                    price_value_elem = None
-                                    if namespace:
-                                        price_value_elem = price_elem.find(f'{{{namespace}}}ЦенаЗаЕдиницу')
-                                    if price_value_elem is None:
-                                        price_value_elem = price_elem.find('ЦенаЗаЕдиницу')
-                                    if price_value_elem is None and 'catalog' in namespaces:
-                                        try:
-                                            price_value_elem = price_elem.find('catalog:ЦенаЗаЕдиницу', namespaces)
-                                        except (KeyError, ValueError):
-                                            pass
-                                    
-                                    if price_value_elem is not None and price_value_elem.text:
-                                        try:
-                                            price_str = price_value_elem.text.strip().replace(',', '.').replace(' ', '').replace('\xa0', '')
-                                            if price_str:
-                                                price = float(price_str)
-                                                if price > 0:
-                                                    # Для оптового каталога обновляем wholesale_price, для розничного - price
-                                                    if catalog_type == 'wholesale':
-                                                        product.wholesale_price = price
-                                                        if idx < 5:
-                                                            logger.info(f"Обновлена оптовая цена (fallback по типу) для товара {product_id}: {price}")
-                                                    else:
-                                                        product.price = price
-                                                        if idx < 5:
-                                                            logger.info(f"Обновлена розничная цена (fallback по типу) для товара {product_id}: {price}")
-                                                    break
-                                        except (ValueError, AttributeError, TypeError):
-                                            pass
-                        
-                        # Если все еще не нашли, берем первую ненулевую цену (последний fallback)
-                        if (price is None or price == 0) and catalog_type == 'wholesale':
-                            # Для оптового каталога в крайнем случае берем любую цену, но логируем
-                            for price_elem in price_elems:
-                                price_value_elem = None
-                                if namespace:
-                                    price_value_elem = price_elem.find(f'{{{namespace}}}ЦенаЗаЕдиницу')
-                                if price_value_elem is None:
-                                    price_value_elem = price_elem.find('ЦенаЗаЕдиницу')
-                                if price_value_elem is None and 'catalog' in namespaces:
-                                    try:
-                                        price_value_elem = price_elem.find('catalog:ЦенаЗаЕдиницу', namespaces)
-                                    except (KeyError, ValueError):
-                                        pass
-                                
-                                if price_value_elem is not None and price_value_elem.text:
-                                    try:
-                                        price_str = price_value_elem.text.strip().replace(',', '.').replace(' ', '').replace('\xa0', '')
-                                        if price_str:
-                                            price = float(price_str)
-                                            if price > 0:
-                                                product.wholesale_price = price
-                                                if idx < 5:
-                                                    logger.warning(f"⚠ Обновлена оптовая цена (fallback - любая цена) для товара {product_id}: {price}")
-                                                break
-                                    except (ValueError, AttributeError, TypeError):
-                                        pass
-                
-                # ВАЖНО: Обновляем остаток из offers.xml
-                # Количество может быть в:
-                # 1. <Количество>268</Количество> или <Количество>0</Количество>
-                # 2. <Склад КоличествоНаСкладе="268"/> или <Склад КоличествоНаСкладе="0"/>
-                # ВАЖНО: Количество = 0 - это валидное значение! Товар должен быть скрыт.
-                quantity = None
-                quantity_elem = None
-                found_quantity_in_xml = False  # Флаг, что количество найдено в XML
-                
-                # Вариант 1: Ищем элемент <Количество> (используем findall для поиска всех вложенных элементов)
-                # ВАЖНО: Может быть несколько элементов <Количество>, суммируем их
-                quantity_elems = []
-                if namespace:
-                    quantity_elems = offer_elem.findall(f'.//{{{namespace}}}Количество')
-                    if idx < 10:
-                        logger.debug(f"Поиск <Количество> с namespace '{namespace}': найдено {len(quantity_elems)} элементов")
-                if not quantity_elems:
-                    quantity_elems = offer_elem.findall('.//Количество')
-                    if idx < 10:
-                        logger.debug(f"Поиск <Количество> без namespace: найдено {len(quantity_elems)} элементов")
-                if not quantity_elems and 'catalog' in namespaces:
-                    try:
-                        quantity_elems = offer_elem.findall('.//catalog:Количество', namespaces)
-                        if idx < 10:
-                            logger.debug(f"Поиск <Количество> с префиксом catalog:: найдено {len(quantity_elems)} элементов")
-                    except (KeyError, ValueError):
-                        pass
-                
-                # ВАЖНО: Если не нашли элементы, логируем структуру XML для отладки
-                if not quantity_elems and idx < 10:
-                    # Пробуем найти любые элементы с похожими названиями
-                    all_elems = offer_elem.findall('.//*')
-                    qty_like_elems = [e for e in all_elems if e.tag and ('количество' in e.tag.lower() or 'quantity' in e.tag.lower())]
-                    if qty_like_elems:
-                        logger.warning(f"⚠ Найдены похожие элементы для товара {product_id}: {[e.tag for e in qty_like_elems[:5]]}")
-                    else:
-                        logger.warning(f"⚠ Элемент <Количество> не найден для товара {product_id}. Доступные элементы: {[e.tag for e in all_elems[:10] if e.tag]}")
-                
-                # Суммируем количество из всех элементов <Количество>
-                # ВАЖНО: Если в XML указано количество = 0, это валидное значение (товар без остатка)
-                total_quantity_from_elems = None
-                found_quantity_in_xml = False
-                for qty_elem in quantity_elems:
-                    if qty_elem is not None and qty_elem.text is not None:
-                        # ВАЖНО: Проверяем даже пустую строку или "0" - это валидное значение
-                        qty_text = qty_elem.text.strip()
-                        try:
-                            qty_value = int(float(qty_text.replace(',', '.')))
-                            if total_quantity_from_elems is None:
-                                total_quantity_from_elems = 0
-                            total_quantity_from_elems += qty_value
-                            found_quantity_in_xml = True
-                            if idx < 10 or qty_value == 0:  # Логируем больше товаров и обязательно товары с количеством = 0
-                                logger.info(f"Найдено количество в элементе <Количество> для товара {product_id}: {qty_value} (текст: '{qty_text}')")
-                        except (ValueError, AttributeError) as e:
-                            if idx < 10:
-                                logger.warning(f"Не удалось распарсить остаток из <Количество> для товара {product_id}: '{qty_elem.text}', ошибка: {e}")
-                    elif qty_elem is not None and qty_elem.text == '':
-                        # Пустая строка - это тоже 0
-                        if total_quantity_from_elems is None:
-                            total_quantity_from_elems = 0
-                        found_quantity_in_xml = True
-                        if idx < 10:
-                            logger.info(f"Найдено пустое количество в элементе <Количество> для товара {product_id} - считаем как 0")
-                
-                if found_quantity_in_xml:
-                    # Количество найдено в XML (даже если = 0) - используем его
-                    quantity = total_quantity_from_elems if total_quantity_from_elems is not None else 0
-                    # ВАЖНО: Логируем ВСЕ товары с количеством = 0 для диагностики
-                    # ВАЖНО: quantity = 0 - это валидное значение! Товар должен быть скрыт.
-                    should_log_qty = (
-                        idx < 10 or 
-                        quantity == 0 or 
-                        (product and '8-97086-338-2' in str(product.article)) or
-                        article_from_xml == '8-97086-338-2' or
-                        '86491d95-6cf4-44be-969c-e7f53c1bdb64' in str(product_id) or
-                        article_from_xml == '22680-AD210' or
-                        '22680-AD210' in str(product_id)
-                    )
-                    if should_log_qty:
-                        logger.info(f"✓ Общее количество из элементов <Количество> для товара {product_id} (артикул: {product.article if product else 'N/A'}, артикул из XML: {article_from_xml}): {quantity} (было: {product.quantity if product else 'N/A'}), found_quantity_in_xml={found_quantity_in_xml}")
-                    # ВАЖНО: found_quantity_in_xml уже установлен в True выше, не нужно устанавливать снова
-                
-                # Вариант 2: Если не нашли в элементе, ищем в атрибуте <Склад КоличествоНаСкладе="..."/>
-                # ВАЖНО: Может быть несколько складов, нужно суммировать количество со всех складов
-                # ВАЖНО: Проверяем quantity is None, чтобы не перезаписать количество, найденное в <Количество>
-                if not found_quantity_in_xml or quantity is None:
-                    warehouse_elems = []
-                    if namespace:
-                        warehouse_elems = offer_elem.findall(f'.//{{{namespace}}}Склад')
-                    if not warehouse_elems:
-                        warehouse_elems = offer_elem.findall('.//Склад')
-                    if not warehouse_elems and 'catalog' in namespaces:
-                        try:
-                            warehouse_elems = offer_elem.findall('.//catalog:Склад', namespaces)
-                        except (KeyError, ValueError):
-                            pass
-                    
-                    # Суммируем количество со всех складов
-                    # ВАЖНО: Если в XML указано количество = 0, это валидное значение (товар без остатка)
-                    total_warehouse_quantity = None
-                    found_warehouse_quantity = False
-                    for warehouse_elem in warehouse_elems:
-                        # Ищем атрибут КоличествоНаСкладе
-                        quantity_attr = warehouse_elem.get('КоличествоНаСкладе')
-                        if not quantity_attr:
-                            # Пробуем английское название атрибута
-                            quantity_attr = warehouse_elem.get('QuantityInStock')
-                        
-                        if quantity_attr:
-                            try:
-                                warehouse_qty = int(float(str(quantity_attr).strip().replace(',', '.')))
-                                if total_warehouse_quantity is None:
-                                    total_warehouse_quantity = 0
-                                total_warehouse_quantity += warehouse_qty
-                                found_warehouse_quantity = True
-                                if idx < 5:
-                                    logger.info(f"Найдено количество на складе для товара {product_id}: {warehouse_qty} (всего складов: {len(warehouse_elems)})")
-                            except (ValueError, AttributeError) as e:
-                                if idx < 5:
-                                    logger.warning(f"Не удалось распарсить остаток из атрибута Склад для товара {product_id}: {quantity_attr}, ошибка: {e}")
-                    
-                    if found_warehouse_quantity:
-                        # Количество найдено в XML (даже если = 0) - используем его
-                        quantity = total_warehouse_quantity if total_warehouse_quantity is not None else 0
-                        found_quantity_in_xml = True  # Отмечаем, что количество найдено
-                        # ВАЖНО: Логируем ВСЕ товары с количеством = 0 для диагностики
-                        should_log_warehouse = (
-                            idx < 10 or 
-                            quantity == 0 or 
-                            (product and '8-97086-338-2' in str(product.article)) or
-                            article_from_xml == '8-97086-338-2' or
-                            '86491d95-6cf4-44be-969c-e7f53c1bdb64' in str(product_id)
-                        )
-                        if should_log_warehouse:
-                            logger.info(f"✓ Общее количество со всех складов для товара {product_id} (артикул: {product.article if product else 'N/A'}, артикул из XML: {article_from_xml}): {quantity} (было: {product.quantity if product else 'N/A'}), found_quantity_in_xml={found_quantity_in_xml}")
-                
-                # Обновляем количество и наличие ТОЛЬКО если товар найден
-                if not product:
-                    if idx < 10:
-                        logger.warning(f"⚠ Товар {product_id} не найден, пропускаем обновление количества. found_quantity_in_xml={found_quantity_in_xml}, quantity={quantity}")
-                    continue
-                
-                if found_quantity_in_xml:
-                    # Если количество найдено в XML (даже если 0) — просто устанавливаем его,
-                    # и определяем активность ТОЛЬКО по количеству (без проверки цены).
-                    if quantity is None:
-                        quantity = 0
-                    product.quantity = quantity
-                    product.availability = 'in_stock' if quantity > 0 else 'out_of_stock'
-                    product.is_active = True
-                    # Сохраняем товар после обновления активности
-                    update_fields = ['quantity', 'availability', 'is_active', 'name']
-                    if catalog_type == 'wholesale':
-                        update_fields.append('wholesale_price')
-                    else:
-                        update_fields.append('price')
-                    save_with_retry(product, update_fields=update_fields)
-                else:
-                    # Если количество не найдено в XML — не трогаем существующее количество
-                    # и определяем активность ТОЛЬКО по нему (цена не участвует).
-                    existing_quantity = product.quantity or 0
-                    product.availability = 'in_stock' if existing_quantity > 0 else 'out_of_stock'
-                    product.is_active = True
-                    save_with_retry(product, update_fields=['availability', 'is_active', 'name'])
-                
-                # ВАЖНО: НЕ переопределяем категорию при каждом обмене из offers.xml!
-                # Категория должна устанавливаться только из import.xml
-                # Переопределение категории приводит к тому, что товары попадают в неактивные категории
-                # и потом скрываются
-                # Категория обновляется ТОЛЬКО если текущая категория неактивна
-                # ВАЖНО: Проверяем, что товар не находится в неактивной категории
-                if product.category:
-                    if not product.category.is_active:
-                        from .services import get_category_for_product
-                        # Только если категория неактивна, ищем активную
-                        new_category = get_category_for_product(product.name, use_db_subcategories=True)
-                        if new_category and new_category.is_active:
-                            old_category = product.category
-                            product.category = new_category
-                            # Сохраняем категорию сразу
-                            save_with_retry(product, update_fields=['category'])
-                            # Логируем ВСЕ перемещения из неактивных категорий
-                            should_log_category = (
-                                idx < 10 or 
-                                '8-97086-338-2' in str(product.article) or
-                                article_from_xml == '8-97086-338-2' or
-                                '86491d95-6cf4-44be-969c-e7f53c1bdb64' in str(product_id)
-                            )
-                            if should_log_category:
-                                logger.warning(f"  ⚠ Товар {product_id} (артикул: {product.article}) был в неактивной категории '{old_category.name}', перемещен в активную '{new_category.name}'")
-                        elif not new_category or not new_category.is_active:
-                            # Ищем активную родительскую категорию
-                            current_cat = product.category
-                            while current_cat.parent:
-                                if current_cat.parent.is_active:
-                                    old_category = product.category
-                                    product.category = current_cat.parent
-                                    save_with_retry(product, update_fields=['category'])
-                                    # Логируем ВСЕ перемещения в родительские категории
-                                    should_log_category = (
-                                        idx < 10 or 
-                                        '8-97086-338-2' in str(product.article) or
-                                        article_from_xml == '8-97086-338-2' or
-                                        '86491d95-6cf4-44be-969c-e7f53c1bdb64' in str(product_id)
-                                    )
-                                    if should_log_category:
-                                        logger.warning(f"  ⚠ Товар {product_id} (артикул: {product.article}) перемещен в активную родительскую категорию '{product.category.name}' (было: '{old_category.name}')")
-                                    break
-                                current_cat = current_cat.parent
-                    # ВАЖНО: Дополнительная проверка - если категория стала неактивной после обновления
-                    # (например, если категория была деактивирована в админке после последнего обмена)
-                    elif not product.category.is_active:
-                        # Это не должно происходить, но на всякий случай проверяем
-                        logger.error(f"  ⚠ ОШИБКА: Товар {product_id} (артикул: {product.article}) находится в неактивной категории '{product.category.name}' после проверки!")
-                
-                save_with_retry(product)
-                
-                # ВАЖНО: Добавляем external_id в список обработанных для логики скрытия
-                # Это предотвращает скрытие товаров из offers.xml при обработке import.xml
-                if product.external_id:
-                    processed_external_ids.add(str(product.external_id).strip())
-                elif product_id:
-                    # Если external_id не установлен, используем product_id из offers.xml
-                    processed_external_ids.add(str(product_id).strip())
-                
-                # ВАЖНО: НЕ инвалидируем кеш при обновлении товаров из offers.xml
-                # Это предотвращает изменение количества при каждом обновлении страницы
-                # Кеш будет обновляться автоматически через 30 минут
-                # Или при создании/удалении товаров из import.xml (force=True)
-                
-                processed_count += 1
-                # ВАЖНО: Увеличиваем updated_count только если товар был найден (не создан)
-                # Если товар был создан выше, updated_count не увеличиваем
-                if not getattr(product, '_just_created', False):
-                    updated_count += 1
-                
-                # Логируем успешное обновление для первых товаров
-                if idx < 10:
-                    current_price = product.price if catalog_type == 'retail' else product.wholesale_price
-                    logger.info(f"✓ Товар обновлен: Ид={product_id}, название={product.name[:50]}, цена={current_price}, остаток={product.quantity}, активен={product.is_active}, каталог={catalog_type}, updated_count={updated_count}")
-                
-                # Успешно обработано - выходим из retry цикла
-                processed_successfully = True
-                break
-                    
-            except OperationalError as e:
-                error_str = str(e).lower()
-                if 'database is locked' in error_str or 'locked' in error_str:
-                    if attempt < max_retries - 1:
-                        # Экспоненциальная задержка: 0.1, 0.2, 0.4 секунд
-                        wait_time = 0.1 * (2 ** attempt)
-                        logger.warning(f"⚠ База данных заблокирована для предложения #{idx+1}, попытка {attempt+1}/{max_retries}, ждем {wait_time:.2f} сек...")
-                        time.sleep(wait_time)
-                        continue
-                    else:
-                        logger.error(f"✗ Не удалось обработать предложение #{idx+1} после {max_retries} попыток: database is locked")
-                        errors.append({
-                            'offer_id': product_id if product_id else f'offer_{idx}',
-                            'error': 'database is locked'
-                        })
-                        break
-                else:
-                    # Другая ошибка - пробрасываем дальше
-                    raise
-                        
-            except Exception as e:
-                # Исключение при обработке предложения - транзакция автоматически откатывается
-                error_msg = str(e)
-                logger.error(f"✗ Исключение при обработке предложения #{idx+1}: {error_msg}", exc_info=True)
-                errors.append({
-                    'offer_id': product_id if product_id else f'offer_{idx}',
-                    'error': error_msg
-                })
-                # Транзакция автоматически откатывается при исключении
-                # Продолжаем обработку следующего предложения
-                break  # Выходим из retry цикла при любой другой ошибке
-    
-    processing_time = (timezone.now() - start_time).total_seconds()
-    request_ip = get_client_ip(request) if request else None
-    
-    logger.info("=" * 80)
-    logger.info(f"📊 ИТОГИ ОБРАБОТКИ offers.xml для каталога {catalog_type}:")
-    logger.info(f"📊 Обработано товаров: {processed_count}")
-    logger.info(f"📊 Создано новых товаров: {created_count}")
-    logger.info(f"📊 Обновлено товаров: {updated_count}")
-    logger.info(f"📊 Ошибок: {len(errors)}")
-    logger.info(f"📊 Уникальных external_id: {len(processed_external_ids)}")
-    logger.info("=" * 80)
-    
-    # ВАЖНО: Статус 'success' только если товары действительно обработаны
-    if processed_count == 0:
-        status = 'failure'
-        message = f'Файл {filename} обработан, но товары не были обновлены для каталога {catalog_type}'
-    elif errors:
-        status = 'partial'
-        message = f'Обработано предложений из файла {filename} для каталога {catalog_type} (с ошибками)'
-    else:
-        status = 'success'
-        message = f'Обработано предложений из файла {filename} для каталога {catalog_type}'
-    
-    # ВАЖНО: Проверяем существование таблицы SyncLog перед использованием
-    from django.db import connection
-    table_exists = False
-    try:
-        with connection.cursor() as cursor:
-            if 'sqlite' in connection.vendor:
-                cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='catalog_synclog'")
-            else:
-                cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_name='catalog_synclog'")
-            table_exists = cursor.fetchone() is not None
-    except Exception:
-        pass
-    
-    if table_exists:
-        sync_log = SyncLog.objects.create(
-            operation_type='file_upload',
-            status=status,
-            message=message,
-            processed_count=processed_count,
-            created_count=created_count,  # ВАЖНО: Используем реальное количество созданных товаров
-            updated_count=updated_count,
-            errors_count=len(errors),
-            errors=errors,
-            request_ip=request_ip,
-            request_format='CommerceML 2 (offers)',
-            filename=filename,
-            processing_time=processing_time
-        )
-    
-    logger.info(f"Обработка предложений завершена: обработано {processed_count}, создано {created_count}, обновлено {updated_count}, ошибок {len(errors)}")
-    
-    return {
-        'status': 'success',
-        'processed': processed_count,
-        'created': 0,
-        'updated': updated_count,
-        'errors': len(errors),
-        'processed_external_ids': processed_external_ids.copy()  # Сохраняем для возможного использования
-    }
 
 
 def _build_import_category_matcher():
-    """Загружает категории один раз для быстрого import.xml."""
+    """Категория по умолчанию и скомпилированный набор подкатегорий для быстрого import.xml."""
+    from .services import get_category_keyword_matcher
+
     default = Category.objects.filter(parent__isnull=True, is_active=True).order_by('id').first()
-    matchers = []
-    for cat in Category.objects.filter(is_active=True, parent__isnull=False):
-        name_kw = (cat.name or '').strip().lower()
-        if name_kw:
-            matchers.append((len(name_kw), name_kw, cat))
-        try:
-            for kw in cat.get_keywords_list():
-                kw_l = (kw or '').strip().lower()
-                if kw_l:
-                    matchers.append((len(kw_l), kw_l, cat))
-        except Exception:
-            pass
-    matchers.sort(key=lambda x: x[0], reverse=True)
-    return default, matchers
+    return default, get_category_keyword_matcher('import')
 
 
-def _import_category_for_name(name, default_cat, matchers, cache):
+def _import_category_for_name(name, default_cat, matcher, cache):
     key = (name or '')[:100].lower()
     if key in cache:
         return cache[key]
-    nl = (name or '').lower()
-    for _ln, kw, cat in matchers:
-        if kw in nl:
-            cache[key] = cat
-            return cat
-    cache[key] = default_cat
-    return default_cat
-
-
-def _import_slug_for_product(external_id, catalog_type, existing_slugs):
-    from .models import transliterate_slug
-    base = transliterate_slug(f"{catalog_type}-{external_id}".replace('#', '-'))[:480]
-    slug = base
-    n = 1
-    while slug in existing_slugs:
-        slug = f"{base}-{n}"[:500]
-        n += 1
-    existing_slugs.add(slug)
-    return slug
+    cat = matcher.search((name or '').lower()) or default_cat
+    cache[key] = cat
+    return cat
 
 
 def _format_import_characteristics(product_data):
@@ -3646,87 +2793,112 @@ def _format_import_characteristics(product_data):
     return '\n'.join(parts)
 
 
+def _import_product_fields(product_data, default_cat, cat_matchers, category_cache):
+    """Поля карточки из записи import.xml (общие для создания и обновления дубликата)."""
+    name = (product_data.get('name') or '').strip()
+    article = (product_data.get('article') or product_data.get('supplier_article') or '').strip()
+    supplier_article = (product_data.get('supplier_article') or article or '').strip()
+    cross = product_data.get('cross_numbers') or []
+    if isinstance(cross, list):
+        cross_text = ', '.join(str(x).strip() for x in cross if str(x).strip())
+    else:
+        cross_text = str(cross).strip()
+    return {
+        'name': name[:500],
+        'article': article,
+        # Артикул1 из import.xml — как у offers (колонка «Артикул» в опте)
+        'supplier_article': supplier_article,
+        'brand': (product_data.get('brand') or '').strip(),
+        'category': _import_category_for_name(name, default_cat, cat_matchers, category_cache),
+        'cross_numbers': cross_text,
+        'characteristics': _format_import_characteristics(product_data),
+    }
+
+
 def bulk_ensure_missing_import_products(products_data, catalog_type, batch_size=500):
     """
     Быстрый import.xml: создаёт только отсутствующие оптовые карточки (qty=0, видимы в опте).
     Розничные карточки создаются из offers.xml при наличии на складе.
-    """
-    existing_ids = set(
-        Product.objects.filter(catalog_type=catalog_type)
-        .exclude(external_id__isnull=True)
-        .exclude(external_id='')
-        .values_list('external_id', flat=True)
-    )
 
+    products_data — любой итерируемый источник, в т.ч. генератор iter_commerceml_import_products.
+    Записи обрабатываются пачками по batch_size: наличие в БД проверяется одним запросом
+    на пачку, поэтому ни файл, ни список external_id каталога целиком в память не грузятся.
+    При повторе Ид в файле используется последний вариант (изменённые данные из 1С).
+    """
     default_cat, cat_matchers = _build_import_category_matcher()
     category_cache = {}
-    existing_slugs = set(Product.objects.values_list('slug', flat=True))
 
-    to_create = []
     created = 0
     skipped_existing = 0
     errors = []
     seen_in_file = set()
+    created_in_run = set()
+    pending = {}  # external_id -> данные товара (порядок из файла)
 
-    for pd in products_data:
-        ext_id = _get_full_external_id_from_product_data(pd)
-        if not ext_id:
-            errors.append({'sku': pd.get('sku'), 'error': 'нет external_id'})
-            continue
-        if ext_id in seen_in_file:
-            continue
-        seen_in_file.add(ext_id)
-
-        if ext_id in existing_ids:
-            skipped_existing += 1
-            continue
-
-        name = (pd.get('name') or '').strip()
-        if not name:
-            errors.append({'external_id': ext_id, 'error': 'нет названия'})
-            continue
-
-        article = (pd.get('article') or pd.get('supplier_article') or '').strip()
-        supplier_article = (pd.get('supplier_article') or article or '').strip()
-        brand = (pd.get('brand') or '').strip()
-        cross = pd.get('cross_numbers') or []
-        if isinstance(cross, list):
-            cross_text = ', '.join(str(x).strip() for x in cross if str(x).strip())
-        else:
-            cross_text = str(cross).strip()
-
-        category = _import_category_for_name(name, default_cat, cat_matchers, category_cache)
-        slug = _import_slug_for_product(ext_id, catalog_type, existing_slugs)
-
-        to_create.append(Product(
-            external_id=ext_id,
-            name=name[:500],
-            slug=slug,
-            article=article,
-            # Артикул1 из import.xml — как у offers (колонка «Артикул» в опте)
-            supplier_article=supplier_article,
-            brand=brand,
-            category=category,
-            catalog_type=catalog_type,
-            quantity=0,
-            availability='out_of_stock',
-            is_active=True,
-            cross_numbers=cross_text,
-            characteristics=_format_import_characteristics(pd),
-        ))
-        existing_ids.add(ext_id)
-
-        if len(to_create) >= batch_size:
-            with transaction.atomic():
+    def _flush():
+        nonlocal created, skipped_existing
+        if not pending:
+            return
+        with exchange_phase('db_write'):
+            existing_ids = set(
+                Product.objects.filter(catalog_type=catalog_type, external_id__in=list(pending))
+                .values_list('external_id', flat=True)
+            )
+        to_create = []
+        for ext_id, pd in pending.items():
+            if ext_id in existing_ids:
+                skipped_existing += 1
+                continue
+            fields = _import_product_fields(pd, default_cat, cat_matchers, category_cache)
+            if not fields['name']:
+                errors.append({'external_id': ext_id, 'error': 'нет названия'})
+                continue
+            to_create.append(Product(
+                external_id=ext_id,
+                catalog_type=catalog_type,
+                quantity=0,
+                availability='out_of_stock',
+                is_active=True,
+                **fields,
+            ))
+        pending.clear()
+        if to_create:
+            with exchange_phase('db_write'), transaction.atomic():
+                # slug вида «<каталог>-<Ид 1С>»: занятые варианты читаются по основам пачки
+                assign_slugs(
+                    to_create,
+                    lambda product: f'{catalog_type}-{product.external_id}'.replace('#', '-'),
+                )
                 Product.objects.bulk_create(to_create, batch_size=batch_size)
+            batch.wrote(len(to_create))
             created += len(to_create)
+            created_in_run.update(p.external_id for p in to_create)
             logger.info(f"[import fast/{catalog_type}] создано {created} новых карточек...")
-            to_create = []
 
-    if to_create:
-        with transaction.atomic():
-            Product.objects.bulk_create(to_create, batch_size=batch_size)
-        created += len(to_create)
+    # Пачки создания фиксируются транзакциями импорта по ONE_C_IMPORT_TRANSACTION_SIZE строк
+    with ImportTransaction() as batch:
+        for pd in products_data:
+            ext_id = _get_full_external_id_from_product_data(pd)
+            if not ext_id:
+                errors.append({'sku': pd.get('sku'), 'error': 'нет external_id'})
+                continue
+            if ext_id in seen_in_file:
+                logger.info(f"Найден дубликат external_id {ext_id} — используем последний вариант из 1С")
+                if ext_id in pending:
+                    pending[ext_id] = pd
+                elif ext_id in created_in_run:
+                    # Карточка уже создана из предыдущей пачки — обновляем её последними данными
+                    fields = _import_product_fields(pd, default_cat, cat_matchers, category_cache)
+                    if fields['name']:
+                        Product.objects.filter(
+                            catalog_type=catalog_type, external_id=ext_id
+                        ).update(**fields)
+                continue
+            seen_in_file.add(ext_id)
+            pending[ext_id] = pd
+            if len(pending) >= batch_size:
+                _flush()
+        _flush()
 
     logger.info(
         f"[import fast/{catalog_type}] готово: создано={created}, "
@@ -4730,7 +3902,7 @@ def process_product_from_commerceml(product_data, catalog_type='retail'):
 
             # ВАЖНО: При обновлении товара принудительно сохраняем все поля
             # Используем save() без update_fields, чтобы гарантировать сохранение ВСЕХ полей
-            save_with_retry(product)
+            save_in_import(product)
             
             # ВАЖНО: Инвалидируем кеш при создании И при обновлении товара
             # Это гарантирует, что изменения сразу отображаются на сайте
@@ -0,0 +1,187 @@
+"""
+Розничный аналог оптового товара (Product.retail_counterpart).
+
+get_retail_counterpart, фото оптовой карточки, коды в таблице опта и выгрузка
+Farpost искали розничную пару каждой строки заново — до четырех запросов: точный
+external_id, база UUID до «#», external_id, начинающийся с «база#», артикул.
+Теперь пара вычисляется для всех оптовых товаров сразу после каждого обмена и
+импорта (два запроса на чтение + пакетный UPDATE изменившихся ссылок) и хранится
+в самоссылке; читатели идут по FK или select_related('retail_counterpart').
+Product.save (админка, скрипты) пересчитывает пару сразу: оптовой строке — по
+ее кандидатам, розничной — у оптовых строк, на которые она может повлиять.
+
+Порядок выбора тот же, что в прежнем поиске: при нескольких кандидатах по
+префиксу «база#» или по артикулу берется товар с большей ценой, затем активный,
+затем с большим id (order_by('-price', '-is_active', '-id')).
+"""
+import logging
+
+from django.db.models import Q
+
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+# Строк на один UPDATE при записи ссылок
+COUNTERPART_BATCH_SIZE = 500
+
+
+def _best(index, key, rank, product_id):
+    current = index.get(key)
+    if current is None or rank > current[0]:
+        index[key] = (rank, product_id)
+
+
+def _retail_indexes(queryset=None):
+    """
+    Индексы розницы: точный external_id, база до «#» и артикул → id лучшего кандидата.
+
+    queryset — только эти розничные товары (кандидаты одной строки, см. retail_counterpart_id_for).
+    """
+    by_external_id = {}
+    by_base = {}
+    by_article = {}
+    if queryset is None:
+        queryset = Product.objects.filter(catalog_type='retail')
+    rows = queryset.order_by().values_list('id', 'external_id', 'article', 'price', 'is_active')
+    for product_id, external_id, article, price, is_active in rows.iterator():
+        rank = (price, is_active, product_id)
+        if external_id:
+            by_external_id[external_id] = product_id
+            if '#' in external_id:
+                # external_id начинается с «база#» ⇔ его часть до первого «#» равна базе
+                _best(by_base, external_id.split('#', 1)[0], rank, product_id)
+        if article:
+            _best(by_article, article, rank, product_id)
+    return (
+        by_external_id,
+        {key: value[1] for key, value in by_base.items()},
+        {key: value[1] for key, value in by_article.items()},
+    )
+
+
+def find_retail_counterpart_id(external_id, article, indexes):
+    """id розничной пары по индексам _retail_indexes (порядок как в прежнем get_retail_counterpart)."""
+    by_external_id, by_base, by_article = indexes
+    eid = (external_id or '').strip()
+    if eid:
+        if eid in by_external_id:
+            return by_external_id[eid]
+        if '#' in eid:
+            base = eid.split('#', 1)[0]
+            if base in by_external_id:
+                return by_external_id[base]
+            if base in by_base:
+                return by_base[base]
+    art = (article or '').strip()
+    if art:
+        return by_article.get(art)
+    return None
+
+
+def _split_key(external_id, article):
+    eid = (external_id or '').strip()
+    base = eid.split('#', 1)[0] if '#' in eid else ''
+    return eid, base, (article or '').strip()
+
+
+def _retail_candidates_q(external_id, article):
+    """Q розничных товаров, которые find_retail_counterpart_id может выбрать для этой строки."""
+    eid, base, art = _split_key(external_id, article)
+    q = Q()
+    if eid:
+        q |= Q(external_id=eid)
+    if base:
+        q |= Q(external_id=base) | Q(external_id__startswith=f'{base}#')
+    if art:
+        q |= Q(article=art)
+    return q
+
+
+def retail_counterpart_id_for(external_id, article):
+    """
+    id розничной пары одной оптовой строки (Product.save при правке в админке и т.п.).
+
+    Читает только кандидатов этой строки, выбор — тот же find_retail_counterpart_id.
+    """
+    q = _retail_candidates_q(external_id, article)
+    if not q:
+        return None
+    indexes = _retail_indexes(Product.objects.filter(q, catalog_type='retail'))
+    return find_retail_counterpart_id(external_id, article, indexes)
+
+
+def _resolve_rows(rows, indexes):
+    """Записывает пары строк (id, external_id, article, retail_counterpart_id). Возвращает изменившиеся id."""
+    from .product_images import refresh_main_images
+
+    changed = []
+    for product_id, external_id, article, current_id in rows:
+        counterpart_id = find_retail_counterpart_id(external_id, article, indexes)
+        if counterpart_id != current_id:
+            changed.append(Product(pk=product_id, retail_counterpart_id=counterpart_id))
+    if changed:
+        Product.objects.bulk_update(changed, ['retail_counterpart'], batch_size=COUNTERPART_BATCH_SIZE)
+        refresh_main_images([product.pk for product in changed])
+    return [product.pk for product in changed]
+
+
+def resolve_wholesale_counterparts_of(retail_product):
+    """
+    Пересчитывает пары оптовых строк, на которые влияет розничный товар
+    (создан, изменены Ид, артикул, цена или активность в Product.save).
+
+    Затрагиваются строки, которые ссылаются на него сейчас или могут выбрать его
+    по external_id, базе до «#» или артикулу. Возвращает число изменившихся строк.
+    """
+    eid, base, art = _split_key(retail_product.external_id, retail_product.article)
+    q = Q(retail_counterpart_id=retail_product.pk)
+    if eid:
+        # Оптовый eid совпадает, его база равна eid или его база равна базе розницы
+        q |= Q(external_id=eid) | Q(external_id__startswith=f'{eid}#')
+    if base:
+        q |= Q(external_id__startswith=f'{base}#')
+    if art:
+        q |= Q(article=art)
+    rows = list(
+        Product.objects.filter(q, catalog_type='wholesale').order_by().values_list(
+            'id', 'external_id', 'article', 'retail_counterpart_id'
+        )
+    )
+    if not rows:
+        return 0
+    candidates = Q()
+    for _, external_id, article, _ in rows:
+        candidates |= _retail_candidates_q(external_id, article)
+    indexes = _retail_indexes(Product.objects.filter(candidates, catalog_type='retail'))
+    return len(_resolve_rows(rows, indexes))
+
+
+def resolve_retail_counterparts():
+    """
+    Пересчитывает retail_counterpart у всех оптовых товаров.
+
+    Записываются только изменившиеся ссылки; у них же обновляется главное фото
+    (фото розничного аналога). Возвращает число изменившихся товаров.
+    """
+    indexes = _retail_indexes()
+    rows = Product.objects.filter(catalog_type='wholesale').order_by().values_list(
+        'id', 'external_id', 'article', 'retail_counterpart_id'
+    )
+    changed = _resolve_rows(rows.iterator(), indexes)
+    # Розничной строке пара не нужна (get_retail_counterpart возвращает ее саму)
+    cleared = Product.objects.filter(
+        catalog_type='retail', retail_counterpart__isnull=False,
+    ).update(retail_counterpart=None)
+    if changed or cleared:
+        logger.info(f"Розничные аналоги обновлены у {len(changed) + cleared} товаров")
+    return len(changed) + cleared
+
+
+def safe_resolve_retail_counterparts():
+    """resolve_retail_counterparts, который не роняет обмен/импорт (ошибка только в лог)."""
+    try:
+        return resolve_retail_counterparts()
+    except Exception as e:
+        logger.warning(f"Не удалось обновить розничные аналоги оптовых товаров: {e}", exc_info=True)
+        return 0
@@ -0,0 +1,278 @@
+"""
+Фоновая обработка файлов обмена CommerceML (очередь ExchangeJob).
+
+Запросы 1С mode=file/import только ставят файл в очередь и сразу отвечают,
+а разбор и запись товаров выполняет management-команда run_exchange_jobs.
+Так обработка большого offers.xml не упирается в таймауты веб-сервера (502),
+а 1С получает честный progress по протоколу CommerceML.
+
+Режим включается настройкой ONE_C_ASYNC_EXCHANGE (по умолчанию выключен) и
+требует запущенного воркера: постоянного (systemd/supervisor) или cron
+`run_exchange_jobs --once` раз в минуту. Без воркера mode=import отвечает
+progress бесконечно и ничего не импортируется.
+"""
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Q
+from django.utils import timezone
+
+from .exchange_profiler import ExchangeProfiler, exchange_profile
+from .models import ExchangeJob
+
+logger = logging.getLogger(__name__)
+
+# Обрабатывать файлы обмена в фоне (воркер run_exchange_jobs) или прямо в запросе 1С
+ASYNC_EXCHANGE = getattr(settings, 'ONE_C_ASYNC_EXCHANGE', False)
+# Через сколько секунд файл без подтверждения mode=import считается загруженным полностью
+JOB_CONFIRM_TIMEOUT = getattr(settings, 'ONE_C_JOB_CONFIRM_TIMEOUT', 300)
+# Задание "выполняется" без обновлений дольше этого времени — воркер упал, перезапускаем
+JOB_STALE_SECONDS = getattr(settings, 'ONE_C_JOB_STALE_SECONDS', 600)
+JOB_MAX_ATTEMPTS = getattr(settings, 'ONE_C_JOB_MAX_ATTEMPTS', 3)
+
+EXCHANGE_SESSION_COOKIE = '1c_exchange_session'
+
+
+def _session_of(request):
+    return request.COOKIES.get(EXCHANGE_SESSION_COOKIE, '') if request is not None else ''
+
+
+def enqueue_exchange_job(file_path, filename, request=None, ready=False, upload_phases=None, member=None):
+    """
+    Ставит файл обмена в очередь.
+
+    Пока задание не взято воркером, повторные вызовы для того же файла в той же
+    сессии (1С дописывает файл частями) переиспользуют его, а не создают новое.
+    ready=True — файл загружен полностью (пришел mode=import).
+    upload_phases — профиль загрузки/распаковки этой части; суммируется в задании
+    и попадает в профиль SyncLog при обработке.
+    member — имя XML внутри ZIP-архива file_path (архив не распаковывается).
+    """
+    session = _session_of(request)
+    job = ExchangeJob.objects.filter(
+        filename=filename, session=session, status='pending'
+    ).order_by('-created_at').first()
+    if job is None:
+        job = ExchangeJob.objects.create(
+            filename=filename, file_path=file_path, member=member or '', session=session, is_ready=ready,
+            result={'upload_phases': upload_phases} if upload_phases else {},
+        )
+        logger.info(f"Файл обмена {filename} поставлен в очередь (задание #{job.pk})")
+        return job
+    job.file_path = file_path
+    job.member = member or ''
+    job.is_ready = job.is_ready or ready
+    update_fields = ['file_path', 'member', 'is_ready', 'updated_at']
+    if upload_phases:
+        combined = ExchangeProfiler(job.result.get('upload_phases'))
+        combined.merge(upload_phases)
+        job.result = {**job.result, 'upload_phases': combined.as_dict()['phases']}
+        update_fields.append('result')
+    job.save(update_fields=update_fields)
+    return job
+
+
+def record_skipped_exchange_job(file_path, filename, request=None, member=None):
+    """
+    Записывает сразу завершенное задание для уже примененного файла (реестр ExchangeFile),
+    чтобы mode=import по нему без очереди получил success.
+    """
+    now = timezone.now()
+    return ExchangeJob.objects.create(
+        filename=filename, file_path=file_path, member=member or '', session=_session_of(request),
+        is_ready=True, status='success', progress=100, result={'status': 'success', 'skipped': True},
+        started_at=now, finished_at=now,
+    )
+
+
+def find_exchange_job(filename, request=None):
+    """Последнее задание для файла в текущей сессии обмена (или вообще последнее, если cookie нет)."""
+    jobs = ExchangeJob.objects.filter(filename=filename)
+    session = _session_of(request)
+    if session:
+        jobs = jobs.filter(session=session)
+    return jobs.order_by('-created_at').first()
+
+
+def exchange_job_response_text(job):
+    """Ответ на mode=import по состоянию задания (протокол CommerceML: progress/success/failure)."""
+    if job.status == 'success':
+        return 'success'
+    if job.status == 'failure':
+        return f'failure\n{job.error or "Ошибка обработки файла"}'
+    return f'progress\n{job.progress}'
+
+
+def current_worker_id():
+    """Идентификатор процесса-воркера для ExchangeJob.worker: host:pid."""
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _worker_alive(worker):
+    """
+    Жив ли процесс, взявший задание.
+
+    Проверить можно только процесс на этом же хосте; про другие хосты (и задания
+    без worker) ничего не известно — для них остается проверка по updated_at.
+    Текущий процесс заданием не владеет: requeue_stale_jobs он вызывает между заданиями.
+    """
+    host, _, pid = (worker or '').rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit() or int(pid) == os.getpid():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def requeue_stale_jobs():
+    """
+    Возвращает в очередь задания, воркер которых умер (нет обновлений дольше JOB_STALE_SECONDS).
+
+    import.xml и шаги после записи (счетчики, аналоги, фото) не двигают контрольную
+    точку, а точки внутри ImportTransaction видны только после фиксации, поэтому
+    долгая исправная обработка тоже выглядит «без обновлений». Задание, процесс
+    которого еще жив, не перезапускаем, а только обновляем его updated_at.
+    """
+    now = timezone.now()
+    stale_before = now - timedelta(seconds=JOB_STALE_SECONDS)
+    stale = ExchangeJob.objects.filter(status='running', updated_at__lt=stale_before)
+    alive = [pk for pk, worker in stale.values_list('pk', 'worker') if _worker_alive(worker)]
+    if alive:
+        ExchangeJob.objects.filter(pk__in=alive).update(updated_at=now)
+        stale = stale.exclude(pk__in=alive)
+    failed = stale.filter(attempts__gte=JOB_MAX_ATTEMPTS).update(
+        status='failure',
+        error='Обработка прерывалась слишком много раз',
+        finished_at=timezone.now(),
+    )
+    requeued = stale.update(status='pending')
+    if failed or requeued:
+        logger.warning(f"Задания обмена: перезапущено {requeued}, отменено {failed} (воркер не отвечал)")
+    return requeued
+
+
+def _ready_jobs():
+    """Задания в очереди, файл которых загружен полностью (или давно не дописывался)."""
+    confirm_before = timezone.now() - timedelta(seconds=JOB_CONFIRM_TIMEOUT)
+    return ExchangeJob.objects.filter(status='pending').filter(
+        Q(is_ready=True) | Q(updated_at__lt=confirm_before)
+    )
+
+
+def claim_job(job):
+    """
+    Захватывает задание: условный UPDATE по статусу, поэтому два воркера не возьмут одно задание.
+
+    Возвращает True, если задание теперь принадлежит этому воркеру.
+    """
+    claimed = ExchangeJob.objects.filter(pk=job.pk, status='pending').update(
+        status='running',
+        worker=current_worker_id(),
+        attempts=job.attempts + 1,
+        started_at=job.started_at or timezone.now(),
+        updated_at=timezone.now(),
+    )
+    if claimed:
+        job.refresh_from_db()
+    return bool(claimed)
+
+
+def claim_next_job():
+    """Берет следующее задание из очереди (в порядке постановки, import раньше offers)."""
+    for job in _ready_jobs().order_by('created_at', 'pk')[:10]:
+        if claim_job(job):
+            return job
+    return None
+
+
+def session_package_jobs(job):
+    """
+    Остальные готовые задания той же сессии обмена — файлы одного пакета (Import0_1.xml, offers1.xml …).
+
+    Задания не захватываются: воркер разбирает их файлы заранее и захватывает
+    каждое (claim_job) непосредственно перед записью.
+    """
+    if not job.session:
+        return []
+    return list(_ready_jobs().filter(session=job.session).exclude(pk=job.pk).order_by('created_at', 'pk'))
+
+
+def write_processed_marker(file_path, result):
+    """
+    Пишет маркер <файл>.processed (формат process_1c_files), чтобы cron не обрабатывал
+    файл повторно. В маркере время изменения самого файла — по нему видно, что файл изменился.
+    """
+    file_mtime_iso = datetime.fromtimestamp(os.path.getmtime(file_path)).isoformat()
+    with open(f"{file_path}.processed", 'w') as f:
+        f.write('processed\n')
+        f.write(f'file_mtime: {file_mtime_iso}\n')  # Время изменения файла
+        f.write(f'marker_time: {datetime.now().isoformat()}\n')  # Время создания маркера
+        f.write(f'processed_count: {result.get("processed", 0)}\n')
+        f.write(f'created: {result.get("created", 0)}\n')
+        f.write(f'updated: {result.get("updated", 0)}\n')
+
+
+def run_exchange_job(job, parsed=None):
+    """
+    Обрабатывает задание, сохраняя прогресс и контрольную точку после каждой пачки предложений.
+
+    parsed — файл задания, уже разобранный в пуле процессов (см. exchange_package).
+    """
+    from .commerceml_views import process_commerceml_file
+
+    def _checkpoint(done, total):
+        # Не больше 99%: 100% и success ставятся только после скрытия отсутствующих и итогов
+        progress = min(99, done * 100 // total) if total else 0
+        ExchangeJob.objects.filter(pk=job.pk).update(
+            checkpoint=done, total=total, progress=progress, updated_at=timezone.now()
+        )
+        job.checkpoint, job.total, job.progress = done, total, progress
+
+    logger.info(
+        f"Задание обмена #{job.pk}: {job.filename} (попытка {job.attempts}, "
+        f"с предложения {job.checkpoint})"
+    )
+    if not os.path.exists(job.file_path):
+        result = {'status': 'failure', 'error': 'Файл не найден'}
+    else:
+        try:
+            # Загрузку файла замеряли запросы mode=file — добавляем ее к профилю обработки
+            with exchange_profile(job.result.get('upload_phases')):
+                result = process_commerceml_file(
+                    job.file_path, job.filename,
+                    start_index=job.checkpoint, progress_callback=_checkpoint,
+                    member=job.member or None, parsed=parsed,
+                )
+        except Exception as e:
+            logger.error(f"Задание обмена #{job.pk}: исключение {e}", exc_info=True)
+            result = {'status': 'failure', 'error': str(e)}
+
+    close_old_connections()
+    status = 'failure' if result.get('status') == 'failure' else 'success'
+    if status == 'success' and result.get('processed'):
+        try:
+            write_processed_marker(job.file_path, result)
+        except OSError as marker_error:
+            logger.warning(f"Не удалось создать маркер для {job.filename}: {marker_error}")
+    job.status = status
+    job.progress = 100 if status == 'success' else job.progress
+    job.error = result.get('error', '') if status == 'failure' else ''
+    job.result = {
+        key: result.get(key)
+        for key in ('status', 'processed', 'created', 'updated', 'unchanged', 'deleted', 'changes_only', 'skipped')
+        if key in result
+    }
+    errors = result.get('errors')
+    job.result['errors_count'] = errors if isinstance(errors, int) else len(errors or [])
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'progress', 'error', 'result', 'finished_at', 'updated_at'])
+    logger.info(f"Задание обмена #{job.pk}: {job.filename} завершено со статусом {status}")
+    return job
@@ -0,0 +1,227 @@
+"""
+Обработка пакета файлов обмена одной сессии (Import0_1.xml, offers0_1.xml, offers1.xml …).
+
+1С делит большой каталог на несколько файлов. Разбор XML — CPU-bound работа
+ElementTree, поэтому файлы пакета разбираются параллельно в пуле процессов
+(parse_exchange_file, без обращения к БД), а пишет в БД только текущий процесс —
+по одному файлу, так что SQLite не упирается в блокировки записи.
+Порядок записи как при последовательной обработке: сначала import, затем offers.
+Весь пакет записывается в режиме писателя импорта (см. import_writer).
+
+Процесс пула не возвращает записи файла списком: он разбирает XML потоково и
+пишет записи пачками во временный файл (spool_records), а писатель читает их
+оттуда по пачке (iter_spooled_records). Память процессов не растет с размером
+каталога, как и при последовательном потоковом разборе.
+"""
+import logging
+import os
+import pickle
+import tempfile
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+
+from .exchange_profiler import exchange_profile
+from .exchange_registry import applied_exchange_file, file_sha256
+from .import_writer import import_writer
+
+logger = logging.getLogger(__name__)
+
+# Процессов для разбора файлов пакета: 0 — по числу ядер, 1 — без пула (последовательно)
+PARSE_WORKERS = getattr(settings, 'ONE_C_PARSE_WORKERS', 0)
+# Каталог временных файлов с разобранными записями (рядом с файлами обмена, не в tmpfs)
+SPOOL_DIR = getattr(settings, 'ONE_C_EXCHANGE_DIR', os.path.join(settings.MEDIA_ROOT, '1c_exchange'))
+# Записей в одной пачке временного файла
+SPOOL_CHUNK_SIZE = 500
+
+# Файл пакета: путь на диске, имя файла обмена и имя XML внутри ZIP (или None)
+ExchangeFileRef = namedtuple('ExchangeFileRef', ['file_path', 'filename', 'member'])
+
+
+def spool_records(records, chunk_size=SPOOL_CHUNK_SIZE):
+    """
+    Пишет записи во временный файл пачками pickle по chunk_size и возвращает путь.
+
+    В памяти одновременно только одна пачка; файл читает и удаляет iter_spooled_records.
+    """
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix='.parsed-', suffix='.pickle', dir=SPOOL_DIR)
+    try:
+        with os.fdopen(fd, 'wb') as spool:
+            chunk = []
+            for record in records:
+                chunk.append(record)
+                if len(chunk) >= chunk_size:
+                    pickle.dump(chunk, spool, protocol=pickle.HIGHEST_PROTOCOL)
+                    chunk = []
+            if chunk:
+                pickle.dump(chunk, spool, protocol=pickle.HIGHEST_PROTOCOL)
+    except BaseException:
+        discard_spool(path)
+        raise
+    return path
+
+
+def iter_spooled_records(path):
+    """Отдает записи временного файла spool_records по пачке и удаляет файл после чтения."""
+    try:
+        with open(path, 'rb') as spool:
+            while True:
+                try:
+                    chunk = pickle.load(spool)
+                except EOFError:
+                    return
+                yield from chunk
+    finally:
+        discard_spool(path)
+
+
+def discard_spool(path):
+    """Удаляет временный файл записей (если он еще есть)."""
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def exchange_file_order(filename):
+    """Ключ сортировки файлов пакета: import раньше offers, остальные в конце."""
+    filename_lower = (filename or '').lower()
+    if 'import' in filename_lower and 'offers' not in filename_lower:
+        return (0, filename_lower)
+    if 'offers' in filename_lower:
+        return (1, filename_lower)
+    return (2, filename_lower)
+
+
+def parse_worker_count(files_count, workers=None):
+    """Сколько процессов разбора запускать для пакета из files_count файлов."""
+    workers = PARSE_WORKERS if workers is None else workers
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return max(1, min(workers, files_count))
+
+
+def _init_parse_worker():
+    # При запуске процессов через spawn (не fork) Django в них еще не настроен
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+
+
+def _parse_in_worker(file_path, member):
+    """Разбор файла в процессе пула; время разбора возвращается как фаза parse профиля."""
+    from .commerceml_views import parse_exchange_file
+
+    started = time.perf_counter()
+    parsed = parse_exchange_file(file_path, member)
+    parsed['phases'] = [{
+        'name': 'parse',
+        'seconds': time.perf_counter() - started,
+        'queries': 0,
+        'peak_mb': 0.0,
+        'calls': 1,
+    }]
+    return parsed
+
+
+def _already_applied(item, force, hashes):
+    """Тот же файл уже применен (реестр ExchangeFile) — разбирать его незачем."""
+    if force:
+        return False
+    if item.file_path not in hashes:
+        try:
+            hashes[item.file_path] = file_sha256(item.file_path)
+        except OSError:
+            hashes[item.file_path] = None
+    return applied_exchange_file(hashes[item.file_path], item.member or item.filename) is not None
+
+
+def run_exchange_package(items, write, workers=None, force=False):
+    """
+    Разбирает файлы пакета в пуле процессов и записывает их по одному в этом процессе.
+
+    items — объекты с file_path, filename и member (ExchangeFileRef или ExchangeJob).
+    write(item, parsed) записывает разобранный файл в БД и возвращает результат;
+    parsed=None — файл не разбирался заранее (уже применен или разбор в пуле упал),
+    write обрабатывает его сам. Разобранные записи лежат во временных файлах (parsed['spool']),
+    которые удаляются после записи.
+    Возвращает [(item, результат write)] в порядке записи.
+    """
+    ordered = sorted(items, key=lambda item: exchange_file_order(item.filename))
+    workers = parse_worker_count(len(ordered), workers)
+    # Режим писателя импорта держится на весь пакет: между import и offers
+    # одной сессии не вклинится другой импорт
+    with import_writer():
+        if workers <= 1:
+            return [(item, write(item, None)) for item in ordered]
+        return _run_in_pool(ordered, write, workers, force)
+
+
+def _run_in_pool(ordered, write, workers, force):
+    """Окно разбора в пуле из workers процессов и запись по порядку (см. run_exchange_package)."""
+    logger.info(f"Пакет обмена: {len(ordered)} файлов, разбор в {workers} процессах")
+    hashes = {}
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_parse_worker) as pool:
+        queue = deque()
+        pending = iter(ordered)
+
+        def _submit_next():
+            for item in pending:
+                if _already_applied(item, force, hashes):
+                    queue.append((item, None))
+                else:
+                    queue.append((item, pool.submit(_parse_in_worker, item.file_path, item.member or None)))
+                return
+
+        for _ in range(workers):
+            _submit_next()
+        while queue:
+            item, future = queue.popleft()
+            parsed = None
+            if future is not None:
+                try:
+                    parsed = future.result()
+                except Exception as e:
+                    logger.error(
+                        f"Пакет обмена: не удалось разобрать {item.filename} в пуле ({e}), "
+                        f"обрабатываем в текущем процессе", exc_info=True
+                    )
+            # Следующий файл разбирается, пока этот пишется в БД
+            _submit_next()
+            if parsed is None:
+                results.append((item, write(item, None)))
+                continue
+            try:
+                with exchange_profile(parsed.pop('phases')):
+                    results.append((item, write(item, parsed)))
+            finally:
+                discard_spool(parsed.get('spool'))
+    return results
+
+
+def process_exchange_package(files, request=None, workers=None, force=False, content_hash=None):
+    """
+    Обрабатывает файлы пакета через process_commerceml_file (см. run_exchange_package).
+
+    files — список ExchangeFileRef; content_hash — хеш, уже посчитанный при приеме
+    (для XML из одного ZIP он общий). Возвращает [(ExchangeFileRef, результат)].
+    """
+    from .commerceml_views import process_commerceml_file
+
+    def _write(item, parsed):
+        try:
+            return process_commerceml_file(
+                item.file_path, item.filename, request, member=item.member,
+                force=force, content_hash=content_hash, parsed=parsed,
+            )
+        except Exception as e:
+            logger.error(f"Ошибка обработки {item.filename}: {e}", exc_info=True)
+            return {'status': 'failure', 'error': str(e)}
+
+    return run_exchange_package(files, _write, workers=workers, force=force)
@@ -0,0 +1,208 @@
+"""
+Профилирование фаз обмена с 1С.
+
+Для каждой фазы (загрузка, распаковка, разбор, категории, запись в БД, скрытие
+отсутствующих, сброс кеша) считаются время, число SQL-запросов и — при
+ONE_C_PROFILE_MEMORY — пик памяти Python (tracemalloc). Профиль сохраняется
+в SyncLog.phase_profile и выводится таблицей в админке — видно, какая фаза
+замедлилась, без поиска по логам.
+
+Фазы учитываются исключительно: пока идет вложенная фаза (например, категории
+внутри записи в БД), время и запросы внешней фазы не растут, поэтому сумма фаз
+равна общему времени. Время вне именованных фаз попадает в «Прочее».
+"""
+import functools
+import threading
+import time
+import tracemalloc
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connection
+
+# Считать пик памяти через tracemalloc. Замедляет обмен в несколько раз,
+# поэтому включается на время разбора регрессий; время и запросы считаются всегда.
+PROFILE_MEMORY = getattr(settings, 'ONE_C_PROFILE_MEMORY', False)
+
+PHASE_LABELS = {
+    'upload': 'Загрузка файла',
+    'unzip': 'Распаковка',
+    'category_sync': 'Синхронизация подкатегорий',
+    'parse': 'Разбор XML',
+    'categories': 'Определение категорий',
+    'db_write': 'Запись в БД',
+    'hide_missing': 'Скрытие отсутствующих',
+    'cache': 'Сброс кеша',
+    'category_counts': 'Счетчики категорий',
+    'counterparts': 'Розничные аналоги',
+    'main_images': 'Главные фото',
+    'other': 'Прочее',
+}
+
+_state = threading.local()
+
+
+def active_profiler():
+    """Профилировщик обмена, запущенный в текущем потоке, или None."""
+    return getattr(_state, 'profiler', None)
+
+
+@contextmanager
+def exchange_phase(name):
+    """Относит время, запросы и память блока к фазе name. Без активного профилировщика ничего не делает."""
+    profiler = active_profiler()
+    if profiler is None:
+        yield
+        return
+    profiler.push(name)
+    try:
+        yield
+    finally:
+        profiler.pop()
+
+
+@contextmanager
+def exchange_profile(phases=None):
+    """
+    Профилировщик текущего обмена: уже запущенный выше по стеку вызовов или новый.
+
+    phases — фазы, замеренные в другом запросе (загрузка файла частями в фоновом режиме).
+    """
+    profiler = active_profiler()
+    if profiler is not None:
+        if phases:
+            profiler.merge(phases)
+        yield profiler
+        return
+    profiler = ExchangeProfiler(phases)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+
+
+def profiled_exchange(func):
+    """Декоратор: функция выполняется под профилировщиком обмена (своим или внешним)."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with exchange_profile():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+class ExchangeProfiler:
+    """Счетчики по фазам одного обмена."""
+
+    def __init__(self, phases=None):
+        self.phases = {}
+        self._stack = []
+        self._mark = None
+        self._queries = 0
+        self._exit_stack = None
+        self._traces_memory = False
+        self._started_tracing = False
+        if phases:
+            self.merge(phases)
+
+    def start(self):
+        _state.profiler = self
+        self._exit_stack = ExitStack()
+        self._exit_stack.enter_context(connection.execute_wrapper(self._count_query))
+        if PROFILE_MEMORY:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            tracemalloc.reset_peak()
+            self._traces_memory = True
+        self._mark = time.perf_counter()
+
+    def stop(self):
+        self._charge()
+        self._exit_stack.close()
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        self._traces_memory = False
+        self._mark = None
+        if active_profiler() is self:
+            _state.profiler = None
+
+    def _count_query(self, execute, sql, params, many, context):
+        self._queries += 1
+        return execute(sql, params, many, context)
+
+    def _phase(self, name):
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = {'seconds': 0.0, 'queries': 0, 'peak_mb': 0.0, 'calls': 0}
+            self.phases[name] = phase
+        return phase
+
+    def _charge(self):
+        """Относит накопленное с прошлой отметки к фазе на вершине стека."""
+        if self._mark is None:
+            return
+        now = time.perf_counter()
+        phase = self._phase(self._stack[-1] if self._stack else 'other')
+        phase['seconds'] += now - self._mark
+        phase['queries'] += self._queries
+        self._queries = 0
+        if self._traces_memory:
+            peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            phase['peak_mb'] = max(phase['peak_mb'], peak)
+            tracemalloc.reset_peak()
+        self._mark = now
+
+    def push(self, name):
+        self._charge()
+        self._stack.append(name)
+        self._phase(name)['calls'] += 1
+
+    def pop(self):
+        self._charge()
+        self._stack.pop()
+
+    def merge(self, phases):
+        """Добавляет фазы из сохраненного профиля (список словарей as_dict()['phases'])."""
+        for item in phases:
+            phase = self._phase(item['name'])
+            phase['seconds'] += item.get('seconds', 0)
+            phase['queries'] += item.get('queries', 0)
+            phase['peak_mb'] = max(phase['peak_mb'], item.get('peak_mb', 0))
+            phase['calls'] += item.get('calls', 0)
+
+    def as_dict(self, only=None):
+        """Профиль для JSON: фазы в порядке первого появления и итог. only — оставить только эти фазы."""
+        self._charge()
+        phases = []
+        for name, phase in self.phases.items():
+            if only is not None and name not in only:
+                continue
+            if not phase['calls'] and not phase['seconds']:
+                continue
+            phases.append({
+                'name': name,
+                'label': PHASE_LABELS.get(name, name),
+                'seconds': round(phase['seconds'], 3),
+                'queries': phase['queries'],
+                'peak_mb': round(phase['peak_mb'], 1),
+                'calls': phase['calls'],
+            })
+        return {
+            'phases': phases,
+            'total': {
+                'seconds': round(sum(p['seconds'] for p in phases), 3),
+                'queries': sum(p['queries'] for p in phases),
+                'peak_mb': max((p['peak_mb'] for p in phases), default=0.0),
+            },
+            'memory_traced': PROFILE_MEMORY,
+        }
+
+    def summary(self):
+        """Строка для лога: «фаза 1.23с/45 запр.» по всем фазам (и пик памяти, если считается)."""
+        return ', '.join(
+            f"{p['label']} {p['seconds']:.2f}с/{p['queries']} запр."
+            + (f"/{p['peak_mb']} МБ" if PROFILE_MEMORY else '')
+            for p in self.as_dict()['phases']
+        )
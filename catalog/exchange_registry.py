@@ -0,0 +1,134 @@
+"""
+Реестр файлов обмена с 1С по содержимому (ExchangeFile).
+
+Каждый принятый файл хешируется (SHA-256) по ходу записи на диск и попадает
+в реестр с размером, типом и результатом обработки. 1С после таймаута часто
+присылает тот же пакет снова: если побайтно такой же файл под тем же именем
+уже успешно применен, его не разбираем повторно, а сразу отвечаем success.
+Маркер .processed этого не умеет — он сравнивает только время изменения.
+"""
+import hashlib
+import logging
+
+from django.db.models import F
+from django.utils import timezone
+
+from .models import ExchangeFile
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def new_exchange_digest():
+    """Объект хеша для подсчета по ходу приема файла (см. _receive_exchange_file)."""
+    return hashlib.sha256()
+
+
+def file_sha256(file_path):
+    """SHA-256 файла на диске (читается кусками)."""
+    digest = new_exchange_digest()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def exchange_file_kind(filename):
+    """Тип файла обмена по имени: import, offers, archive (ZIP) или other."""
+    name = (filename or '').lower()
+    if name.endswith('.zip'):
+        return 'archive'
+    if 'offers' in name:
+        return 'offers'
+    if 'import' in name:
+        return 'import'
+    return 'other'
+
+
+def register_exchange_file(filename, sha256, size, file_path=''):
+    """Записывает в реестр принятый файл (или обновляет путь и размер уже известного)."""
+    entry, created = ExchangeFile.objects.get_or_create(
+        sha256=sha256, filename=filename,
+        defaults={'file_path': file_path, 'size': size, 'kind': exchange_file_kind(filename)},
+    )
+    if not created and (entry.file_path != file_path or entry.size != size):
+        entry.file_path = file_path
+        entry.size = size
+        entry.save(update_fields=['file_path', 'size', 'updated_at'])
+    return entry
+
+
+def is_exchange_applied(sha256, filenames):
+    """
+    Все файлы filenames с этим содержимым уже успешно применены.
+
+    Для ZIP-архива передаются имена XML файлов в нем (хеш — хеш архива).
+    """
+    names = set(filenames)
+    if not sha256 or not names:
+        return False
+    applied = ExchangeFile.objects.filter(sha256=sha256, filename__in=names, status='success').count()
+    return applied == len(names)
+
+
+def applied_exchange_file(sha256, filename):
+    """Запись реестра об успешно примененном файле с этим содержимым или None."""
+    if not sha256:
+        return None
+    return ExchangeFile.objects.filter(sha256=sha256, filename=filename, status='success').first()
+
+
+def mark_exchange_skipped(sha256, filenames):
+    """Учитывает повторный прием уже примененного пакета."""
+    ExchangeFile.objects.filter(sha256=sha256, filename__in=list(filenames)).update(
+        skipped=F('skipped') + 1, updated_at=timezone.now()
+    )
+
+
+def skipped_exchange_result(entry):
+    """Ответ process_commerceml_file для пропущенного повтора: итоги прошлой обработки."""
+    return {
+        'status': 'success',
+        'skipped': True,
+        'processed': entry.result.get('processed', 0),
+        'created': 0,
+        'updated': 0,
+        'message': f'Файл {entry.filename} уже применен, повтор пропущен',
+    }
+
+
+def record_exchange_result(sha256, filename, result, file_path='', archive=None, archive_members=()):
+    """
+    Сохраняет результат обработки файла в реестр.
+
+    Успешно примененным считается только status=success. archive/archive_members —
+    имя ZIP-архива и его XML файлы, если filename читался из архива: архив помечается
+    примененным, когда применены все его XML файлы.
+    """
+    status = 'success' if result.get('status') == 'success' else 'failure'
+    errors = result.get('errors')
+    summary = {
+        key: result.get(key)
+        for key in ('status', 'processed', 'created', 'updated', 'unchanged', 'deleted', 'changes_only', 'error')
+        if key in result
+    }
+    summary['errors_count'] = errors if isinstance(errors, int) else len(errors or [])
+    ExchangeFile.objects.update_or_create(
+        sha256=sha256, filename=filename,
+        defaults={
+            'file_path': file_path,
+            'kind': exchange_file_kind(filename),
+            'status': status,
+            'result': summary,
+            'processed_at': timezone.now(),
+        },
+    )
+    if archive:
+        archive_status = 'failure' if status == 'failure' else (
+            'success' if is_exchange_applied(sha256, archive_members) else 'received'
+        )
+        ExchangeFile.objects.filter(sha256=sha256, filename=archive).update(
+            status=archive_status, processed_at=timezone.now(), updated_at=timezone.now()
+        )
+    logger.info(f"Реестр обмена: {filename} ({sha256[:12]}) — {status}")
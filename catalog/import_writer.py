@@ -0,0 +1,204 @@
+"""
+Режим писателя импорта из 1С (SQLite).
+
+Импорт пишет в ту же базу, из которой читает витрина. В журнале отката (DELETE)
+запись блокирует читателей, а сохранение по одному товару с повтором на
+«database is locked» крутилось в циклах сна. В режиме писателя (import_writer):
+
+- база переводится в WAL: читатели видят последнюю зафиксированную версию и не
+  ждут импорт, импорт не ждет читателей. WAL — свойство файла базы, режим
+  остается включенным и после импорта;
+- synchronous и busy_timeout соединения настраиваются (ONE_C_SQLITE_SYNCHRONOUS,
+  ONE_C_SQLITE_BUSY_TIMEOUT): редкие конфликты (контрольная точка WAL, запись из
+  админки) ждет сама SQLite, без повторов в Python;
+- записи группируются в транзакции по ONE_C_IMPORT_TRANSACTION_SIZE строк
+  (ImportTransaction);
+- одновременно работает только один писатель импорта — блокировка файла
+  ONE_C_IMPORT_LOCK_FILE, общая для веб-процессов и воркера run_exchange_jobs.
+"""
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import close_old_connections, connections, transaction
+from django.db.backends.signals import connection_created
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировка только внутри процесса
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Уровень synchronous SQLite на время импорта (NORMAL безопасен для WAL)
+SQLITE_SYNCHRONOUS = getattr(settings, 'ONE_C_SQLITE_SYNCHRONOUS', 'NORMAL')
+# Сколько мс SQLite сама ждет освобождения блокировки, прежде чем вернуть ошибку
+SQLITE_BUSY_TIMEOUT = getattr(settings, 'ONE_C_SQLITE_BUSY_TIMEOUT', 60000)
+# Строк товаров на одну транзакцию импорта
+IMPORT_TRANSACTION_SIZE = getattr(settings, 'ONE_C_IMPORT_TRANSACTION_SIZE', 2000)
+# Файл блокировки единственного писателя импорта
+IMPORT_LOCK_FILE = getattr(settings, 'ONE_C_IMPORT_LOCK_FILE', os.path.join(
+    getattr(settings, 'ONE_C_EXCHANGE_DIR', os.path.join(settings.MEDIA_ROOT, '1c_exchange')),
+    '.import.lock',
+))
+
+_state = threading.local()
+_process_lock = threading.Lock()
+
+
+def import_writer_active():
+    """Текущий поток работает в режиме писателя импорта."""
+    return getattr(_state, 'depth', 0) > 0
+
+
+def _configure_connection(conn):
+    """PRAGMA режима писателя для соединения SQLite."""
+    with conn.cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode')
+        if cursor.fetchone()[0].lower() != 'wal':
+            if conn.in_atomic_block:
+                logger.warning("Импорт: соединение уже в транзакции, WAL не включен")
+            else:
+                cursor.execute('PRAGMA journal_mode=WAL')
+        # Внутри транзакции SQLite не дает менять synchronous («Safety level may not be changed»)
+        if not conn.in_atomic_block:
+            cursor.execute(f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}')
+        cursor.execute(f'PRAGMA busy_timeout={int(SQLITE_BUSY_TIMEOUT)}')
+
+
+def _restore_connection(conn):
+    """Возвращает соединению synchronous и busy_timeout по умолчанию (timeout из DATABASES)."""
+    timeout = conn.settings_dict.get('OPTIONS', {}).get('timeout', 5)
+    with conn.cursor() as cursor:
+        cursor.execute('PRAGMA synchronous=FULL')
+        cursor.execute(f'PRAGMA busy_timeout={int(timeout * 1000)}')
+
+
+def _on_connection_created(sender, connection, **kwargs):
+    # Соединение переоткрыто посреди импорта (close_old_connections между транзакциями)
+    if connection.vendor == 'sqlite' and import_writer_active():
+        _configure_connection(connection)
+
+
+connection_created.connect(_on_connection_created)
+
+
+def _acquire_lock():
+    if fcntl is None:
+        _process_lock.acquire()
+        return None
+    os.makedirs(os.path.dirname(IMPORT_LOCK_FILE), exist_ok=True)
+    lock_file = open(IMPORT_LOCK_FILE, 'a+')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        logger.info(f"Импорт: работает другой писатель импорта, ждем блокировку {IMPORT_LOCK_FILE}")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.write(str(os.getpid()))
+    lock_file.flush()
+    return lock_file
+
+
+def _release_lock(lock_file):
+    if lock_file is None:
+        _process_lock.release()
+        return
+    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    lock_file.close()
+
+
+@contextmanager
+def import_writer():
+    """
+    Режим писателя импорта на время блока.
+
+    Вложенные вызовы в том же потоке (пакет файлов → файл → сохранение товара)
+    переиспользуют уже взятую блокировку.
+    """
+    if import_writer_active():
+        _state.depth += 1
+        try:
+            yield
+        finally:
+            _state.depth -= 1
+        return
+
+    lock_file = _acquire_lock()
+    _state.depth = 1
+    try:
+        for conn in connections.all():
+            if conn.vendor == 'sqlite' and conn.connection is not None:
+                _configure_connection(conn)
+        yield
+    finally:
+        _state.depth = 0
+        try:
+            for conn in connections.all():
+                if conn.vendor == 'sqlite' and conn.connection is not None and not conn.in_atomic_block:
+                    _restore_connection(conn)
+        finally:
+            _release_lock(lock_file)
+
+
+class ImportTransaction:
+    """
+    Транзакция импорта, которая фиксируется каждые size записанных строк.
+
+        with ImportTransaction() as batch:
+            for chunk in chunks:
+                ...запись пачки...
+                batch.wrote(len(chunk))
+
+    Между транзакциями соединение проверяется close_old_connections (внутри
+    транзакции закрывать его нельзя). Вложенная в чужую транзакцию работает
+    точками сохранения, а фиксирует внешняя.
+    """
+
+    def __init__(self, size=None, using=None):
+        self.size = IMPORT_TRANSACTION_SIZE if size is None else size
+        self.using = using
+        self.pending = 0
+        self._atomic = None
+
+    def __enter__(self):
+        self._begin()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._end(exc_type, exc_value, traceback)
+        return False
+
+    def _begin(self):
+        if not transaction.get_connection(self.using).in_atomic_block:
+            close_old_connections()
+        self._atomic = transaction.atomic(using=self.using)
+        self._atomic.__enter__()
+
+    def _end(self, exc_type=None, exc_value=None, traceback=None):
+        atomic, self._atomic = self._atomic, None
+        self.pending = 0
+        if atomic is not None:
+            atomic.__exit__(exc_type, exc_value, traceback)
+
+    def wrote(self, count=1):
+        """Учитывает записанные строки; набралось size — фиксирует и открывает следующую транзакцию."""
+        self.pending += count
+        if self.pending >= self.size:
+            self._end()
+            self._begin()
+
+
+def save_in_import(instance, update_fields=None):
+    """
+    Сохранение одного объекта импорта в режиме писателя.
+
+    Блокировки ждет SQLite (busy_timeout), а не цикл повторов. Внутри транзакции
+    импорта сохранение идет в точке сохранения: ошибка одного товара не обрывает
+    всю транзакцию.
+    """
+    with import_writer(), transaction.atomic():
+        instance.save(update_fields=update_fields)
@@ -0,0 +1,115 @@
+"""
+Многошаблонный поиск ключевых слов (автомат Ахо — Корасик).
+
+Используется для автоопределения категорий и брендов: вместо проверки
+`keyword in text` для каждого из сотен ключевых слов текст проходится один раз,
+и стоимость классификации почти не зависит от количества ключевых слов.
+"""
+
+
+def is_ascii_word_char(char):
+    """Символ слова для проверки границ брендов: как [A-Z0-9] в старом регулярном выражении."""
+    return ('A' <= char <= 'Z') or ('0' <= char <= '9')
+
+
+class KeywordMatcher:
+    """
+    Скомпилированный набор ключевых слов.
+
+    entries — последовательность (keyword, payload, rank). Текст и ключевые слова
+    должны быть уже приведены к одному регистру. search() возвращает payload
+    совпавшего ключевого слова с наименьшим rank — так вызывающий код задает
+    прежний порядок приоритета (например, (-длина, порядок) = «самое длинное,
+    при равной длине — первое в списке»).
+
+    word_char — если задан, совпадение засчитывается только на границах слова:
+    соседние символы не должны быть символами слова (TOYO не найдется в TOYOTA).
+    """
+
+    def __init__(self, entries, word_char=None):
+        self.word_char = word_char
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]  # состояние -> [(длина, индекс записи)]
+        self._payloads = []
+        self._ranks = []
+        for keyword, payload, rank in entries:
+            if not keyword:
+                continue
+            index = len(self._payloads)
+            self._payloads.append(payload)
+            self._ranks.append(rank)
+            state = 0
+            for char in keyword:
+                next_state = self._goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                    self._goto[state][char] = next_state
+                state = next_state
+            self._out[state].append((len(keyword), index))
+        self._build_failure_links()
+
+    def _build_failure_links(self):
+        queue = list(self._goto[0].values())
+        head = 0
+        while head < len(queue):
+            state = queue[head]
+            head += 1
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(char, 0)
+                self._fail[next_state] = target if target != next_state else 0
+                # Выходы суффиксного состояния тоже совпадают в этой позиции
+                self._out[next_state] = self._out[next_state] + self._out[self._fail[next_state]]
+
+    def __len__(self):
+        return len(self._payloads)
+
+    def iter_matches(self, text):
+        """Все совпадения: (начало, конец, индекс записи)."""
+        goto, fail, out = self._goto, self._fail, self._out
+        word_char = self.word_char
+        state = 0
+        for position, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if not out[state]:
+                continue
+            end = position + 1
+            for length, index in out[state]:
+                start = end - length
+                if word_char is not None:
+                    if start > 0 and word_char(text[start - 1]):
+                        continue
+                    if end < len(text) and word_char(text[end]):
+                        continue
+                yield start, end, index
+
+    def search(self, text):
+        """payload лучшего (с наименьшим rank) совпадения или None."""
+        found = self.search_ranked(text)
+        return None if found is None else found[1]
+
+    def search_ranked(self, text, accept=None):
+        """
+        (rank, payload) лучшего совпадения или None.
+
+        accept — необязательный фильтр payload: отклоненные совпадения пропускаются.
+        Нужен, чтобы объединять результаты нескольких наборов по rank.
+        """
+        best_index = None
+        ranks, payloads = self._ranks, self._payloads
+        for _start, _end, index in self.iter_matches(text):
+            if best_index is not None and ranks[index] >= ranks[best_index]:
+                continue
+            if accept is not None and not accept(payloads[index]):
+                continue
+            best_index = index
+        return None if best_index is None else (ranks[best_index], payloads[best_index])
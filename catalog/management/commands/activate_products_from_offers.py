@@ -3,7 +3,9 @@
 Проверяет файл offers.xml и активирует товары, которые должны быть активны.
 """
 from django.core.management.base import BaseCommand
+from catalog.commerceml_extract import extract_commerceml_item, find_elements, parse_quantity
 from catalog.models import Product
+from catalog.offers_parse import RETAIL_PRICE_TYPE_ID, WHOLESALE_PRICE_TYPE_ID
 from django.db.models import Q
 from django.db import transaction
 import xml.etree.ElementTree as ET
@@ -66,118 +68,34 @@ class Command(BaseCommand):
             tree = ET.parse(file_path)
             root = tree.getroot()
             
-            # Находим namespace
-            namespaces = {}
-            if root.tag.startswith('{'):
-                namespace = root.tag[1:].split('}')[0]
-                namespaces[''] = namespace
-                namespaces['cml'] = namespace
-                namespaces['cml2'] = namespace
-            
-            # Ищем предложения
-            namespace = namespaces.get('', namespaces.get('cml', namespaces.get('cml2', None)))
-            offers = []
-            if namespace:
-                offers = root.findall(f'.//{{{namespace}}}Предложение')
-                if not offers:
-                    package = root.find(f'.//{{{namespace}}}ПакетПредложений')
-                    if package is not None:
-                        offers = package.findall(f'.//{{{namespace}}}Предложение')
-            if not offers:
-                offers = root.findall('.//Предложение')
-                if not offers:
-                    package = root.find('.//ПакетПредложений')
-                    if package is not None:
-                        offers = package.findall('.//Предложение')
+            # Ищем предложения (namespace корня или без него)
+            offers = find_elements(root, 'Предложение')
             
             self.stdout.write(f"Найдено предложений в XML: {len(offers)}")
             self.stdout.write()
             
-            # ID типов цен
-            RETAIL_PRICE_TYPE_ID = 'f6708032-0bd5-11f1-811f-00155d01d802'
-            WHOLESALE_PRICE_TYPE_ID = 'b12f44c0-1208-11f1-811f-00155d01d802'
-            
             activated_retail = 0
             activated_wholesale = 0
             not_found = 0
             
             with transaction.atomic():
                 for idx, offer_elem in enumerate(offers):
-                    # Извлекаем Ид товара
-                    product_id_elem = None
-                    if namespace:
-                        product_id_elem = offer_elem.find(f'{{{namespace}}}Ид')
-                    if product_id_elem is None:
-                        product_id_elem = offer_elem.find('Ид')
-                    
-                    if product_id_elem is None or not product_id_elem.text:
+                    # Предложение разбирается за один обход
+                    item = extract_commerceml_item(offer_elem)
+                    if not item.id:
                         continue
                     
-                    product_id = product_id_elem.text.strip()
+                    product_id = item.id
                     product_base_id = product_id.split('#')[0] if '#' in product_id else product_id
                     
-                    # Извлекаем количество
-                    quantity = None
-                    quantity_elem = None
-                    if namespace:
-                        quantity_elem = offer_elem.find(f'{{{namespace}}}Количество')
-                    if quantity_elem is None:
-                        quantity_elem = offer_elem.find('Количество')
-                    
-                    if quantity_elem is not None and quantity_elem.text:
-                        try:
-                            quantity = int(float(quantity_elem.text.strip().replace(',', '.')))
-                        except (ValueError, AttributeError):
-                            quantity = None
-                    
+                    # Количество
+                    quantity = parse_quantity(item.quantity)
                     if quantity is None or quantity == 0:
                         continue  # Пропускаем товары без остатка
                     
-                    # Извлекаем цены
-                    prices_elem = None
-                    if namespace:
-                        prices_elem = offer_elem.find(f'{{{namespace}}}Цены')
-                    if prices_elem is None:
-                        prices_elem = offer_elem.find('Цены')
-                    
-                    retail_price = None
-                    wholesale_price = None
-                    
-                    if prices_elem is not None:
-                        price_elems = []
-                        if namespace:
-                            price_elems = prices_elem.findall(f'{{{namespace}}}Цена')
-                        if not price_elems:
-                            price_elems = prices_elem.findall('Цена')
-                        
-                        for price_elem in price_elems:
-                            price_type_id_elem = None
-                            if namespace:
-                                price_type_id_elem = price_elem.find(f'{{{namespace}}}ИдТипаЦены')
-                            if price_type_id_elem is None:
-                                price_type_id_elem = price_elem.find('ИдТипаЦены')
-                            
-                            if price_type_id_elem is not None and price_type_id_elem.text:
-                                price_type_id = price_type_id_elem.text.strip()
-                                
-                                price_value_elem = None
-                                if namespace:
-                                    price_value_elem = price_elem.find(f'{{{namespace}}}ЦенаЗаЕдиницу')
-                                if price_value_elem is None:
-                                    price_value_elem = price_elem.find('ЦенаЗаЕдиницу')
-                                
-                                if price_value_elem is not None and price_value_elem.text:
-                                    try:
-                                        price_str = price_value_elem.text.strip().replace(',', '.').replace(' ', '').replace('\xa0', '')
-                                        if price_str:
-                                            price = float(price_str)
-                                            if price > 0:
-                                                if price_type_id == RETAIL_PRICE_TYPE_ID:
-                                                    retail_price = price
-                                                elif price_type_id == WHOLESALE_PRICE_TYPE_ID:
-                                                    wholesale_price = price
-                                    except (ValueError, AttributeError, TypeError):
-                                        pass
+                    # Цены
+                    retail_price = item.price(RETAIL_PRICE_TYPE_ID)
+                    wholesale_price = item.price(WHOLESALE_PRICE_TYPE_ID)
                     
                     # Если нет цены или количества, пропускаем
                     if not retail_price and not wholesale_price:
@@ -0,0 +1,271 @@
+"""
+Management команда для замера обмена с 1С на отдельной (временной) базе SQLite.
+
+Использование:
+    python manage.py benchmark_exchange --generate 50000
+    python manage.py benchmark_exchange /path/to/package_dir
+    python manage.py benchmark_exchange import0_1.xml offers0_1.xml --workers 1
+    python manage.py benchmark_exchange /path/to/v8_package.zip --output report.json
+
+Пакет (записанный с боевого обмена или сгенерированный generate_commerceml)
+прогоняется через process_exchange_package так же, как при обмене, но в чистую
+временную базу: рабочая база не меняется. Категории копируются из рабочей базы
+(без --no-categories), иначе создается синтетическое дерево под сгенерированный пакет.
+
+Результат — JSON: предложений в секунду, SQL-запросов на предложение, пик RSS
+и время по фазам (exchange_profiler). Сравнивая отчеты до и после изменения,
+видно регрессию скорости обмена.
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+import zipfile
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from catalog import import_writer, services
+from catalog.commerceml_extract import local_tag
+from catalog.commerceml_generator import generate_exchange_package, synthetic_category_tree
+from catalog.commerceml_views import exchange_xml_members
+from catalog.exchange_package import ExchangeFileRef, process_exchange_package
+from catalog.exchange_profiler import exchange_profile
+from catalog.models import Category, Product
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def _peak_rss_mb(who):
+    """Пик RSS процесса (или завершившихся дочерних процессов) в МБ."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # Linux отдает КБ, macOS — байты
+    divider = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return round(peak / divider, 1)
+
+
+def _count_offers(ref):
+    """Число Предложение в файле пакета (потоковый разбор, до замера)."""
+    if 'offers' not in ref.filename.lower():
+        return 0
+    if ref.member:
+        with zipfile.ZipFile(ref.file_path) as archive, archive.open(ref.member) as source:
+            return _count_offer_elements(source)
+    with open(ref.file_path, 'rb') as source:
+        return _count_offer_elements(source)
+
+
+def _count_offer_elements(source):
+    count = 0
+    for _event, elem in ET.iterparse(source, events=('end',)):
+        if local_tag(elem.tag) == 'Предложение':
+            count += 1
+            elem.clear()
+    return count
+
+
+class Command(BaseCommand):
+    help = 'Замеряет обмен с 1С (offers/sec, запросы, память, фазы) на временной базе SQLite'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths',
+            nargs='*',
+            help='XML/ZIP файлы пакета или каталог с ними',
+        )
+        parser.add_argument(
+            '--generate',
+            type=int,
+            default=None,
+            help='Сгенерировать синтетический пакет на N предложений вместо файлов',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Seed генератора для --generate',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=None,
+            help='Процессов разбора (по умолчанию ONE_C_PARSE_WORKERS)',
+        )
+        parser.add_argument(
+            '--no-categories',
+            action='store_true',
+            help='Не копировать категории из рабочей базы (создать синтетическое дерево)',
+        )
+        parser.add_argument(
+            '--keep-db',
+            action='store_true',
+            help='Не удалять временную базу и файлы после замера',
+        )
+        parser.add_argument(
+            '--output',
+            type=str,
+            default=None,
+            help='Записать JSON отчет в файл',
+        )
+
+    def handle(self, *args, **options):
+        if not options['paths'] and not options['generate']:
+            raise CommandError('Укажите файлы пакета или --generate N')
+        if connection.vendor != 'sqlite':
+            raise CommandError('Замер поддерживает только SQLite')
+
+        work_dir = tempfile.mkdtemp(prefix='benchmark_exchange_')
+        try:
+            files = self._collect_files(options, work_dir)
+            if not files:
+                raise CommandError('В пакете нет XML файлов')
+            offers = sum(_count_offers(ref) for ref in files)
+            categories = [] if options['no_categories'] else list(
+                Category.objects.order_by('tree_id', 'lft').values()
+            )
+            report = self._run(files, offers, categories, options, work_dir)
+        finally:
+            if options['keep_db']:
+                self.stderr.write(f'Временные файлы сохранены: {work_dir}')
+            else:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+        output = json.dumps(report, ensure_ascii=False, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(output)
+        self.stdout.write(output)
+
+    def _collect_files(self, options, work_dir):
+        """Файлы пакета как ExchangeFileRef (XML внутри ZIP читаются из архива)."""
+        if options['generate']:
+            package = generate_exchange_package(
+                os.path.join(work_dir, 'package'), options['generate'], seed=options['seed']
+            )
+            return [
+                ExchangeFileRef(package[key], os.path.basename(package[key]), None)
+                for key in ('import', 'offers')
+            ]
+
+        paths = []
+        for path in options['paths']:
+            if os.path.isdir(path):
+                paths.extend(
+                    os.path.join(path, name) for name in sorted(os.listdir(path))
+                    if name.lower().endswith(('.xml', '.zip'))
+                )
+            elif os.path.isfile(path):
+                paths.append(path)
+            else:
+                raise CommandError(f'Файл не найден: {path}')
+
+        files = []
+        for path in paths:
+            path = os.path.abspath(path)
+            if path.lower().endswith('.zip'):
+                files.extend(
+                    ExchangeFileRef(path, os.path.basename(member), member)
+                    for member in exchange_xml_members(path)
+                )
+            else:
+                files.append(ExchangeFileRef(path, os.path.basename(path), None))
+        return files
+
+    def _run(self, files, offers, categories, options, work_dir):
+        settings_dict = connection.settings_dict
+        original_name = settings_dict['NAME']
+        original_lock = import_writer.IMPORT_LOCK_FILE
+        original_fingerprint = services.KEYWORDS_FINGERPRINT_FILE
+        db_path = os.path.join(work_dir, 'benchmark.sqlite3')
+
+        connection.close()
+        settings_dict['NAME'] = db_path
+        import_writer.IMPORT_LOCK_FILE = os.path.join(work_dir, '.import.lock')
+        services.KEYWORDS_FINGERPRINT_FILE = os.path.join(work_dir, '.keywords.fingerprint')
+        try:
+            self._create_schema()
+            self._seed_categories(categories)
+            self.stderr.write(
+                f'Замер: {len(files)} файлов, {offers} предложений, база {db_path}'
+            )
+
+            started = time.perf_counter()
+            with exchange_profile() as profiler:
+                results = process_exchange_package(files, workers=options['workers'], force=True)
+            seconds = time.perf_counter() - started
+
+            profile = profiler.as_dict()
+            queries = profile['total']['queries']
+            return {
+                'files': [
+                    {
+                        'filename': ref.filename,
+                        'status': result.get('status'),
+                        'processed': result.get('processed', 0),
+                        'created': result.get('created', 0),
+                        'updated': result.get('updated', 0),
+                        'errors': self._errors_count(result),
+                    }
+                    for ref, result in results
+                ],
+                'offers': offers,
+                'workers': options['workers'],
+                'seconds': round(seconds, 3),
+                'offers_per_second': round(offers / seconds, 1) if seconds and offers else None,
+                'queries': queries,
+                'queries_per_offer': round(queries / offers, 2) if offers else None,
+                'peak_rss_mb': _peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+                'peak_rss_children_mb': _peak_rss_mb(resource.RUSAGE_CHILDREN) if resource else None,
+                'products': {
+                    'retail': Product.objects.filter(catalog_type='retail').count(),
+                    'wholesale': Product.objects.filter(catalog_type='wholesale').count(),
+                },
+                'phases': profile['phases'],
+                'memory_traced': profile['memory_traced'],
+            }
+        finally:
+            connection.close()
+            settings_dict['NAME'] = original_name
+            import_writer.IMPORT_LOCK_FILE = original_lock
+            services.KEYWORDS_FINGERPRINT_FILE = original_fingerprint
+            self._invalidate_matchers()
+
+    @staticmethod
+    def _errors_count(result):
+        errors = result.get('errors')
+        return errors if isinstance(errors, int) else len(errors or [])
+
+    def _create_schema(self):
+        """Таблицы всех моделей во временной базе (миграции не нужны — база одноразовая)."""
+        with connection.schema_editor() as editor:
+            for model in apps.get_models():
+                meta = model._meta
+                if meta.managed and not meta.proxy and not meta.swapped:
+                    editor.create_model(model)
+
+    def _seed_categories(self, categories):
+        """Категории из рабочей базы или синтетическое дерево под generate_commerceml."""
+        if categories:
+            Category.objects.bulk_create([Category(**row) for row in categories])
+            self.stderr.write(f'Скопировано категорий: {len(categories)}')
+        else:
+            for root_name, children in synthetic_category_tree():
+                root = Category.objects.create(name=root_name)
+                for name, keywords in children:
+                    Category.objects.create(name=name, parent=root, keywords=keywords)
+            self.stderr.write('Создано синтетическое дерево категорий')
+        self._invalidate_matchers()
+
+    @staticmethod
+    def _invalidate_matchers():
+        # Наборы ключевых слов скомпилированы по категориям другой базы
+        services.invalidate_keyword_matchers()
@@ -3,6 +3,7 @@
 Проверяет, почему товары не обрабатываются из offers.xml.
 """
 from django.core.management.base import BaseCommand
+from catalog.commerceml_extract import extract_commerceml_item, find_elements, parse_quantity
 from catalog.models import Product
 from django.db.models import Q
 import xml.etree.ElementTree as ET
@@ -56,29 +57,9 @@ class Command(BaseCommand):
             tree = ET.parse(file_path)
             root = tree.getroot()
             
-            # Находим namespace
-            namespaces = {}
-            if root.tag.startswith('{'):
-                namespace = root.tag[1:].split('}')[0]
-                namespaces[''] = namespace
-                namespaces['cml'] = namespace
-                namespaces['cml2'] = namespace
-            
-            # Ищем предложения
-            namespace = namespaces.get('', namespaces.get('cml', namespaces.get('cml2', None)))
-            offers = []
-            if namespace:
-                offers = root.findall(f'.//{{{namespace}}}Предложение')
-                if not offers:
-                    package = root.find(f'.//{{{namespace}}}ПакетПредложений')
-                    if package is not None:
-                        offers = package.findall(f'.//{{{namespace}}}Предложение')
-            if not offers:
-                offers = root.findall('.//Предложение')
-                if not offers:
-                    package = root.find('.//ПакетПредложений')
-                    if package is not None:
-                        offers = package.findall('.//Предложение')
+            # Ищем предложения (namespace корня или без него); каждое разбираем за один обход
+            offers = find_elements(root, 'Предложение')
+            items = [extract_commerceml_item(offer_elem) for offer_elem in offers]
             
             self.stdout.write(f"Найдено предложений в XML: {len(offers)}")
             self.stdout.write()
@@ -92,20 +73,13 @@ class Command(BaseCommand):
             
             examples_not_found = []
             
-            for idx, offer_elem in enumerate(offers[:100]):
+            for item in items[:100]:
                 analyzed += 1
                 
-                # Извлекаем Ид товара
-                product_id_elem = None
-                if namespace:
-                    product_id_elem = offer_elem.find(f'{{{namespace}}}Ид')
-                if product_id_elem is None:
-                    product_id_elem = offer_elem.find('Ид')
-                
-                if product_id_elem is None or not product_id_elem.text:
+                if not item.id:
                     continue
                 
-                product_id = product_id_elem.text.strip()
+                product_id = item.id
                 product_base_id = product_id.split('#')[0] if '#' in product_id else product_id
                 
                 # Ищем товар в базе
@@ -124,15 +98,8 @@ class Command(BaseCommand):
                 else:
                     not_found_in_db += 1
                     if len(examples_not_found) < 5:
-                        # Извлекаем артикул для примера
-                        article = None
-                        article_elem = None
-                        if namespace:
-                            article_elem = offer_elem.find(f'.//{{{namespace}}}Артикул')
-                        if article_elem is None:
-                            article_elem = offer_elem.find('.//Артикул')
-                        if article_elem is not None and article_elem.text:
-                            article = article_elem.text.strip()
+                        # Артикул для примера
+                        article = item.article or None
                         
                         examples_not_found.append({
                             'product_id': product_id,
@@ -146,20 +113,9 @@ class Command(BaseCommand):
             offers_with_retail_price_gt_0 = 0
             offers_with_wholesale_price_gt_0 = 0
             
-            for offer_elem in offers:
+            for item in items:
                 # Количество
-                quantity = None
-                quantity_elem = None
-                if namespace:
-                    quantity_elem = offer_elem.find(f'{{{namespace}}}Количество')
-                if quantity_elem is None:
-                    quantity_elem = offer_elem.find('Количество')
-                if quantity_elem is not None and quantity_elem.text:
-                    try:
-                        quantity = int(float(quantity_elem.text.strip().replace(',', '.')))
-                    except (ValueError, AttributeError):
-                        quantity = None
-                
+                quantity = parse_quantity(item.quantity)
                 if quantity is not None:
                     if quantity > 0:
                         offers_with_qty_gt_0 += 1
@@ -167,37 +123,9 @@ class Command(BaseCommand):
                         offers_with_qty_eq_0 += 1
                 
                 # Цены
-                prices_elem = None
-                if namespace:
-                    prices_elem = offer_elem.find(f'{{{namespace}}}Цены')
-                if prices_elem is None:
-                    prices_elem = offer_elem.find('Цены')
-                
-                if prices_elem is not None:
-                    price_elems = []
-                    if namespace:
-                        price_elems = prices_elem.findall(f'{{{namespace}}}Цена')
-                    if not price_elems:
-                        price_elems = prices_elem.findall('Цена')
-                    
-                    for price_elem in price_elems:
-                        price_value_elem = None
-                        if namespace:
-                            price_value_elem = price_elem.find(f'{{{namespace}}}ЦенаЗаЕдиницу')
-                        if price_value_elem is None:
-                            price_value_elem = price_elem.find('ЦенаЗаЕдиницу')
-                        
-                        if price_value_elem is not None and price_value_elem.text:
-                            try:
-                                price_str = price_value_elem.text.strip().replace(',', '.').replace(' ', '').replace('\xa0', '')
-                                if price_str:
-                                    price = float(price_str)
-                                    if price > 0:
-                                        offers_with_retail_price_gt_0 += 1
-                                        offers_with_wholesale_price_gt_0 += 1
-                                        break
-                            except (ValueError, AttributeError, TypeError):
-                                pass
+                if any(price.value is not None and price.value > 0 for price in item.prices):
+                    offers_with_retail_price_gt_0 += 1
+                    offers_with_wholesale_price_gt_0 += 1
             
             self.stdout.write(f"Проанализировано предложений: {analyzed}")
             self.stdout.write(f"Найдено товаров в базе: {found_in_db}")
@@ -0,0 +1,72 @@
+"""
+Management команда для генерации синтетического пакета CommerceML (import.xml + offers.xml).
+
+Использование:
+    python manage.py generate_commerceml --offers 50000 --output /tmp/bench_50k
+    python manage.py generate_commerceml --offers 500000 --output /tmp/bench_500k --seed 7 --zip
+    python manage.py generate_commerceml --offers 1000 --output /tmp/bench_1k --no-namespace
+
+Пакет воспроизводим: при одном seed файлы совпадают побайтно. Используется для
+замеров benchmark_exchange.
+"""
+import os
+import zipfile
+
+from django.core.management.base import BaseCommand
+
+from catalog.commerceml_generator import COMMERCEML_NAMESPACE, generate_exchange_package
+
+
+class Command(BaseCommand):
+    help = 'Генерирует синтетический пакет CommerceML (import.xml + offers.xml) для замеров обмена'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--offers',
+            type=int,
+            default=1000,
+            help='Количество товаров/предложений в пакете (по умолчанию 1000)',
+        )
+        parser.add_argument(
+            '--output',
+            type=str,
+            default=None,
+            help='Каталог для файлов (по умолчанию ./commerceml_<offers>)',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Seed генератора (по умолчанию 0)',
+        )
+        parser.add_argument(
+            '--no-namespace',
+            action='store_true',
+            help='Писать файлы без xmlns',
+        )
+        parser.add_argument(
+            '--zip',
+            action='store_true',
+            help='Дополнительно упаковать пакет в package.zip (как присылает 1С)',
+        )
+
+    def handle(self, *args, **options):
+        offers = options['offers']
+        out_dir = options['output'] or os.path.join(os.getcwd(), f'commerceml_{offers}')
+        namespace = '' if options['no_namespace'] else COMMERCEML_NAMESPACE
+
+        self.stdout.write(f'Генерация пакета на {offers} предложений в {out_dir}...')
+        package = generate_exchange_package(out_dir, offers, seed=options['seed'], namespace=namespace)
+        for key in ('import', 'offers'):
+            size_mb = os.path.getsize(package[key]) / 1024 / 1024
+            self.stdout.write(f'  {package[key]} ({size_mb:.1f} МБ)')
+
+        if options['zip']:
+            zip_path = os.path.join(out_dir, 'package.zip')
+            with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+                for key in ('import', 'offers'):
+                    archive.write(package[key], os.path.basename(package[key]))
+            size_mb = os.path.getsize(zip_path) / 1024 / 1024
+            self.stdout.write(f'  {zip_path} ({size_mb:.1f} МБ)')
+
+        self.stdout.write(self.style.SUCCESS(f'✓ Пакет готов: {offers} предложений'))
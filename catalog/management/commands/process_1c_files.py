@@ -11,6 +11,12 @@ Management команда для автоматической обработки
 - Имеют расширение .xml или .zip
 - Не имеют маркера .processed
 - Или были изменены недавно (опция --recent)
+
+Отобранные файлы обрабатываются одним пакетом: разбор XML параллельно в пуле
+процессов (--workers), запись в БД по одному файлу, import раньше offers.
+
+Побайтно тот же файл, уже успешно примененный (реестр ExchangeFile), повторно
+не обрабатывается; --force обрабатывает файлы заново в любом случае.
 """
 import os
 import logging
@@ -18,7 +24,9 @@ import time
 from datetime import datetime, timedelta
 from django.core.management.base import BaseCommand
 from django.conf import settings
-from catalog.commerceml_views import EXCHANGE_DIR, process_commerceml_file
+from catalog.commerceml_views import EXCHANGE_DIR, exchange_xml_members, process_commerceml_file
+from catalog.exchange_jobs import write_processed_marker
+from catalog.exchange_package import ExchangeFileRef, exchange_file_order, process_exchange_package
 
 logger = logging.getLogger(__name__)
 
@@ -48,6 +56,17 @@ class Command(BaseCommand):
             action='store_true',
             help='Обрабатывать также ZIP архивы',
         )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Обработать заново, даже если файл уже обработан или тот же пакет уже применен',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=None,
+            help='Процессов для параллельного разбора файлов (по умолчанию ONE_C_PARSE_WORKERS; 1 — последовательно)',
+        )
         parser.add_argument(
             '--reset',
             action='store_true',
@@ -71,8 +90,10 @@ class Command(BaseCommand):
             
             self.stdout.write(f'Обработка файла: {options["file"]}')
             try:
-                result = process_commerceml_file(file_path, options['file'])
-                if result['status'] == 'success':
+                result = process_commerceml_file(file_path, options['file'], force=options['force'])
+                if result.get('skipped'):
+                    self.stdout.write(f'Пропускаем файл (тот же пакет уже применен, используйте --force): {options["file"]}')
+                elif result['status'] == 'success':
                     self.stdout.write(self.style.SUCCESS(
                         f'✓ Файл обработан: обработано {result.get("processed", 0)} товаров'
                     ))
@@ -130,16 +151,7 @@ class Command(BaseCommand):
         
         # ВАЖНО: Сортируем файлы так, чтобы сначала обрабатывались import.xml, потом offers.xml
         # Это гарантирует, что товары сначала создаются/обновляются, а потом обновляются цены и остатки
-        def sort_key(filename):
-            filename_lower = filename.lower()
-            if 'import' in filename_lower and 'offers' not in filename_lower:
-                return (0, filename)  # import.xml - приоритет 0 (обрабатываем первыми)
-            elif 'offers' in filename_lower:
-                return (1, filename)  # offers.xml - приоритет 1 (обрабатываем вторыми)
-            else:
-                return (2, filename)  # остальные файлы - приоритет 2
-        
-        target_files = sorted(target_files, key=sort_key)
+        target_files = sorted(target_files, key=exchange_file_order)
         
         # Определяем время для фильтрации недавних файлов
         recent_minutes = options.get('recent', 0)
@@ -152,13 +164,14 @@ class Command(BaseCommand):
         # Иначе удаляются связи `Product -> ProductImage`, и фото пропадают,
         # даже если сами товары потом пересоздаются/обновляются.
 
+        to_process = []
         for filename in target_files:  # Обрабатываем в правильном порядке
             file_path = os.path.join(EXCHANGE_DIR, filename)
             
             # ВАЖНО: Проверяем, не обработан ли уже файл (по наличию файла .processed)
             # И НЕ обрабатываем повторно, если файл не изменился (даже с --all)
             processed_marker = f"{file_path}.processed"
-            if os.path.exists(processed_marker):
+            if os.path.exists(processed_marker) and not options['force']:
                 # Файл уже обрабатывался - проверяем, изменился ли он
                 try:
                     # Получаем текущее время файла
@@ -220,54 +233,46 @@ class Command(BaseCommand):
                     self.stdout.write(f'Пропускаем старый файл: {filename} (изменен {file_mtime.strftime("%Y-%m-%d %H:%M:%S")})')
                     continue
             
-            self.stdout.write(f'Обработка файла: {filename}...')
+            to_process.append(filename)
+        
+        # Отобранные файлы — один пакет: разбор параллельно в пуле процессов,
+        # запись в БД по одному файлу, import раньше offers
+        results = self._process_package(to_process, options) if to_process else {}
+        
+        for filename in to_process:
+            file_path = os.path.join(EXCHANGE_DIR, filename)
+            result = results[filename]
             
-            try:
-                # Показываем размер файла
-                file_size = os.path.getsize(file_path)
-                file_size_mb = file_size / (1024 * 1024)
-                self.stdout.write(f'  Размер файла: {file_size_mb:.2f} MB')
-                
-                result = process_commerceml_file(file_path, filename)
+            if result.get('skipped'):
+                self.stdout.write(f'Пропускаем файл (тот же пакет уже применен, используйте --force): {filename}')
+                continue
+            
+            # ВАЖНО: Маркер создается только если товары действительно обработаны
+            # Если processed_count = 0, это ошибка, маркер не создается
+            processed_items = result.get("processed", 0)
+            if result['status'] == 'success' and processed_items > 0:
+                processed_count += 1
+                # Создаем маркер обработанного файла
+                # ВАЖНО: Сохраняем время изменения ФАЙЛА, а не время создания маркера
+                # Это нужно для правильной проверки, изменился ли файл
+                try:
+                    write_processed_marker(file_path, result)
+                except Exception as marker_error:
+                    self.stdout.write(self.style.WARNING(f'Не удалось создать маркер: {marker_error}'))
                 
-                # ВАЖНО: Маркер создается только если товары действительно обработаны
-                # Если processed_count = 0, это ошибка, маркер не создается
-                processed_items = result.get("processed", 0)
-                if result['status'] == 'success' and processed_items > 0:
-                    processed_count += 1
-                    # Создаем маркер обработанного файла
-                    # ВАЖНО: Сохраняем время изменения ФАЙЛА, а не время создания маркера
-                    # Это нужно для правильной проверки, изменился ли файл
-                    try:
-                        file_mtime = os.path.getmtime(file_path)
-                        file_mtime_iso = datetime.fromtimestamp(file_mtime).isoformat()
-                        with open(processed_marker, 'w') as f:
-                            f.write(f'processed\n')
-                            f.write(f'file_mtime: {file_mtime_iso}\n')  # Время изменения файла
-                            f.write(f'marker_time: {datetime.now().isoformat()}\n')  # Время создания маркера
-                            f.write(f'processed_count: {processed_items}\n')
-                            f.write(f'created: {result.get("created", 0)}\n')
-                            f.write(f'updated: {result.get("updated", 0)}\n')
-                    except Exception as marker_error:
-                        self.stdout.write(self.style.WARNING(f'Не удалось создать маркер: {marker_error}'))
-                    
-                    self.stdout.write(self.style.SUCCESS(
-                        f'✓ {filename}: обработано {processed_items} товаров '
-                        f'(создано: {result.get("created", 0)}, обновлено: {result.get("updated", 0)})'
-                    ))
-                else:
-                    error_count += 1
-                    if processed_items == 0:
-                        error_msg = f"Товары не обработаны (processed_count=0). Статус: {result.get('status', 'unknown')}"
-                    else:
-                        error_msg = result.get("error", "Неизвестная ошибка")
-                    self.stdout.write(self.style.ERROR(f'✗ {filename}: {error_msg}'))
-                    logger.error(f'Ошибка обработки файла {filename}: {error_msg}')
-                    # НЕ создаем маркер, если товары не обработаны
-            except Exception as e:
+                self.stdout.write(self.style.SUCCESS(
+                    f'✓ {filename}: обработано {processed_items} товаров '
+                    f'(создано: {result.get("created", 0)}, обновлено: {result.get("updated", 0)})'
+                ))
+            else:
                 error_count += 1
-                self.stdout.write(self.style.ERROR(f'✗ {filename}: исключение - {e}'))
-                logger.error(f'Ошибка обработки файла {filename}: {e}', exc_info=True)
+                if processed_items == 0:
+                    error_msg = f"Товары не обработаны (processed_count=0). Статус: {result.get('status', 'unknown')}"
+                else:
+                    error_msg = result.get("error", "Неизвестная ошибка")
+                self.stdout.write(self.style.ERROR(f'✗ {filename}: {error_msg}'))
+                logger.error(f'Ошибка обработки файла {filename}: {error_msg}')
+                # НЕ создаем маркер, если товары не обработаны
         
         # Итоговая статистика
         self.stdout.write('')
@@ -276,3 +281,53 @@ class Command(BaseCommand):
         if error_count > 0:
             self.stdout.write(self.style.ERROR(f'Ошибок: {error_count}'))
         self.stdout.write('=' * 60)
+
+    def _process_package(self, filenames, options):
+        """
+        Обрабатывает файлы пакетом (см. catalog.exchange_package).
+
+        XML файлы ZIP-архивов входят в пакет по отдельности и читаются прямо из архива.
+        Возвращает {имя файла: результат}; для архива — суммарный по его XML файлам.
+        """
+        refs = []
+        results = {}
+        for filename in filenames:
+            file_path = os.path.join(EXCHANGE_DIR, filename)
+            self.stdout.write(f'Обработка файла: {filename}...')
+            # Показываем размер файла
+            file_size_mb = os.path.getsize(file_path) / (1024 * 1024)
+            self.stdout.write(f'  Размер файла: {file_size_mb:.2f} MB')
+            if not filename.lower().endswith('.zip'):
+                refs.append(ExchangeFileRef(file_path, filename, None))
+                continue
+            try:
+                members = exchange_xml_members(file_path)
+            except Exception as e:
+                results[filename] = {'status': 'failure', 'error': f'Ошибка чтения ZIP: {e}'}
+                continue
+            if not members:
+                results[filename] = {'status': 'failure', 'error': 'В ZIP архиве не найдено XML файлов'}
+                continue
+            for member in members:
+                self.stdout.write(f'  Файл в архиве: {member}')
+                refs.append(ExchangeFileRef(file_path, member, member))
+
+        errors = {}
+        for ref, result in process_exchange_package(refs, workers=options['workers'], force=options['force']):
+            source = os.path.basename(ref.file_path)
+            total = results.setdefault(
+                source, {'status': 'success', 'processed': 0, 'created': 0, 'updated': 0, 'skipped': True}
+            )
+            if result.get('skipped'):
+                continue
+            total['skipped'] = False
+            for key in ('processed', 'created', 'updated'):
+                total[key] += result.get(key, 0) or 0
+            if result.get('status') == 'failure':
+                errors.setdefault(source, []).append(f'{ref.filename}: {result.get("error", "Неизвестная ошибка")}')
+            elif result.get('status') != 'success' and total['status'] == 'success':
+                total['status'] = result.get('status')
+        for source, source_errors in errors.items():
+            results[source]['status'] = 'failure'
+            results[source]['error'] = '; '.join(source_errors)
+        return results
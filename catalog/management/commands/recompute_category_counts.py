@@ -0,0 +1,21 @@
+"""
+Management команда для пересчета счетчиков товаров категорий (CategoryProductCount).
+
+Использование:
+    python manage.py recompute_category_counts
+
+Счетчики пересчитываются сами после обмена, импорта API, обновления остатков и
+перемещения категорий. Команда нужна после ручных массовых правок товаров
+(админка, скрипты), которые эти пути не проходят.
+"""
+from django.core.management.base import BaseCommand
+
+from catalog.category_counts import recompute_category_counts
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает счетчики товаров категорий (розница, опт, в наличии)'
+
+    def handle(self, *args, **options):
+        written = recompute_category_counts()
+        self.stdout.write(self.style.SUCCESS(f'✓ Счетчики пересчитаны для {written} категорий'))
@@ -7,13 +7,13 @@ Management команда для перераспределения товаро
     python manage.py redistribute_categories --catalog-type both
     
 Перераспределяет все товары по категориям на основе их названий,
-используя функцию get_category_for_product.
+используя пакетную классификацию classify_names (логика get_category_for_product).
 """
 import logging
 from django.core.management.base import BaseCommand
 from django.db.models import Q, Count
 from catalog.models import Product, Category
-from catalog.services import get_category_for_product, rebalance_subcategory_roots
+from catalog.services import classify_names, rebalance_subcategory_roots
 
 logger = logging.getLogger(__name__)
 
@@ -107,13 +107,17 @@ class Command(BaseCommand):
             # Обрабатываем товары батчами
             batch_size = 100
             for i in range(0, total_count, batch_size):
-                batch = products[i:i+batch_size]
+                batch = list(products[i:i+batch_size])
+                # Категории для всей пачки — одним пакетом, без запросов на каждый товар
+                categories = classify_names(
+                    [product.name for product in batch], use_db_subcategories=True
+                )
                 
                 for product in batch:
                     try:
                         # Определяем категорию на основе названия товара
                         # Используем исходное название (name), так как в нём могут быть ключевые слова
-                        category = get_category_for_product(product.name, use_db_subcategories=True)
+                        category = categories.get(product.name)
                         
                         if not category:
                             self.stdout.write(self.style.ERROR(f'  ⚠ Товар {product.id} ({product.article}): не удалось определить категорию'))
@@ -0,0 +1,33 @@
+"""
+Management команда для пересчета главного фото товаров (Product.main_image).
+
+Использование:
+    python manage.py refresh_main_images          # только товары без ссылки, у которых есть фото
+    python manage.py refresh_main_images --all    # все товары
+
+Ссылка обновляется сама при сохранении/удалении ProductImage и после обмена с 1С.
+Команда нужна после ручных массовых правок фото (queryset.update/delete, скрипты).
+"""
+from django.core.management.base import BaseCommand
+
+from catalog.models import Product
+from catalog.product_images import refresh_main_images, refresh_missing_main_images
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает главное фото товаров (свое или розничного аналога для опта)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Пересчитать все товары, а не только товары без главного фото',
+        )
+
+    def handle(self, *args, **options):
+        if options['all']:
+            product_ids = list(Product.objects.order_by('id').values_list('id', flat=True))
+            updated = refresh_main_images(product_ids)
+        else:
+            updated = refresh_missing_main_images()
+        self.stdout.write(self.style.SUCCESS(f'✓ Главное фото обновлено у {updated} товаров'))
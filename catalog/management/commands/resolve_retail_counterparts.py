@@ -0,0 +1,21 @@
+"""
+Management команда для пересчета розничных аналогов оптовых товаров (Product.retail_counterpart).
+
+Использование:
+    python manage.py resolve_retail_counterparts
+
+Пары пересчитываются сами после обмена с 1С, импорта API и массового импорта опта.
+Правки через Product.save (админка) пересчитывают пару сразу; команда нужна после
+правок external_id/артикулов в обход save (queryset.update, bulk_update, SQL).
+"""
+from django.core.management.base import BaseCommand
+
+from catalog.counterparts import resolve_retail_counterparts
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает розничные аналоги оптовых товаров'
+
+    def handle(self, *args, **options):
+        changed = resolve_retail_counterparts()
+        self.stdout.write(self.style.SUCCESS(f'✓ Розничные аналоги обновлены у {changed} товаров'))
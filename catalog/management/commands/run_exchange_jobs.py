@@ -0,0 +1,83 @@
+"""
+Management команда — воркер фоновой обработки файлов обмена с 1С.
+
+Использование:
+    python manage.py run_exchange_jobs            # работает постоянно (systemd/supervisor)
+    python manage.py run_exchange_jobs --once     # обработать очередь и выйти (cron раз в минуту)
+
+Берет задания ExchangeJob, поставленные запросами mode=file/import, и обрабатывает
+их по одному в порядке постановки. Прогресс и контрольная точка сохраняются после
+каждой пачки предложений: если воркер убит, следующий запуск продолжит задание
+с места остановки, а не с начала файла.
+
+Готовые задания одной сессии (1С делит каталог на Import0_1.xml, offers0_1.xml, …)
+обрабатываются пакетом: файлы разбираются параллельно в пуле процессов
+(ONE_C_PARSE_WORKERS), а пишутся в БД по одному, import раньше offers.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+
+from catalog.exchange_jobs import (
+    claim_job, claim_next_job, requeue_stale_jobs, run_exchange_job, session_package_jobs,
+)
+from catalog.exchange_package import run_exchange_package
+
+
+class Command(BaseCommand):
+    help = 'Обрабатывает очередь заданий обмена с 1С (ExchangeJob)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Обработать все готовые задания и завершиться',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=2.0,
+            help='Пауза между проверками очереди в секундах (без --once)',
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write('Воркер обмена с 1С запущен')
+        processed = 0
+        while True:
+            requeue_stale_jobs()
+            job = claim_next_job()
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+                continue
+
+            for job in self._run_with_package(job):
+                processed += 1
+                if job.status == 'success':
+                    self.stdout.write(self.style.SUCCESS(
+                        f'✓ {job.filename}: обработано {job.result.get("processed", 0)} товаров'
+                    ))
+                else:
+                    self.stdout.write(self.style.ERROR(f'✗ {job.filename}: {job.error}'))
+
+        self.stdout.write(f'Обработано заданий: {processed}')
+
+    def _run_with_package(self, first):
+        """Обрабатывает задание вместе с остальными готовыми заданиями его сессии."""
+        package = session_package_jobs(first)
+        if not package:
+            self.stdout.write(f'Задание #{first.pk}: {first.filename}...')
+            return [run_exchange_job(first)]
+
+        self.stdout.write(f'Пакет заданий сессии из {len(package) + 1} файлов')
+
+        def _write(job, parsed):
+            # Остальные задания пакета захватываем только перед записью — их мог взять другой воркер
+            if job is not first and not claim_job(job):
+                return None
+            self.stdout.write(f'Задание #{job.pk}: {job.filename}...')
+            return run_exchange_job(job, parsed=parsed)
+
+        results = run_exchange_package([first, *package], _write)
+        return [job for _, job in results if job is not None]
@@ -21,7 +21,8 @@ class CommerceMLLoggingMiddleware:
             logger.info(f"  Path: {request.path}")
             logger.info(f"  Method: {request.method}")
             logger.info(f"  GET: {dict(request.GET)}")
-            logger.info(f"  POST data size: {len(request.body)} bytes")
+            # Не трогаем request.body: иначе весь загружаемый файл обмена окажется в памяти
+            logger.info(f"  POST data size: {request.META.get('CONTENT_LENGTH') or 0} bytes")
             logger.info(f"  Cookies: {dict(request.COOKIES)}")
             logger.info(f"  Headers: Authorization={bool(request.META.get('HTTP_AUTHORIZATION'))}")
             logger.info(f"  IP: {request.META.get('REMOTE_ADDR', 'unknown')}")
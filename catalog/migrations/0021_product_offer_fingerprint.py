@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0020_product_supplier_article'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='offer_fingerprint',
+            field=models.CharField(blank=True, editable=False, help_text='Хеш полей последнего примененного предложения offers.xml; неизменившиеся предложения не перезаписываются', max_length=40, verbose_name='Отпечаток предложения 1С'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0021_product_offer_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExchangeJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('filename', models.CharField(max_length=255, verbose_name='Имя файла')),
+                ('file_path', models.CharField(max_length=1024, verbose_name='Путь к файлу')),
+                ('session', models.CharField(blank=True, db_index=True, max_length=128, verbose_name='Сессия обмена')),
+                ('is_ready', models.BooleanField(default=False, help_text='Выставляется запросом mode=import: до него 1С может дописывать файл частями', verbose_name='Файл загружен полностью')),
+                ('status', models.CharField(choices=[('pending', 'В очереди'), ('running', 'Выполняется'), ('success', 'Успешно'), ('failure', 'Ошибка')], default='pending', max_length=20, verbose_name='Статус')),
+                ('progress', models.PositiveSmallIntegerField(default=0, verbose_name='Прогресс, %')),
+                ('checkpoint', models.PositiveIntegerField(default=0, verbose_name='Обработано предложений')),
+                ('total', models.PositiveIntegerField(default=0, verbose_name='Всего предложений')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Попыток')),
+                ('result', models.JSONField(blank=True, default=dict, verbose_name='Результат')),
+                ('error', models.TextField(blank=True, verbose_name='Ошибка')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создано')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлено')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Начато')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Завершено')),
+            ],
+            options={
+                'verbose_name': 'Задание обмена с 1С',
+                'verbose_name_plural': 'Задания обмена с 1С',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['status', 'created_at'], name='catalog_exc_status_d598f0_idx'), models.Index(fields=['filename', 'session'], name='catalog_exc_filenam_20a6a1_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0022_exchangejob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExchangeStagingKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run_id', models.CharField(max_length=32, verbose_name='Прогон')),
+                ('kind', models.CharField(choices=[('external_id', 'ID из 1С'), ('article', 'Артикул')], max_length=16, verbose_name='Тип ключа')),
+                ('value', models.CharField(max_length=255, verbose_name='Значение')),
+            ],
+            options={
+                'verbose_name': 'Ключ товара из обмена',
+                'verbose_name_plural': 'Ключи товаров из обмена',
+                'indexes': [models.Index(fields=['run_id', 'kind', 'value'], name='catalog_exc_run_id_d872be_idx')],
+            },
+        ),
+    ]
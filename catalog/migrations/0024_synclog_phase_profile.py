@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0023_exchangestagingkey'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='synclog',
+            name='phase_profile',
+            field=models.JSONField(blank=True, default=dict, verbose_name='Профиль по фазам'),
+        ),
+    ]
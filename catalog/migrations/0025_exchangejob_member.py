@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0024_synclog_phase_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exchangejob',
+            name='member',
+            field=models.CharField(blank=True, help_text='Имя XML внутри ZIP-архива: файл читается прямо из архива, без распаковки', max_length=255, verbose_name='Файл в архиве'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0025_exchangejob_member'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExchangeFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, verbose_name='SHA-256')),
+                ('filename', models.CharField(max_length=255, verbose_name='Имя файла')),
+                ('file_path', models.CharField(blank=True, max_length=1024, verbose_name='Путь к файлу')),
+                ('size', models.BigIntegerField(default=0, verbose_name='Размер, байт')),
+                ('kind', models.CharField(choices=[('import', 'Каталог (import)'), ('offers', 'Предложения (offers)'), ('archive', 'ZIP-архив'), ('other', 'Другое')], default='other', max_length=16, verbose_name='Тип')),
+                ('status', models.CharField(choices=[('received', 'Получен'), ('success', 'Применен'), ('failure', 'Ошибка')], default='received', max_length=16, verbose_name='Статус')),
+                ('result', models.JSONField(blank=True, default=dict, verbose_name='Результат')),
+                ('skipped', models.PositiveIntegerField(default=0, help_text='Сколько раз тот же пакет приходил снова и не обрабатывался', verbose_name='Повторов пропущено')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Получен')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлено')),
+                ('processed_at', models.DateTimeField(blank=True, null=True, verbose_name='Обработан')),
+            ],
+            options={
+                'verbose_name': 'Файл обмена с 1С',
+                'verbose_name_plural': 'Реестр файлов обмена с 1С',
+                'ordering': ['-created_at'],
+                'unique_together': {('sha256', 'filename')},
+            },
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0026_exchangefile'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='synclog',
+            name='operation_type',
+            field=models.CharField(choices=[('file_upload', 'Загрузка файла'), ('api_sync', 'API синхронизация'), ('stock_update', 'Остатки и цены')], default='api_sync', max_length=20, verbose_name='Тип операции'),
+        ),
+    ]
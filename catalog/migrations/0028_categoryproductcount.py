@@ -0,0 +1,29 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0027_synclog_stock_update'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryProductCount',
+            fields=[
+                ('category', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='counts', serialize=False, to='catalog.category', verbose_name='Категория')),
+                ('retail_direct', models.PositiveIntegerField(default=0, verbose_name='Розница (в категории)')),
+                ('retail_total', models.PositiveIntegerField(default=0, verbose_name='Розница (с подкатегориями)')),
+                ('wholesale_direct', models.PositiveIntegerField(default=0, verbose_name='Опт (в категории)')),
+                ('wholesale_total', models.PositiveIntegerField(default=0, verbose_name='Опт (с подкатегориями)')),
+                ('in_stock_direct', models.PositiveIntegerField(default=0, verbose_name='Опт в наличии (в категории)')),
+                ('in_stock_total', models.PositiveIntegerField(default=0, verbose_name='Опт в наличии (с подкатегориями)')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Пересчитано')),
+            ],
+            options={
+                'verbose_name': 'Счетчики товаров категории',
+                'verbose_name_plural': 'Счетчики товаров категорий',
+            },
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Полный путь slug категории для URL без запросов предков
+
+from django.db import migrations, models
+
+
+def populate_full_path(apps, schema_editor):
+    """Заполняет full_path всех категорий (от корней к листьям)."""
+    Category = apps.get_model('catalog', 'Category')
+    categories = list(Category.objects.order_by('level', 'id').only('id', 'slug', 'parent_id'))
+    paths = {}
+    pending = categories
+    # Порядок по level; при сбитом MPTT — повторные проходы, пока путь родителя не известен
+    while pending:
+        rest = []
+        for category in pending:
+            if category.parent_id is None:
+                paths[category.pk] = category.slug
+            elif category.parent_id in paths:
+                paths[category.pk] = f'{paths[category.parent_id]}/{category.slug}'
+            else:
+                rest.append(category)
+        if len(rest) == len(pending):
+            break
+        pending = rest
+    for category in categories:
+        category.full_path = paths.get(category.pk, category.slug)
+    Category.objects.bulk_update(categories, ['full_path'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0028_categoryproductcount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='full_path',
+            field=models.CharField(blank=True, editable=False, max_length=1000, verbose_name='Полный путь'),
+        ),
+        migrations.RunPython(populate_full_path, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# Денормализованное главное фото товара для сеток без запросов на карточку
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def populate_main_image(apps, schema_editor):
+    """Заполняет main_image: свое фото (главное, иначе первое), у опта без фото — фото розницы."""
+    Product = apps.get_model('catalog', 'Product')
+    ProductImage = apps.get_model('catalog', 'ProductImage')
+    first_image = {}
+    rows = ProductImage.objects.order_by('product_id', '-is_main', 'order', 'id').values_list('product_id', 'id')
+    for product_id, image_id in rows.iterator():
+        first_image.setdefault(product_id, image_id)
+    retail_by_external_id = dict(
+        Product.objects.filter(catalog_type='retail', external_id__gt='').values_list('external_id', 'id')
+    )
+    products = []
+    for product in Product.objects.only('id', 'catalog_type', 'external_id').iterator():
+        image_id = first_image.get(product.pk)
+        if image_id is None and product.catalog_type == 'wholesale' and product.external_id:
+            image_id = first_image.get(retail_by_external_id.get(product.external_id))
+        if image_id is not None:
+            product.main_image_id = image_id
+            products.append(product)
+    Product.objects.bulk_update(products, ['main_image'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0029_category_full_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='main_image',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='catalog.productimage', verbose_name='Главное изображение'),
+        ),
+        migrations.RunPython(populate_main_image, migrations.RunPython.noop),
+    ]
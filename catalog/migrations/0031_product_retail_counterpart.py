@@ -0,0 +1,73 @@
+# Розничный аналог оптового товара, вычисляемый пакетно после обмена
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def populate_retail_counterpart(apps, schema_editor):
+    """
+    Заполняет retail_counterpart оптовых товаров (как catalog.counterparts) и
+    главное фото оптовых товаров без своих фото по найденной паре.
+    """
+    Product = apps.get_model('catalog', 'Product')
+    ProductImage = apps.get_model('catalog', 'ProductImage')
+
+    by_external_id, by_base, by_article = {}, {}, {}
+
+    def best(index, key, rank, product_id):
+        if key not in index or rank > index[key][0]:
+            index[key] = (rank, product_id)
+
+    rows = Product.objects.filter(catalog_type='retail').values_list('id', 'external_id', 'article', 'price', 'is_active')
+    for product_id, external_id, article, price, is_active in rows.iterator():
+        rank = (price, is_active, product_id)
+        if external_id:
+            by_external_id[external_id] = product_id
+            if '#' in external_id:
+                best(by_base, external_id.split('#', 1)[0], rank, product_id)
+        if article:
+            best(by_article, article, rank, product_id)
+
+    def find(external_id, article):
+        eid = (external_id or '').strip()
+        if eid:
+            if eid in by_external_id:
+                return by_external_id[eid]
+            if '#' in eid:
+                base = eid.split('#', 1)[0]
+                if base in by_external_id:
+                    return by_external_id[base]
+                if base in by_base:
+                    return by_base[base][1]
+        art = (article or '').strip()
+        if art and art in by_article:
+            return by_article[art][1]
+        return None
+
+    first_image = {}
+    images = ProductImage.objects.order_by('product_id', '-is_main', 'order', 'id').values_list('product_id', 'id')
+    for product_id, image_id in images.iterator():
+        first_image.setdefault(product_id, image_id)
+
+    products = []
+    for product in Product.objects.filter(catalog_type='wholesale').only('id', 'external_id', 'article').iterator():
+        product.retail_counterpart_id = find(product.external_id, product.article)
+        product.main_image_id = first_image.get(product.pk) or first_image.get(product.retail_counterpart_id)
+        products.append(product)
+    Product.objects.bulk_update(products, ['retail_counterpart', 'main_image'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0030_product_main_image'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='retail_counterpart',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='wholesale_counterparts', to='catalog.product', verbose_name='Розничный аналог'),
+        ),
+        migrations.RunPython(populate_retail_counterpart, migrations.RunPython.noop),
+    ]
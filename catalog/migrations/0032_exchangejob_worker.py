@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalog', '0031_product_retail_counterpart'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exchangejob',
+            name='worker',
+            field=models.CharField(blank=True, help_text='host:pid процесса, взявшего задание: пока он жив, задание не перезапускается', max_length=255, verbose_name='Воркер'),
+        ),
+    ]
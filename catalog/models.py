@@ -1,6 +1,8 @@
 from django.db import models
+from django.db.models.signals import post_delete, post_save
 from django.urls import reverse
 from mptt.models import MPTTModel, TreeForeignKey
+from mptt.signals import node_moved
 from django.utils.text import slugify
 from transliterate import translit, detect_language
 import os
@@ -16,6 +18,18 @@ def transliterate_slug(text):
     return slugify(text, allow_unicode=False)
 
 
+def _invalidate_category_keywords():
+    """Сбрасывает скомпилированные наборы ключевых слов категорий в этом процессе."""
+    from .services import invalidate_keyword_matchers
+    invalidate_keyword_matchers()
+
+
+def _bump_category_tree():
+    """Помечает снимок дерева категорий (catalog.category_tree) устаревшим."""
+    from .category_tree import bump_category_tree_version
+    bump_category_tree_version()
+
+
 def category_image_path(instance, filename):
     """Генерация пути для изображений категории."""
     # Используем slug категории вместо оригинального имени файла
@@ -37,6 +51,8 @@ class Category(MPTTModel):
     """Категория товаров с поддержкой неограниченной вложенности."""
     name = models.CharField('Название', max_length=200)
     slug = models.SlugField('URL', max_length=200, unique=True, blank=True)
+    # Путь slug от корня 'a/b/c' для URL (пересчитывается для поддерева при смене slug или родителя)
+    full_path = models.CharField('Полный путь', max_length=1000, blank=True, editable=False)
     parent = TreeForeignKey(
         'self', 
         on_delete=models.CASCADE, 
@@ -77,20 +93,70 @@ class Category(MPTTModel):
 
     def save(self, *args, **kwargs):
         if not self.slug:
-            base_slug = transliterate_slug(self.name)
-            slug = base_slug
-            counter = 1
-            # Проверяем уникальность slug
-            while Category.objects.filter(slug=slug).exclude(pk=self.pk).exists():
-                slug = f'{base_slug}-{counter}'
-                counter += 1
-            self.slug = slug
+            from .slugs import allocate_slugs
+            self.slug = allocate_slugs(Category, [transliterate_slug(self.name)], exclude_pk=self.pk)[0]
+        adding = self._state.adding
+        old_path = self.full_path
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or {'slug', 'parent'} & set(update_fields):
+            self.full_path = self.build_full_path()
+            if update_fields is not None and self.full_path != old_path:
+                kwargs['update_fields'] = list(update_fields) + ['full_path']
         super().save(*args, **kwargs)
+        if not adding and self.full_path != old_path:
+            self.refresh_descendant_paths()
+        _invalidate_category_keywords()
+        _bump_category_tree()
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        _invalidate_category_keywords()
+        _bump_category_tree()
+        _recompute_category_counts()
+        return result
+
+    def get_slug_path(self):
+        """Полный путь slug 'a/b/c' из снимка дерева категорий (без запросов)."""
+        from .category_tree import category_tree
+        tree = category_tree()
+        if self.pk in tree:
+            return tree.slug_path(self.pk)
+        # Категории еще нет в снимке (например, не сохранена)
+        return '/'.join(cat.slug for cat in self.get_ancestors(include_self=True))
+
+    def build_full_path(self):
+        """Путь slug 'a/b/c': full_path родителя + slug."""
+        if not self.parent_id:
+            return self.slug
+        parent = self.parent
+        return f'{parent.full_path or parent.get_slug_path()}/{self.slug}'
+
+    def refresh_descendant_paths(self):
+        """
+        Пересчитывает full_path потомков от full_path этой категории.
+
+        Обход по parent_id (а не по lft/rght), поэтому работает и до перестройки
+        MPTT: запрос на уровень дерева и bulk_update измененных путей.
+        """
+        paths = {self.pk: self.full_path}
+        changed = []
+        frontier = [self.pk]
+        while frontier:
+            children = list(Category.objects.filter(parent_id__in=frontier).only('id', 'slug', 'parent_id', 'full_path'))
+            frontier = []
+            for child in children:
+                path = f'{paths[child.parent_id]}/{child.slug}'
+                paths[child.pk] = path
+                frontier.append(child.pk)
+                if child.full_path != path:
+                    child.full_path = path
+                    changed.append(child)
+        if changed:
+            Category.objects.bulk_update(changed, ['full_path'], batch_size=500)
+        return len(changed)
 
     def get_absolute_url(self):
-        ancestors = self.get_ancestors(include_self=True)
-        path = '/'.join([cat.slug for cat in ancestors])
-        return reverse('catalog:category', kwargs={'path': path})
+        return reverse('catalog:category', kwargs={'path': self.full_path or self.get_slug_path()})
 
     def get_meta_title(self):
         return self.meta_title or f'{self.name} - купить в каталоге'
@@ -106,24 +172,68 @@ class Category(MPTTModel):
 
     @property
     def product_count(self):
-        """Количество товаров в категории и её подкатегориях (только retail)."""
+        """Количество видимых товаров retail в категории и её подкатегориях (CategoryProductCount)."""
         # Если уже посчитано (например, в HomeView), используем кэшированное значение
         if hasattr(self, '_product_count'):
             return self._product_count
-        
-        # ВАЖНО: НЕ используем кеширование - всегда получаем актуальные данные из БД
-        # Это гарантирует, что количество товаров всегда корректное
-        descendants = self.get_descendants(include_self=True)
-        # Преобразуем QuerySet в список ID для более надежной работы
-        descendant_ids = list(descendants.values_list('id', flat=True))
-        if not descendant_ids:
-            return 0
-        
-        count = Product.for_site_catalog('retail').filter(
-            category_id__in=descendant_ids,
-        ).count()
-        
-        return count
+        try:
+            # Загружено select_related('counts') — без запроса
+            return self.counts.retail_total
+        except CategoryProductCount.DoesNotExist:
+            from .category_counts import category_count
+            return category_count(self)
+
+
+class CategoryProductCount(models.Model):
+    """
+    Счетчики товаров категории: прямые (в самой категории) и по поддереву.
+
+    Пересчитываются целиком (catalog.category_counts) после обмена, импорта,
+    обновления остатков и перемещения категорий; сохранение и удаление одного
+    товара сдвигают счетчики его категории и предков.
+    """
+    category = models.OneToOneField(
+        Category,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='counts',
+        verbose_name='Категория'
+    )
+    retail_direct = models.PositiveIntegerField('Розница (в категории)', default=0)
+    retail_total = models.PositiveIntegerField('Розница (с подкатегориями)', default=0)
+    wholesale_direct = models.PositiveIntegerField('Опт (в категории)', default=0)
+    wholesale_total = models.PositiveIntegerField('Опт (с подкатегориями)', default=0)
+    in_stock_direct = models.PositiveIntegerField('Опт в наличии (в категории)', default=0)
+    in_stock_total = models.PositiveIntegerField('Опт в наличии (с подкатегориями)', default=0)
+    updated_at = models.DateTimeField('Пересчитано', auto_now=True)
+
+    class Meta:
+        verbose_name = 'Счетчики товаров категории'
+        verbose_name_plural = 'Счетчики товаров категорий'
+
+    def __str__(self):
+        return f'{self.category_id}: {self.retail_total}/{self.wholesale_total}'
+
+
+def _recompute_category_counts(**kwargs):
+    """Пересчитывает счетчики товаров категорий (поддеревья изменились)."""
+    from .category_counts import safe_recompute_category_counts
+    safe_recompute_category_counts()
+
+
+def _category_moved(sender, instance, **kwargs):
+    # move_to/move_node не вызывают save — путь переносимой ветки пересчитываем здесь
+    path = instance.build_full_path()
+    if path != instance.full_path:
+        instance.full_path = path
+        Category.objects.filter(pk=instance.pk).update(full_path=path)
+        instance.refresh_descendant_paths()
+    _bump_category_tree()
+    _recompute_category_counts()
+
+
+# Перенос категории (save со сменой parent или move_to) меняет пути и счетчики поддеревьев
+node_moved.connect(_category_moved, sender=Category, dispatch_uid='catalog_category_moved')
 
 
 class Product(models.Model):
@@ -159,6 +269,7 @@ class Product(models.Model):
     name = models.CharField('Название', max_length=500)
     slug = models.SlugField('URL', max_length=500, unique=True, blank=True)
     external_id = models.CharField('ID из 1С', max_length=255, blank=True, null=True, db_index=True, help_text='Уникальный идентификатор товара из 1С (уникален в комбинации с catalog_type)')
+    offer_fingerprint = models.CharField('Отпечаток предложения 1С', max_length=40, blank=True, editable=False, help_text='Хеш полей последнего примененного предложения offers.xml; неизменившиеся предложения не перезаписываются')
     supplier_article = models.CharField('Артикул', max_length=100, blank=True, db_index=True)
     article = models.CharField('Кросс-номер', max_length=100, blank=True, db_index=True)
     brand = models.CharField('Бренд', max_length=200, blank=True, db_index=True)
@@ -197,6 +308,28 @@ class Product(models.Model):
     applicability = models.TextField('Применимость', blank=True, help_text='Марки и модели техники')
     cross_numbers = models.TextField('Кросс-номера', blank=True, help_text='Аналоги и взаимозаменяемые номера')
     
+    # Розничная пара оптового товара, вычисляется после обмена (см. counterparts)
+    retail_counterpart = models.ForeignKey(
+        'self',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        editable=False,
+        related_name='wholesale_counterparts',
+        verbose_name='Розничный аналог'
+    )
+
+    # Главное фото: свое или, у оптового товара без фото, розничного аналога (см. product_images)
+    main_image = models.ForeignKey(
+        'ProductImage',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        editable=False,
+        related_name='+',
+        verbose_name='Главное изображение'
+    )
+
     # Farpost интеграция
     farpost_url = models.URLField('Ссылка на Farpost', blank=True)
     
@@ -262,62 +395,95 @@ class Product(models.Model):
         """
         return (self.supplier_article or '').strip()
 
+    # Поля, от которых зависит выбор розничной пары (см. counterparts)
+    COUNTERPART_FIELDS = ('catalog_type', 'external_id', 'article', 'price', 'is_active')
+
+    # Поля, от которых зависит вклад товара в счетчики категорий (см. category_counts)
+    COUNT_FIELDS = ('category_id', 'catalog_type', 'is_active', 'quantity', 'availability')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._counterpart_key = instance._get_counterpart_key()
+        instance._count_state = instance._get_count_state()
+        return instance
+
+    def _get_counterpart_key(self):
+        # __dict__, а не getattr: отложенные (only/defer) поля не догружаются
+        return tuple(self.__dict__.get(name) for name in self.COUNTERPART_FIELDS)
+
+    def _get_count_state(self):
+        """(category_id, вклад в счетчики) или None, если нужные поля отложены (only/defer)."""
+        if any(name not in self.__dict__ for name in self.COUNT_FIELDS):
+            return None
+        from .category_counts import product_visibility
+        return (
+            self.category_id,
+            product_visibility(self.catalog_type, self.is_active, self.quantity, self.availability),
+        )
+
     def save(self, *args, **kwargs):
         if not self.slug:
+            from .slugs import allocate_slugs
             base_slug = transliterate_slug(f'{self.name}-{self.article}' if self.article else self.name)
-            slug = base_slug
-            counter = 1
-            while Product.objects.filter(slug=slug).exclude(pk=self.pk).exists():
-                slug = f'{base_slug}-{counter}'
-                counter += 1
-            self.slug = slug
+            self.slug = allocate_slugs(Product, [base_slug], exclude_pk=self.pk)[0]
+
+        # Товар из админки или скрипта получает пару сразу, а не после следующего обмена
+        key = self._get_counterpart_key()
+        update_fields = kwargs.get('update_fields')
+        resolve = self._state.adding or key != getattr(self, '_counterpart_key', None)
+        if update_fields is not None and not set(update_fields) & set(self.COUNTERPART_FIELDS):
+            resolve = False
+        previous_counterpart_id = self.retail_counterpart_id
+        if resolve:
+            from .counterparts import retail_counterpart_id_for
+            if self.catalog_type == 'wholesale':
+                self.retail_counterpart_id = retail_counterpart_id_for(self.external_id, self.article)
+            else:
+                self.retail_counterpart_id = None
+            if update_fields is not None and self.retail_counterpart_id != previous_counterpart_id:
+                kwargs['update_fields'] = [*update_fields, 'retail_counterpart']
+
         super().save(*args, **kwargs)
+        self._counterpart_key = key
+
+        if resolve:
+            if self.catalog_type == 'retail':
+                from .counterparts import resolve_wholesale_counterparts_of
+                resolve_wholesale_counterparts_of(self)
+            elif self.retail_counterpart_id != previous_counterpart_id:
+                from .product_images import refresh_main_images
+                refresh_main_images([self.pk])
 
     def get_absolute_url(self):
-        if self.category:
-            ancestors = self.category.get_ancestors(include_self=True)
-            path = '/'.join([cat.slug for cat in ancestors])
+        if self.category_id:
+            # Списки, sitemap и выгрузки загружают категорию через select_related('category')
+            category = self.category
+            path = category.full_path or category.get_slug_path()
             return reverse('catalog:product', kwargs={'category_path': path, 'slug': self.slug})
         return reverse('catalog:product_simple', kwargs={'slug': self.slug})
 
     def get_main_image(self):
         """Получить главное изображение товара.
-        Для оптовых товаров без собственных фото берём фото из розничного аналога.
+        Для оптовых товаров без собственных фото — фото розничного аналога.
+        Ссылка денормализована в main_image (см. product_images); в списках
+        загружайте ее через select_related('main_image').
         """
-        main = self.images.filter(is_main=True).first()
-        if main:
-            return main
-        first = self.images.first()
-        if first:
-            return first
-        # Фоллбэк: если это оптовый товар без фото, ищем фото у розничного аналога
-        if self.catalog_type == 'wholesale' and self.external_id:
-            retail = Product.objects.filter(
-                external_id=self.external_id,
-                catalog_type='retail'
-            ).first()
-            if retail:
-                main = retail.images.filter(is_main=True).first()
-                if main:
-                    return main
-                return retail.images.first()
-        return None
+        if self.main_image_id is None:
+            return None
+        return self.main_image
 
     def get_all_images(self):
         """Получить все изображения товара.
         Для оптовых товаров без собственных фото берём фото из розничного аналога.
         """
-        own_images = self.images.all().order_by('-is_main', 'order')
-        if own_images.exists():
+        # Meta.ordering ProductImage — ('-is_main', 'order'); all() использует prefetch_related('images')
+        own_images = self.images.all()
+        if own_images:
             return own_images
-        # Фоллбэк: если это оптовый товар без фото, ищем фото у розничного аналога
-        if self.catalog_type == 'wholesale' and self.external_id:
-            retail = Product.objects.filter(
-                external_id=self.external_id,
-                catalog_type='retail'
-            ).first()
-            if retail:
-                return retail.images.all().order_by('-is_main', 'order')
+        counterpart = self.get_retail_counterpart()
+        if counterpart is not None and counterpart.pk != self.pk:
+            return counterpart.images.all()
         return own_images
 
     def get_retail_counterpart(self):
@@ -325,37 +491,14 @@ class Product(models.Model):
         Розничная запись того же товара из 1С.
         Для catalog_type=retail возвращает self; для wholesale — пару из основного каталога
         (тот же external_id, иначе база UUID до «#», иначе совпадение по артикулу).
+        Пара вычисляется пакетно после обмена и хранится в retail_counterpart (см. counterparts);
+        в списках загружайте ее через select_related('retail_counterpart').
         """
         if self.catalog_type == 'retail':
             return self
-        eid = (self.external_id or '').strip()
-        if eid:
-            r = Product.objects.filter(catalog_type='retail', external_id=eid).first()
-            if r:
-                return r
-            if '#' in eid:
-                base = eid.split('#', 1)[0]
-                r = Product.objects.filter(catalog_type='retail', external_id=base).first()
-                if r:
-                    return r
-                r = (
-                    Product.objects.filter(
-                        catalog_type='retail',
-                        external_id__startswith=f'{base}#',
-                    )
-                    .order_by('-price', '-is_active', '-id')
-                    .first()
-                )
-                if r:
-                    return r
-        art = (self.article or '').strip()
-        if art:
-            return (
-                Product.objects.filter(catalog_type='retail', article=art)
-                .order_by('-price', '-is_active', '-id')
-                .first()
-            )
-        return None
+        if self.retail_counterpart_id is None:
+            return None
+        return self.retail_counterpart
 
     def get_meta_title(self):
         if self.meta_title:
@@ -600,7 +743,12 @@ class ProductImage(models.Model):
         # Автоматический alt
         if not self.alt:
             self.alt = f'Фото {self.product.article} {self.product.brand}'.strip()
+        previous_product_id = None
+        if self.pk:
+            previous_product_id = ProductImage.objects.filter(pk=self.pk).values_list('product_id', flat=True).first()
         super().save(*args, **kwargs)
+        from .product_images import refresh_main_images
+        refresh_main_images([self.product_id, previous_product_id])
 
     def get_image_url(self):
         """Возвращает полный URL изображения."""
@@ -609,6 +757,17 @@ class ProductImage(models.Model):
         return None
 
 
+def _product_image_deleted(sender, instance, **kwargs):
+    # Ссылки на удаленное фото обнулены (SET_NULL) — выбираем следующее
+    from .product_images import refresh_main_images
+    refresh_main_images([instance.product_id])
+
+
+# Сигнал, а не ProductImage.delete: queryset.delete() (действие админки «Удалить выбранные»,
+# каскад при удалении товара) delete() отдельных объектов не вызывает
+post_delete.connect(_product_image_deleted, sender=ProductImage, dispatch_uid='catalog_product_image_deleted')
+
+
 class Brand(models.Model):
     """Бренды товаров."""
     name = models.CharField('Название', max_length=200, unique=True)
@@ -695,6 +854,7 @@ class SyncLog(models.Model):
     OPERATION_TYPE_CHOICES = [
         ('file_upload', 'Загрузка файла'),
         ('api_sync', 'API синхронизация'),
+        ('stock_update', 'Остатки и цены'),
     ]
     
     STATUS_CHOICES = [
@@ -725,6 +885,8 @@ class SyncLog(models.Model):
     
     created_at = models.DateTimeField('Дата синхронизации', auto_now_add=True)
     processing_time = models.FloatField('Время обработки (сек)', default=0.0)
+    # Время, SQL-запросы и пик памяти по фазам обмена (catalog.exchange_profiler)
+    phase_profile = models.JSONField('Профиль по фазам', default=dict, blank=True)
 
     class Meta:
         verbose_name = 'Лог синхронизации'
@@ -784,6 +946,139 @@ class OneCExchangeLog(models.Model):
         return f'{self.request_path} - {self.status} - {self.created_at}'
 
 
+class ExchangeJob(models.Model):
+    """
+    Задание фоновой обработки файла обмена CommerceML.
+
+    mode=file/import только ставят задание в очередь, обрабатывает его
+    management-команда run_exchange_jobs; 1С опрашивает mode=import и получает
+    progress/success/failure. checkpoint — индекс следующего необработанного
+    предложения offers.xml: после падения воркера обработка продолжается с него.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'В очереди'),
+        ('running', 'Выполняется'),
+        ('success', 'Успешно'),
+        ('failure', 'Ошибка'),
+    ]
+
+    filename = models.CharField('Имя файла', max_length=255)
+    file_path = models.CharField('Путь к файлу', max_length=1024)
+    member = models.CharField(
+        'Файл в архиве', max_length=255, blank=True,
+        help_text='Имя XML внутри ZIP-архива: файл читается прямо из архива, без распаковки'
+    )
+    session = models.CharField('Сессия обмена', max_length=128, blank=True, db_index=True)
+    is_ready = models.BooleanField(
+        'Файл загружен полностью', default=False,
+        help_text='Выставляется запросом mode=import: до него 1С может дописывать файл частями'
+    )
+    status = models.CharField('Статус', max_length=20, choices=STATUS_CHOICES, default='pending')
+    progress = models.PositiveSmallIntegerField('Прогресс, %', default=0)
+    checkpoint = models.PositiveIntegerField('Обработано предложений', default=0)
+    total = models.PositiveIntegerField('Всего предложений', default=0)
+    attempts = models.PositiveSmallIntegerField('Попыток', default=0)
+    worker = models.CharField(
+        'Воркер', max_length=255, blank=True,
+        help_text='host:pid процесса, взявшего задание: пока он жив, задание не перезапускается'
+    )
+    result = models.JSONField('Результат', default=dict, blank=True)
+    error = models.TextField('Ошибка', blank=True)
+
+    created_at = models.DateTimeField('Создано', auto_now_add=True)
+    updated_at = models.DateTimeField('Обновлено', auto_now=True)
+    started_at = models.DateTimeField('Начато', null=True, blank=True)
+    finished_at = models.DateTimeField('Завершено', null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Задание обмена с 1С'
+        verbose_name_plural = 'Задания обмена с 1С'
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+            models.Index(fields=['filename', 'session']),
+        ]
+
+    def __str__(self):
+        return f'{self.filename} - {self.status} - {self.progress}%'
+
+
+class ExchangeFile(models.Model):
+    """
+    Реестр файлов обмена с 1С по содержимому (SHA-256).
+
+    Хеш считается по ходу приема файла. Побайтно тот же пакет, уже успешно
+    примененный под тем же именем, повторно не обрабатывается: 1С часто
+    присылает его снова после таймаута. Для XML внутри ZIP-архива хранится
+    хеш архива и имя файла в нем.
+    """
+    KIND_CHOICES = [
+        ('import', 'Каталог (import)'),
+        ('offers', 'Предложения (offers)'),
+        ('archive', 'ZIP-архив'),
+        ('other', 'Другое'),
+    ]
+    STATUS_CHOICES = [
+        ('received', 'Получен'),
+        ('success', 'Применен'),
+        ('failure', 'Ошибка'),
+    ]
+
+    sha256 = models.CharField('SHA-256', max_length=64)
+    filename = models.CharField('Имя файла', max_length=255)
+    file_path = models.CharField('Путь к файлу', max_length=1024, blank=True)
+    size = models.BigIntegerField('Размер, байт', default=0)
+    kind = models.CharField('Тип', max_length=16, choices=KIND_CHOICES, default='other')
+    status = models.CharField('Статус', max_length=16, choices=STATUS_CHOICES, default='received')
+    result = models.JSONField('Результат', default=dict, blank=True)
+    skipped = models.PositiveIntegerField(
+        'Повторов пропущено', default=0,
+        help_text='Сколько раз тот же пакет приходил снова и не обрабатывался'
+    )
+
+    created_at = models.DateTimeField('Получен', auto_now_add=True)
+    updated_at = models.DateTimeField('Обновлено', auto_now=True)
+    processed_at = models.DateTimeField('Обработан', null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Файл обмена с 1С'
+        verbose_name_plural = 'Реестр файлов обмена с 1С'
+        ordering = ['-created_at']
+        unique_together = [['sha256', 'filename']]
+
+    def __str__(self):
+        return f'{self.filename} ({self.sha256[:12]}) - {self.status}'
+
+
+class ExchangeStagingKey(models.Model):
+    """
+    Ключи товаров (external_id и артикулы), пришедшие в текущем обмене с 1С.
+
+    Промежуточная таблица для скрытия отсутствующих в обмене товаров: ключи
+    записываются пачкой под одним run_id, а скрытие выполняется одним
+    UPDATE ... WHERE NOT EXISTS вместо огромных списков external_id__in.
+    После прогона строки run_id удаляются.
+    """
+    KIND_CHOICES = [
+        ('external_id', 'ID из 1С'),
+        ('article', 'Артикул'),
+    ]
+
+    run_id = models.CharField('Прогон', max_length=32)
+    kind = models.CharField('Тип ключа', max_length=16, choices=KIND_CHOICES)
+    value = models.CharField('Значение', max_length=255)
+
+    class Meta:
+        verbose_name = 'Ключ товара из обмена'
+        verbose_name_plural = 'Ключи товаров из обмена'
+        indexes = [
+            models.Index(fields=['run_id', 'kind', 'value']),
+        ]
+
+    def __str__(self):
+        return f'{self.run_id}: {self.kind}={self.value}'
+
+
 class FarpostAPISettings(models.Model):
     """Настройки API Farpost для синхронизации товаров."""
     login = models.CharField('Логин', max_length=255, blank=True, help_text='Логин для входа на Farpost (необязательно, если используется ключ)')
@@ -938,4 +1233,36 @@ class WholesaleProduct(Product):
         proxy = True
         app_label = 'partners'
         verbose_name = 'Оптовый товар'
-        verbose_name_plural = 'Оптовые товары (импорт для партнёров)'
\ No newline at end of file
+        verbose_name_plural = 'Оптовые товары (импорт для партнёров)'
+
+
+def _product_saved(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    # Счетчики категорий не отстают от списков после правки товара в админке / быстрого добавления
+    if raw:
+        return
+    if update_fields is not None and not set(update_fields) & {'category', *Product.COUNT_FIELDS}:
+        return
+    from .category_counts import safe_apply_product_count_change, safe_recompute_category_counts
+    before = None if created else getattr(instance, '_count_state', None)
+    after = instance._get_count_state()
+    instance._count_state = after
+    if after is None or (before is None and not created):
+        # Прежнее или новое состояние неизвестно (отложенные поля) — пересчитываем целиком
+        safe_recompute_category_counts()
+    else:
+        safe_apply_product_count_change(before, after)
+
+
+def _product_deleted(sender, instance, **kwargs):
+    from .category_counts import safe_apply_product_count_change, safe_recompute_category_counts
+    state = getattr(instance, '_count_state', None)
+    if state is None:
+        safe_recompute_category_counts()
+    else:
+        safe_apply_product_count_change(state, None)
+
+
+# Proxy-модель шлет сигналы со своим sender — подключаем обе
+for _sender in (Product, WholesaleProduct):
+    post_save.connect(_product_saved, sender=_sender, dispatch_uid=f'catalog_product_saved_{_sender.__name__}')
+    post_delete.connect(_product_deleted, sender=_sender, dispatch_uid=f'catalog_product_deleted_{_sender.__name__}')
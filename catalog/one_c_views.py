@@ -11,13 +11,20 @@ from django.http import JsonResponse, HttpResponse
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
 from django.db import transaction
+from django.db.models import Q
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.utils import timezone
 from django.core.mail import send_mail
 
 from .models import Product, ProductCharacteristic, Category, SyncLog
+from .category_counts import safe_recompute_category_counts
+from .counterparts import safe_resolve_retail_counterparts
+from .product_upsert import ALWAYS, FILL_NULL, IF_PRESENT, upsert_products, upsert_supported
 from .serializers import validate_sync_request, validate_product
+from .stock_updates import (
+    STOCK_FORMATS, StockFormatError, apply_stock_updates, detect_stock_format, iter_stock_rows, request_stream,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -227,6 +234,59 @@ def get_or_create_category(category_name):
     return category
 
 
+def _new_product(validated_data):
+    """Новый товар из данных API (sku — и external_id для совместимости, и article)."""
+    sku = validated_data['sku']
+    return Product(
+        external_id=sku,
+        article=sku,
+        name=validated_data['name'],
+        price=validated_data['price'],
+        quantity=validated_data.get('stock', 0),
+        is_active=validated_data.get('is_active', True),
+    )
+
+
+def _apply_product_fields(product, validated_data, was_created, category_cache=None):
+    """Переносит поля товара из данных API в карточку (без сохранения)."""
+    sku = validated_data['sku']
+    # Обновляем external_id, если его не было
+    if not product.external_id:
+        product.external_id = sku
+    # Обновляем article, если его не было или он отличается
+    if not product.article or product.article != sku:
+        product.article = sku
+    
+    product.name = validated_data['name']
+    product.price = validated_data['price']
+    product.quantity = validated_data.get('stock', 0)
+    product.is_active = validated_data.get('is_active', True)
+    
+    if validated_data.get('description'):
+        product.description = validated_data['description']
+    
+    if validated_data.get('old_price'):
+        product.old_price = validated_data['old_price']
+    
+    # Категория: не перетираем ручную категорию у существующих товаров.
+    category_name = validated_data.get('category')
+    if category_name and (was_created or not product.category_id):
+        if category_cache is None:
+            category = get_or_create_category(category_name)
+        else:
+            if category_name not in category_cache:
+                category_cache[category_name] = get_or_create_category(category_name)
+            category = category_cache[category_name]
+        if category:
+            product.category = category
+    
+    # Обновляем наличие
+    if product.quantity > 0:
+        product.availability = 'in_stock'
+    else:
+        product.availability = 'out_of_stock'
+
+
 def process_product(product_data, sync_log=None):
     """Обработка одного товара. Возвращает (product, error, was_created)."""
     try:
@@ -258,50 +318,9 @@ def process_product(product_data, sync_log=None):
         
         was_created = existing_product is None
         
-        if was_created:
-            # Создаем новый товар
-            product = Product(
-                external_id=sku,  # Используем sku как external_id для совместимости
-                article=sku,      # Также сохраняем в article
-                name=validated_data['name'],
-                price=validated_data['price'],
-                quantity=validated_data.get('stock', 0),
-                is_active=validated_data.get('is_active', True),
-            )
-        else:
-            # Обновляем существующий товар
-            product = existing_product
-            # Обновляем external_id, если его не было
-            if not product.external_id:
-                product.external_id = sku
-            # Обновляем article, если его не было или он отличается
-            if not product.article or product.article != sku:
-                product.article = sku
-        
-        # Обновляем поля товара
-        product.name = validated_data['name']
-        product.price = validated_data['price']
-        product.quantity = validated_data.get('stock', 0)
-        product.is_active = validated_data.get('is_active', True)
-        
-        if validated_data.get('description'):
-            product.description = validated_data['description']
-        
-        if validated_data.get('old_price'):
-            product.old_price = validated_data['old_price']
-        
-        # Категория: не перетираем ручную категорию у существующих товаров.
-        if validated_data.get('category') and (was_created or not product.category_id):
-            category = get_or_create_category(validated_data['category'])
-            if category:
-                product.category = category
-        
-        # Обновляем наличие
-        if product.quantity > 0:
-            product.availability = 'in_stock'
-        else:
-            product.availability = 'out_of_stock'
+        product = _new_product(validated_data) if was_created else existing_product
         
+        _apply_product_fields(product, validated_data, was_created)
         product.save()
         
         # Обработка характеристик
@@ -337,6 +356,141 @@ def process_product(product_data, sync_log=None):
         return None, error_msg, False
 
 
+# Политики upsert для товаров API — те же правила, что в _apply_product_fields
+API_UPSERT_POLICIES = {
+    'name': ALWAYS,
+    'article': ALWAYS,
+    'price': ALWAYS,
+    'quantity': ALWAYS,
+    'availability': ALWAYS,
+    'is_active': ALWAYS,
+    'description': IF_PRESENT,
+    'old_price': IF_PRESENT,
+    'category': FILL_NULL,
+}
+
+
+def process_products_batch(products_data, sync_log=None):
+    """
+    Обработка списка товаров API пачкой. Возвращает (created, updated, errors).
+
+    Существующие товары загружаются одним запросом (по external_id, затем по article,
+    как в process_product), а записываются одним INSERT ... ON CONFLICT по
+    (external_id, catalog_type) — см. product_upsert. Если база не поддерживает
+    upsert или пачка не записалась, товары обрабатываются по одному (process_product).
+    """
+    errors = []
+    valid = []
+    for product_data in products_data:
+        try:
+            valid.append((product_data, validate_product(product_data)))
+        except Exception as e:
+            error_msg = f"Ошибка валидации: {str(e)}"
+            logger.warning(error_msg)
+            if sync_log:
+                sync_log.errors.append({
+                    'sku': product_data.get('sku', 'unknown'),
+                    'error': error_msg
+                })
+            errors.append(error_msg)
+    if not valid:
+        return 0, 0, errors
+    if not upsert_supported():
+        return _process_products_one_by_one([data for data, _ in valid], sync_log, errors)
+
+    skus = {validated_data['sku'] for _, validated_data in valid}
+    by_external_id = {}
+    by_article = {}
+    for product in Product.objects.filter(Q(external_id__in=skus) | Q(article__in=skus)):
+        if product.external_id in skus:
+            by_external_id.setdefault(product.external_id, product)
+        if product.article in skus:
+            by_article.setdefault(product.article, product)
+
+    created = updated = 0
+    category_cache = {}
+    products = {}  # id(product) -> product, без повторов
+    rekeyed = set()  # у карточки не было external_id: ключа upsert в базе еще нет
+    characteristics = {}
+    for _, validated_data in valid:
+        sku = validated_data['sku']
+        product = by_external_id.get(sku) or by_article.get(sku)
+        was_created = product is None
+        if was_created:
+            product = _new_product(validated_data)
+            created += 1
+        else:
+            if not product.external_id and product.pk is not None:
+                rekeyed.add(id(product))
+            updated += 1
+        _apply_product_fields(product, validated_data, was_created, category_cache)
+        by_external_id.setdefault(product.external_id, product)
+        by_article.setdefault(product.article, product)
+        products[id(product)] = product
+        if validated_data.get('characteristics'):
+            characteristics[id(product)] = validated_data['characteristics']
+
+    try:
+        with transaction.atomic():
+            upsert_products(
+                [product for key, product in products.items() if key not in rekeyed],
+                API_UPSERT_POLICIES,
+            )
+            for key in rekeyed:
+                products[key].save()
+    except Exception as e:
+        logger.warning(f"API 1С: пачка из {len(valid)} товаров не записалась целиком ({e}), сохраняем по одному")
+        return _process_products_one_by_one([data for data, _ in valid], sync_log, errors)
+
+    if characteristics:
+        _replace_characteristics_batch(products, characteristics)
+    return created, updated, errors
+
+
+def _process_products_one_by_one(products_data, sync_log, errors):
+    created = updated = 0
+    for product_data in products_data:
+        product, error, was_created = process_product(product_data, sync_log=sync_log)
+        if product:
+            if was_created:
+                created += 1
+            else:
+                updated += 1
+        elif error:
+            errors.append(error)
+    return created, updated, errors
+
+
+def _replace_characteristics_batch(products, characteristics):
+    """Заменяет ProductCharacteristic товаров пачки (первичные ключи новых берутся из базы)."""
+    keys = {(products[key].external_id, products[key].catalog_type) for key in characteristics}
+    pk_by_key = {
+        (external_id, catalog_type): pk
+        for external_id, catalog_type, pk in Product.objects.filter(
+            external_id__in={external_id for external_id, _ in keys}
+        ).values_list('external_id', 'catalog_type', 'id')
+    }
+    rows = []
+    product_ids = set()
+    for key, chars in characteristics.items():
+        product = products[key]
+        product_id = product.pk or pk_by_key.get((product.external_id, product.catalog_type))
+        if product_id is None:
+            continue
+        product_ids.add(product_id)
+        rows.extend(
+            ProductCharacteristic(product_id=product_id, name=char_data['name'], value=char_data['value'], order=idx)
+            for idx, char_data in enumerate(chars)
+        )
+    try:
+        with transaction.atomic():
+            ProductCharacteristic.objects.filter(product_id__in=product_ids).delete()
+            ProductCharacteristic.objects.bulk_create(rows)
+    except Exception as char_error:
+        # Как в process_product: характеристики уже есть в поле product.characteristics
+        logger.warning(f"Не удалось обработать ProductCharacteristic для {len(product_ids)} товаров: {str(char_error)}")
+
+
 @csrf_exempt
 @require_http_methods(["POST"])
 def file_upload_view(request):
@@ -406,11 +560,7 @@ def file_upload_view(request):
             }, status=400)
         
         # Обработка товаров в транзакции
-        created_count = 0
-        updated_count = 0
-        errors = []
-        
-        # Создаем временный sync_log для передачи в process_product
+        # Создаем временный sync_log для передачи в process_products_batch
         temp_sync_log = SyncLog(
             operation_type='file_upload',
             status='processing',
@@ -418,15 +568,10 @@ def file_upload_view(request):
         )
         
         with transaction.atomic():
-            for product_data in products_data:
-                product, error, was_created = process_product(product_data, sync_log=temp_sync_log)
-                if product:
-                    if was_created:
-                        created_count += 1
-                    else:
-                        updated_count += 1
-                elif error:
-                    errors.append(error)
+            created_count, updated_count, errors = process_products_batch(products_data, sync_log=temp_sync_log)
+        if created_count or updated_count:
+            safe_recompute_category_counts()
+            safe_resolve_retail_counterparts()
         
         # Создание лога
         processing_time = time.time() - start_time
@@ -563,11 +708,7 @@ def one_c_api_view(request):
             }, status=400)
         
         # Обработка товаров в транзакции
-        created_count = 0
-        updated_count = 0
-        errors = []
-        
-        # Создаем временный sync_log для передачи в process_product
+        # Создаем временный sync_log для передачи в process_products_batch
         temp_sync_log = SyncLog(
             operation_type='api_sync',
             status='processing',
@@ -575,15 +716,10 @@ def one_c_api_view(request):
         )
         
         with transaction.atomic():
-            for product_data in products_data:
-                product, error, was_created = process_product(product_data, sync_log=temp_sync_log)
-                if product:
-                    if was_created:
-                        created_count += 1
-                    else:
-                        updated_count += 1
-                elif error:
-                    errors.append(error)
+            created_count, updated_count, errors = process_products_batch(products_data, sync_log=temp_sync_log)
+        if created_count or updated_count:
+            safe_recompute_category_counts()
+            safe_resolve_retail_counterparts()
         
         # Создание лога
         processing_time = time.time() - start_time
@@ -650,3 +786,86 @@ def one_c_api_view(request):
             'message': 'Внутренняя ошибка сервера',
             'error': error_message
         }, status=500)
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def stock_update_view(request):
+    """
+    Быстрое обновление только остатков и цен (CSV, NDJSON, XML).
+
+    Тело запроса — данные целиком или файл в поле file. Формат берется из
+    параметра format, имени файла или Content-Type. Товары ищутся по external_id
+    в обоих каталогах; остальные поля не меняются.
+    """
+    start_time = time.time()
+    has_access, error_message = check_token_auth(request)
+    if not has_access:
+        SyncLog.objects.create(
+            operation_type='stock_update',
+            status='unauthorized',
+            message=error_message,
+            request_ip=get_client_ip(request),
+            processing_time=time.time() - start_time,
+        )
+        return JsonResponse({'status': 'error', 'message': error_message}, status=401)
+
+    uploaded_file = request.FILES.get('file')
+    filename = uploaded_file.name if uploaded_file else ''
+    file_format = (request.GET.get('format') or '').lower() or detect_stock_format(filename, request.content_type)
+    if file_format not in STOCK_FORMATS:
+        return JsonResponse({
+            'status': 'error',
+            'message': f'Неподдерживаемый формат: {file_format}. Поддерживаются: CSV, NDJSON, XML'
+        }, status=400)
+    # Тело без multipart читаем потоком, а не через request.body (лимит DATA_UPLOAD_MAX_MEMORY_SIZE)
+    stream = uploaded_file if uploaded_file else request_stream(request)
+
+    try:
+        stats = apply_stock_updates(iter_stock_rows(stream, file_format))
+    except StockFormatError as e:
+        SyncLog.objects.create(
+            operation_type='stock_update',
+            status='error',
+            message=str(e),
+            request_ip=get_client_ip(request),
+            request_format=file_format.upper(),
+            filename=filename,
+            processing_time=time.time() - start_time,
+        )
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    except Exception as e:
+        logger.error(f'Ошибка обновления остатков: {e}', exc_info=True)
+        SyncLog.objects.create(
+            operation_type='stock_update',
+            status='error',
+            message=str(e),
+            request_ip=get_client_ip(request),
+            request_format=file_format.upper(),
+            filename=filename,
+            processing_time=time.time() - start_time,
+        )
+        return JsonResponse({
+            'status': 'error',
+            'message': 'Внутренняя ошибка сервера',
+            'error': str(e)
+        }, status=500)
+
+    status = 'success' if stats['updated'] or not stats['received'] else 'partial'
+    SyncLog.objects.create(
+        operation_type='stock_update',
+        status=status,
+        message=f"Остатки: строк {stats['received']}, не найдено Ид {stats['not_found']}",
+        processed_count=stats['received'],
+        updated_count=stats['updated'],
+        request_ip=get_client_ip(request),
+        request_format=file_format.upper(),
+        filename=filename,
+        processing_time=time.time() - start_time,
+    )
+    return JsonResponse({
+        'status': status,
+        'processed': stats['received'],
+        'updated': stats['updated'],
+        'not_found': stats['not_found'],
+    })
@@ -0,0 +1,115 @@
+"""
+Денормализованное главное изображение товара (Product.main_image).
+
+Product.get_main_image делал images.filter(is_main=True).first() и images.first():
+фильтр обходит prefetch_related('images'), поэтому каждая карточка сетки стоила
+двух запросов, а оптовая карточка без фото — еще поиска розничного аналога и его
+фото. Теперь ссылка на главное фото хранится в товаре: собственное фото (главное,
+иначе первое по порядку), а у оптового товара без фото — фото розничного аналога.
+Сетки читают его через select_related('main_image') без запросов на карточку.
+
+Ссылку поддерживают ProductImage.save и сигнал post_delete фото (в том числе
+массовая загрузка фото, инлайны админки, «Удалить выбранные» и каскадное удаление
+товара), пересчет розничных аналогов (Product.retail_counterpart, см. counterparts),
+заполнение пропусков после обмена с 1С и команда refresh_main_images.
+"""
+import logging
+
+from django.db.models import Exists, OuterRef, Q
+
+from .models import Product, ProductImage
+
+logger = logging.getLogger(__name__)
+
+# Товаров на один пакет запросов (ограничение числа параметров SQLite)
+MAIN_IMAGE_BATCH_SIZE = 500
+
+
+def _first_images(product_ids):
+    """{product_id: id главного фото} в порядке ProductImage.Meta.ordering (-is_main, order)."""
+    first = {}
+    rows = (
+        ProductImage.objects.filter(product_id__in=product_ids)
+        .order_by('product_id', '-is_main', 'order', 'id')
+        .values_list('product_id', 'id')
+    )
+    for product_id, image_id in rows:
+        first.setdefault(product_id, image_id)
+    return first
+
+
+def _refresh_batch(product_ids):
+    fields = ('id', 'catalog_type', 'retail_counterpart_id', 'main_image_id')
+    rows = {row['id']: row for row in Product.objects.filter(pk__in=product_ids).order_by().values(*fields)}
+    # Фото розничного товара показывает и оптовый аналог без своих фото
+    retail_ids = [product_id for product_id, row in rows.items() if row['catalog_type'] == 'retail']
+    if retail_ids:
+        for row in Product.objects.filter(
+            catalog_type='wholesale', retail_counterpart_id__in=retail_ids,
+        ).exclude(pk__in=list(rows)).order_by().values(*fields):
+            rows[row['id']] = row
+
+    main_images = _first_images(list(rows))
+
+    counterpart_ids = {
+        row['retail_counterpart_id'] for product_id, row in rows.items()
+        if product_id not in main_images and row['catalog_type'] == 'wholesale' and row['retail_counterpart_id']
+    }
+    if counterpart_ids:
+        retail_images = _first_images(list(counterpart_ids))
+        for product_id, row in rows.items():
+            if product_id in main_images or row['catalog_type'] != 'wholesale':
+                continue
+            if row['retail_counterpart_id'] in retail_images:
+                main_images[product_id] = retail_images[row['retail_counterpart_id']]
+
+    changed = [
+        Product(pk=product_id, main_image_id=main_images.get(product_id))
+        for product_id, row in rows.items()
+        if row['main_image_id'] != main_images.get(product_id)
+    ]
+    if changed:
+        Product.objects.bulk_update(changed, ['main_image'], batch_size=MAIN_IMAGE_BATCH_SIZE)
+    return len(changed)
+
+
+def refresh_main_images(product_ids):
+    """
+    Пересчитывает Product.main_image для товаров (и оптовых аналогов розничных из списка).
+
+    Возвращает число товаров, у которых ссылка изменилась.
+    """
+    product_ids = list(dict.fromkeys(pid for pid in product_ids if pid is not None))
+    updated = 0
+    for start in range(0, len(product_ids), MAIN_IMAGE_BATCH_SIZE):
+        updated += _refresh_batch(product_ids[start:start + MAIN_IMAGE_BATCH_SIZE])
+    return updated
+
+
+def refresh_missing_main_images():
+    """
+    Заполняет main_image у товаров без ссылки, для которых фото уже есть:
+    свои фото или фото розничного аналога у оптового товара (например, оптовая
+    строка создана обменом после загрузки фото в розницу).
+    """
+    own_images = ProductImage.objects.filter(product_id=OuterRef('pk'))
+    retail_images = ProductImage.objects.filter(product_id=OuterRef('retail_counterpart_id'))
+    product_ids = list(
+        Product.objects.filter(main_image__isnull=True)
+        .filter(Q(Exists(own_images)) | Q(catalog_type='wholesale') & Q(Exists(retail_images)))
+        .order_by()
+        .values_list('id', flat=True)
+    )
+    updated = refresh_main_images(product_ids)
+    if updated:
+        logger.info(f"Главное фото заполнено у {updated} товаров")
+    return updated
+
+
+def safe_refresh_missing_main_images():
+    """refresh_missing_main_images, который не роняет обмен (ошибка только в лог)."""
+    try:
+        return refresh_missing_main_images()
+    except Exception as e:
+        logger.warning(f"Не удалось обновить главные фото товаров: {e}", exc_info=True)
+        return 0
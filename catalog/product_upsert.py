@@ -0,0 +1,140 @@
+"""
+Пакетный upsert товаров по ключу (external_id, catalog_type).
+
+Каждое предложение 1С хранится двумя строками Product (retail и wholesale) с
+unique_together (external_id, catalog_type). Вместо поиска строки и отдельного
+сохранения пачка пишется одним INSERT ... ON CONFLICT(external_id, catalog_type)
+DO UPDATE (SQLite 3.24+, PostgreSQL) — на каждый каталог один запрос.
+
+Какие поля существующей строки обновлять, задает политика поля:
+
+- ALWAYS — всегда значение из обмена (остаток, цена, наличие);
+- IF_PRESENT — значение из обмена, только если оно не пустое (артикул, бренд);
+- FILL_NULL — только если в строке поле пустое (категория: ручную не трогаем).
+
+Поля без политики пишутся только при вставке новой строки — ручные поля
+админки (описание, SEO, slug, рекомендуемый) обмен не перетирает. Поля
+auto_now (updated_at) обновляются всегда.
+"""
+import logging
+
+from django.db import connections, models, router
+
+from .models import Product
+from .slugs import assign_slugs
+
+logger = logging.getLogger(__name__)
+
+ALWAYS = 'always'
+IF_PRESENT = 'if_present'
+FILL_NULL = 'fill_null'
+
+UPSERT_KEY = ('external_id', 'catalog_type')
+
+# Лимит параметров запроса, если драйвер не сообщает свой
+_DEFAULT_MAX_QUERY_PARAMS = 999
+
+
+def upsert_supported(using=None):
+    """База поддерживает INSERT ... ON CONFLICT DO UPDATE."""
+    connection = connections[using or router.db_for_write(Product)]
+    return connection.vendor in ('sqlite', 'postgresql')
+
+
+def allocate_product_slugs(products):
+    """Назначает slug новым товарам пачки (как Product.save, но фиксированным числом запросов)."""
+    assign_slugs(
+        products,
+        lambda product: f'{product.name}-{product.article}' if product.article else product.name,
+        fallback='product',
+    )
+
+
+def _max_query_params(connection):
+    if connection.vendor == 'sqlite':
+        connection.ensure_connection()
+        getlimit = getattr(connection.connection, 'getlimit', None)
+        if getlimit is not None:
+            import sqlite3
+            return getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+        return _DEFAULT_MAX_QUERY_PARAMS
+    if connection.vendor == 'postgresql':
+        return 65535
+    return connection.features.max_query_params or _DEFAULT_MAX_QUERY_PARAMS
+
+
+def _is_text(field):
+    return isinstance(field, (models.CharField, models.TextField))
+
+
+def _set_clause(field, policy, table, qn):
+    column = qn(field.column)
+    new = f'EXCLUDED.{column}'
+    old = f'{table}.{column}'
+    if policy == ALWAYS:
+        return f'{column} = {new}'
+    if policy == IF_PRESENT:
+        value = f"NULLIF({new}, '')" if _is_text(field) else new
+        return f'{column} = COALESCE({value}, {old})'
+    if policy == FILL_NULL:
+        value = f"NULLIF({old}, '')" if _is_text(field) else old
+        return f'{column} = COALESCE({value}, {new})'
+    raise ValueError(f'Неизвестная политика обновления поля {field.name}: {policy}')
+
+
+def upsert_products(products, policies, using=None):
+    """
+    Записывает товары одним INSERT ... ON CONFLICT(external_id, catalog_type) DO UPDATE.
+
+    products — экземпляры Product (новые и загруженные) с заполненными external_id
+    и catalog_type, без повторов ключа. policies — {имя поля: ALWAYS | IF_PRESENT | FILL_NULL}.
+    Новым товарам назначается slug. Первичные ключи новым экземплярам не проставляются.
+    Возвращает число вставленных и обновленных строк.
+    """
+    products = list(products)
+    if not products:
+        return 0
+    using = using or router.db_for_write(Product)
+    connection = connections[using]
+    meta = Product._meta
+    qn = connection.ops.quote_name
+
+    fields = [field for field in meta.concrete_fields if not field.primary_key]
+    field_names = {field.name for field in fields}
+    unknown = set(policies) - field_names
+    if unknown:
+        raise ValueError(f'Политики для несуществующих полей Product: {", ".join(sorted(unknown))}')
+    allocate_product_slugs([product for product in products if product._state.adding])
+
+    table = qn(meta.db_table)
+    assignments = []
+    for field in fields:
+        if field.name in UPSERT_KEY:
+            continue
+        policy = policies.get(field.name)
+        if policy is None and getattr(field, 'auto_now', False):
+            policy = ALWAYS
+        if policy is not None:
+            assignments.append(_set_clause(field, policy, table, qn))
+
+    columns = ', '.join(qn(field.column) for field in fields)
+    conflict = ', '.join(qn(meta.get_field(name).column) for name in UPSERT_KEY)
+    row_sql = f"({', '.join(['%s'] * len(fields))})"
+    batch_size = max(1, _max_query_params(connection) // len(fields))
+
+    written = 0
+    with connection.cursor() as cursor:
+        for start in range(0, len(products), batch_size):
+            batch = products[start:start + batch_size]
+            params = []
+            for product in batch:
+                add = product._state.adding
+                for field in fields:
+                    params.append(field.get_db_prep_save(field.pre_save(product, add), connection=connection))
+            cursor.execute(
+                f'INSERT INTO {table} ({columns}) VALUES {", ".join([row_sql] * len(batch))} '
+                f'ON CONFLICT({conflict}) DO UPDATE SET {", ".join(assignments)}',
+                params,
+            )
+            written += max(cursor.rowcount, 0)
+    return written
@@ -2,14 +2,19 @@
 Сервисы автоматизации для каталога товаров.
 """
 import hashlib
+import logging
 import re
 import os
+from django.conf import settings
 from django.core.files.base import ContentFile
 from django.db import transaction
-from django.db.models import Count, Q, Value
+from django.db.models import Count, Max, Q, Value
 from django.db.models.functions import Lower, Replace
 from django.utils.text import capfirst
 from .models import Category, Product, ProductImage, Brand
+from .keyword_matcher import KeywordMatcher, is_ascii_word_char
+
+logger = logging.getLogger(__name__)
 
 
 # =============================================================================
@@ -272,6 +277,9 @@ ROOT_CATEGORY_EXPLICIT_RULES = {
 }
 
 
+_root_category_token_rules = None
+
+
 def _build_root_category_token_rules() -> dict:
     """
     Собирает полные правила распределения подкатегорий по корневым категориям
@@ -497,6 +505,120 @@ def clear_brands_cache():
 KNOWN_BRANDS = _DEFAULT_BRANDS
 
 
+# =============================================================================
+# СКОМПИЛИРОВАННЫЕ НАБОРЫ КЛЮЧЕВЫХ СЛОВ (категории и бренды)
+# =============================================================================
+# Наборы строятся один раз и пересобираются только при изменении источников:
+# категории — по сигнатуре (количество, последнее updated_at), которая проверяется
+# не чаще раза в _KEYWORD_MATCHERS_RECHECK_SECONDS; бренды — при смене списка get_known_brands().
+_KEYWORD_MATCHERS_RECHECK_SECONDS = 10
+_static_keyword_matchers = {}
+_db_keyword_matchers = {}
+_db_keyword_signature = None
+_db_keyword_checked_at = 0.0
+_brand_matcher = None
+_brand_matcher_source = None
+
+
+def invalidate_keyword_matchers():
+    """Сбрасывает наборы ключевых слов из БД (вызывается при сохранении/удалении категорий)."""
+    global _db_keyword_checked_at
+    _db_keyword_matchers.clear()
+    _db_keyword_checked_at = 0.0
+
+
+def _static_keyword_matcher(name):
+    """Наборы из MAIN_CATEGORIES и SUBCATEGORY_KEYWORDS (не меняются во время работы)."""
+    matcher = _static_keyword_matchers.get(name)
+    if matcher is not None:
+        return matcher
+    entries = []
+    if name == 'main_categories':
+        # Самое длинное ключевое слово выигрывает, при равной длине — первое по порядку
+        for category_name, keywords in MAIN_CATEGORIES.items():
+            for keyword in keywords:
+                entries.append((keyword.lower(), category_name, (-len(keyword), len(entries))))
+    elif name == 'subcategory_keywords':
+        # Первое по порядку словаря
+        for keyword, info in SUBCATEGORY_KEYWORDS.items():
+            entries.append((keyword.lower(), info, (len(entries),)))
+    matcher = KeywordMatcher(entries)
+    _static_keyword_matchers[name] = matcher
+    return matcher
+
+
+def get_category_keyword_matcher(name):
+    """
+    Наборы из Category.keywords/названий подкатегорий:
+    'root' — корневые категории (приоритет — порядок категорий), payload — название;
+    'subcategory' — подкатегории активных корней, payload — (корень, подкатегория);
+    'import' — все активные подкатегории, payload — Category (для import.xml).
+    """
+    global _db_keyword_signature, _db_keyword_checked_at
+    import time
+
+    now = time.time()
+    if not _db_keyword_matchers or now - _db_keyword_checked_at > _KEYWORD_MATCHERS_RECHECK_SECONDS:
+        stats = Category.objects.aggregate(count=Count('id'), changed=Max('updated_at'))
+        signature = (stats['count'], stats['changed'])
+        _db_keyword_checked_at = now
+        if signature != _db_keyword_signature or not _db_keyword_matchers:
+            _db_keyword_matchers.clear()
+            _db_keyword_matchers.update(_build_db_keyword_matchers())
+            _db_keyword_signature = signature
+    return _db_keyword_matchers[name]
+
+
+def _build_db_keyword_matchers():
+    root_entries = []
+    subcategory_entries = []
+    import_entries = []
+    root_index = 0
+    for category in Category.objects.filter(is_active=True).select_related('parent'):
+        keywords = category.get_keywords_list()
+        name_kw = (category.name or '').strip().lower()
+        if category.parent_id is None:
+            if keywords:
+                for keyword in keywords:
+                    root_entries.append((keyword, category.name, (root_index,)))
+                root_index += 1
+            continue
+
+        # import.xml: название, затем keywords; самое длинное совпадение выигрывает
+        for keyword in ([name_kw] if name_kw else []) + keywords:
+            import_entries.append((keyword, category, (-len(keyword), len(import_entries))))
+
+        parent = category.parent
+        if not parent or not parent.is_active:
+            continue
+        for keyword in keywords + ([name_kw] if name_kw else []):
+            subcategory_entries.append(
+                (keyword, (parent.name, category.name), (-len(keyword), len(subcategory_entries)))
+            )
+    return {
+        'root': KeywordMatcher(root_entries),
+        'subcategory': KeywordMatcher(subcategory_entries),
+        'import': KeywordMatcher(import_entries),
+    }
+
+
+def _known_brands_matcher():
+    """Набор брендов с проверкой границ слова; пересобирается при смене списка брендов."""
+    global _brand_matcher, _brand_matcher_source
+    known_brands = get_known_brands()
+    if _brand_matcher is None or (
+        known_brands is not _brand_matcher_source and list(known_brands) != list(_brand_matcher_source)
+    ):
+        # Более длинные бренды приоритетнее (TOYOTA раньше TOYO), при равной длине — порядок списка
+        entries = [
+            (brand.upper(), brand, (-len(brand), index))
+            for index, brand in enumerate(known_brands)
+        ]
+        _brand_matcher = KeywordMatcher(entries, word_char=is_ascii_word_char)
+    _brand_matcher_source = known_brands
+    return _brand_matcher
+
+
 def detect_category(text):
     """
     Автоматически определяет категорию по ключевым словам.
@@ -508,43 +630,21 @@ def detect_category(text):
     """
     text_lower = text.lower()
     
-    # 1. Сначала проверяем категории из базы данных (корневые с ключевыми словами)
+    # 1. Сначала проверяем категории из базы данных (корневые с ключевыми словами):
+    # выигрывает первая по порядку категория, у которой совпало любое ключевое слово
     try:
-        from .models import Category
-        # Получаем корневые категории с заполненными ключевыми словами
-        db_categories = Category.objects.filter(
-            parent__isnull=True,
-            is_active=True,
-            keywords__isnull=False
-        ).exclude(keywords='')
-        
-        # Сортируем ключевые слова по длине (более длинные = более специфичные первыми)
-        for category in db_categories:
-            keywords_list = category.get_keywords_list()
-            # Сортируем по длине в убывающем порядке
-            sorted_keywords = sorted(keywords_list, key=lambda x: len(x), reverse=True)
-            for keyword in sorted_keywords:
-                if keyword in text_lower:
-                    return category.name
+        category_name = get_category_keyword_matcher('root').search(text_lower)
+        if category_name:
+            return category_name
     except Exception:
         # Если база данных недоступна, используем hardcoded
         pass
     
     # 2. Если не нашли в БД, используем hardcoded категории
-    # Сортируем ключевые слова по длине для каждой категории (более специфичные первыми)
-    # Сначала собираем все ключевые слова с их категориями и сортируем глобально по длине
-    all_keywords = []
-    for category_name, keywords in MAIN_CATEGORIES.items():
-        for keyword in keywords:
-            all_keywords.append((len(keyword), keyword.lower(), category_name))
-    
-    # Сортируем по длине в убывающем порядке (самые длинные/специфичные первыми)
-    all_keywords.sort(key=lambda x: x[0], reverse=True)
-    
-    # Проверяем в порядке от самых специфичных к общим
-    for length, keyword, category_name in all_keywords:
-        if keyword in text_lower:
-            return category_name
+    # (самые длинные/специфичные ключевые слова приоритетнее общих)
+    category_name = _static_keyword_matcher('main_categories').search(text_lower)
+    if category_name:
+        return category_name
     
     # По умолчанию - Двигатель и выхлопная система
     return 'Двигатель и выхлопная система'
@@ -562,37 +662,16 @@ def detect_subcategory_info(text, use_db_subcategories: bool = True):
         # Подкатегория = Category с parent != None.
         # ВАЖНО: не требуем заполненный keywords, иначе подкатегории без keywords
         # вообще не участвуют в распределении и товары падают в корень.
+        # Ключевые слова и названия подкатегорий — одним набором, самое длинное совпадение выигрывает.
         try:
-            db_subcats = Category.objects.filter(
-                parent__isnull=False,
-                is_active=True,
-            )
-
-            # Собираем все (keyword -> (parent_name, subcat_name)), сортируем по длине keyword
-            candidates = []
-            for subcat in db_subcats.select_related('parent'):
-                parent = subcat.parent
-                if not parent or not parent.is_active:
-                    continue
-                for kw in subcat.get_keywords_list():
-                    candidates.append((len(kw), kw, parent.name, subcat.name))
-                name_kw = (subcat.name or '').strip().lower()
-                if name_kw:
-                    candidates.append((len(name_kw), name_kw, parent.name, subcat.name))
-
-            candidates.sort(key=lambda x: x[0], reverse=True)
-            for _len, kw, parent_name, subcat_name in candidates:
-                if kw and kw in text_lower:
-                    return (parent_name, subcat_name)
+            info = get_category_keyword_matcher('subcategory').search(text_lower)
+            if info:
+                return info
         except Exception:
             # Если БД недоступна/ошибка — fallback на хардкод ниже
             pass
     
-    for keyword, (main_cat, subcat) in SUBCATEGORY_KEYWORDS.items():
-        if keyword.lower() in text_lower:
-            return (main_cat, subcat)
-    
-    return None
+    return _static_keyword_matcher('subcategory_keywords').search(text_lower)
 
 
 def _sanitize_subcategory_name(raw_name: str) -> str:
@@ -657,7 +736,11 @@ def _detect_target_root_for_subcategory(subcategory_name: str) -> str | None:
     if explicit_target:
         return explicit_target
 
-    rules = _build_root_category_token_rules()
+    global _root_category_token_rules
+    if _root_category_token_rules is None:
+        # Правила собираются только из констант модуля — строим один раз на процесс
+        _root_category_token_rules = _build_root_category_token_rules()
+    rules = _root_category_token_rules
 
     # Считаем "вес" совпадений по каждому корню и выбираем самый сильный.
     scores = {}
@@ -1071,9 +1154,71 @@ def sync_all_subcategories_from_keywords(*, root_only: bool = True, deactivate_r
     rebalance_stats = rebalance_subcategory_roots()
     totals['moved'] = rebalance_stats.get('moved', 0)
     totals['merged'] = rebalance_stats.get('merged', 0)
+    # Отпечаток считается после синхронизации: ее собственные изменения уже в нем
+    _store_keywords_fingerprint(category_keywords_fingerprint())
     return totals
 
 
+# =============================================================================
+# ОТПЕЧАТОК КЛЮЧЕВЫХ СЛОВ ДЛЯ СИНХРОНИЗАЦИИ ПОДКАТЕГОРИЙ ПРИ ОБМЕНЕ
+# =============================================================================
+# 1С присылает за сессию десяток файлов, и полная синхронизация подкатегорий
+# перед каждым из них почти всегда ничего не меняет. Последний отпечаток
+# категорий (Ид, родитель, активность, keywords, updated_at), при котором
+# синхронизация выполнялась, хранится в файле; обмен запускает ее снова,
+# только если отпечаток изменился.
+KEYWORDS_FINGERPRINT_FILE = getattr(settings, 'ONE_C_KEYWORDS_FINGERPRINT_FILE', os.path.join(
+    getattr(settings, 'ONE_C_EXCHANGE_DIR', os.path.join(settings.MEDIA_ROOT, '1c_exchange')),
+    '.keywords.fingerprint',
+))
+
+
+def category_keywords_fingerprint() -> str:
+    """SHA-256 по Ид, родителю, активности, keywords и updated_at всех категорий."""
+    digest = hashlib.sha256()
+    rows = Category.objects.order_by('id').values_list(
+        'id', 'parent_id', 'is_active', 'keywords', 'updated_at'
+    )
+    for category_id, parent_id, is_active, keywords, updated_at in rows.iterator(chunk_size=2000):
+        digest.update(
+            f"{category_id}\x1f{parent_id}\x1f{int(is_active)}\x1f{keywords or ''}\x1f"
+            f"{updated_at.isoformat() if updated_at else ''}\x1e".encode('utf-8')
+        )
+    return digest.hexdigest()
+
+
+def stored_keywords_fingerprint():
+    """Отпечаток, при котором последний раз выполнялась синхронизация, или None."""
+    try:
+        with open(KEYWORDS_FINGERPRINT_FILE, encoding='utf-8') as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def _store_keywords_fingerprint(fingerprint):
+    try:
+        os.makedirs(os.path.dirname(KEYWORDS_FINGERPRINT_FILE), exist_ok=True)
+        tmp_path = f'{KEYWORDS_FINGERPRINT_FILE}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(fingerprint)
+        os.replace(tmp_path, KEYWORDS_FINGERPRINT_FILE)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить отпечаток ключевых слов категорий: {e}")
+
+
+def sync_subcategories_if_keywords_changed(*, root_only: bool = True, deactivate_removed: bool = False):
+    """
+    sync_all_subcategories_from_keywords, только если категории изменились с прошлой синхронизации.
+
+    Возвращает итоги синхронизации или None, если она пропущена.
+    Принудительный запуск — sync_all_subcategories_from_keywords (кнопка в админке категорий).
+    """
+    if category_keywords_fingerprint() == stored_keywords_fingerprint():
+        return None
+    return sync_all_subcategories_from_keywords(root_only=root_only, deactivate_removed=deactivate_removed)
+
+
 def merge_duplicate_subcategories(*, dry_run: bool = True, delete_empty_duplicates: bool = False) -> dict:
     """
     Сливает дубли подкатегорий под одним родителем (регистронезависимо по имени).
@@ -1144,6 +1289,7 @@ def merge_duplicate_subcategories(*, dry_run: bool = True, delete_empty_duplicat
                 Product.objects.filter(category=dup).update(category=keeper)
             if moved_children:
                 Category.objects.filter(parent=dup).exclude(id=keeper.id).update(parent=keeper)
+                keeper.refresh_descendant_paths()
 
             if dup.is_active:
                 dup.is_active = False
@@ -1172,24 +1318,9 @@ def detect_brand(text):
     то находился именно "TOYOTA", а не "TOYO".
     Но если в тексте только "TOYO", то находится именно "TOYO".
     """
-    text_upper = text.upper()
-    known_brands = get_known_brands()
-    
-    # Сортируем бренды по длине в убывающем порядке, чтобы более длинные совпадения проверялись первыми
-    # Это важно для случаев, когда один бренд является частью другого (например, TOYO и TOYOTA)
-    sorted_brands = sorted(known_brands, key=lambda x: len(x), reverse=True)
-    
-    for brand in sorted_brands:
-        brand_upper = brand.upper()
-        # Используем более точную проверку: бренд должен быть отдельным словом
-        # Учитываем различные разделители: пробелы, запятые, начало/конец строки
-        # Паттерн: начало строки ИЛИ не буква/цифра, затем бренд, затем не буква/цифра ИЛИ конец строки
-        # Это гарантирует, что "TOYO" не будет найден в "TOYOTA", и наоборот
-        pattern = r'(?:^|[^A-Z0-9])' + re.escape(brand_upper) + r'(?:[^A-Z0-9]|$)'
-        if re.search(pattern, text_upper):
-            return brand
-    
-    return None
+    # Бренд должен быть отдельным словом: соседние символы не A-Z/0-9
+    # (начало/конец строки, пробелы, запятые) — так "TOYO" не найдется в "TOYOTA", и наоборот.
+    return _known_brands_matcher().search(text.upper())
 
 
 def extract_article(text):
@@ -1712,11 +1843,243 @@ def get_or_create_category(category_name, parent=None):
         return default
 
 
-def get_category_for_product(product_name, use_db_subcategories: bool = True):
+class _CategoryStore:
     """
-    Определяет категорию и подкатегорию для товара по его названию.
-    Возвращает объект Category (подкатегорию если найдена, иначе основную категорию).
-    ВАЖНО: Возвращает только активные категории, чтобы товары не попадали в неактивные категории.
+    Доступ классификатора названий к дереву категорий — прямые запросы к БД.
+    Активация, перенос и создание подкатегорий сохраняются сразу.
+    """
+
+    def root(self, name):
+        """Активная корневая категория по названию (без учета регистра)."""
+        return Category.objects.filter(name__iexact=name, parent=None, is_active=True).first()
+
+    def first_root(self):
+        return Category.objects.filter(parent=None, is_active=True).first()
+
+    def child(self, parent, name, active_only=False):
+        children = Category.objects.filter(name__iexact=name, parent=parent)
+        if active_only:
+            children = children.filter(is_active=True)
+        return children.first()
+
+    def best_duplicate(self, name, exclude_parent):
+        """Подкатегория с таким названием под другим корнем: больше товаров -> активная -> меньший id."""
+        return Category.objects.filter(
+            name__iexact=name,
+            parent__isnull=False,
+        ).exclude(parent=exclude_parent).annotate(
+            products_count=Count('products')
+        ).order_by('-products_count', '-is_active', 'id').first()
+
+    def active_children(self, parent):
+        return Category.objects.filter(parent=parent, is_active=True)
+
+    def first_active_child(self, parent):
+        return Category.objects.filter(parent=parent, is_active=True).order_by('id').first()
+
+    def detect_subcategory_info(self, text, use_db_subcategories):
+        return detect_subcategory_info(text, use_db_subcategories=use_db_subcategories)
+
+    def activate(self, category, parent=None):
+        """Активирует подкатегорию и при необходимости переносит ее под parent."""
+        changed_fields = []
+        if parent is not None and category.parent_id != parent.id:
+            category.parent = parent
+            changed_fields.append('parent')
+        if not category.is_active:
+            category.is_active = True
+            changed_fields.append('is_active')
+        if changed_fields:
+            changed_fields.append('updated_at')
+            category.save(update_fields=changed_fields)
+        return category
+
+    def create(self, parent, name):
+        return Category.objects.create(
+            name=capfirst(name),
+            parent=parent,
+            is_active=True,
+            keywords=name.lower(),
+        )
+
+
+class _CategorySnapshot(_CategoryStore):
+    """
+    Дерево категорий в памяти для пакетной классификации (classify_names).
+
+    Загружается одним запросом, поиск по названиям идет по словарям. Активации,
+    переносы и новые подкатегории сразу видны следующим названиям пакета, а в БД
+    записываются одной транзакцией в apply().
+    """
+
+    def __init__(self):
+        self._by_name = {}  # название в нижнем регистре -> [Category]
+        self._children = {}  # id родителя -> [Category]
+        self._by_id = {}
+        self._product_counts = None
+        self._pending = {}  # id(объекта) -> (Category, изменённые поля); новые — с полями None
+        self._pending_matcher = None
+        categories = list(Category.objects.order_by('name', 'id'))
+        for category in categories:
+            self._by_id[category.pk] = category
+            self._by_name.setdefault(category.name.lower(), []).append(category)
+            self._children.setdefault(category.parent_id, []).append(category)
+        self._matcher = self._subcategory_matcher(categories, 0)
+
+    @staticmethod
+    def _order_key(category):
+        # Как ORDER BY name, id; еще не сохраненные — после сохраненных
+        return (category.name, category.pk is None, category.pk or 0)
+
+    def _subcategory_matcher(self, categories, rank_offset):
+        """То же, что набор 'subcategory' из get_category_keyword_matcher, но по снимку."""
+        entries = []
+        for category in categories:
+            parent = self._by_id.get(category.parent_id)
+            if not category.is_active or parent is None or not parent.is_active:
+                continue
+            name_kw = (category.name or '').strip().lower()
+            for keyword in category.get_keywords_list() + ([name_kw] if name_kw else []):
+                entries.append((
+                    keyword,
+                    (parent.name, category.name, id(category)),
+                    (-len(keyword), rank_offset + len(entries)),
+                ))
+        return KeywordMatcher(entries)
+
+    def root(self, name):
+        for category in self._by_name.get(name.lower(), ()):
+            if category.parent_id is None and category.is_active:
+                return category
+        return None
+
+    def first_root(self):
+        for category in self._children.get(None, ()):
+            if category.is_active:
+                return category
+        return None
+
+    def child(self, parent, name, active_only=False):
+        for category in self._by_name.get(name.lower(), ()):
+            if category.parent_id == parent.id and (category.is_active or not active_only):
+                return category
+        return None
+
+    def best_duplicate(self, name, exclude_parent):
+        candidates = [
+            category for category in self._by_name.get(name.lower(), ())
+            if category.parent_id is not None and category.parent_id != exclude_parent.id
+        ]
+        if not candidates:
+            return None
+        if self._product_counts is None:
+            self._product_counts = dict(
+                Product.objects.filter(category__isnull=False).order_by()
+                .values_list('category_id').annotate(count=Count('id'))
+            )
+        counts = self._product_counts
+        return min(candidates, key=lambda category: (
+            -counts.get(category.pk, 0),
+            not category.is_active,
+            category.pk is None,
+            category.pk or 0,
+        ))
+
+    def active_children(self, parent):
+        return [category for category in self._children.get(parent.id, ()) if category.is_active]
+
+    def first_active_child(self, parent):
+        children = self.active_children(parent)
+        if not children:
+            return None
+        return min(children, key=lambda category: (category.pk is None, category.pk or 0))
+
+    def detect_subcategory_info(self, text, use_db_subcategories):
+        text_lower = text.lower()
+        if use_db_subcategories:
+            # Подкатегории, измененные в этом пакете, ищутся по отдельному набору —
+            # иначе следующее название увидело бы их старого родителя.
+            found = self._matcher.search_ranked(
+                text_lower, accept=lambda payload: payload[2] not in self._pending
+            )
+            if self._pending:
+                if self._pending_matcher is None:
+                    self._pending_matcher = self._subcategory_matcher(
+                        [category for category, _fields in self._pending.values()],
+                        len(self._matcher),
+                    )
+                pending_found = self._pending_matcher.search_ranked(text_lower)
+                if pending_found and (found is None or pending_found[0] < found[0]):
+                    found = pending_found
+            if found:
+                return found[1][:2]
+        return _static_keyword_matcher('subcategory_keywords').search(text_lower)
+
+    def _reindex(self, category, old_parent_id):
+        siblings = self._children.get(old_parent_id, [])
+        self._children[old_parent_id] = [c for c in siblings if c is not category]
+        siblings = self._children.setdefault(category.parent_id, [])
+        siblings.append(category)
+        siblings.sort(key=self._order_key)
+
+    def activate(self, category, parent=None):
+        changed = set()
+        if parent is not None and category.parent_id != parent.id:
+            old_parent_id = category.parent_id
+            category.parent = parent
+            self._reindex(category, old_parent_id)
+            changed.add('parent')
+        if not category.is_active:
+            category.is_active = True
+            changed.add('is_active')
+        if changed:
+            pending = self._pending.setdefault(id(category), (category, set()))
+            if pending[1] is not None:
+                pending[1].update(changed)
+            self._pending_matcher = None
+        return category
+
+    def create(self, parent, name):
+        category = Category(
+            name=capfirst(name),
+            parent=parent,
+            is_active=True,
+            keywords=name.lower(),
+        )
+        self._by_name.setdefault(category.name.lower(), []).append(category)
+        self._by_name[category.name.lower()].sort(key=self._order_key)
+        siblings = self._children.setdefault(parent.id, [])
+        siblings.append(category)
+        siblings.sort(key=self._order_key)
+        self._pending[id(category)] = (category, None)
+        self._pending_matcher = None
+        return category
+
+    def apply(self):
+        """Записывает накопленные изменения одной транзакцией. Возвращает (создано, изменено)."""
+        created = updated = 0
+        if not self._pending:
+            return created, updated
+        # Дерево MPTT пересчитывается один раз в конце, а не при каждой вставке
+        with transaction.atomic(), Category.objects.delay_mptt_updates():
+            for category, fields in self._pending.values():
+                if fields is None:
+                    category.save()
+                    created += 1
+                else:
+                    category.save(update_fields=sorted(fields) + ['updated_at'])
+                    updated += 1
+        for category, _fields in self._pending.values():
+            self._by_id[category.pk] = category
+        self._pending.clear()
+        self._pending_matcher = None
+        return created, updated
+
+
+def _classify_product_name(store, product_name, use_db_subcategories=True):
+    """
+    Определяет категорию товара по названию, обращаясь к дереву через store
+    (_CategoryStore — запросы к БД, _CategorySnapshot — снимок в памяти).
     """
     def _reuse_or_create_subcategory(root_category: Category, raw_subcat_name: str):
         """
@@ -1730,44 +2093,18 @@ def get_category_for_product(product_name, use_db_subcategories: bool = True):
             return root_category
 
         # 1) Уже существует под целевым корнем — просто активируем при необходимости.
-        existing_target = Category.objects.filter(
-            name__iexact=clean_name,
-            parent=root_category,
-        ).first()
+        existing_target = store.child(root_category, clean_name)
         if existing_target:
-            if not existing_target.is_active:
-                existing_target.is_active = True
-                existing_target.save(update_fields=['is_active', 'updated_at'])
-            return existing_target
+            return store.activate(existing_target)
 
         # 2) Переиспользуем наиболее "весомый" дубль из других корней, а не создаем новый.
         # Приоритет: больше товаров -> активная -> меньший id.
-        existing_any = Category.objects.filter(
-            name__iexact=clean_name,
-            parent__isnull=False,
-        ).exclude(parent=root_category).annotate(
-            products_count=Count('products')
-        ).order_by('-products_count', '-is_active', 'id').first()
+        existing_any = store.best_duplicate(clean_name, root_category)
         if existing_any:
-            changed_fields = []
-            if existing_any.parent_id != root_category.id:
-                existing_any.parent = root_category
-                changed_fields.append('parent')
-            if not existing_any.is_active:
-                existing_any.is_active = True
-                changed_fields.append('is_active')
-            if changed_fields:
-                changed_fields.append('updated_at')
-                existing_any.save(update_fields=changed_fields)
-            return existing_any
+            return store.activate(existing_any, parent=root_category)
 
         # 3) Не нашли — создаем новую.
-        return Category.objects.create(
-            name=capfirst(clean_name),
-            parent=root_category,
-            is_active=True,
-            keywords=clean_name.lower(),
-        )
+        return store.create(root_category, clean_name)
 
     def _best_existing_child_for_name(root_category: Category, raw_name: str):
         """
@@ -1790,7 +2127,7 @@ def get_category_for_product(product_name, use_db_subcategories: bool = True):
 
         best = None
         best_score = 0
-        for child in Category.objects.filter(parent=root_category, is_active=True):
+        for child in store.active_children(root_category):
             child_name = _sanitize_subcategory_name(child.name or '')
             child_tokens = {
                 t for t in re.split(r'[\s/\\,;:()\\-]+', child_name.lower())
@@ -1899,10 +2236,7 @@ def get_category_for_product(product_name, use_db_subcategories: bool = True):
         if best_existing_child:
             return best_existing_child
 
-        any_active_child = Category.objects.filter(
-            parent=root_category,
-            is_active=True,
-        ).order_by('id').first()
+        any_active_child = store.first_active_child(root_category)
         if any_active_child:
             return any_active_child
 
@@ -1927,11 +2261,7 @@ def get_category_for_product(product_name, use_db_subcategories: bool = True):
     base_name = _sanitize_subcategory_name(clean_product_name(product_name))
     explicit_root_name = _detect_target_root_for_subcategory(base_name)
     if explicit_root_name:
-        explicit_root = Category.objects.filter(
-            name__iexact=explicit_root_name,
-            parent=None,
-            is_active=True
-        ).first()
+        explicit_root = store.root(explicit_root_name)
         if explicit_root:
             preferred_root = explicit_root
             existing_explicit_sub = _reuse_or_create_subcategory(explicit_root, base_name)
@@ -1939,16 +2269,12 @@ def get_category_for_product(product_name, use_db_subcategories: bool = True):
                 return existing_explicit_sub
 
     # 1) Пытаемся определить подкатегорию
-    subcat_info = detect_subcategory_info(product_name, use_db_subcategories=use_db_subcategories)
+    subcat_info = store.detect_subcategory_info(product_name, use_db_subcategories)
     
     if subcat_info:
         main_cat_name, subcat_name = subcat_info
         # Находим основную категорию (только активную)
-        main_category = Category.objects.filter(
-            name__iexact=main_cat_name,
-            parent=None,
-            is_active=True  # ВАЖНО: Только активные категории
-        ).first()
+        main_category = store.root(main_cat_name)
         
         if main_category:
             # Если явные доменные правила уже определили другой целевой корень,
@@ -1960,11 +2286,7 @@ def get_category_for_product(product_name, use_db_subcategories: bool = True):
                     return _reuse_or_create_subcategory(preferred_root, clean_subcat_name)
                 return preferred_root
             # Ищем подкатегорию (только активную)
-            subcategory = Category.objects.filter(
-                name__iexact=subcat_name,
-                parent=main_category,
-                is_active=True  # ВАЖНО: Только активные подкатегории
-            ).first()
+            subcategory = store.child(main_category, subcat_name, active_only=True)
             
             if subcategory:
                 return subcategory
@@ -1983,15 +2305,11 @@ def get_category_for_product(product_name, use_db_subcategories: bool = True):
         main_category = preferred_root
     else:
         main_cat_name = detect_category(product_name)
-        main_category = Category.objects.filter(
-            name__iexact=main_cat_name,
-            parent=None,
-            is_active=True  # ВАЖНО: Только активные категории
-        ).first()
+        main_category = store.root(main_cat_name)
     
     # Если основная категория не найдена, берем первую активную из корневых
     if not main_category:
-        main_category = Category.objects.filter(parent=None, is_active=True).first()
+        main_category = store.first_root()
 
     # Fallback: если конкретная подкатегория не определилась по keywords,
     # пробуем использовать "тип детали" из названия (до скобок):
@@ -2012,15 +2330,9 @@ def get_category_for_product(product_name, use_db_subcategories: bool = True):
             base_name = ' '.join(filtered_parts).strip()
             subcat_name = _sanitize_subcategory_name(base_name)
             if _is_valid_subcategory_name(subcat_name):
-                existing_subcat = Category.objects.filter(
-                    name__iexact=subcat_name,
-                    parent=main_category,
-                ).first()
+                existing_subcat = store.child(main_category, subcat_name)
                 if existing_subcat:
-                    if not existing_subcat.is_active:
-                        existing_subcat.is_active = True
-                        existing_subcat.save(update_fields=['is_active', 'updated_at'])
-                    return existing_subcat
+                    return store.activate(existing_subcat)
                 return _reuse_or_create_subcategory(main_category, subcat_name)
         except Exception:
             pass
@@ -2033,6 +2345,60 @@ def get_category_for_product(product_name, use_db_subcategories: bool = True):
     return _ensure_non_root_category(main_category, '') or main_category
 
 
+def get_category_for_product(product_name, use_db_subcategories: bool = True):
+    """
+    Определяет категорию и подкатегорию для товара по его названию.
+    Возвращает объект Category (подкатегорию если найдена, иначе основную категорию).
+    ВАЖНО: Возвращает только активные категории, чтобы товары не попадали в неактивные категории.
+
+    Для множества названий используйте classify_names — он не делает запросов на каждое название.
+    """
+    return _classify_product_name(_CategoryStore(), product_name, use_db_subcategories)
+
+
+def classify_names(names, use_db_subcategories: bool = True):
+    """
+    Пакетный вариант get_category_for_product: {название: Category}.
+
+    Дерево категорий загружается в память один раз, названия классифицируются
+    без запросов к БД, а нужные активации/переносы/новые подкатегории
+    записываются одной транзакцией в конце.
+    """
+    snapshot = _CategorySnapshot()
+    result = {}
+    for name in names:
+        if name not in result:
+            result[name] = _classify_product_name(snapshot, name, use_db_subcategories)
+    snapshot.apply()
+    return result
+
+
+def _classify_bulk_names(names):
+    """
+    classify_names для массового импорта; None — пакет не удался.
+
+    Ошибка пакетной классификации не должна обрывать весь импорт (раньше она
+    роняла только свою строку): категории тогда определяются построчно (_bulk_category).
+    """
+    try:
+        # Точка сохранения: ошибка БД в пакете не ломает внешнюю транзакцию импорта
+        with transaction.atomic():
+            return classify_names(names)
+    except Exception as e:
+        logger.warning(
+            f"Массовый импорт: пакетная классификация категорий не удалась ({e}), определяем по строкам",
+            exc_info=True,
+        )
+        return None
+
+
+def _bulk_category(categories, name):
+    """Категория строки массового импорта: из пакета _classify_bulk_names или поштучно."""
+    if categories is None:
+        return get_category_for_product(name)
+    return categories.get(name)
+
+
 def learn_subcategory_keyword_from_product(product: Product, category: Category):
     """
     Дообучает keywords выбранной ПОДкатегории по ручной правке товара в админке.
@@ -2150,6 +2516,15 @@ def process_bulk_import(data_rows, auto_category=True, auto_brand=True):
     }
     
     with transaction.atomic():
+        # Категории всех строк определяем одним пакетом: дерево категорий
+        # загружается один раз, новые подкатегории создаются вместе.
+        category_names = []
+        for row in data_rows:
+            name = str(row.get('name', '')).strip()
+            if name and name.lower() not in ['none', 'null', '']:
+                category_names.append(str(row.get('category_name', '')).strip() or name)
+        categories = _classify_bulk_names(category_names)
+
         for i, row in enumerate(data_rows, 1):
             try:
                 # Получаем название товара из поля 'name'
@@ -2181,10 +2556,7 @@ def process_bulk_import(data_rows, auto_category=True, auto_brand=True):
                 # Определяем категорию
                 # Сначала пробуем из колонки category_name (Номенклатура из 1С)
                 category_name = str(row.get('category_name', '')).strip()
-                if category_name:
-                    category = get_category_for_product(category_name)
-                else:
-                    category = get_category_for_product(name)
+                category = _bulk_category(categories, category_name or name)
                 
                 # Обрабатываем розничную цену
                 # Формат может быть: "2 000,00" (пробел - тысячи, запятая - десятичные) или просто число
@@ -2559,6 +2931,10 @@ def process_bulk_import(data_rows, auto_category=True, auto_brand=True):
             except Exception as e:
                 stats['errors'] += 1
                 stats['error_details'].append(f'Строка {i}: {str(e)}')
+
+    if stats['created'] or stats['updated'] or stats['wholesale_created'] or stats['wholesale_updated']:
+        from .category_counts import safe_recompute_category_counts
+        safe_recompute_category_counts()
     
     return stats
 
@@ -4084,24 +4460,17 @@ def enrich_wholesale_catalog_codes(product):
     """
     Код детали + артикул для таблицы опта.
     Для товаров «нет в наличии» (созданных из import) подставляем те же поля,
-    что у карточек в наличии; при пустых — из розничного аналога с тем же external_id.
+    что у карточек в наличии; при пустых — из розничного аналога (retail_counterpart).
     """
     part_code = product_part_number_value(product)
     article = product_catalog_article_value(product)
     if (part_code and article) or not getattr(product, 'external_id', None):
         return part_code, article
     try:
-        retail = (
-            Product.objects.filter(
-                external_id=product.external_id,
-                catalog_type='retail',
-            )
-            .exclude(pk=getattr(product, 'pk', None))
-            .first()
-        )
+        retail = product.get_retail_counterpart()
     except Exception:
         retail = None
-    if retail:
+    if retail and retail.pk != product.pk:
         if not part_code:
             part_code = product_part_number_value(retail)
         if not article:
@@ -4164,6 +4533,13 @@ def generate_farpost_api_file(products, file_format='xls', request=None):
     import io
     import csv
     from datetime import datetime
+    from django.db.models import QuerySet
+
+    if isinstance(products, QuerySet):
+        # Ссылка на сайт, фото, цена и бренд оптовой строки (из розничной пары) — без запросов на строку
+        products = products.select_related('category', 'retail_counterpart').prefetch_related(
+            'images', 'retail_counterpart__images',
+        )
     
     if file_format == 'csv':
         # CSV формат
@@ -4400,6 +4776,14 @@ def process_bulk_import_wholesale(data_rows, auto_category=True, auto_brand=True
     }
     
     with transaction.atomic():
+        # Категории всех строк — одним пакетом (см. process_bulk_import)
+        categories = {}
+        if auto_category:
+            categories = _classify_bulk_names(
+                name for name in (str(row.get('name', '')).strip() for row in data_rows)
+                if name and name.lower() not in ['none', 'null', '']
+            )
+
         for i, row in enumerate(data_rows, 1):
             try:
                 # Получаем название товара
@@ -4462,7 +4846,7 @@ def process_bulk_import_wholesale(data_rows, auto_category=True, auto_brand=True
                     brand = row.get('brand', '').strip()
                 
                 # Определяем категорию
-                category = get_category_for_product(name) if auto_category else None
+                category = _bulk_category(categories, name) if auto_category else None
                 
                 # Обрабатываем розничную цену
                 price_value = 0
@@ -4581,6 +4965,12 @@ def process_bulk_import_wholesale(data_rows, auto_category=True, auto_brand=True
             except Exception as e:
                 stats['errors'] += 1
                 stats['error_details'].append(f'Строка {i}: {str(e)}')
+
+    if stats['created'] or stats['updated']:
+        from .category_counts import safe_recompute_category_counts
+        from .counterparts import safe_resolve_retail_counterparts
+        safe_resolve_retail_counterparts()
+        safe_recompute_category_counts()
     
     return stats
 
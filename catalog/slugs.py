@@ -0,0 +1,114 @@
+"""
+Выделение уникальных slug для пачки объектов.
+
+Раньше slug подбирался циклом filter(slug=...).exists() с растущим счетчиком
+(запрос на каждую попытку), а быстрый импорт загружал все slug таблицы в память.
+Здесь занятые варианты base, base-1, base-2, … читаются одним запросом на группу
+базовых slug (префиксный поиск по индексу + точная форма base-N), и для каждого
+объекта берется наименьший свободный номер. Запросов на пачку — фиксированное
+число, в память попадают только slug с теми же основами.
+"""
+import re
+
+from django.db import connections, router
+from django.db.models import Q
+
+# Базовых slug в одном запросе занятых вариантов
+SLUG_LOOKUP_CHUNK = 50
+# Запас длины под суффикс -N
+_SUFFIX_RESERVE = 8
+
+
+def _prefix_lookup(field, base, sqlite):
+    """
+    Условие «slug начинается с base» по индексу.
+
+    LIKE в SQLite регистронезависимый и индекс slug не использует, зато сравнение
+    строк там побайтовое: base и base-N — ровно диапазон [base, base + '.')
+    ('-' < '.', а остальные символы slug больше '.'). В PostgreSQL порядок строк
+    зависит от collation, поэтому там префиксный LIKE.
+    """
+    if sqlite:
+        return {f'{field}__gte': base, f'{field}__lt': f'{base}.'}
+    return {f'{field}__startswith': base}
+
+
+def _taken_suffixes(model, bases, field, exclude_pk=None):
+    """{base: множество занятых номеров (0 — сам base)} для группы базовых slug."""
+    sqlite = connections[router.db_for_read(model)].vendor == 'sqlite'
+    taken = {base: set() for base in bases}
+    bases = list(taken)
+    for start in range(0, len(bases), SLUG_LOOKUP_CHUNK):
+        chunk = bases[start:start + SLUG_LOOKUP_CHUNK]
+        condition = Q()
+        for base in chunk:
+            condition |= Q(**_prefix_lookup(field, base, sqlite), **{
+                f'{field}__regex': rf'^{re.escape(base)}(-[0-9]+)?$',
+            })
+        queryset = model._default_manager.filter(condition).order_by()
+        if exclude_pk is not None:
+            queryset = queryset.exclude(pk=exclude_pk)
+        for slug in queryset.values_list(field, flat=True):
+            if slug in taken:
+                taken[slug].add(0)
+            head, _, tail = slug.rpartition('-')
+            if tail.isdigit() and head in taken:
+                taken[head].add(int(tail))
+    return taken
+
+
+def _suffix_stem(base, max_length):
+    """Основа для base-N: укорачивается, только если с суффиксом не влезет в поле."""
+    if len(base) <= max_length - _SUFFIX_RESERVE:
+        return base
+    return base[:max_length - _SUFFIX_RESERVE]
+
+
+def allocate_slugs(model, bases, field='slug', exclude_pk=None):
+    """
+    Уникальные slug для списка базовых slug (в том же порядке).
+
+    Свободный base остается как есть (только обрезается по длине поля), занятый
+    получает наименьший свободный суффикс -N (как прежний цикл с exists()); место
+    под суффикс освобождается, лишь когда суффикс действительно добавляется.
+    Повторы внутри пачки тоже разводятся.
+    """
+    max_length = model._meta.get_field(field).max_length
+    bases = [base[:max_length] for base in bases]
+    stems = [_suffix_stem(base, max_length) for base in bases]
+    taken = _taken_suffixes(model, set(bases) | set(stems), field, exclude_pk=exclude_pk)
+    slugs = []
+    # Выданные в этой пачке: base-N одной основы может совпасть с base другой
+    assigned = set()
+    for base, stem in zip(bases, stems):
+        if 0 not in taken[base] and base not in assigned:
+            taken[base].add(0)
+            slug = base
+        else:
+            used = taken[stem]
+            number = 1
+            while number in used or f'{stem}-{number}' in assigned:
+                number += 1
+            used.add(number)
+            slug = f'{stem}-{number}'
+        assigned.add(slug)
+        slugs.append(slug)
+    return slugs
+
+
+def assign_slugs(objects, source, field='slug', fallback=''):
+    """
+    Назначает slug объектам без slug одной пачкой.
+
+    source(obj) — текст, из которого транслитерацией получается базовый slug;
+    fallback — базовый slug, если транслитерация дала пустую строку.
+    """
+    from .models import transliterate_slug
+
+    pending = [obj for obj in objects if not getattr(obj, field)]
+    if not pending:
+        return
+    model = type(pending[0])
+    bases = [transliterate_slug(source(obj)) or fallback for obj in pending]
+    for obj, slug in zip(pending, allocate_slugs(model, bases, field=field)):
+        setattr(obj, field, slug)
@@ -0,0 +1,304 @@
+"""
+Быстрое обновление остатков и цен из 1С без полного offers.xml.
+
+Чтобы синхронизировать остатки каждые несколько минут, 1С присылает только
+Ид товара, количество, розничную и оптовую цену — компактным CSV, NDJSON или XML
+(в том числе CommerceML-пакетом предложений без свойств). Строки применяются
+пачками: на пачку по одному UPDATE ... CASE на каталог (retail, wholesale) по
+индексу external_id. Характеристики, категории и названия не трогаются.
+
+Форматы (Ид — полный external_id, как в offers.xml, вместе с «#характеристикой»):
+
+- CSV: external_id;quantity;price;wholesale_price — с заголовком или без,
+  разделитель «;» или «,»;
+- NDJSON: по объекту на строку: {"external_id": "...", "quantity": 3, "price": 100, "wholesale_price": 80};
+- XML: <Остатки><Остаток Ид="..." Количество="3" Цена="100" ЦенаОпт="80"/></Остатки>
+  или CommerceML <Предложение> с Ид, Цены и Количество/Склад.
+
+Пустое значение не меняет поле. Обновленные товары становятся активными, наличие
+пересчитывается по количеству — как при применении offers.xml. После применения
+пересчитываются счетчики товаров категорий.
+"""
+import codecs
+import csv
+import io
+import json
+import logging
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .category_counts import safe_recompute_category_counts
+from .commerceml_extract import extract_commerceml_item, local_tag, parse_price, parse_quantity
+from .import_writer import ImportTransaction, import_writer
+from .models import Product
+from .offers_parse import RETAIL_PRICE_TYPE_ID, WHOLESALE_PRICE_TYPE_ID
+
+logger = logging.getLogger(__name__)
+
+# Строк остатков на один UPDATE (на строку уходит до 7 параметров запроса)
+STOCK_UPDATE_BATCH_SIZE = getattr(settings, 'ONE_C_STOCK_UPDATE_BATCH_SIZE', 500)
+
+STOCK_FORMATS = ('csv', 'ndjson', 'xml')
+
+StockRow = namedtuple('StockRow', ['external_id', 'quantity', 'retail_price', 'wholesale_price'])
+
+# Имена колонок CSV / ключей NDJSON / атрибутов XML
+_COLUMN_ALIASES = {
+    'external_id': ('external_id', 'id', 'ид', 'guid', 'sku'),
+    'quantity': ('quantity', 'qty', 'stock', 'количество', 'остаток'),
+    'retail_price': ('retail_price', 'price', 'цена', 'цена_розница', 'розница'),
+    'wholesale_price': ('wholesale_price', 'opt_price', 'цена_опт', 'ценаопт', 'опт'),
+}
+_ALIAS_TO_COLUMN = {alias: column for column, aliases in _COLUMN_ALIASES.items() for alias in aliases}
+
+
+class StockFormatError(ValueError):
+    """Данные остатков не удалось разобрать."""
+
+
+class _ReaderStream(io.RawIOBase):
+    """Бинарный поток поверх объекта с read(size) (тело запроса Django — wsgi.input)."""
+
+    def __init__(self, reader):
+        self._reader = reader
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._reader.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def request_stream(request, buffer_size=64 * 1024):
+    """
+    Тело запроса как буферизованный бинарный поток для iter_stock_rows.
+
+    Читается по мере разбора (как _receive_exchange_file в commerceml_views), а не через
+    request.body: память не зависит от размера файла и нет лимита DATA_UPLOAD_MAX_MEMORY_SIZE.
+    """
+    return io.BufferedReader(_ReaderStream(request), buffer_size=buffer_size)
+
+
+def detect_stock_format(filename='', content_type=''):
+    """Формат данных по расширению файла или Content-Type (по умолчанию csv)."""
+    name = (filename or '').lower()
+    content_type = (content_type or '').lower()
+    if name.endswith(('.ndjson', '.jsonl', '.json')) or 'ndjson' in content_type or 'json' in content_type:
+        return 'ndjson'
+    if name.endswith('.xml') or 'xml' in content_type:
+        return 'xml'
+    return 'csv'
+
+
+def _stock_row(values):
+    """StockRow из словаря {колонка: сырое значение}; None — строка без Ид или без данных."""
+    external_id = str(values.get('external_id') or '').strip()
+    if not external_id:
+        return None
+    quantity = parse_quantity(_as_text(values.get('quantity')))
+    retail_price = _price(values.get('retail_price'))
+    wholesale_price = _price(values.get('wholesale_price'))
+    if quantity is None and retail_price is None and wholesale_price is None:
+        return None
+    return StockRow(external_id, None if quantity is None else max(quantity, 0), retail_price, wholesale_price)
+
+
+def _as_text(value):
+    return None if value is None else str(value)
+
+
+def _price(value):
+    value = parse_price(_as_text(value))
+    if value is None or value < 0:
+        return None
+    try:
+        return Decimal(str(value)).quantize(Decimal('0.01'))
+    except InvalidOperation:
+        return None
+
+
+def _named(values):
+    """Ключи словаря → колонки StockRow по _COLUMN_ALIASES."""
+    named = {}
+    for key, value in values.items():
+        column = _ALIAS_TO_COLUMN.get(str(key).strip().lower())
+        if column and column not in named:
+            named[column] = value
+    return named
+
+
+def _iter_csv(stream):
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='') if _is_binary(stream) else stream
+    first = text.readline()
+    if not first:
+        return
+    delimiter = ';' if first.count(';') >= first.count(',') else ','
+    header = next(csv.reader([first], delimiter=delimiter))
+    columns = [_ALIAS_TO_COLUMN.get(cell.strip().lower()) for cell in header]
+    reader = csv.reader(text, delimiter=delimiter)
+    if 'external_id' not in columns:
+        # Без заголовка: external_id, quantity, price, wholesale_price по порядку
+        columns = list(_COLUMN_ALIASES)
+        reader = _chain_first(header, reader)
+    for cells in reader:
+        yield {column: cell for column, cell in zip(columns, cells) if column}
+
+
+def _chain_first(first, rows):
+    yield first
+    yield from rows
+
+
+def _iter_ndjson(stream):
+    lines = codecs.getreader('utf-8-sig')(stream) if _is_binary(stream) else stream
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            values = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise StockFormatError(f'NDJSON, строка {number}: {e}')
+        if isinstance(values, dict):
+            yield _named(values)
+
+
+def _iter_xml(stream):
+    try:
+        for _event, elem in ET.iterparse(stream, events=('end',)):
+            tag = local_tag(elem.tag)
+            if tag == 'Предложение':
+                item = extract_commerceml_item(elem)
+                yield {
+                    'external_id': item.id or item.attr_id,
+                    'quantity': item.stock() if (item.quantities or item.warehouses) else None,
+                    'retail_price': item.price(RETAIL_PRICE_TYPE_ID),
+                    'wholesale_price': item.price(WHOLESALE_PRICE_TYPE_ID),
+                }
+                elem.clear()
+            elif tag in ('Остаток', 'item') and elem.attrib:
+                yield _named(elem.attrib)
+                elem.clear()
+    except ET.ParseError as e:
+        raise StockFormatError(f'XML: {e}')
+
+
+def _is_binary(stream):
+    return not isinstance(stream, io.TextIOBase)
+
+
+def iter_stock_rows(stream, fmt):
+    """Строки остатков (StockRow) из потока в формате fmt (csv, ndjson, xml)."""
+    readers = {'csv': _iter_csv, 'ndjson': _iter_ndjson, 'xml': _iter_xml}
+    if fmt not in readers:
+        raise StockFormatError(f'Неизвестный формат остатков: {fmt}')
+    for values in readers[fmt](stream):
+        row = _stock_row(values)
+        if row is not None:
+            yield row
+
+
+def _case_sql(column, pairs, field):
+    """«column = CASE external_id WHEN %s THEN %s ... ELSE column END» и его параметры."""
+    qn = connection.ops.quote_name
+    whens = ' '.join(['WHEN %s THEN %s'] * len(pairs))
+    params = []
+    for external_id, value in pairs:
+        params += [external_id, field.get_db_prep_value(value, connection)]
+    return f"{qn(column)} = CASE {qn('external_id')} {whens} ELSE {qn(column)} END", params
+
+
+def _update_catalog(rows, catalog_type, now):
+    """
+    Один UPDATE ... CASE пачки строк для каталога catalog_type. Возвращает число строк в БД.
+
+    SQL собирается вручную: Case(When(...)) ORM компилирует каждую ветку отдельным
+    выражением, и на полном файле остатков (десятки тысяч Ид) сборка запросов
+    занимала больше времени, чем сам UPDATE.
+    """
+    meta = Product._meta
+    price_field = 'price' if catalog_type == 'retail' else 'wholesale_price'
+    quantities = []
+    availabilities = []
+    prices = []
+    for row in rows:
+        if row.quantity is not None:
+            quantities.append((row.external_id, row.quantity))
+            availabilities.append((row.external_id, 'in_stock' if row.quantity > 0 else 'out_of_stock'))
+        price = row.retail_price if catalog_type == 'retail' else row.wholesale_price
+        if price is not None:
+            prices.append((row.external_id, price))
+    if not quantities and not prices:
+        return 0
+
+    qn = connection.ops.quote_name
+    assignments = [f"{qn('is_active')} = %s", f"{qn('updated_at')} = %s"]
+    params = [True, meta.get_field('updated_at').get_db_prep_value(now, connection)]
+    for column, pairs in (('quantity', quantities), ('availability', availabilities), (price_field, prices)):
+        if pairs:
+            sql, case_params = _case_sql(column, pairs, meta.get_field(column))
+            assignments.append(sql)
+            params += case_params
+    # Только Ид со значениями для этого каталога: строка с одной оптовой ценой не
+    # должна активировать (и трогать updated_at) розничный товар
+    external_ids = list(dict.fromkeys(
+        external_id for external_id, _ in quantities + prices
+    ))
+    sql = (
+        f"UPDATE {qn(meta.db_table)} SET {', '.join(assignments)} "
+        f"WHERE {qn('catalog_type')} = %s AND {qn('external_id')} IN ({', '.join(['%s'] * len(external_ids))})"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params + [catalog_type] + external_ids)
+        return cursor.rowcount
+
+
+def apply_stock_updates(rows, batch_size=None):
+    """
+    Применяет строки остатков пачками по batch_size.
+
+    Повтор Ид внутри пачки — берется последняя строка. Возвращает статистику:
+    received (строк), updated (строк товаров в БД), not_found (Ид без товаров), batches.
+    """
+    batch_size = batch_size or STOCK_UPDATE_BATCH_SIZE
+    stats = {'received': 0, 'updated': 0, 'not_found': 0, 'batches': 0}
+
+    def _flush(batch):
+        rows = list(batch.values())
+        now = timezone.now()
+        updated = 0
+        for catalog_type in ('retail', 'wholesale'):
+            updated += _update_catalog(rows, catalog_type, now)
+        found = set(
+            Product.objects.filter(external_id__in=list(batch)).values_list('external_id', flat=True)
+        )
+        stats['updated'] += updated
+        stats['not_found'] += len(batch) - len(found)
+        stats['batches'] += 1
+        return updated
+
+    with import_writer(), ImportTransaction() as transaction_batch:
+        pending = {}
+        for row in rows:
+            stats['received'] += 1
+            pending[row.external_id] = row
+            if len(pending) >= batch_size:
+                transaction_batch.wrote(_flush(pending))
+                pending = {}
+        if pending:
+            transaction_batch.wrote(_flush(pending))
+    if stats['updated']:
+        safe_recompute_category_counts()
+
+    logger.info(
+        f"Остатки 1С: строк {stats['received']}, обновлено товаров {stats['updated']}, "
+        f"не найдено Ид {stats['not_found']}, пачек {stats['batches']}"
+    )
+    return stats
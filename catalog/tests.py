@@ -0,0 +1,750 @@
+import io
+import os
+import re
+import socket
+import subprocess
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import transaction
+from django.http import Http404
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from .category_counts import category_counts, recompute_category_counts
+from .category_tree import CATEGORY_TREE_VERSION_KEY, bump_category_tree_version, category_tree
+from .commerceml_generator import generate_exchange_package
+from .commerceml_views import (
+    _offer_fingerprint, _offer_unchanged, _upsert_offers_chunk, hide_products_missing_from_exchange,
+    process_commerceml_file,
+)
+from .counterparts import (
+    _retail_indexes, find_retail_counterpart_id, resolve_retail_counterparts, retail_counterpart_id_for,
+)
+from .exchange_jobs import (
+    JOB_MAX_ATTEMPTS, JOB_STALE_SECONDS, claim_job, claim_next_job, current_worker_id, requeue_stale_jobs,
+    run_exchange_job,
+)
+from .models import Brand, Category, ExchangeJob, ExchangeStagingKey, Product, ProductImage
+from .one_c_views import API_UPSERT_POLICIES
+from .product_upsert import ALWAYS, FILL_NULL, IF_PRESENT, upsert_products
+from .services import (
+    classify_names, clear_brands_cache, detect_brand, detect_category, detect_subcategory_info,
+    get_category_for_product, invalidate_keyword_matchers, process_bulk_import,
+)
+from .slugs import allocate_slugs
+from .stock_updates import StockFormatError, StockRow, apply_stock_updates, iter_stock_rows
+from .views import CategoryView
+
+
+class MainImageTests(TestCase):
+    """Денормализованное главное фото (Product.main_image)."""
+
+    def setUp(self):
+        self.product = Product.objects.create(name='Фара', article='A1', external_id='p1')
+        self.first = ProductImage.objects.create(product=self.product, image='products/1.jpg', order=0)
+        self.second = ProductImage.objects.create(product=self.product, image='products/2.jpg', order=1)
+
+    def test_queryset_delete_picks_next_image(self):
+        # Действие админки «Удалить выбранные» удаляет фото через queryset.delete()
+        ProductImage.objects.filter(pk=self.first.pk).delete()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.main_image_id, self.second.pk)
+
+    def test_queryset_delete_of_all_images_clears_link(self):
+        self.product.images.all().delete()
+        self.product.refresh_from_db()
+        self.assertIsNone(self.product.main_image_id)
+
+    def test_wholesale_without_images_uses_retail_image(self):
+        wholesale = Product.objects.create(
+            name='Фара', article='A1', external_id='p1', catalog_type='wholesale',
+            retail_counterpart=self.product,
+        )
+        ProductImage.objects.filter(pk=self.first.pk).delete()
+        wholesale.refresh_from_db()
+        self.assertEqual(wholesale.main_image_id, self.second.pk)
+
+
+def legacy_retail_counterpart(external_id, article):
+    """Прежний Product.get_retail_counterpart (до поля retail_counterpart) — эталон порядка выбора."""
+    retail = Product.objects.filter(catalog_type='retail')
+    eid = (external_id or '').strip()
+    if eid:
+        r = retail.filter(external_id=eid).first()
+        if r:
+            return r
+        if '#' in eid:
+            base = eid.split('#', 1)[0]
+            r = retail.filter(external_id=base).first()
+            if r:
+                return r
+            r = retail.filter(external_id__startswith=f'{base}#').order_by('-price', '-is_active', '-id').first()
+            if r:
+                return r
+    art = (article or '').strip()
+    if art:
+        return retail.filter(article=art).order_by('-price', '-is_active', '-id').first()
+    return None
+
+
+class RetailCounterpartTests(TestCase):
+    """Розничный аналог оптового товара (Product.retail_counterpart)."""
+
+    WHOLESALE_KEYS = [
+        ('u1', ''), (' u1 ', ''), ('u1#z', ''), ('u2', ''), ('u2#s1', ''), ('u2#s9', ''),
+        ('u3#q', 'B'), ('nope', 'B'), (None, 'C'), (None, 'zzz'), ('u5#a', 'D'), (None, ''),
+    ]
+
+    def setUp(self):
+        retail = [
+            ('u1', 'A', '100', True),
+            ('u2#s1', 'B', '50', True),
+            ('u2#s2', 'B', '50', False),
+            ('u2#s3', 'C', '70', False),
+            ('u3#x', 'B', '50', True),
+            ('u3#y', 'C', '70', False),
+            ('u4', 'D', '10', True),
+            ('u5#b', 'D', '10', True),
+        ]
+        for external_id, article, price, is_active in retail:
+            Product.objects.create(
+                name=external_id, external_id=external_id, article=article,
+                price=Decimal(price), is_active=is_active,
+            )
+
+    def expected_id(self, external_id, article):
+        legacy = legacy_retail_counterpart(external_id, article)
+        return legacy.pk if legacy else None
+
+    def test_ranking_matches_legacy_lookup(self):
+        indexes = _retail_indexes()
+        for external_id, article in self.WHOLESALE_KEYS:
+            with self.subTest(external_id=external_id, article=article):
+                expected = self.expected_id(external_id, article)
+                self.assertEqual(find_retail_counterpart_id(external_id, article, indexes), expected)
+                self.assertEqual(retail_counterpart_id_for(external_id, article), expected)
+
+    def test_resolve_matches_legacy_lookup(self):
+        Product.objects.bulk_create([
+            Product(name=f'w{i}', slug=f'w{i}', catalog_type='wholesale', external_id=external_id, article=article)
+            for i, (external_id, article) in enumerate(self.WHOLESALE_KEYS)
+        ])
+        with self.assertLogs('catalog.counterparts', level='INFO'):
+            resolve_retail_counterparts()
+        for product in Product.objects.filter(catalog_type='wholesale'):
+            with self.subTest(external_id=product.external_id, article=product.article):
+                self.assertEqual(product.retail_counterpart_id, self.expected_id(product.external_id, product.article))
+
+    def test_save_resolves_wholesale_product(self):
+        # Оптовый товар, созданный в админке, получает пару без обмена
+        product = Product.objects.create(name='w', catalog_type='wholesale', external_id='u2#s9')
+        self.assertEqual(product.get_retail_counterpart(), legacy_retail_counterpart('u2#s9', ''))
+        product.external_id = 'u4'
+        product.save()
+        product.refresh_from_db()
+        self.assertEqual(product.retail_counterpart_id, self.expected_id('u4', ''))
+
+    def test_save_of_retail_product_updates_wholesale_pairs(self):
+        wholesale = Product.objects.create(name='w', catalog_type='wholesale', external_id='u9#a', article='E')
+        self.assertIsNone(wholesale.retail_counterpart_id)
+        retail = Product.objects.create(name='r', external_id='u9#b', article='F')
+        wholesale.refresh_from_db()
+        self.assertEqual(wholesale.retail_counterpart_id, retail.pk)
+
+        # Более дорогой кандидат с той же базой становится парой
+        other = Product.objects.create(name='r2', external_id='u9#c', price=Decimal('5'))
+        wholesale.refresh_from_db()
+        self.assertEqual(wholesale.retail_counterpart_id, other.pk)
+
+        retail.price = Decimal('10')
+        retail.save()
+        wholesale.refresh_from_db()
+        self.assertEqual(wholesale.retail_counterpart_id, retail.pk)
+
+    def test_save_with_unrelated_update_fields_skips_lookup(self):
+        product = Product.objects.get(external_id='u4')
+        product.quantity = 3
+        with self.assertNumQueries(1):
+            product.save(update_fields=['quantity'])
+
+
+class OfferFingerprintTests(TestCase):
+    """Пропуск неизменившихся предложений offers.xml (offer_fingerprint)."""
+
+    rec = {
+        'product_id': 'offer-1', 'name': 'Стартер', 'article': 'A1', 'supplier_article': 'S1', 'brand': 'TOYOTA',
+        'characteristics': '', 'applicability': '', 'cross_numbers': '', 'quantity': 5,
+        'retail_price': Decimal('100.00'), 'wholesale_price': Decimal('80.00'),
+    }
+
+    def apply_offer(self):
+        stats = {
+            'processed': 0, 'created': 0, 'updated': 0, 'unchanged': 0, 'errors': [],
+            'processed_external_ids': set(), 'processed_articles': set(),
+        }
+        _upsert_offers_chunk([dict(self.rec)], 'retail', stats, lambda name: None)
+        return stats
+
+    def setUp(self):
+        self.apply_offer()
+        self.product = Product.objects.get(external_id='offer-1', catalog_type='retail')
+
+    def test_same_offer_is_skipped(self):
+        self.assertEqual(self.product.offer_fingerprint, _offer_fingerprint(self.rec))
+        self.assertTrue(_offer_unchanged(self.product, self.rec, _offer_fingerprint(self.rec), 'retail', lambda name: None))
+        stats = self.apply_offer()
+        self.assertEqual((stats['unchanged'], stats['updated']), (1, 0))
+
+    def test_quantity_changed_outside_exchange_is_rewritten(self):
+        # Остаток поменяли в обход обмена (заказ, скрытие отсутствующих) — отпечаток тот же
+        Product.objects.filter(pk=self.product.pk).update(quantity=0, availability='out_of_stock')
+        self.product.refresh_from_db()
+        self.assertFalse(_offer_unchanged(self.product, self.rec, _offer_fingerprint(self.rec), 'retail', lambda name: None))
+        stats = self.apply_offer()
+        self.assertEqual((stats['unchanged'], stats['updated']), (0, 1))
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.quantity, self.product.availability), (5, 'in_stock'))
+
+    def test_inactive_product_is_rewritten(self):
+        Product.objects.filter(pk=self.product.pk).update(is_active=False)
+        self.product.refresh_from_db()
+        self.assertFalse(_offer_unchanged(self.product, self.rec, _offer_fingerprint(self.rec), 'retail', lambda name: None))
+        stats = self.apply_offer()
+        self.assertEqual((stats['unchanged'], stats['updated']), (0, 1))
+        self.product.refresh_from_db()
+        self.assertTrue(self.product.is_active)
+
+
+class CategoryCountTests(TestCase):
+    """Счетчики товаров категорий (CategoryProductCount) после правки одного товара."""
+
+    def setUp(self):
+        self.root = Category.objects.create(name='Автозапчасти')
+        self.child = Category.objects.create(name='Фары', parent=self.root)
+        recompute_category_counts()
+
+    def counts(self):
+        counts = category_counts([self.root, self.child])
+        return {
+            category_id: (c.retail_direct, c.retail_total, c.wholesale_total, c.in_stock_total)
+            for category_id, c in counts.items()
+        }
+
+    def assertMatchesRecompute(self):
+        # Сдвиги ±1 дают то же, что полный пересчет
+        shifted = self.counts()
+        recompute_category_counts()
+        self.assertEqual(shifted, self.counts())
+
+    def test_created_product_is_counted(self):
+        Product.objects.create(name='Фара', category=self.child, quantity=2, availability='in_stock')
+        self.assertEqual(self.counts(), {self.root.pk: (0, 1, 0, 0), self.child.pk: (1, 1, 0, 0)})
+        self.assertEqual(Category.objects.get(pk=self.root.pk).product_count, 1)
+        self.assertMatchesRecompute()
+
+    def test_edit_and_delete_shift_counts(self):
+        product = Product.objects.create(name='Фара', category=self.child, quantity=2, availability='in_stock')
+        product.quantity = 0
+        product.availability = 'out_of_stock'
+        product.save(update_fields=['quantity', 'availability'])
+        self.assertEqual(self.counts()[self.root.pk], (0, 0, 0, 0))
+
+        product = Product.objects.get(pk=product.pk)
+        product.quantity = 1
+        product.availability = 'in_stock'
+        product.category = self.root
+        product.save()
+        self.assertEqual(self.counts(), {self.root.pk: (1, 1, 0, 0), self.child.pk: (0, 0, 0, 0)})
+        self.assertMatchesRecompute()
+
+        Product.objects.filter(pk=product.pk).delete()
+        self.assertEqual(self.counts()[self.root.pk], (0, 0, 0, 0))
+
+    def test_wholesale_and_deferred_fields(self):
+        Product.objects.create(name='Фара', category=self.child, catalog_type='wholesale', quantity=0)
+        self.assertEqual(self.counts()[self.root.pk], (0, 0, 1, 0))
+        # Загружен без полей счетчиков — пересчет целиком
+        product = Product.objects.only('id', 'name').get(catalog_type='wholesale')
+        product.quantity = 3
+        product.save()
+        self.assertEqual(self.counts()[self.root.pk], (0, 0, 1, 1))
+        self.assertMatchesRecompute()
+
+
+class StockUpdateTests(TestCase):
+    """Быстрое обновление остатков и цен (stock_updates)."""
+
+    def rows(self, data, fmt):
+        return list(iter_stock_rows(io.BytesIO(data.encode('utf-8')), fmt))
+
+    def test_formats_parse_into_rows(self):
+        expected = [
+            StockRow('a#1', 3, Decimal('100.00'), Decimal('80.50')),
+            StockRow('b', 0, None, None),
+        ]
+        csv_data = 'Ид;Количество;Цена;ЦенаОпт\na#1;3;100;80,50\nb;-2;;\n'
+        self.assertEqual(self.rows(csv_data, 'csv'), expected)
+        # Без заголовка — колонки по порядку, разделитель «,»
+        self.assertEqual(self.rows('a#1,3,100,80.50\nb,-2,,\n', 'csv'), expected)
+        ndjson = (
+            '{"external_id": "a#1", "quantity": 3, "price": 100, "wholesale_price": "80.50"}\n'
+            '\n'
+            '{"id": "b", "qty": -2}\n'
+        )
+        self.assertEqual(self.rows(ndjson, 'ndjson'), expected)
+        xml = '<Остатки><Остаток Ид="a#1" Количество="3" Цена="100" ЦенаОпт="80.50"/><Остаток Ид="b" Количество="-2"/></Остатки>'
+        self.assertEqual(self.rows(xml, 'xml'), expected)
+
+    def test_rows_without_id_or_values_are_skipped(self):
+        self.assertEqual(self.rows('external_id;quantity\n;5\nc;\n', 'csv'), [])
+        with self.assertRaises(StockFormatError):
+            self.rows('{broken\n', 'ndjson')
+
+    def test_apply_updates_each_catalog(self):
+        retail = Product.objects.create(name='r', external_id='a#1', price=Decimal('1'))
+        wholesale = Product.objects.create(
+            name='w', external_id='a#1', catalog_type='wholesale', wholesale_price=Decimal('1'),
+        )
+        rows = [
+            StockRow('a#1', 7, Decimal('10.00'), Decimal('5.00')),
+            StockRow('missing', 1, Decimal('1.00'), None),
+            # Повтор Ид в пачке — берется последняя строка
+            StockRow('a#1', 0, Decimal('12.00'), Decimal('6.00')),
+        ]
+        with self.assertLogs('catalog.stock_updates', level='INFO'):
+            stats = apply_stock_updates(iter(rows))
+        self.assertEqual(
+            (stats['received'], stats['updated'], stats['not_found'], stats['batches']), (3, 2, 1, 1),
+        )
+        retail.refresh_from_db()
+        wholesale.refresh_from_db()
+        self.assertEqual(
+            (retail.quantity, retail.availability, retail.price, retail.wholesale_price),
+            (0, 'out_of_stock', Decimal('12.00'), None),
+        )
+        self.assertEqual(
+            (wholesale.quantity, wholesale.availability, wholesale.price, wholesale.wholesale_price),
+            (0, 'out_of_stock', Decimal('0.00'), Decimal('6.00')),
+        )
+
+    def test_row_without_values_for_catalog_leaves_it_alone(self):
+        hidden = Product.objects.create(name='r', external_id='a', is_active=False, quantity=2, price=Decimal('3'))
+        Product.objects.create(name='w', external_id='a', catalog_type='wholesale')
+        Product.objects.create(name='b', external_id='b')
+        updated_at = Product.objects.get(pk=hidden.pk).updated_at
+        rows = [StockRow('a', None, None, Decimal('9.00')), StockRow('b', 4, None, None)]
+        with self.assertLogs('catalog.stock_updates', level='INFO'):
+            stats = apply_stock_updates(iter(rows))
+        self.assertEqual(stats['updated'], 2)
+        hidden.refresh_from_db()
+        self.assertEqual((hidden.is_active, hidden.quantity, hidden.updated_at), (False, 2, updated_at))
+        self.assertEqual(Product.objects.get(catalog_type='wholesale').wholesale_price, Decimal('9.00'))
+
+
+class HideMissingProductsTests(TestCase):
+    """Скрытие товаров, которых нет в обмене (hide_products_missing_from_exchange)."""
+
+    def product(self, external_id, **fields):
+        fields.setdefault('quantity', 5)
+        return Product.objects.create(name=external_id or 'no-id', external_id=external_id, **fields)
+
+    def state(self, product):
+        product.refresh_from_db()
+        return product.quantity, product.availability, product.is_active
+
+    def test_sweep(self):
+        present = self.product('present')
+        by_article = self.product('old-id', article='ART-1')
+        missing = self.product('missing')
+        hidden = self.product('hidden', quantity=0, availability='out_of_stock')
+        inactive_present = self.product('back', is_active=False)
+        stale = self.product(None, article='GONE')
+        wholesale = self.product('missing', catalog_type='wholesale')
+
+        result = hide_products_missing_from_exchange(
+            'retail', ['present', 'back'], articles=['art-1'], hide_stale_by_article=True,
+        )
+
+        # Уже скрытый товар не перезаписывается и не попадает в счетчик
+        self.assertEqual(result, {'hidden': 1, 'reactivated': 1, 'stale': 1})
+        self.assertEqual(self.state(present), (5, 'in_stock', True))
+        self.assertEqual(self.state(by_article), (5, 'in_stock', True))
+        self.assertEqual(self.state(missing), (0, 'out_of_stock', True))
+        self.assertEqual(self.state(hidden), (0, 'out_of_stock', True))
+        self.assertEqual(self.state(inactive_present), (5, 'in_stock', True))
+        self.assertEqual(self.state(stale), (0, 'out_of_stock', True))
+        self.assertEqual(self.state(wholesale), (5, 'in_stock', True))
+        self.assertFalse(ExchangeStagingKey.objects.exists())
+
+
+class ProductUpsertTests(TestCase):
+    """INSERT ... ON CONFLICT(external_id, catalog_type) с политиками полей (product_upsert)."""
+
+    def setUp(self):
+        self.manual = Category.objects.create(name='Ручная')
+        self.exchange = Category.objects.create(name='Из обмена')
+
+    def incoming(self, **fields):
+        # Строка из обмена: новый экземпляр, даже если товар с таким ключом уже есть
+        values = {'name': 'Фара', 'external_id': 'x1', 'price': Decimal('10'), 'quantity': 1}
+        values.update(fields)
+        return Product(**values)
+
+    def test_insert_and_update_on_conflict(self):
+        self.assertEqual(upsert_products([self.incoming(article='A1')], API_UPSERT_POLICIES), 1)
+        product = Product.objects.get(external_id='x1')
+        self.assertTrue(product.slug)
+        Product.objects.filter(pk=product.pk).update(meta_title='SEO из админки')
+
+        upsert_products([self.incoming(name='Фара LED', price=Decimal('12'), article='A1')], API_UPSERT_POLICIES)
+        self.assertEqual(Product.objects.filter(external_id='x1').count(), 1)
+        product.refresh_from_db()
+        self.assertEqual((product.name, product.price), ('Фара LED', Decimal('12.00')))
+        # Поле без политики пишется только при вставке
+        self.assertEqual(product.meta_title, 'SEO из админки')
+
+    def test_if_present_keeps_old_value_for_empty_input(self):
+        policies = {'description': IF_PRESENT, 'old_price': IF_PRESENT}
+        upsert_products([self.incoming(description='Старое', old_price=Decimal('15'))], policies)
+        upsert_products([self.incoming(description='', old_price=None)], policies)
+        product = Product.objects.get(external_id='x1')
+        self.assertEqual((product.description, product.old_price), ('Старое', Decimal('15.00')))
+        upsert_products([self.incoming(description='Новое', old_price=Decimal('20'))], policies)
+        product.refresh_from_db()
+        self.assertEqual((product.description, product.old_price), ('Новое', Decimal('20.00')))
+
+    def test_fill_null_only_fills_empty_column(self):
+        policies = {'category': FILL_NULL}
+        upsert_products([self.incoming(), self.incoming(external_id='x2', category=self.manual)], policies)
+        upsert_products([
+            self.incoming(category=self.exchange),
+            self.incoming(external_id='x2', category=self.exchange),
+        ], policies)
+        categories = dict(Product.objects.values_list('external_id', 'category_id'))
+        self.assertEqual(categories, {'x1': self.exchange.pk, 'x2': self.manual.pk})
+
+    def test_retail_and_wholesale_rows_stay_separate(self):
+        policies = {'price': ALWAYS, 'wholesale_price': ALWAYS}
+        upsert_products([
+            self.incoming(price=Decimal('10')),
+            self.incoming(catalog_type='wholesale', price=Decimal('0'), wholesale_price=Decimal('7')),
+        ], policies)
+        upsert_products([self.incoming(catalog_type='wholesale', price=Decimal('0'), wholesale_price=Decimal('8'))], policies)
+        rows = dict(Product.objects.filter(external_id='x1').values_list('catalog_type', 'wholesale_price'))
+        self.assertEqual(rows, {'retail': None, 'wholesale': Decimal('8.00')})
+        self.assertEqual(Product.objects.get(external_id='x1', catalog_type='retail').price, Decimal('10.00'))
+
+    def test_unknown_policy_field_is_rejected(self):
+        with self.assertRaises(ValueError):
+            upsert_products([self.incoming()], {'no_such_field': ALWAYS})
+
+
+class ClassifyNamesTests(TestCase):
+    """Пакетная классификация (classify_names) совпадает с поштучной (get_category_for_product)."""
+
+    names = [
+        'Хаб (TOYOTA, COROLLA)', 'Стартер TOYOTA, A0', 'Генератор NISSAN, 23100',
+        'Хаб (TOYOTA, CAMRY)', 'Фара левая TOYOTA',
+    ]
+
+    def setUp(self):
+        engine = Category.objects.create(name='Двигатель и выхлопная система')
+        Category.objects.create(name='Трансмиссия и тормозная система')
+        electric = Category.objects.create(name='Автоэлектрика')
+        # Неактивная подкатегория (активируется) и дубль под чужим корнем (переносится)
+        Category.objects.create(name='Стартеры', parent=engine, is_active=False)
+        Category.objects.create(name='Генераторы', parent=electric, is_active=False)
+
+    def tree(self):
+        return sorted(
+            (c.name, c.parent.name if c.parent else None, c.is_active)
+            for c in Category.objects.select_related('parent')
+        )
+
+    @staticmethod
+    def label(category):
+        return category and (category.name, category.parent.name if category.parent else None)
+
+    def test_batch_matches_sequential(self):
+        before = self.tree()
+        with transaction.atomic():
+            sequential = {name: self.label(get_category_for_product(name)) for name in self.names}
+            sequential_tree = self.tree()
+            transaction.set_rollback(True)
+        self.assertEqual(self.tree(), before)
+
+        batch = {name: self.label(category) for name, category in classify_names(self.names).items()}
+        self.assertEqual(batch, sequential)
+        self.assertEqual(self.tree(), sequential_tree)
+
+        tree = {(name, parent): active for name, parent, active in sequential_tree}
+        self.assertTrue(tree[('Хаб', 'Трансмиссия и тормозная система')])
+        self.assertTrue(tree[('Стартеры', 'Двигатель и выхлопная система')])
+        self.assertTrue(tree[('Генераторы', 'Двигатель и выхлопная система')])
+        # Дубль перенесен, а не создан заново
+        self.assertEqual(Category.objects.filter(name='Генераторы').count(), 1)
+
+    def test_bulk_import_survives_batch_classification_error(self):
+        rows = [{'name': name, 'price': '100', 'quantity': '1'} for name in self.names[:2]]
+        with mock.patch('catalog.services.classify_names', side_effect=RuntimeError('boom')), \
+                self.assertLogs('catalog.services', level='WARNING'):
+            stats = process_bulk_import(rows)
+        self.assertEqual((stats['created'], stats['errors']), (2, 0))
+        categories = {p.name: self.label(p.category) for p in Product.objects.select_related('category__parent')}
+        self.assertEqual(categories['Стартер TOYOTA, A0'], ('Стартеры', 'Двигатель и выхлопная система'))
+
+
+class KeywordMatcherTests(TestCase):
+    """Автоопределение бренда и категории через KeywordMatcher."""
+
+    def setUp(self):
+        clear_brands_cache()
+        invalidate_keyword_matchers()
+
+    def test_brand_word_boundaries(self):
+        # Справочник брендов пуст — используются базовые, где есть и TOYO, и Toyota
+        self.assertEqual(detect_brand('Стартер TOYOTA COROLLA'), 'Toyota')
+        self.assertEqual(detect_brand('Крестовина TOYO TT-124'), 'TOYO')
+        self.assertEqual(detect_brand('крестовина toyo, tt-124'), 'TOYO')
+        self.assertIsNone(detect_brand('TOYOTAS TOYOX'))
+
+    def test_brand_list_from_database(self):
+        Brand.objects.create(name='TOYO')
+        Brand.objects.create(name='TOYOTA')
+        clear_brands_cache()
+        self.assertEqual(detect_brand('TOYO TOYOTA'), 'TOYOTA')
+        self.assertEqual(detect_brand('Крестовина TOYO'), 'TOYO')
+
+    def test_longest_keyword_wins(self):
+        self.assertEqual(detect_category('Датчик скорости колеса передний'), 'Трансмиссия и тормозная система')
+        self.assertEqual(detect_category('Датчик скорости'), 'Автоэлектрика')
+        self.assertEqual(detect_category('Что-то без ключевых слов'), 'Двигатель и выхлопная система')
+
+        root = Category.objects.create(name='Оптика', keywords='фара')
+        Category.objects.create(name='Фары', parent=root, keywords='фара')
+        Category.objects.create(name='Фары противотуманные', parent=root, keywords='фара противотуманная')
+        self.assertEqual(detect_subcategory_info('Фара противотуманная левая'), ('Оптика', 'Фары противотуманные'))
+        self.assertEqual(detect_subcategory_info('Фара левая'), ('Оптика', 'Фары'))
+
+    def test_matcher_rebuilt_after_category_save(self):
+        root = Category.objects.create(name='Тюнинг', keywords='спойлер')
+        self.assertEqual(detect_category('Спойлер задний'), 'Тюнинг')
+        self.assertEqual(detect_category('Реле поворотов'), 'Автоэлектрика')
+
+        root.keywords = 'спойлер, реле'
+        root.save()
+        # Без ожидания перепроверки сигнатуры (_KEYWORD_MATCHERS_RECHECK_SECONDS)
+        self.assertEqual(detect_category('Реле поворотов'), 'Тюнинг')
+
+
+class AllocateSlugsTests(TestCase):
+    """Выделение уникальных slug пачкой."""
+
+    def test_free_base_kept_unchanged(self):
+        long_base = 'a' * 200
+        self.assertEqual(allocate_slugs(Category, ['filtry', long_base]), ['filtry', long_base])
+        # Длиннее поля — только обрезка по max_length
+        self.assertEqual(allocate_slugs(Category, ['b' * 250]), ['b' * 200])
+
+    def test_smallest_free_suffix(self):
+        for slug in ('filtr', 'filtr-1', 'filtr-3', 'filtr-abc'):
+            Category.objects.create(name=slug, slug=slug)
+        self.assertEqual(allocate_slugs(Category, ['filtr']), ['filtr-2'])
+
+        long_base = 'a' * 200
+        Category.objects.create(name='Длинная', slug=long_base)
+        slug, = allocate_slugs(Category, [long_base])
+        self.assertLessEqual(len(slug), 200)
+        self.assertTrue(slug.endswith('-1'))
+        self.assertTrue(long_base.startswith(slug[:-2]))
+
+    def test_duplicates_within_batch(self):
+        self.assertEqual(allocate_slugs(Category, ['maslo', 'maslo', 'maslo']), ['maslo', 'maslo-1', 'maslo-2'])
+
+        Category.objects.create(name='abc', slug='abc')
+        # base-N одной основы не должен совпасть со свободным base другой
+        self.assertEqual(allocate_slugs(Category, ['abc', 'abc-1']), ['abc-1', 'abc-1-1'])
+
+    def test_exclude_pk(self):
+        category = Category.objects.create(name='filtr', slug='filtr')
+        self.assertEqual(allocate_slugs(Category, ['filtr'], exclude_pk=category.pk), ['filtr'])
+        self.assertEqual(allocate_slugs(Category, ['filtr']), ['filtr-1'])
+
+
+class CategoryTreeTests(TestCase):
+    """Снимок дерева категорий: разбор пути, потомки, инвалидация."""
+
+    def setUp(self):
+        # Откат транзакции теста счетчик версии не меняет — снимок прошлого теста сбрасываем
+        bump_category_tree_version()
+        self.engine = Category.objects.create(name='Двигатель', slug='dvigatel')
+        self.starters = Category.objects.create(name='Стартеры', slug='startery', parent=self.engine)
+        self.bendix = Category.objects.create(name='Бендиксы', slug='bendiksy', parent=self.starters)
+        self.hidden = Category.objects.create(name='Архив', slug='arhiv', is_active=False)
+        self.hidden_child = Category.objects.create(name='Фильтры', slug='filtry', parent=self.hidden)
+
+    def test_resolve_path_normalizes_slashes(self):
+        tree = category_tree()
+        for path in ('dvigatel/startery', 'dvigatel/startery/', '/dvigatel//startery/', 'dvigatel///startery'):
+            self.assertEqual(tree.resolve_path(path).pk, self.starters.pk, path)
+        self.assertEqual(tree.resolve_path('dvigatel/startery/bendiksy').pk, self.bendix.pk)
+        self.assertIsNone(tree.resolve_path('startery'))
+        self.assertIsNone(tree.resolve_path('dvigatel/bendiksy'))
+        self.assertIsNone(tree.resolve_path(''))
+
+    def test_inactive_ancestor_returns_404(self):
+        tree = category_tree()
+        self.assertIsNone(tree.resolve_path('arhiv'))
+        self.assertIsNone(tree.resolve_path('arhiv/filtry'))
+
+        view = CategoryView()
+        view.kwargs = {'path': 'arhiv/filtry/'}
+        with self.assertRaises(Http404):
+            view.get_category()
+        view.kwargs = {'path': 'dvigatel/startery/'}
+        self.assertEqual(view.get_category().pk, self.starters.pk)
+
+    def test_descendant_ids(self):
+        tree = category_tree()
+        self.assertEqual(tree.descendant_ids(self.engine.pk), {self.engine.pk, self.starters.pk, self.bendix.pk})
+        self.assertEqual(tree.descendant_ids(self.engine.pk, include_self=False), {self.starters.pk, self.bendix.pk})
+        self.assertEqual(tree.descendant_ids(self.bendix.pk), {self.bendix.pk})
+        self.assertEqual(tree.descendant_ids(-1), frozenset())
+        engine = Category.objects.get(pk=self.engine.pk)
+        mptt_ids = engine.get_descendants(include_self=True).values_list('id', flat=True)
+        self.assertEqual(tree.descendant_ids(engine.pk), set(mptt_ids))
+
+    def test_snapshot_invalidated_after_category_save(self):
+        tree = category_tree()
+        version = cache.get(CATEGORY_TREE_VERSION_KEY, 0)
+        self.assertIs(category_tree(), tree)
+
+        self.hidden.is_active = True
+        self.hidden.save()
+        self.assertGreater(cache.get(CATEGORY_TREE_VERSION_KEY, 0), version)
+        # Без ожидания перепроверки сигнатуры (CATEGORY_TREE_RECHECK_SECONDS)
+        fresh = category_tree()
+        self.assertIsNot(fresh, tree)
+        self.assertEqual(fresh.resolve_path('arhiv/filtry').pk, self.hidden_child.pk)
+
+    def test_snapshot_signature_catches_queryset_update(self):
+        tree = category_tree()
+        # Перенос через queryset.update версию не меняет — его видит сигнатура таблицы
+        Category.objects.filter(pk=self.bendix.pk).update(parent=self.engine)
+        self.assertIs(category_tree(), tree)
+        with mock.patch('catalog.category_tree.CATEGORY_TREE_RECHECK_SECONDS', 0):
+            fresh = category_tree()
+        self.assertIsNot(fresh, tree)
+        self.assertEqual(fresh.resolve_path('dvigatel/bendiksy').pk, self.bendix.pk)
+
+
+@override_settings(ONE_C_HIDE_MISSING_PRODUCTS=True)
+class ChangesOnlyOffersTests(TestCase):
+    """offers.xml: пакет изменений не скрывает товары, которых в нем нет."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        package = generate_exchange_package(self.tmp.name, offers=3)
+        self.offers_path = package['offers']
+        for catalog_type in ('retail', 'wholesale'):
+            Product.objects.create(
+                name='Старый товар', external_id='absent-1', catalog_type=catalog_type,
+                quantity=5, availability='in_stock', is_active=True,
+            )
+
+    def _process(self, changes_only):
+        with open(self.offers_path, encoding='utf-8') as f:
+            xml = f.read()
+        if changes_only:
+            xml = xml.replace('СодержитТолькоИзменения="false"', 'СодержитТолькоИзменения="true"')
+        with open(self.offers_path, 'w', encoding='utf-8') as f:
+            f.write(xml)
+        return process_commerceml_file(self.offers_path, 'offers.xml', force=True)
+
+    def test_delta_package_keeps_absent_products(self):
+        result = self._process(changes_only=True)
+        self.assertTrue(result['changes_only'])
+        for product in Product.objects.filter(external_id='absent-1'):
+            self.assertEqual((product.quantity, product.availability), (5, 'in_stock'), product.catalog_type)
+
+    def test_full_package_hides_absent_products(self):
+        result = self._process(changes_only=False)
+        self.assertFalse(result['changes_only'])
+        for product in Product.objects.filter(external_id='absent-1'):
+            self.assertEqual((product.quantity, product.availability), (0, 'out_of_stock'), product.catalog_type)
+
+
+class ExchangeJobTests(TestCase):
+    """Очередь заданий обмена: захват, контрольная точка, перезапуск упавших."""
+
+    def _running_job(self, worker, attempts=1, stale=True):
+        job = ExchangeJob.objects.create(
+            filename='offers.xml', file_path='/nonexistent/offers.xml', is_ready=True,
+            status='running', worker=worker, attempts=attempts,
+        )
+        if stale:
+            updated_at = timezone.now() - timedelta(seconds=JOB_STALE_SECONDS + 60)
+            ExchangeJob.objects.filter(pk=job.pk).update(updated_at=updated_at)
+        return job
+
+    def test_claim_job(self):
+        job = ExchangeJob.objects.create(filename='offers.xml', file_path='/tmp/offers.xml', is_ready=True)
+        # Копия, прочитанная другим воркером до захвата
+        other = ExchangeJob.objects.get(pk=job.pk)
+        self.assertTrue(claim_job(job))
+        self.assertEqual((job.status, job.worker, job.attempts), ('running', current_worker_id(), 1))
+        self.assertIsNotNone(job.started_at)
+        self.assertFalse(claim_job(other))
+        self.assertEqual(other.status, 'pending')
+
+    def test_claim_next_job_skips_unconfirmed_upload(self):
+        ExchangeJob.objects.create(filename='import.xml', file_path='/tmp/import.xml', is_ready=False)
+        ready = ExchangeJob.objects.create(filename='offers.xml', file_path='/tmp/offers.xml', is_ready=True)
+        self.assertEqual(claim_next_job().pk, ready.pk)
+        self.assertIsNone(claim_next_job())
+
+    def test_resume_from_checkpoint(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        offers_path = generate_exchange_package(tmp.name, offers=5)['offers']
+        with open(offers_path, encoding='utf-8') as f:
+            offer_ids = re.findall(r'<Предложение><Ид>([^<]+)</Ид>', f.read())
+
+        job = ExchangeJob.objects.create(filename='offers.xml', file_path=offers_path, is_ready=True)
+        self.assertTrue(claim_job(job))
+        # Воркер упал после первых трех предложений
+        ExchangeJob.objects.filter(pk=job.pk).update(checkpoint=3)
+        job.refresh_from_db()
+        run_exchange_job(job)
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.progress, job.checkpoint, job.total), ('success', 100, 5, 5))
+        written = set(Product.objects.filter(catalog_type='retail').values_list('external_id', flat=True))
+        self.assertEqual(written, set(offer_ids[3:]))
+
+    def test_requeue_only_dead_workers(self):
+        host = socket.gethostname()
+        finished = subprocess.Popen(['true'])
+        finished.wait()
+        dead = self._running_job(f'{host}:{finished.pid}')
+        # Родительский процесс тестов заведомо жив
+        alive = self._running_job(f'{host}:{os.getppid()}')
+        fresh = self._running_job(f'{host}:{finished.pid}', stale=False)
+        exhausted = self._running_job(f'{host}:{finished.pid}', attempts=JOB_MAX_ATTEMPTS)
+        old_alive_updated_at = ExchangeJob.objects.get(pk=alive.pk).updated_at
+
+        with self.assertLogs('catalog.exchange_jobs', 'WARNING'):
+            self.assertEqual(requeue_stale_jobs(), 1)
+
+        statuses = dict(ExchangeJob.objects.values_list('pk', 'status'))
+        self.assertEqual(statuses[dead.pk], 'pending')
+        self.assertEqual(statuses[alive.pk], 'running')
+        self.assertEqual(statuses[fresh.pk], 'running')
+        self.assertEqual(statuses[exhausted.pk], 'failure')
+        # Живому воркеру продлевается срок, чтобы не проверять его на каждом проходе
+        self.assertGreater(ExchangeJob.objects.get(pk=alive.pk).updated_at, old_alive_updated_at)
@@ -7,6 +7,8 @@ from django.core.paginator import Paginator
 from django.urls import reverse
 from django.conf import settings
 from .models import Category, Product
+from .category_counts import category_count, category_counts
+from .category_tree import category_tree
 from .filters import ProductFilter, get_brand_choices
 from .services import (
     format_models_multiline,
@@ -23,6 +25,32 @@ from .services import (
 )
 
 
+def _subcategories_with_counts(category, products, filterset, request):
+    """
+    Активные подкатегории category, в которых есть видимые товары, и сумма их товаров.
+
+    Без фильтров количество берется из CategoryProductCount одним запросом; с фильтрами
+    считается по отфильтрованному queryset products (по запросу на подкатегорию).
+    """
+    subcategories = []
+    total = 0
+    children = list(category.children.filter(is_active=True).order_by('name'))
+    filtered = any(request.GET.get(name) for name in filterset.filters)
+    counts = category_counts(children)
+    for sub in children:
+        # Шаблон берет sub.product_count как значение по умолчанию — без запроса на подкатегорию
+        sub._product_count = counts[sub.pk].retail_total if sub.pk in counts else 0
+        if filtered:
+            visible_count = products.filter(category_id__in=category_tree().descendant_ids(sub.id)).count()
+        else:
+            visible_count = sub._product_count
+        if visible_count > 0:
+            sub.visible_product_count = visible_count
+            subcategories.append(sub)
+            total += visible_count
+    return subcategories, total
+
+
 class CatalogView(ListView):
     """Главная страница каталога."""
     model = Category
@@ -40,10 +68,12 @@ class CatalogView(ListView):
         context = super().get_context_data(**kwargs)
         # Фильтруем категории, у которых есть товары (включая подкатегории)
         categories_with_products = []
-        for category in context['categories']:
-            category.active_children = category.children.filter(is_active=True)
-            # Единый источник правды для количества: Category.product_count.
-            product_count = category.product_count
+        categories = list(context['categories'])
+        # Счетчики всех корневых категорий — одним запросом (CategoryProductCount)
+        counts = category_counts(categories)
+        for category in categories:
+            category.active_children = [child for child in category.children.all() if child.is_active]
+            product_count = counts[category.pk].retail_total if category.pk in counts else 0
             if product_count > 0:
                 category.retail_product_count = product_count
                 categories_with_products.append(category)
@@ -60,38 +90,21 @@ class CategoryView(ListView):
     paginate_by = None
 
     def _visible_products_count_for_branch(self, category):
-        descendants = category.get_descendants(include_self=True)
-        return Product.for_site_catalog('retail').filter(
-            category__in=descendants,
-        ).count()
+        return category_count(category)
 
     def get_category(self):
         path = self.kwargs.get('path', '')
         if not path:
             return None
         
-        slugs = [s for s in path.split('/') if s]  # Убираем пустые строки
-        
-        if not slugs:
+        if not any(s for s in path.split('/')):
             return None
         
-        
-        category = None
-        for slug in slugs:
-            if category:
-                category = get_object_or_404(
-                    Category, 
-                    slug=slug, 
-                    parent=category,
-                    is_active=True
-                )
-            else:
-                category = get_object_or_404(
-                    Category, 
-                    slug=slug, 
-                    parent=None,
-                    is_active=True
-                )
+        # Весь путь — по снимку дерева категорий, без запроса на сегмент
+        category = category_tree().resolve_path(path)
+        if category is None:
+            from django.http import Http404
+            raise Http404("Категория не найдена")
         return category
     
 
@@ -100,17 +113,16 @@ class CategoryView(ListView):
         if not self.category:
             # Если категория не найдена, возвращаем пустой queryset
             # Это вызовет 404 через get_object_or_404 в get_category
-            from django.core.exceptions import Http404
+            from django.http import Http404
             raise Http404("Категория не найдена")
         
-        descendants = self.category.get_descendants(include_self=True)
         # Для категорий с подкатегориями показываем только товары из дочерних веток.
         # Это выравнивает "Найдено" с суммой по подкатегориям.
-        if self.category.children.filter(is_active=True).exists():
-            descendants = descendants.exclude(id=self.category.id)
+        has_active_children = self.category.children.filter(is_active=True).exists()
+        descendants = category_tree().descendant_ids(self.category.id, include_self=not has_active_children)
         queryset = Product.for_site_catalog('retail').filter(
-            category__in=descendants,
-        ).select_related('category').prefetch_related('images')
+            category_id__in=descendants,
+        ).select_related('category', 'main_image')
         
         # Применяем фильтры
         self.filterset = ProductFilter(self.request.GET, queryset=queryset)
@@ -119,11 +131,11 @@ class CategoryView(ListView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         if not self.category:
-            from django.core.exceptions import Http404
+            from django.http import Http404
             raise Http404("Категория не найдена")
         
         context['category'] = self.category
-        context['breadcrumbs'] = self.category.get_ancestors(include_self=True)
+        context['breadcrumbs'] = category_tree().ancestors(self.category.id, include_self=True)
         # Пагинация
         products = self.get_queryset()
         paginator = Paginator(products, getattr(settings, 'PRODUCTS_PER_PAGE', 24))
@@ -141,22 +153,15 @@ class CategoryView(ListView):
 
         # Показываем только активные дочерние подкатегории с товарами (>0).
         # "Найдено" считаем строго как сумму отображаемых подкатегорий.
-        subcategories = []
-        total_in_subcategories = 0
-        subcategories_qs = self.category.children.filter(is_active=True).order_by('name')
-        for sub in subcategories_qs:
-            sub_descendants = sub.get_descendants(include_self=True)
-            visible_count = products.filter(category__in=sub_descendants).count()
-            if visible_count > 0:
-                sub.visible_product_count = visible_count
-                subcategories.append(sub)
-                total_in_subcategories += visible_count
+        subcategories, total_in_subcategories = _subcategories_with_counts(
+            self.category, products, self.filterset, self.request
+        )
         context['subcategories'] = subcategories
         context['found_count'] = total_in_subcategories if subcategories else paginator.count
         
         # Данные для фильтров
         all_products = Product.for_site_catalog('retail').filter(
-            category__in=self.category.get_descendants(include_self=True),
+            category_id__in=category_tree().descendant_ids(self.category.id),
         )
         context['brands'] = get_brand_choices(self.category)
         context['price_range'] = all_products.aggregate(min_price=Min('price'), max_price=Max('price'))
@@ -172,10 +177,7 @@ class CatalogItemView(ListView):
     paginate_by = None
 
     def _visible_products_count_for_branch(self, category):
-        descendants = category.get_descendants(include_self=True)
-        return Product.for_site_catalog('retail').filter(
-            category__in=descendants,
-        ).count()
+        return category_count(category)
     
     def dispatch(self, request, *args, **kwargs):
         """Определяем, что это - категория или товар."""
@@ -183,46 +185,36 @@ class CatalogItemView(ListView):
         slug = kwargs.get('slug', '')
         
         if category_path and slug:
-            category_slugs = [s for s in category_path.split('/') if s]
-            parent_category = None
+            tree = category_tree()
+            # Родительская категория — по снимку дерева, без запроса на сегмент пути
+            parent_category = tree.resolve_path(category_path)
             
-            # Пытаемся найти родительскую категорию
-            try:
-                for cat_slug in category_slugs:
-                    if parent_category:
-                        parent_category = Category.objects.get(slug=cat_slug, parent=parent_category, is_active=True)
-                    else:
-                        parent_category = Category.objects.get(slug=cat_slug, parent=None, is_active=True)
+            # Если нашли родительскую категорию, проверяем, не является ли slug тоже категорией
+            if parent_category:
+                subcategory = tree.resolve_path(f'{category_path}/{slug}')
+                if subcategory:
+                    # Если это категория, обрабатываем как категорию
+                    self.is_category = True
+                    self.category = subcategory
+                    return super().dispatch(request, *args, **kwargs)
                 
-                # Если нашли родительскую категорию, проверяем, не является ли slug тоже категорией
-                if parent_category:
-                    try:
-                        subcategory = Category.objects.get(slug=slug, parent=parent_category, is_active=True)
-                        # Если это категория, обрабатываем как категорию
-                        self.is_category = True
-                        self.category = subcategory
-                        return super().dispatch(request, *args, **kwargs)
-                    except Category.DoesNotExist:
-                        # Это не категория, проверяем, является ли это товаром
-                        descendants = parent_category.get_descendants(include_self=True)
-                        product = Product.for_site_catalog('retail').filter(
-                            slug=slug,
-                            category__in=descendants,
-                        ).first()
-                        
-                        if product:
-                            # Это товар - используем ProductView напрямую
-                            product_view = ProductView()
-                            product_view.request = request
-                            product_view.args = args
-                            product_view.kwargs = kwargs
-                            return product_view.dispatch(request, *args, **kwargs)
-                        else:
-                            # Ни категория, ни товар - 404
-                            from django.http import Http404
-                            raise Http404("Не найдено")
-            except Category.DoesNotExist:
-                pass
+                # Это не категория, проверяем, является ли это товаром
+                product = Product.for_site_catalog('retail').filter(
+                    slug=slug,
+                    category_id__in=tree.descendant_ids(parent_category.id),
+                ).first()
+                
+                if product:
+                    # Это товар - используем ProductView напрямую
+                    product_view = ProductView()
+                    product_view.request = request
+                    product_view.args = args
+                    product_view.kwargs = kwargs
+                    return product_view.dispatch(request, *args, **kwargs)
+                else:
+                    # Ни категория, ни товар - 404
+                    from django.http import Http404
+                    raise Http404("Не найдено")
         
         # Если не определили, пробуем как товар
         product_view = ProductView()
@@ -235,14 +227,13 @@ class CatalogItemView(ListView):
         # Если это категория, используем логику CategoryView
         if hasattr(self, 'is_category') and self.is_category:
             category = self.category
-            descendants = category.get_descendants(include_self=True)
             # Для категорий с подкатегориями показываем только товары из дочерних веток.
             # Это выравнивает "Найдено" с суммой по подкатегориям.
-            if category.children.filter(is_active=True).exists():
-                descendants = descendants.exclude(id=category.id)
+            has_active_children = category.children.filter(is_active=True).exists()
+            descendants = category_tree().descendant_ids(category.id, include_self=not has_active_children)
             queryset = Product.for_site_catalog('retail').filter(
-                category__in=descendants,
-            ).select_related('category').prefetch_related('images')
+                category_id__in=descendants,
+            ).select_related('category', 'main_image')
             
             # Применяем фильтры
             self.filterset = ProductFilter(self.request.GET, queryset=queryset)
@@ -256,7 +247,7 @@ class CatalogItemView(ListView):
         if hasattr(self, 'is_category') and self.is_category:
             context = super().get_context_data(**kwargs)
             context['category'] = self.category
-            context['breadcrumbs'] = self.category.get_ancestors(include_self=True)
+            context['breadcrumbs'] = category_tree().ancestors(self.category.id, include_self=True)
             # Пагинация
             products = self.get_queryset()
             paginator = Paginator(products, getattr(settings, 'PRODUCTS_PER_PAGE', 24))
@@ -273,22 +264,15 @@ class CatalogItemView(ListView):
 
             # Показываем только активные дочерние подкатегории с товарами (>0).
             # "Найдено" считаем строго как сумму отображаемых подкатегорий.
-            subcategories = []
-            total_in_subcategories = 0
-            subcategories_qs = self.category.children.filter(is_active=True).order_by('name')
-            for sub in subcategories_qs:
-                sub_descendants = sub.get_descendants(include_self=True)
-                visible_count = products.filter(category__in=sub_descendants).count()
-                if visible_count > 0:
-                    sub.visible_product_count = visible_count
-                    subcategories.append(sub)
-                    total_in_subcategories += visible_count
+            subcategories, total_in_subcategories = _subcategories_with_counts(
+                self.category, products, self.filterset, self.request
+            )
             context['subcategories'] = subcategories
             context['found_count'] = total_in_subcategories if subcategories else paginator.count
             
             # Данные для фильтров
             all_products = Product.for_site_catalog('retail').filter(
-                category__in=self.category.get_descendants(include_self=True),
+                category_id__in=category_tree().descendant_ids(self.category.id),
             )
             context['brands'] = get_brand_choices(self.category)
             context['price_range'] = all_products.aggregate(min_price=Min('price'), max_price=Max('price'))
@@ -313,28 +297,12 @@ class ProductView(DetailView):
         
         # Проверяем, не является ли это категорией
         if category_path and slug:
-            category_slugs = [s for s in category_path.split('/') if s]
-            parent_category = None
-            
-            # Пытаемся найти родительскую категорию
-            try:
-                for cat_slug in category_slugs:
-                    if parent_category:
-                        parent_category = Category.objects.get(slug=cat_slug, parent=parent_category, is_active=True)
-                    else:
-                        parent_category = Category.objects.get(slug=cat_slug, parent=None, is_active=True)
-                
-                # Если нашли родительскую категорию, проверяем, не является ли slug тоже категорией
-                if parent_category:
-                    try:
-                        subcategory = Category.objects.get(slug=slug, parent=parent_category, is_active=True)
-                        # Если это категория, поднимаем 404, чтобы Django попробовал CategoryView
-                        from django.http import Http404
-                        raise Http404("Это категория, а не товар")
-                    except Category.DoesNotExist:
-                        pass
-            except Category.DoesNotExist:
-                pass
+            tree = category_tree()
+            # Если slug — активная подкатегория найденной категории, это не товар:
+            # поднимаем 404, чтобы Django попробовал CategoryView
+            if tree.resolve_path(category_path) and tree.resolve_path(f'{category_path}/{slug}'):
+                from django.http import Http404
+                raise Http404("Это категория, а не товар")
         
         return super().dispatch(request, *args, **kwargs)
     
@@ -348,27 +316,15 @@ class ProductView(DetailView):
         
         # Ищем товар
         if category_path:
-            # Пытаемся найти категорию для товара
-            category_slugs = category_path.split('/')
-            parent_category = None
-            for cat_slug in category_slugs:
-                if parent_category:
-                    try:
-                        parent_category = Category.objects.get(slug=cat_slug, parent=parent_category, is_active=True)
-                    except Category.DoesNotExist:
-                        parent_category = None
-                        break
-                else:
-                    try:
-                        parent_category = Category.objects.get(slug=cat_slug, parent=None, is_active=True)
-                    except Category.DoesNotExist:
-                        parent_category = None
-                        break
+            # Пытаемся найти категорию для товара (по снимку дерева категорий)
+            tree = category_tree()
+            parent_category = tree.resolve_path(category_path)
             
             if parent_category:
                 # Ищем товар в этой категории или её потомках
-                descendants = parent_category.get_descendants(include_self=True)
-                obj = get_object_or_404(queryset, slug=slug, category__in=descendants)
+                obj = get_object_or_404(
+                    queryset, slug=slug, category_id__in=tree.descendant_ids(parent_category.id)
+                )
             else:
                 obj = get_object_or_404(queryset, slug=slug)
         else:
@@ -384,7 +340,7 @@ class ProductView(DetailView):
     def get_queryset(self):
         # ВАЖНО: Фильтруем товары так же, как в каталоге - только активные с количеством > 0 и в наличии
         # Это гарантирует, что если товар показывается в каталоге, он будет доступен и на странице товара
-        return Product.for_site_catalog('retail').select_related('category').prefetch_related('images')
+        return Product.for_site_catalog('retail').select_related('category', 'main_image')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -393,7 +349,7 @@ class ProductView(DetailView):
             return format_models_multiline(v)
         
         if product.category:
-            context['breadcrumbs'] = product.category.get_ancestors(include_self=True)
+            context['breadcrumbs'] = category_tree().ancestors(product.category_id, include_self=True)
         
         # Похожие товары - подборка по автомобилю из применимости
         related_products = Product.objects.none()
@@ -454,7 +410,7 @@ class ProductView(DetailView):
                     ).exclude(
                         pk=product.pk,
                         applicability=''
-                    ).select_related('category').prefetch_related('images')[:300])
+                    ).select_related('category', 'main_image')[:300])
                     
                     # Точная проверка пересечения кодов моделей и применимости
                     matching_products = []
@@ -487,7 +443,7 @@ class ProductView(DetailView):
                         if product_ids:
                             related_products = Product.objects.filter(
                                 pk__in=product_ids
-                            ).exclude(pk=product.pk).select_related('category').prefetch_related('images')
+                            ).exclude(pk=product.pk).select_related('category', 'main_image')
         
         # Приоритет 2: Если не нашли по применимости, ищем товары того же бренда в той же категории
         if not related_products.exists() and product.brand and product.category:
@@ -495,7 +451,7 @@ class ProductView(DetailView):
             related_products = Product.for_site_catalog('retail').filter(
                 brand__iexact=brand_normalized,
                 category=product.category,
-            ).exclude(pk=product.pk).select_related('category').prefetch_related('images')[:12]
+            ).exclude(pk=product.pk).select_related('category', 'main_image')[:12]
         
         # Приоритет 3: Если не нашли, ищем товары того же бренда в дочерних категориях
         if not related_products.exists() and product.brand and product.category:
@@ -504,13 +460,13 @@ class ProductView(DetailView):
             related_products = Product.for_site_catalog('retail').filter(
                 brand__iexact=brand_normalized,
                 category__in=descendants,
-            ).exclude(pk=product.pk).select_related('category').prefetch_related('images')[:12]
+            ).exclude(pk=product.pk).select_related('category', 'main_image')[:12]
         
         # Приоритет 4: Если не нашли, берем из той же категории (только если нет бренда)
         if not related_products.exists() and product.category and not product.brand:
             related_products = Product.for_site_catalog('retail').filter(
                 category=product.category,
-            ).exclude(pk=product.pk).select_related('category').prefetch_related('images')[:12]
+            ).exclude(pk=product.pk).select_related('category', 'main_image')[:12]
         
         context['related_products'] = related_products[:6]  # Показываем максимум 6
         context['images'] = product.images.all()
@@ -932,7 +888,7 @@ def filter_products_ajax(request):
     
     # Применяем фильтры
     filterset = ProductFilter(request.GET, queryset=queryset)
-    products = filterset.qs.select_related('category').prefetch_related('images')
+    products = filterset.qs.select_related('category', 'main_image')
     
     # Пагинация
     paginator = Paginator(products, getattr(settings, 'PRODUCTS_PER_PAGE', 24))
@@ -975,7 +931,7 @@ def search_products(request):
     
     if query:
         products = apply_product_search(Product.for_site_catalog('retail'), query)
-        products = products.select_related('category').prefetch_related('images').distinct()
+        products = products.select_related('category', 'main_image').distinct()
     else:
         products = Product.objects.none()
     
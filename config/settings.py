@@ -169,6 +169,9 @@ IMPORT_EXPORT_USE_TRANSACTIONS = True
 # Pagination
 PRODUCTS_PER_PAGE = 24
 
+# Снимок дерева категорий в памяти процесса (catalog.category_tree)
+CATEGORY_TREE_RECHECK_SECONDS = 10  # Сек. между проверками таблицы категорий в БД (изменения из других процессов)
+
 # Static files versioning (обновляйте при изменении CSS/JS)
 STATIC_VERSION = '2.7'
 
@@ -179,6 +182,19 @@ ONE_C_API_KEY = '1XV8XYzbGBNVsMKhV8jYZ6823o9Aw7JZjpuvSYQiAhdhsS2V6M2tyBCUAGvtwHZ
 ONE_C_EXCHANGE_DIR = os.path.join(MEDIA_ROOT, '1c_exchange')  # Директория для временного хранения файлов обмена
 ONE_C_FILE_LIMIT = 104857600  # Максимальный размер файла в байтах (100 MB)
 ONE_C_SUPPORT_ZIP = True  # Поддержка ZIP сжатия
+ONE_C_UPLOAD_CHUNK_SIZE = 64 * 1024  # Размер куска при потоковой записи загружаемых файлов на диск
+ONE_C_OFFERS_BATCH_SIZE = 400  # Предложений offers.xml на одну пачку записи в БД
+ONE_C_ASYNC_EXCHANGE = False  # True — файлы обмена обрабатывает воркер run_exchange_jobs (нужен запущенный воркер или cron с --once), а не HTTP-запрос 1С
+ONE_C_JOB_CONFIRM_TIMEOUT = 300  # Сек.: файл без mode=import считается загруженным и берется в обработку
+ONE_C_JOB_STALE_SECONDS = 600  # Сек. без прогресса, после которых задание упавшего воркера перезапускается
+ONE_C_PROFILE_MEMORY = False  # Пик памяти по фазам обмена в SyncLog (tracemalloc, замедляет обмен в несколько раз)
+ONE_C_PARSE_WORKERS = 0  # Процессов разбора файлов пакета обмена: 0 — по числу ядер, 1 — последовательно
+ONE_C_SQLITE_SYNCHRONOUS = 'NORMAL'  # PRAGMA synchronous SQLite на время импорта (база в режиме WAL)
+ONE_C_SQLITE_BUSY_TIMEOUT = 60000  # Мс, которые SQLite сама ждет блокировку при импорте (вместо повторов)
+ONE_C_IMPORT_TRANSACTION_SIZE = 2000  # Строк товаров на одну транзакцию импорта
+ONE_C_IMPORT_LOCK_FILE = os.path.join(ONE_C_EXCHANGE_DIR, '.import.lock')  # Блокировка: одновременно идет только один импорт
+ONE_C_KEYWORDS_FINGERPRINT_FILE = os.path.join(ONE_C_EXCHANGE_DIR, '.keywords.fingerprint')  # Отпечаток keywords категорий последней синхронизации подкатегорий
+ONE_C_STOCK_UPDATE_BATCH_SIZE = 500  # Строк на один UPDATE быстрого обновления остатков и цен (/api/1c/stock/, mode=stock)
 
 # CommerceML: скрывать ли товары, которые НЕ пришли в текущем exchange.
 # Если 1С присылает полный каталог — включайте, чтобы удаление в 1С отражалось на сайте.
@@ -18,7 +18,7 @@ class HomeView(TemplateView):
             is_active=True, 
             is_featured=True,
             quantity__gt=0  # Только товары с остатком
-        ).select_related('category').prefetch_related('images')[:8]
+        ).select_related('category', 'main_image')[:8]
         from django.db.models import Count, Q
         from django.db import transaction
         
@@ -28,10 +28,13 @@ class HomeView(TemplateView):
             is_active=True
         ).order_by('name')[:6]
         
-        # Для главной используем единый счетчик модели Category.product_count,
-        # чтобы не было расхождений между страницами.
+        # Для главной используем те же счетчики, что и Category.product_count
+        # (CategoryProductCount), — для всех категорий одним запросом.
+        from catalog.category_counts import category_counts
+        categories = list(categories)
+        counts = category_counts(categories)
         for category in categories:
-            count = category.product_count
+            count = counts[category.pk].retail_total if category.pk in counts else 0
             category.home_product_count = count
             category._product_count = count
         
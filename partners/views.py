@@ -19,6 +19,7 @@ from django.utils.encoding import force_bytes
 from django.utils.http import urlsafe_base64_encode
 
 from catalog.models import Category, Product
+from catalog.category_counts import category_counts
 from catalog.services import (
     build_farpost_compact_name,
     format_models_multiline,
@@ -180,7 +181,7 @@ class WholesaleView(TemplateView):
         
         # Несколько товаров для превью — сначала в наличии
         context['preview_products'] = _order_wholesale_in_stock_first(
-            Product.for_site_catalog('wholesale').select_related('category').prefetch_related('images'),
+            Product.for_site_catalog('wholesale').select_related('category', 'main_image', 'retail_counterpart'),
             'name',
         )[:6]
         
@@ -428,7 +429,7 @@ class PartnerProductView(PartnerRequiredMixin, DetailView):
     
     def get_queryset(self):
         # ТОЛЬКО товары из партнёрского каталога с количеством > 0!
-        return Product.for_site_catalog('wholesale').select_related('category').prefetch_related('images')
+        return Product.for_site_catalog('wholesale').select_related('category', 'main_image', 'retail_counterpart')
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -580,7 +581,7 @@ class PartnerProductView(PartnerRequiredMixin, DetailView):
                         query,
                         is_active=True,
                         catalog_type='wholesale'
-                    ).exclude(pk=product.pk).select_related('category').prefetch_related('images')[:4])
+                    ).exclude(pk=product.pk).select_related('category', 'main_image')[:4])
         
         # Приоритет 2: Та же категория + та же применимость
         if len(similar_products) < 4 and product.category and product.applicability:
@@ -597,7 +598,7 @@ class PartnerProductView(PartnerRequiredMixin, DetailView):
                     category=product.category,
                     is_active=True,
                     catalog_type='wholesale'
-                ).exclude(pk=product.pk).exclude(pk__in=existing_ids).select_related('category').prefetch_related('images')[:4 - len(similar_products)]
+                ).exclude(pk=product.pk).exclude(pk__in=existing_ids).select_related('category', 'main_image')[:4 - len(similar_products)]
                 similar_products.extend(list(more_products))
         
         # Приоритет 3: Та же категория + тот же бренд
@@ -608,7 +609,7 @@ class PartnerProductView(PartnerRequiredMixin, DetailView):
                 brand__iexact=product.brand.strip(),
                 is_active=True,
                 catalog_type='wholesale'
-            ).exclude(pk=product.pk).exclude(pk__in=existing_ids).select_related('category').prefetch_related('images')[:4 - len(similar_products)]
+            ).exclude(pk=product.pk).exclude(pk__in=existing_ids).select_related('category', 'main_image')[:4 - len(similar_products)]
             similar_products.extend(list(more_products))
         
         # Приоритет 4: Просто та же категория
@@ -618,7 +619,7 @@ class PartnerProductView(PartnerRequiredMixin, DetailView):
                 category=product.category,
                 is_active=True,
                 catalog_type='wholesale'
-            ).exclude(pk=product.pk).exclude(pk__in=existing_ids).select_related('category').prefetch_related('images')[:4 - len(similar_products)]
+            ).exclude(pk=product.pk).exclude(pk__in=existing_ids).select_related('category', 'main_image')[:4 - len(similar_products)]
             similar_products.extend(list(more_products))
         
         context['similar_products'] = similar_products[:4]
@@ -679,7 +680,7 @@ class PublicPartnerCatalogView(ListView):
     
     def get_queryset(self):
         # ТОЛЬКО товары из партнёрского каталога с остатком!
-        queryset = Product.for_site_catalog('wholesale').select_related('category').prefetch_related('images')
+        queryset = Product.for_site_catalog('wholesale').select_related('category', 'main_image', 'retail_counterpart')
         
         # Фильтр по категории
         category_slug = self.kwargs.get('category_slug')
@@ -729,19 +730,17 @@ class PublicPartnerCatalogView(ListView):
         
         # Для каждой категории проверяем наличие товаров в оптовом каталоге
         categories_with_products = []
+        root_categories = list(root_categories)
+        counts = category_counts(root_categories)
         for category in root_categories:
-            # Получаем активные подкатегории
-            category.active_children = category.children.filter(is_active=True).order_by('order', 'name')
+            # Активные подкатегории из prefetch_related('children')
+            category.active_children = sorted(
+                (child for child in category.children.all() if child.is_active),
+                key=lambda child: (child.order, child.name),
+            )
             
-            # Проверяем, есть ли товары в категории или её подкатегориях (только wholesale)
-            descendants = category.get_descendants(include_self=True)
-            descendant_ids = list(descendants.values_list('id', flat=True))
-            if descendant_ids:
-                product_count = Product.for_site_catalog('wholesale').filter(
-                    category_id__in=descendant_ids,
-                ).count()
-            else:
-                product_count = 0
+            # Товары опта в категории и её подкатегориях (CategoryProductCount)
+            product_count = counts[category.pk].wholesale_total if category.pk in counts else 0
             
             if product_count > 0:
                 category.wholesale_product_count = product_count
@@ -764,7 +763,7 @@ class PublicPartnerProductView(DetailView):
     
     def get_queryset(self):
         # ТОЛЬКО товары из партнёрского каталога!
-        return Product.for_site_catalog('wholesale').select_related('category').prefetch_related('images')
+        return Product.for_site_catalog('wholesale').select_related('category', 'main_image', 'retail_counterpart')
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -917,7 +916,7 @@ class PartnerCatalogView(PartnerRequiredMixin, ListView):
     paginate_by = 24
     
     def get_queryset(self):
-        queryset = Product.for_site_catalog('wholesale').select_related('category').prefetch_related('images')
+        queryset = Product.for_site_catalog('wholesale').select_related('category', 'main_image', 'retail_counterpart')
         
         # Фильтр по категории
         category_slug = self.kwargs.get('category_slug')
@@ -980,36 +979,16 @@ class PartnerCatalogView(PartnerRequiredMixin, ListView):
         ).order_by('order', 'name').prefetch_related('children')
         
         categories_list = []
+        root_categories = list(root_categories)
+        # Счетчики опта по поддеревьям — одним запросом (CategoryProductCount)
+        counts = category_counts(root_categories)
         for category in root_categories:
-            # Получаем активные подкатегории
-            category.active_children = category.children.filter(is_active=True).order_by('order', 'name')
-            
-            # Пытаемся посчитать товары в оптовом каталоге (для отображения счетчика)
-            product_count = 0
-            try:
-                # Используем более простой способ - проверяем товары напрямую в категории и подкатегориях
-                from django.db.models import Count
-                
-                # Сначала проверяем товары в самой категории
-                direct_count = Product.for_site_catalog('wholesale').filter(
-                    category=category,
-                ).count()
-                
-                # Затем проверяем товары в подкатегориях
-                if category.active_children.exists():
-                    subcategory_ids = list(category.active_children.values_list('id', flat=True))
-                    if subcategory_ids:
-                        subcategory_count = Product.for_site_catalog('wholesale').filter(
-                            category_id__in=subcategory_ids,
-                        ).count()
-                        product_count = direct_count + subcategory_count
-                    else:
-                        product_count = direct_count
-                else:
-                    product_count = direct_count
-            except Exception as e:
-                # Если что-то пошло не так, просто ставим 0
-                product_count = 0
+            # Активные подкатегории из prefetch_related('children')
+            category.active_children = sorted(
+                (child for child in category.children.all() if child.is_active),
+                key=lambda child: (child.order, child.name),
+            )
+            product_count = counts[category.pk].wholesale_total if category.pk in counts else 0
             
             # Всегда добавляем категорию в список, даже если товаров нет
             category.wholesale_product_count = product_count